@@ -0,0 +1,264 @@
+"""
+VIREX API — асинхронные задачи обработки видео v3.4.0
+
+Заменяет блокирующий subprocess.run в обработчиках aiohttp:
+- FFmpeg запускается через общий run_ffmpeg (ffmpeg_utils)
+- Ограничение параллельных задач (семафор) и длины очереди
+- Прогресс из `-progress pipe:1` (для опроса и SSE)
+- Результат хранится API_JOB_RESULT_TTL секунд, затем удаляется
+"""
+
+import os
+import time
+import uuid
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Set
+
+
+class JobQueueFull(Exception):
+    """Очередь задач переполнена"""
+
+
+@dataclass
+class ApiJob:
+    """Задача обработки видео из API"""
+    job_id: str
+    user_id: int
+    template: str
+    input_path: str
+    output_path: str
+    cmd: List[str]
+    duration: float = 0.0               # Длительность входного видео (для прогресса)
+    priority: int = 0                   # PlanLimits.priority
+    threads: int = 0                    # v3.4.0: Потоки FFmpeg по cpu_policy (0 — без ограничения)
+    status: str = "queued"              # queued / running / done / error
+    progress: float = 0.0               # 0-100
+    error: str = ""
+    created_at: float = field(default_factory=time.time)
+    started_at: float = 0.0
+    finished_at: float = 0.0
+    on_success: Optional[Callable] = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ("done", "error")
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.job_id,
+            "status": self.status,
+            "progress": round(self.progress, 1),
+            "error": self.error or None,
+            "template": self.template,
+            "created_at": self.created_at,
+            "started_at": self.started_at or None,
+            "finished_at": self.finished_at or None,
+            "download_url": f"/api/jobs/{self.job_id}/download" if self.status == "done" else None,
+        }
+
+
+class ApiJobManager:
+    """Очередь и исполнитель задач FFmpeg для API сервера"""
+
+    def __init__(self, max_concurrent: int = 2, max_queued: int = 20,
+                 max_per_user: int = 2, timeout: int = 600,
+                 memory_limit_mb: int = 0, result_ttl: int = 3600,
+                 scheduler=None):
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.timeout = timeout
+        self.memory_limit_mb = memory_limit_mb
+        self.result_ttl = result_ttl
+        self.jobs: Dict[str, ApiJob] = {}
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        # Ссылки на запущенные _run — иначе задачу может собрать GC
+        self._inflight: Set[asyncio.Task] = set()
+        # v3.4.0: Общий планировщик (слоты делятся с ботом), None = только семафор
+        self.scheduler = scheduler
+
+    # ═════════════════════════════════════════════════════════════
+    # SUBMIT / QUERY
+    # ═════════════════════════════════════════════════════════════
+
+    def pending_count(self) -> int:
+        return sum(1 for j in self.jobs.values() if not j.finished)
+
+    def user_pending_count(self, user_id: int) -> int:
+        return sum(1 for j in self.jobs.values() if j.user_id == user_id and not j.finished)
+
+    def submit(self, user_id: int, template: str, input_path: str, output_path: str,
+               cmd: List[str], duration: float = 0.0, priority: int = 0,
+               threads: int = 0, on_success: Optional[Callable] = None) -> ApiJob:
+        """Поставить задачу в очередь. Бросает JobQueueFull при превышении лимитов"""
+        if self.pending_count() >= self.max_queued:
+            raise JobQueueFull("Очередь переполнена, попробуйте позже")
+        if self.user_pending_count(user_id) >= self.max_per_user:
+            raise JobQueueFull(f"Максимум {self.max_per_user} задач одновременно")
+
+        job = ApiJob(
+            job_id=uuid.uuid4().hex,
+            user_id=user_id,
+            template=template,
+            input_path=input_path,
+            output_path=output_path,
+            cmd=cmd,
+            duration=duration,
+            priority=priority,
+            threads=threads,
+            on_success=on_success,
+        )
+        self.jobs[job.job_id] = job
+        task = asyncio.create_task(self._run(job))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        print(f"[JOBS] Queued {job.job_id} user={user_id} template={template}")
+        return job
+
+    def get(self, job_id: str, user_id: int = None) -> Optional[ApiJob]:
+        """Получить задачу (только свою, если указан user_id)"""
+        job = self.jobs.get(job_id)
+        if job and user_id is not None and job.user_id != user_id:
+            return None
+        return job
+
+    # ═════════════════════════════════════════════════════════════
+    # EXECUTION
+    # ═════════════════════════════════════════════════════════════
+
+    def _limit_memory(self):
+        """preexec_fn: ограничение адресного пространства процесса FFmpeg"""
+        import resource
+        limit = self.memory_limit_mb * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+    @asynccontextmanager
+    async def _global_slot(self, job: ApiJob):
+        if self.scheduler is None:
+            yield
+            return
+        async with self.scheduler.slot("api", job.priority, job.user_id, weight=max(1, job.threads)):
+            yield
+
+    async def _run(self, job: ApiJob):
+        try:
+            async with self._semaphore, self._global_slot(job):
+                await self._execute(job)
+        except Exception as e:
+            # Ошибка до запуска FFmpeg (например, планировщик недоступен)
+            if not job.finished:
+                job.status = "error"
+                job.error = str(e)
+                job.finished_at = time.time()
+                if os.path.exists(job.input_path):
+                    os.remove(job.input_path)
+                job.done.set()
+
+    async def _execute(self, job: ApiJob):
+        job.status = "running"
+        job.started_at = time.time()
+
+        # v3.4.0: Общий запуск FFmpeg (хвост stderr, kill группы, замеры)
+        from ffmpeg_utils import run_ffmpeg, usage_sink, _thread_args
+        from metrics import JobMetrics, PLAN_BY_PRIORITY, get_metrics_registry
+
+        metrics = JobMetrics(template=job.template, quality="api",
+                             plan=PLAN_BY_PRIORITY.get(job.priority, "free"))
+        metrics.add("queue_wait", job.started_at - job.created_at)
+        sink_token = usage_sink.set(metrics)
+
+        # -progress pipe:1 сразу после пути к ffmpeg
+        cmd = [job.cmd[0], "-progress", "pipe:1", "-nostats"] + job.cmd[1:]
+        # Потоки — перед выходным файлом (последний аргумент)
+        cmd[-1:-1] = _thread_args(job.threads)
+        preexec_fn = None
+        if self.memory_limit_mb > 0 and os.name == "posix":
+            preexec_fn = self._limit_memory
+
+        try:
+            with metrics.stage("encode"):
+                result = await run_ffmpeg(
+                    cmd, label="api_job", timeout=self.timeout, tail_lines=20,
+                    on_stdout_line=lambda line: self._on_progress_line(job, line),
+                    preexec_fn=preexec_fn,
+                )
+
+            if result.timed_out:
+                job.status = "error"
+                job.error = "Превышено время обработки"
+            elif result.ok and os.path.exists(job.output_path):
+                job.status = "done"
+                job.progress = 100.0
+                metrics.output_size = os.path.getsize(job.output_path)
+                if job.on_success:
+                    try:
+                        job.on_success(job)
+                    except Exception as e:
+                        print(f"[JOBS] on_success error: {e}")
+            else:
+                job.status = "error"
+                job.error = "Ошибка обработки видео"
+                tail = result.stderr_tail.replace("\n", " | ")[-500:]
+                print(f"[JOBS] {job.job_id} ffmpeg rc={result.returncode}: {tail}")
+        except Exception as e:
+            job.status = "error"
+            job.error = str(e)
+            print(f"[JOBS] {job.job_id} exception: {e}")
+        finally:
+            usage_sink.reset(sink_token)
+            metrics.status = "ok" if job.status == "done" else "error"
+            get_metrics_registry().record_job(metrics, source="api")
+            job.finished_at = time.time()
+            if os.path.exists(job.input_path):
+                try:
+                    os.remove(job.input_path)
+                except OSError:
+                    pass
+            job.done.set()
+            print(f"[JOBS] {job.job_id} {job.status} in {job.finished_at - job.started_at:.1f}s")
+
+    @staticmethod
+    def _on_progress_line(job: ApiJob, line: str):
+        """Парсинг одной строки key=value из -progress pipe:1"""
+        line = line.strip()
+        if line.startswith("out_time_us=") or line.startswith("out_time_ms="):
+            # out_time_ms исторически тоже в микросекундах
+            try:
+                seconds = int(line.split("=", 1)[1]) / 1_000_000
+            except ValueError:
+                return
+            if job.duration > 0:
+                job.progress = min(99.0, seconds / job.duration * 100)
+        elif line == "progress=end":
+            job.progress = 99.0
+
+    # ═════════════════════════════════════════════════════════════
+    # CLEANUP
+    # ═════════════════════════════════════════════════════════════
+
+    def cleanup_expired(self) -> int:
+        """Удалить завершённые задачи старше result_ttl вместе с файлами"""
+        now = time.time()
+        expired = [
+            job_id for job_id, job in self.jobs.items()
+            if job.finished and now - job.finished_at > self.result_ttl
+        ]
+        for job_id in expired:
+            job = self.jobs.pop(job_id)
+            for path in (job.input_path, job.output_path):
+                try:
+                    if os.path.exists(path):
+                        os.remove(path)
+                except OSError:
+                    pass
+        return len(expired)
+
+    async def periodic_cleanup(self, interval: int = 300):
+        while True:
+            await asyncio.sleep(interval)
+            removed = self.cleanup_expired()
+            if removed:
+                print(f"[JOBS] Cleaned up {removed} expired jobs")
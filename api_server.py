@@ -21,7 +21,12 @@ import aiofiles
 from config import BOT_TOKEN
 from rate_limit import RateLimiter
 
+from api_jobs import ApiJobManager, JobQueueFull
+from scheduler import SchedulerClient
+
 # Инициализация rate limiter для доступа к данным пользователей
+# v3.4.0: журнал users_data.journal общий с ботом — append и компактация в
+# UserStore идут под межпроцессным flock (users_data.journal.lock)
 rate_limiter = RateLimiter()
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -34,6 +39,16 @@ MAX_FILE_SIZE = 500 * 1024 * 1024  # 500 MB - без ограничений
 TEMP_DIR = os.path.join(tempfile.gettempdir(), "virex_api")
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+# v3.4.0: Лимиты асинхронных задач обработки
+API_MAX_CONCURRENT_JOBS = int(os.getenv("API_MAX_CONCURRENT_JOBS", 2))
+API_MAX_QUEUED_JOBS = int(os.getenv("API_MAX_QUEUED_JOBS", 20))
+API_MAX_JOBS_PER_USER = int(os.getenv("API_MAX_JOBS_PER_USER", 2))
+API_JOB_TIMEOUT_SECONDS = int(os.getenv("API_JOB_TIMEOUT_SECONDS", 600))
+API_JOB_MEMORY_LIMIT_MB = int(os.getenv("API_JOB_MEMORY_LIMIT_MB", 0))  # 0 = без лимита
+API_JOB_RESULT_TTL = int(os.getenv("API_JOB_RESULT_TTL", 3600))
+# v3.4.0: Prometheus /metrics (задачи API + запуски FFmpeg этого процесса)
+API_METRICS_ENABLED = os.getenv("API_METRICS_ENABLED", "0") == "1"
+
 SESSIONS_FILE = "api_sessions.json"
 
 # Активные сессии (user_id -> session_token)
@@ -64,6 +79,17 @@ def save_sessions():
 # Загружаем сессии при старте
 load_sessions()
 
+job_manager = ApiJobManager(
+    max_concurrent=API_MAX_CONCURRENT_JOBS,
+    max_queued=API_MAX_QUEUED_JOBS,
+    max_per_user=API_MAX_JOBS_PER_USER,
+    timeout=API_JOB_TIMEOUT_SECONDS,
+    memory_limit_mb=API_JOB_MEMORY_LIMIT_MB,
+    result_ttl=API_JOB_RESULT_TTL,
+    # v3.4.0: Слоты FFmpeg из общего планировщика бота (IPC), иначе локально
+    scheduler=SchedulerClient("api"),
+)
+
 # ══════════════════════════════════════════════════════════════════════════════
 # АВТОРИЗАЦИЯ ЧЕРЕЗ TELEGRAM
 # ══════════════════════════════════════════════════════════════════════════════
@@ -498,20 +524,38 @@ async def get_templates(request):
     })
 
 
-@routes.post('/api/video/process')
-async def process_video_api(request):
-    """Обработка видео"""
+def get_authorized_user_id(request) -> Optional[int]:
+    """v3.4.0: user_id из заголовков, если сессия валидна"""
     user_id = request.headers.get('X-User-Id')
     token = request.headers.get('X-Auth-Token')
-    
     if not user_id or not token:
-        return web.json_response({'error': 'Unauthorized'}, status=401)
-    
-    if not verify_session(int(user_id), token):
-        return web.json_response({'error': 'Session expired'}, status=401)
-    
+        return None
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return None
+    if not verify_session(user_id, token):
+        return None
+    return user_id
+
+
+def _on_job_success(job):
+    """Обновляем статистику пользователя через rate_limiter"""
+    user = rate_limiter.get_user(job.user_id)
+    user.total_videos += 1
+    user.daily_videos += 1
+    rate_limiter.save_data(job.user_id)
+    output_size = os.path.getsize(job.output_path) if os.path.exists(job.output_path) else 0
+    print(f"[API] Output size: {output_size} bytes")
+
+
+async def submit_video_job(request, user_id: int):
+    """
+    v3.4.0: Принять multipart, проверить лимиты и поставить задачу в очередь.
+    Возвращает (job, None) или (None, error_response)
+    """
     # Проверяем подписку для некоторых шаблонов
-    subscription = get_user_subscription(int(user_id))
+    subscription = get_user_subscription(user_id)
     is_premium = subscription['is_premium']
     
     # Премиум шаблоны
@@ -521,114 +565,124 @@ async def process_video_api(request):
         'viral_120fps', 'viral_8k_120fps', 'avatar_style', 'aesthetic_hdr', 'movie_quality', 'ultra_viral'
     ]
     
-    try:
-        # Читаем multipart данные
-        reader = await request.multipart()
-        
-        video_data = None
-        template = 'tiktok'
-        text_overlay = None
-        
-        async for part in reader:
-            print(f"[API] Received part: name='{part.name}', filename='{part.filename}'")
-            if part.name == 'video':
-                # Сохраняем видео во временный файл
-                input_path = os.path.join(TEMP_DIR, f"input_{user_id}_{uuid.uuid4().hex}.mp4")
-                async with aiofiles.open(input_path, 'wb') as f:
-                    while True:
-                        chunk = await part.read_chunk()
-                        if not chunk:
-                            break
-                        await f.write(chunk)
-                video_data = input_path
-                
-            elif part.name == 'template':
-                raw_template = await part.read()
-                template = raw_template.decode().strip()
-                print(f"[API] Raw template bytes: {raw_template}")
-                print(f"[API] Parsed template: '{template}'")
-                
-            elif part.name == 'text':
-                text_overlay = (await part.read()).decode().strip()
-        
-        if not video_data:
-            return web.json_response({'error': 'No video provided'}, status=400)
-        
-        print(f"[API] Received video: {video_data}, size: {os.path.getsize(video_data)} bytes")
-        print(f"[API] Requested template: {template}")
-        
-        # Проверяем премиум шаблоны
-        if template in premium_templates and not is_premium:
-            os.remove(video_data)
-            return web.json_response({
-                'error': 'Этот шаблон доступен только для Premium пользователей'
-            }, status=403)
-        
-        # Проверяем размер файла
-        file_size = os.path.getsize(video_data)
-        max_size = subscription['max_file_size'] * 1024 * 1024
-        if file_size > max_size:
+    # Читаем multipart данные
+    reader = await request.multipart()
+    
+    video_data = None
+    template = 'tiktok'
+    text_overlay = None
+    
+    async for part in reader:
+        print(f"[API] Received part: name='{part.name}', filename='{part.filename}'")
+        if part.name == 'video':
+            # Сохраняем видео во временный файл
+            input_path = os.path.join(TEMP_DIR, f"input_{user_id}_{uuid.uuid4().hex}.mp4")
+            async with aiofiles.open(input_path, 'wb') as f:
+                while True:
+                    chunk = await part.read_chunk()
+                    if not chunk:
+                        break
+                    await f.write(chunk)
+            video_data = input_path
+            
+        elif part.name == 'template':
+            raw_template = await part.read()
+            template = raw_template.decode().strip()
+            print(f"[API] Parsed template: '{template}'")
+            
+        elif part.name == 'text':
+            text_overlay = (await part.read()).decode().strip()
+    
+    if not video_data:
+        return None, web.json_response({'error': 'No video provided'}, status=400)
+    
+    print(f"[API] Received video: {video_data}, size: {os.path.getsize(video_data)} bytes")
+    
+    # Проверяем премиум шаблоны
+    if template in premium_templates and not is_premium:
+        os.remove(video_data)
+        return None, web.json_response({
+            'error': 'Этот шаблон доступен только для Premium пользователей'
+        }, status=403)
+    
+    # Проверяем размер файла
+    file_size = os.path.getsize(video_data)
+    max_size = subscription['max_file_size'] * 1024 * 1024
+    if file_size > max_size:
+        os.remove(video_data)
+        return None, web.json_response({
+            'error': f'Файл слишком большой. Максимум: {subscription["max_file_size"]}MB'
+        }, status=400)
+    
+    # Проверяем дневной лимит для бесплатных
+    if not is_premium and subscription['daily_limit'] > 0:
+        if subscription['videos_today'] >= subscription['daily_limit']:
             os.remove(video_data)
-            return web.json_response({
-                'error': f'Файл слишком большой. Максимум: {subscription["max_file_size"]}MB'
-            }, status=400)
-        
-        # Проверяем дневной лимит для бесплатных
-        if not is_premium and subscription['daily_limit'] > 0:
-            if subscription['videos_today'] >= subscription['daily_limit']:
-                os.remove(video_data)
-                return web.json_response({
-                    'error': f'Достигнут дневной лимит ({subscription["daily_limit"]} видео). Оформите Premium для безлимита.'
-                }, status=429)
-        
-        # Генерируем путь для выходного файла
-        output_path = os.path.join(TEMP_DIR, f"output_{user_id}_{uuid.uuid4().hex}.mp4")
-        
-        # Строим FFmpeg команду в зависимости от шаблона
-        from config import FFMPEG_PATH
-        
-        cmd = build_ffmpeg_command(template, video_data, output_path, text_overlay)
-        
-        print(f"[API] Template: {template}")
-        print(f"[API] Input: {video_data}")
-        print(f"[API] Output: {output_path}")
-        print(f"[API] FFmpeg command: {' '.join(cmd[:10])}...")
-        
-        try:
-            import subprocess
-            result = subprocess.run(cmd, capture_output=True, timeout=600)
-            success = result.returncode == 0 and os.path.exists(output_path)
-            print(f"[API] FFmpeg return code: {result.returncode}")
-            print(f"[API] Output exists: {os.path.exists(output_path)}")
-            if not success:
-                print(f"[API] FFmpeg error: {result.stderr.decode()[:500]}")
-            else:
-                output_size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
-                print(f"[API] Output size: {output_size} bytes")
-        except Exception as e:
-            print(f"[API] FFmpeg exception: {e}")
-            success = False
+            return None, web.json_response({
+                'error': f'Достигнут дневной лимит ({subscription["daily_limit"]} видео). Оформите Premium для безлимита.'
+            }, status=429)
+    
+    # Генерируем путь для выходного файла
+    output_path = os.path.join(TEMP_DIR, f"output_{user_id}_{uuid.uuid4().hex}.mp4")
+    
+    # Строим FFmpeg команду в зависимости от шаблона
+    cmd = build_ffmpeg_command(template, video_data, output_path, text_overlay)
+    print(f"[API] Template: {template}, FFmpeg command: {' '.join(cmd[:10])}...")
+    
+    # Длительность для прогресса
+    from ffmpeg_utils import probe
+    media = await probe(video_data)
+    duration = media.duration if media else 0.0
+    # v3.4.0: Потоки FFmpeg по разрешению (столько же единиц списывает планировщик)
+    from cpu_policy import get_cpu_policy
+    threads = get_cpu_policy().threads_for(media.width, media.height) if media else 0
+    
+    try:
+        job = job_manager.submit(
+            user_id, template, video_data, output_path, cmd,
+            duration=duration, priority=rate_limiter.get_limits(user_id).priority,
+            threads=threads,
+            on_success=_on_job_success,
+        )
+    except JobQueueFull as e:
+        os.remove(video_data)
+        return None, web.json_response({'error': str(e)}, status=429)
+    
+    return job, None
+
+
+@routes.post('/api/video/process')
+async def process_video_api(request):
+    """
+    Обработка видео (синхронный ответ для старых клиентов).
+    v3.4.0: FFmpeg идёт через очередь задач — event loop не блокируется.
+    """
+    user_id = request.headers.get('X-User-Id')
+    token = request.headers.get('X-Auth-Token')
+    
+    if not user_id or not token:
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    
+    if not verify_session(int(user_id), token):
+        return web.json_response({'error': 'Session expired'}, status=401)
+    
+    try:
+        job, error_response = await submit_video_job(request, int(user_id))
+        if error_response:
+            return error_response
         
-        # Удаляем входной файл
-        if os.path.exists(video_data):
-            os.remove(video_data)
+        await job.done.wait()
         
-        if not success or not os.path.exists(output_path):
+        if job.status != "done" or not os.path.exists(job.output_path):
             return web.json_response({
-                'error': 'Ошибка обработки видео'
+                'error': job.error or 'Ошибка обработки видео'
             }, status=500)
         
-        # Обновляем статистику пользователя через rate_limiter
-        user = rate_limiter.get_user(int(user_id))
-        user.total_videos += 1
-        user.daily_videos += 1
-        rate_limiter.save_data()
-        
         # Возвращаем обработанное видео
         return web.FileResponse(
-            output_path,
+            job.output_path,
             headers={
-                'Content-Disposition': f'attachment; filename="virex_processed.mp4"'
+                'Content-Disposition': 'attachment; filename="virex_processed.mp4"'
             }
         )
         
@@ -639,6 +693,97 @@ async def process_video_api(request):
         }, status=500)
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: АСИНХРОННЫЕ ЗАДАЧИ (job id → прогресс → скачивание)
+# ══════════════════════════════════════════════════════════════════════════════
+
+@routes.post('/api/jobs')
+async def create_job_api(request):
+    """Поставить видео в очередь, сразу вернуть job_id"""
+    user_id = get_authorized_user_id(request)
+    if user_id is None:
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    
+    try:
+        job, error_response = await submit_video_job(request, user_id)
+        if error_response:
+            return error_response
+        return web.json_response(job.to_dict(), status=202)
+    except Exception as e:
+        print(f"[API] Error: {e}")
+        return web.json_response({'error': str(e)}, status=500)
+
+
+@routes.get('/api/jobs/{job_id}')
+async def job_status_api(request):
+    """Статус и прогресс задачи (polling)"""
+    user_id = get_authorized_user_id(request)
+    if user_id is None:
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    
+    job = job_manager.get(request.match_info['job_id'], user_id)
+    if not job:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    return web.json_response(job.to_dict())
+
+
+@routes.get('/api/jobs/{job_id}/events')
+async def job_events_api(request):
+    """Прогресс задачи через Server-Sent Events"""
+    user_id = get_authorized_user_id(request)
+    if user_id is None:
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    
+    job = job_manager.get(request.match_info['job_id'], user_id)
+    if not job:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    
+    response = web.StreamResponse(headers={
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    })
+    await response.prepare(request)
+    
+    last_sent = None
+    while True:
+        state = (job.status, round(job.progress, 1))
+        if state != last_sent:
+            await response.write(f"data: {json.dumps(job.to_dict())}\n\n".encode())
+            last_sent = state
+        if job.finished:
+            break
+        try:
+            await asyncio.wait_for(job.done.wait(), timeout=1.0)
+        except asyncio.TimeoutError:
+            pass
+    
+    await response.write_eof()
+    return response
+
+
+@routes.get('/api/jobs/{job_id}/download')
+async def job_download_api(request):
+    """Скачать результат задачи"""
+    user_id = get_authorized_user_id(request)
+    if user_id is None:
+        return web.json_response({'error': 'Unauthorized'}, status=401)
+    
+    job = job_manager.get(request.match_info['job_id'], user_id)
+    if not job:
+        return web.json_response({'error': 'Job not found'}, status=404)
+    if job.status != "done":
+        return web.json_response(job.to_dict(), status=409)
+    if not os.path.exists(job.output_path):
+        return web.json_response({'error': 'Result expired'}, status=410)
+    
+    return web.FileResponse(
+        job.output_path,
+        headers={
+            'Content-Disposition': 'attachment; filename="virex_processed.mp4"'
+        }
+    )
+
+
 def build_ffmpeg_command(template: str, input_path: str, output_path: str, text_overlay: str = None) -> list:
     """Строит FFmpeg команду в зависимости от шаблона"""
     from config import FFMPEG_PATH
@@ -1037,18 +1182,12 @@ async def video_info_api(request):
                             break
                         await f.write(chunk)
                 
-                # Получаем информацию через ffprobe
-                import subprocess
-                from config import FFPROBE_PATH
-                
-                cmd = [
-                    FFPROBE_PATH, '-v', 'quiet', '-print_format', 'json',
-                    '-show_format', '-show_streams', input_path
-                ]
+                # Получаем информацию через ffprobe (v3.4.0: async probe, без блокировки loop)
+                from ffmpeg_utils import probe
                 
                 try:
-                    result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-                    info = json.loads(result.stdout) if result.returncode == 0 else {}
+                    media = await probe(input_path)
+                    info = {'streams': media.streams, 'format': media.format} if media else {}
                 except Exception as e:
                     info = {'error': str(e)}
                 
@@ -1071,6 +1210,9 @@ async def start_api_server():
     """Запуск API сервера"""
     app = web.Application(client_max_size=MAX_FILE_SIZE)
     app.add_routes(routes)
+    if API_METRICS_ENABLED:
+        from metrics import metrics_handler
+        app.router.add_get('/metrics', metrics_handler)
     
     # CORS middleware
     async def cors_middleware(app, handler):
@@ -1095,6 +1237,9 @@ async def start_api_server():
     
     print(f"[API] Server started on http://{API_HOST}:{API_PORT}")
     
+    # v3.4.0: Очистка результатов задач по TTL
+    cleanup_task = asyncio.create_task(job_manager.periodic_cleanup())
+    
     # Ожидаем бесконечно (Ctrl+C для остановки)
     try:
         while True:
@@ -1102,6 +1247,7 @@ async def start_api_server():
     except KeyboardInterrupt:
         print("[API] Server stopping...")
     finally:
+        cleanup_task.cancel()
         await runner.cleanup()
         print("[API] Server stopped")
 
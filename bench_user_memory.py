@@ -0,0 +1,139 @@
+"""
+Virex — бенчмарк памяти UserState v3.4.0
+
+Сколько байт занимает один пользователь в RateLimiter.users (+ состояние UserStore)
+на синтетических пользователях: прежнее представление (dataclass с __dict__,
+списки у каждого, полный JSON в UserStore) против компактного (__slots__,
+интернированные строки, холодные коллекции в одном JSON-слоте, дайджесты).
+Компактный режим — настоящий RateLimiter, загруженный из временного
+users_data.json (вместе со вторичными индексами UserIndex).
+
+Запуск:
+    python bench_user_memory.py                  # 10k / 100k / 1M
+    python bench_user_memory.py 10000 50000      # свои размеры
+    python bench_user_memory.py --compact-only   # без прежнего представления
+
+Под tracemalloc 1M пользователей считаются долго (десятки минут на ядро).
+Пример (10k / 100k): 4356 / 4376 байт → 1740 / 1826 байт на пользователя
+(у компактного — вместе с индексами ip / username / plan / рейтингов).
+"""
+import gc
+import os
+import sys
+import json
+import random
+import tempfile
+import tracemalloc
+import dataclasses
+
+from rate_limit import RateLimiter, UserState, COLD_FIELDS
+
+DEFAULT_SIZES = (10_000, 100_000, 1_000_000)
+
+# Прежний UserState: те же поля, холодные коллекции — обычные поля со списками
+LegacyUserState = dataclasses.make_dataclass(
+    "LegacyUserState",
+    [(f.name, f.type, f) for f in dataclasses.fields(UserState) if f.name != "_cold"]
+    + [(name, factory, dataclasses.field(default_factory=factory))
+       for name, factory in COLD_FIELDS.items()],
+)
+
+
+def make_record(i: int, rng: random.Random) -> dict:
+    """Запись как из users_data.json: ~80% спящих, ~20% активных"""
+    active = rng.random() < 0.2
+    day = f"2025-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+    record = {
+        "plan": rng.choice(("free", "free", "free", "vip", "premium")),
+        "mode": rng.choice(("tiktok", "youtube")),
+        "quality": rng.choice(("low", "medium", "high")),
+        "language": rng.choice(("ru", "en")),
+        "username": f"user{i}" if rng.random() < 0.7 else "",
+        "first_seen": day,
+        "daily_date": day,
+        "week_start": day,
+        "period_start": day,
+        "total_videos": rng.randint(0, 500) if active else rng.randint(0, 3),
+        "points": rng.randint(0, 300) if active else 0,
+        "history": [], "favorites": [], "achievements": [], "reminders": [],
+        "weekly_stats": {}, "merge_videos": [], "scheduled_tasks": [],
+    }
+    if active:
+        record["history"] = [
+            {"type": "video", "time": 1700000000 + k, "mode": "tiktok", "size": rng.randint(1, 50) * 1024}
+            for k in range(rng.randint(1, 20))
+        ]
+        record["achievements"] = rng.sample(["first_video", "ten_videos", "streak_3", "referral", "night_owl"], 2)
+        record["weekly_stats"] = {day: rng.randint(1, 10)}
+    # Через JSON — строки получаются новыми объектами, как при загрузке с диска
+    return json.loads(json.dumps(record))
+
+
+def load_legacy(record: dict, uid: int):
+    user = LegacyUserState(user_id=uid)
+    for key, value in record.items():
+        if hasattr(user, key):
+            setattr(user, key, value)
+    return user, json.dumps(record, ensure_ascii=False, sort_keys=True)
+
+
+def measure_legacy(count: int) -> float:
+    """Байт на пользователя (users + persisted), по tracemalloc"""
+    rng = random.Random(42)
+    gc.collect()
+    tracemalloc.start()
+    users, persisted = {}, {}
+    base = tracemalloc.get_traced_memory()[0]
+    for uid in range(count):
+        # Запись живёт только в пределах итерации, как при загрузке
+        users[uid], persisted[str(uid)] = load_legacy(make_record(uid, rng), uid)
+    gc.collect()
+    used = tracemalloc.get_traced_memory()[0] - base
+    tracemalloc.stop()
+    del users, persisted
+    gc.collect()
+    return used / count
+
+
+def measure_compact(count: int) -> float:
+    """Байт на пользователя у RateLimiter, загруженного из снапшота, по tracemalloc"""
+    rng = random.Random(42)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "users_data.json"), 'w', encoding='utf-8') as f:
+            json.dump({str(uid): make_record(uid, rng) for uid in range(count)}, f, ensure_ascii=False)
+        # RateLimiter читает users_data.json / журнал из текущей директории
+        os.chdir(tmp)
+        try:
+            gc.collect()
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+            limiter = RateLimiter()
+            gc.collect()
+            used = tracemalloc.get_traced_memory()[0] - base
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+    del limiter
+    gc.collect()
+    return used / count
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith("--")]
+    sizes = [int(a) for a in args] or DEFAULT_SIZES
+    compact_only = "--compact-only" in sys.argv
+
+    print(f"{'users':>10} | {'legacy B/user':>14} | {'compact B/user':>14} | {'ratio':>6}")
+    print("-" * 56)
+    for count in sizes:
+        compact = measure_compact(count)
+        if compact_only:
+            print(f"{count:>10} | {'-':>14} | {compact:>14.0f} | {'-':>6}")
+            continue
+        legacy = measure_legacy(count)
+        print(f"{count:>10} | {legacy:>14.0f} | {compact:>14.0f} | {legacy / compact:>5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
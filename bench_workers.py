@@ -0,0 +1,107 @@
+"""
+Virex — бенчмарк пула воркеров v3.4.0
+
+Смесь синтетических клипов (testsrc2 + sine) 720p / 1080p / 4K через
+process_video под ProcessingScheduler:
+    legacy — 2 воркера (прежний MAX_CONCURRENT_TASKS), по слоту на задачу,
+             FFmpeg сам выбирает число потоков
+    policy — воркеры и бюджет потоков из cpu_policy, -threads по разрешению,
+             задача занимает в планировщике столько единиц, сколько потоков
+Для каждого режима: общее время, задач в минуту и среднее время задачи по
+разрешениям (у legacy оно включает конкуренцию за ядра с соседней задачей).
+
+Запуск:
+    python bench_workers.py              # по 2 клипа 720p/1080p/4K, 2 с
+    python bench_workers.py 3 4          # по 3 клипа, 4 с
+    VIREX_CPU_THREADS=4 python bench_workers.py
+
+Пример (2 × 3 разрешения × 2 с, 1 ядро): legacy 138.6 с, 2.6 задач/мин,
+4K 96.0 с на задачу; policy (1 поток, 1 воркер) 124.3 с, 2.9 задач/мин,
+4K 43.6 с.
+"""
+import sys
+import time
+import asyncio
+import tempfile
+from pathlib import Path
+
+from config import FFMPEG_PATH
+from cpu_policy import build_cpu_policy
+from ffmpeg_utils import process_video
+from scheduler import ProcessingScheduler
+
+RESOLUTIONS = {"720p": (1280, 720), "1080p": (1920, 1080), "4K": (3840, 2160)}
+QUALITY = "low"  # preset fast — иначе случайный slower/veryslow из TIKTOK_VIDEO
+LEGACY_WORKERS = 2
+
+
+async def make_clip(path: str, width: int, height: int, seconds: float):
+    cmd = [FFMPEG_PATH, "-y", "-v", "error",
+           "-f", "lavfi", "-i", f"testsrc2=s={width}x{height}:r=30:d={seconds}",
+           "-f", "lavfi", "-i", f"sine=f=440:r=44100:d={seconds}",
+           "-c:v", "libx264", "-preset", "ultrafast", "-c:a", "aac", "-pix_fmt", "yuv420p", path]
+    proc = await asyncio.create_subprocess_exec(*cmd)
+    await proc.wait()
+
+
+async def run_pool(jobs, work: Path, mode: str, workers: int, slots: int, threads_for):
+    scheduler = ProcessingScheduler(slots=slots)
+    queue: asyncio.Queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    durations = {name: [] for name in RESOLUTIONS}
+    failed = 0
+
+    async def worker():
+        nonlocal failed
+        while not queue.empty():
+            index, name, path = queue.get_nowait()
+            width, height = RESOLUTIONS[name]
+            threads = threads_for(width, height)
+            async with scheduler.slot("bot", weight=max(1, threads)):
+                started = time.perf_counter()
+                ok = await process_video(path, str(work / f"{mode}_{index}.mp4"), "tiktok",
+                                         QUALITY, False, "none", threads=threads)
+                durations[name].append(time.perf_counter() - started)
+                failed += not ok
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(workers)))
+    return time.perf_counter() - started, durations, failed
+
+
+async def main():
+    per_resolution = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2.0
+    policy = build_cpu_policy(enabled=True)
+    print(f"{per_resolution} × {len(RESOLUTIONS)} clips × {seconds:.0f} s, policy: {policy.describe()}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        work = Path(tmp)
+        jobs = []
+        # Вперемешку, как приходят в бота
+        for i in range(per_resolution):
+            for name, (width, height) in RESOLUTIONS.items():
+                path = str(work / f"src_{name}_{i}.mp4")
+                await make_clip(path, width, height, seconds)
+                jobs.append((len(jobs), name, path))
+
+        modes = (
+            ("legacy", LEGACY_WORKERS, LEGACY_WORKERS, lambda w, h: 0),
+            ("policy", policy.workers, policy.threads, policy.threads_for),
+        )
+        results = []
+        for mode, workers, slots, threads_for in modes:
+            results.append((mode, await run_pool(jobs, work, mode, workers, slots, threads_for)))
+
+    print(f"{'mode':>7} | {'time, s':>7} | {'jobs/min':>8} | " +
+          " | ".join(f"{name + ', s':>8}" for name in RESOLUTIONS) + " | failed")
+    print("-" * 70)
+    for mode, (elapsed, durations, failed) in results:
+        means = [sum(d) / len(d) if d else 0.0 for d in durations.values()]
+        print(f"{mode:>7} | {elapsed:>7.1f} | {len(jobs) / elapsed * 60:>8.1f} | " +
+              " | ".join(f"{m:>8.1f}" for m in means) + f" | {failed}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -10,6 +10,8 @@ import uuid
 from pathlib import Path
 from typing import Dict
 from datetime import datetime
+# v3.4.0: Первым из своих модулей — точка отсчёта времени импорта
+from startup import StartupOrchestrator, IMPORT_STARTED
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import (
     Message, CallbackQuery, FSInputFile,
@@ -25,11 +27,16 @@ from config import (
     BOT_TOKEN, Mode, DEFAULT_MODE,
     MAX_FILE_SIZE_MB, MAX_VIDEO_DURATION_SECONDS, ALLOWED_EXTENSIONS,
     TEXTS, BUTTONS, Quality, QUALITY_SETTINGS, SHORT_ID_TTL_SECONDS,
-    ADMIN_IDS, ADMIN_USERNAMES, PLAN_LIMITS, MAX_CONCURRENT_TASKS,
+    ADMIN_IDS, ADMIN_USERNAMES, PLAN_LIMITS,
     TEXTS_EN, BUTTONS_EN, BOT_VERSION,
     FFMPEG_PATH, FFPROBE_PATH
 )
 from rate_limit import rate_limiter
+from scheduler import start_scheduler_server
+from cpu_policy import get_cpu_policy
+from result_cache import get_result_cache
+from download_manager import get_download_manager
+from timed_tasks import get_timed_scheduler, parse_hhmm
 from ffmpeg_utils import (
     start_workers, add_to_queue, ProcessingTask,
     get_temp_dir, generate_unique_filename, cleanup_file,
@@ -86,6 +93,25 @@ def get_button(user_id: int, key: str) -> str:
     return buttons.get(key, BUTTONS.get(key, key))
 
 
+def make_progress_reporter(message: Message, user_id: int):
+    """ v3.4.0: Callback живого прогресса FFmpeg — редактирует статус-сообщение """
+    cancel_kb = InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_processing")]
+    ])
+    
+    async def report(tracker: ProgressTracker):
+        try:
+            await message.edit_text(
+                get_text(user_id, "processing_progress",
+                         percent=tracker.get_percent(), eta=tracker.get_eta()),
+                reply_markup=cancel_kb
+            )
+        except Exception:
+            pass  # message is not modified / сообщение удалено
+    
+    return report
+
+
 def _get_period_name(days: int) -> str:
     """ Получить название периода по количеству дней """
     if days == 1:
@@ -131,6 +157,8 @@ bot = Bot(
     session=session
 )
 dp = Dispatcher()
+# v3.4.0: Параллельные загрузки из Telegram с кэшем по file_unique_id
+download_manager = get_download_manager(bot)
 
 pending_files: dict = {}
 pending_detection: dict = {}  # v3.2.0: Пользователи, ожидающие видео для детекции Watermark-Trap
@@ -1545,7 +1573,7 @@ async def cmd_addadmin(message: Message):
     # Ставим флаг админа
     user_data = rate_limiter.get_user(target_id)
     user_data.is_admin = True
-    rate_limiter.save_data()
+    rate_limiter.save_data(target_id)
     
     # Автоматически даём Premium на 99 лет (36135 дней)
     rate_limiter.set_plan_with_expiry(target_id, "premium", 36135)
@@ -1701,7 +1729,7 @@ async def cmd_globalstats(message: Message):
         f"⬇️ Скачиваний: <b>{stats['total_downloads']}</b>\n"
         f"⭐ VIP: <b>{stats['vip_users']}</b>\n"
         f"👑 Premium: <b>{stats['premium_users']}</b>\n"
-        f"💾 Кэш видео: <b>{len(video_cache)}</b>"
+        f"💾 Кэш видео: <b>{len(get_result_cache())}</b>"
     )
     await message.answer(text)
 
@@ -2010,7 +2038,7 @@ async def cb_start_lang(callback: CallbackQuery):
         print(f"[LANG] set_referrer result: {result}")
     
     # Сохраняем данные
-    rate_limiter.save_data()
+    rate_limiter.save_data(user_id)
     
     # Показываем основной интерфейс
     mode = rate_limiter.get_mode(user_id)
@@ -2364,7 +2392,7 @@ async def cmd_queue(message: Message):
     
     text = get_text(user_id, "queue_status",
         queue_size=queue_size,
-        workers=MAX_CONCURRENT_TASKS,
+        workers=get_cpu_policy().workers,
         eta=eta
     )
     await message.answer(text)
@@ -3485,11 +3513,11 @@ async def cb_merge_now(callback: CallbackQuery):
     temp_files = []
     
     try:
-        for i, file_id in enumerate(queue):
-            file = await bot.get_file(file_id)
-            temp_path = str(temp_dir / f"merge_{user_id}_{i}_{uuid.uuid4().hex[:8]}.mp4")
-            await bot.download_file(file.file_path, temp_path)
-            temp_files.append(temp_path)
+        # v3.4.0: Все клипы параллельно (и из кэша, если уже скачивались)
+        temp_files = await download_manager.fetch_many(
+            queue, user_id,
+            lambda i: str(temp_dir / f"merge_{user_id}_{i}_{uuid.uuid4().hex[:8]}.mp4")
+        )
         
         # Склеиваем
         output_path = str(temp_dir / f"merged_{user_id}_{uuid.uuid4().hex[:8]}.mp4")
@@ -3832,6 +3860,21 @@ async def cb_volume_select(callback: CallbackQuery):
 async def cmd_schedule(message: Message):
     """ /schedule — запланировать задачу """
     user_id = message.from_user.id
+    args = message.text.split()
+    
+    # v3.4.0: /schedule HH:MM process — ответом на видео, выполнит TimedTaskScheduler
+    if len(args) >= 3:
+        from config import SCHEDULE_ACTIONS
+        time_str, action = args[1], args[2].lower()
+        reply = message.reply_to_message
+        video = reply.video if reply else None
+        if parse_hhmm(time_str) is None or action not in SCHEDULE_ACTIONS or video is None:
+            await message.answer(get_text(user_id, "schedule_need_video"))
+            return
+        params = {"file_id": video.file_id, "file_unique_id": video.file_unique_id}
+        rate_limiter.add_scheduled_task(user_id, time_str, action, params)
+        await message.answer(get_text(user_id, "schedule_added", time=time_str))
+        return
     
     tasks = rate_limiter.get_scheduled_tasks(user_id)
     
@@ -3858,6 +3901,76 @@ async def cb_schedule_clear(callback: CallbackQuery):
     await callback.answer("✅ Все задачи удалены", show_alert=True)
 
 
+async def send_timed_reminder(user_id: int, reminder: dict):
+    """ v3.4.0: Напоминание о публикации (темп задаёт TimedTaskScheduler) """
+    await bot.send_message(user_id, get_text(user_id, "reminder_notify", platform=reminder["platform"]))
+
+
+async def run_timed_task(user_id: int, task: dict):
+    """ v3.4.0: Отложенная задача /schedule — скачать видео и поставить в очередь FFmpeg """
+    params = task.get("params") or {}
+    file_id = params.get("file_id")
+    if task.get("action") != "process" or not file_id:
+        return
+    sender = get_timed_scheduler().sender
+    
+    # Заполненность очереди и ожидаемое ожидание решает add_to_queue (admission)
+    can_process, reason = rate_limiter.check_rate_limit(user_id)
+    if not can_process:
+        await sender.wait()
+        await bot.send_message(user_id, get_text(user_id, "rate_limit"))
+        return
+    
+    input_path = str(get_temp_dir() / generate_unique_filename())
+    download_started = time_module.perf_counter()
+    try:
+        await download_manager.fetch(file_id, input_path, user_id)
+    except Exception as e:
+        logger.error(f"[TIMED] Download error for {user_id}: {type(e).__name__}: {e}")
+        cleanup_file(input_path)
+        await sender.wait()
+        await bot.send_message(user_id, get_text(user_id, "error_download"))
+        return
+    
+    rate_limiter.register_request(user_id, params.get("file_unique_id", file_id))
+    
+    async def on_complete(success: bool, output_path: str):
+        await sender.wait()
+        if not (success and output_path):
+            await bot.send_message(user_id, get_text(user_id, "error"))
+            return
+        try:
+            rate_limiter.increment_video_count(user_id)
+            await bot.send_video(
+                chat_id=user_id,
+                video=FSInputFile(output_path),
+                caption=get_text(user_id, "schedule_executed")
+            )
+        except Exception as e:
+            logger.error(f"[TIMED] Send error for {user_id}: {e}")
+        finally:
+            cleanup_file(output_path)
+    
+    processing_task = ProcessingTask(
+        user_id=user_id,
+        input_path=input_path,
+        mode=rate_limiter.get_mode(user_id),
+        callback=on_complete,
+        quality=rate_limiter.get_quality(user_id),
+        text_overlay=rate_limiter.get_text_overlay(user_id),
+        priority=rate_limiter.get_limits(user_id).priority,
+        template=rate_limiter.get_template(user_id) or "none",
+        enable_watermark_trap=rate_limiter.can_use_watermark_trap(user_id),
+        plan=rate_limiter.get_plan(user_id),
+    )
+    processing_task.metrics.add("download", time_module.perf_counter() - download_started)
+    queued, _ = await add_to_queue(processing_task)
+    if not queued:
+        cleanup_file(input_path)
+        await sender.wait()
+        await bot.send_message(user_id, get_text(user_id, "queue_full"))
+
+
 @dp.message(Command("autoprocess"))
 async def cmd_autoprocess(message: Message):
     """ /autoprocess — авто-обработка по шаблону """
@@ -3930,6 +4043,7 @@ async def cmd_admin(message: Message):
         ],
         [
             InlineKeyboardButton(text="📝 Команды", callback_data="admin_commands"),
+            InlineKeyboardButton(text="⚡ Производительность", callback_data="admin_perf"),
         ],
     ])
     
@@ -4127,7 +4241,7 @@ async def cb_admin_queue(callback: CallbackQuery):
     text = (
         f"📥 <b>Очередь обработки</b>\n\n"
         f"Задач в очереди: {queue_size}\n"
-        f"Воркеров: {MAX_CONCURRENT_TASKS}\n\n"
+        f"Воркеров: {get_cpu_policy().workers}\n\n"
         f"ℹ️ VIP и Premium пользователи имеют приоритет в очереди."
     )
     
@@ -4197,6 +4311,7 @@ async def cb_admin_back(callback: CallbackQuery):
         ],
         [
             InlineKeyboardButton(text="📝 Команды", callback_data="admin_commands"),
+            InlineKeyboardButton(text="⚡ Производительность", callback_data="admin_perf"),
         ],
     ])
     
@@ -4321,6 +4436,7 @@ async def cb_admin_health(callback: CallbackQuery):
     
     # Очередь
     queue_size = get_queue_size()
+    cpu_policy = get_cpu_policy()
     
     # Temp папка
     from ffmpeg_utils import get_temp_dir_size
@@ -4335,8 +4451,9 @@ async def cb_admin_health(callback: CallbackQuery):
         f"💾 Память: {memory_mb:.1f} MB\n"
         f"📁 Temp: {temp_size_mb} MB ({temp_files} файлов)\n\n"
         f"<b>Очередь:</b>\n"
-        f"📥 Задач: {queue_size}/{MAX_CONCURRENT_TASKS * 10}\n"
-        f"👷 Воркеров: {MAX_CONCURRENT_TASKS}"
+        f"📥 Задач: {queue_size}/{cpu_policy.workers * 10}\n"
+        f"👷 Воркеров: {cpu_policy.workers}\n"
+        f"🧮 CPU: {cpu_policy.describe()}"
     )
     
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
@@ -4362,6 +4479,81 @@ async def cb_admin_cleanup_temp(callback: CallbackQuery):
     await cb_admin_health(callback)
 
 
+PERF_DIMENSIONS = {"template": "шаблону", "quality": "качеству", "plan": "плану"}
+
+
+def format_perf_report(dimension: str) -> str:
+    """ v3.4.0: Стадии задач и p50/p95/p99 из MetricsRegistry """
+    from metrics import get_metrics_registry
+    from ffmpeg_utils import get_runner_stats
+    
+    registry = get_metrics_registry()
+    jobs = registry.get_stats()["jobs"].get("bot", {})
+    
+    def fmt(summary: dict, scale: float = 1.0) -> str:
+        return " / ".join(f"{summary[f'p{p}'] / scale:.1f}" for p in (50, 95, 99))
+    
+    lines = [
+        "⚡ <b>Производительность</b>",
+        f"Задач: ✅ {jobs.get('ok', 0)} · ❌ {jobs.get('error', 0)} · 🚫 {jobs.get('cancelled', 0)}",
+        f"Воркеров: {get_cpu_policy().workers}",
+        "",
+        "<b>Стадии</b> (p50 / p95 / p99, с):",
+    ]
+    stage_lines = [f"{stage:<11}{fmt(summary)}  n={summary['count']}"
+                   for stage, summary in registry.stage_summary().items() if summary["count"]]
+    lines.append(f"<pre>{chr(10).join(stage_lines) or 'нет данных'}</pre>")
+    
+    lines.append(f"<b>По {PERF_DIMENSIONS[dimension]}</b> (всего, с · CPU, с · размер, MB):")
+    rows = []
+    cpu = registry.breakdown(dimension, "virex_job_cpu_seconds")
+    size = registry.breakdown(dimension, "virex_job_output_bytes")
+    for value, summary in registry.breakdown(dimension).items():
+        row = f"{value or '—'}: {fmt(summary)}  n={summary['count']}"
+        if value in cpu:
+            row += f"\n  cpu {fmt(cpu[value])}"
+        if value in size:
+            row += f"\n  size {fmt(size[value], 1024 * 1024)}"
+        rows.append(row)
+    lines.append(f"<pre>{chr(10).join(rows) or 'нет данных'}</pre>")
+    
+    runner = sorted(get_runner_stats().items(), key=lambda item: -item[1]["runs"])[:6]
+    if runner:
+        lines.append("<b>FFmpeg</b> (запусков · wall / CPU, с · пик RSS, MB):")
+        runner_lines = [f"{label}: {stats['runs']} · {stats['avg_wall']:.1f} / {stats['avg_cpu']:.1f}"
+                        f" · {stats['peak_rss_mb']:.0f}" for label, stats in runner]
+        lines.append(f"<pre>{chr(10).join(runner_lines)}</pre>")
+    return "\n".join(lines)
+
+
+@dp.callback_query(F.data.startswith("admin_perf"))
+async def cb_admin_perf(callback: CallbackQuery):
+    """ v3.4.0: Метрики задач: стадии, перцентили по шаблону / качеству / плану """
+    if not is_admin(callback.from_user):
+        await callback.answer("⛔ Нет доступа", show_alert=True)
+        return
+    
+    dimension = callback.data.partition(":")[2] or "template"
+    if dimension not in PERF_DIMENSIONS:
+        dimension = "template"
+    
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text=("• " if key == dimension else "") + title.capitalize(),
+                                 callback_data=f"admin_perf:{key}")
+            for key, title in (("template", "шаблон"), ("quality", "качество"), ("plan", "план"))
+        ],
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data=f"admin_perf:{dimension}")],
+        [InlineKeyboardButton(text="« Назад", callback_data="admin_back")]
+    ])
+    
+    try:
+        await callback.message.edit_text(format_perf_report(dimension), reply_markup=keyboard)
+    except Exception:
+        pass  # message is not modified
+    await callback.answer()
+
+
 # ===== Быстрый выбор качества =====
 @dp.callback_query(F.data.startswith("quick_q:"))
 async def cb_quick_quality(callback: CallbackQuery):
@@ -4912,6 +5104,7 @@ async def cb_open_admin(callback: CallbackQuery):
         ],
         [
             InlineKeyboardButton(text="📝 Команды", callback_data="admin_commands"),
+            InlineKeyboardButton(text="⚡ Производительность", callback_data="admin_perf"),
         ],
     ])
     
@@ -5691,23 +5884,13 @@ async def cb_process(callback: CallbackQuery):
     await callback.answer()
     
     try:
-        logger.info(f"[PROCESS] Getting file {file_id} for user {user_id}")
-        tg_file = await bot.get_file(file_id)
-        logger.info(f"[PROCESS] File path: {tg_file.file_path}")
         input_path = str(get_temp_dir() / generate_unique_filename())
-        logger.info(f"[PROCESS] Downloading to: {input_path}")
+        logger.info(f"[PROCESS] Downloading {file_id} for user {user_id} to: {input_path}")
         
-        # Retry logic для скачивания (до 3 попыток)
-        for attempt in range(3):
-            try:
-                await bot.download_file(tg_file.file_path, input_path)
-                logger.info(f"[PROCESS] Download complete (attempt {attempt + 1})")
-                break
-            except asyncio.TimeoutError:
-                logger.warning(f"[PROCESS] Download timeout, attempt {attempt + 1}/3")
-                if attempt == 2:
-                    raise
-                await asyncio.sleep(2)
+        # v3.4.0: Повторы, докачка и кэш по file_unique_id — в DownloadManager
+        download_started = time_module.perf_counter()
+        await download_manager.fetch(file_id, input_path, user_id)
+        download_seconds = time_module.perf_counter() - download_started
         
         # Проверяем что файл скачался корректно
         if not os.path.exists(input_path):
@@ -5739,21 +5922,28 @@ async def cb_process(callback: CallbackQuery):
     
     # Определяем приоритет на основе плана
     plan = rate_limiter.get_plan(user_id)
-    priority = {"free": 0, "vip": 1, "premium": 2}.get(plan, 0)
+    priority = rate_limiter.get_limits(user_id).priority  # v3.4.0: из PlanLimits
     
     async def on_complete(success: bool, output_path: str):
         rate_limiter.set_processing(user_id, False)
         
         if success and output_path:
             try:
-                # Увеличиваем счётчик статистики
-                rate_limiter.increment_video_count(user_id)
-                # v2.8.0: Обновляем streak
-                streak, bonus = rate_limiter.update_streak(user_id)
-                # Сохраняем в историю
-                rate_limiter.add_to_history(user_id, "unique", "file")
-                # v2.8.0: Добавляем в лог
-                rate_limiter.add_log(user_id, "video_processed", "file")
+                # v3.4.0: Весь учёт по видео — одной записью в журнал
+                with rate_limiter.transaction(user_id):
+                    # Увеличиваем счётчик статистики
+                    rate_limiter.increment_video_count(user_id)
+                    # v2.8.0: Обновляем streak
+                    streak, bonus = rate_limiter.update_streak(user_id)
+                    # Сохраняем в историю
+                    rate_limiter.add_to_history(user_id, "unique", "file")
+                    # v2.8.0: Добавляем в лог
+                    rate_limiter.add_log(user_id, "video_processed", "file")
+                    
+                    # v2.9.0: Gamification
+                    new_level, level_up = rate_limiter.add_points(user_id, 10, "video_processed")
+                    achievements = rate_limiter.check_achievements(user_id)
+                    rate_limiter.update_weekly_stats(user_id)
                 
                 # v3.3.0: Virex Shield — аналитика и паспорт
                 if VIREX_SHIELD_AVAILABLE:
@@ -5763,11 +5953,6 @@ async def cb_process(callback: CallbackQuery):
                     except Exception as shield_err:
                         logger.warning(f"[SHIELD] Analytics error: {shield_err}")
                 
-                # v2.9.0: Gamification
-                new_level, level_up = rate_limiter.add_points(user_id, 10, "video_processed")
-                achievements = rate_limiter.check_achievements(user_id)
-                rate_limiter.update_weekly_stats(user_id)
-                
                 video_file = FSInputFile(output_path)
                 
                 # Формируем caption с учётом level up и achievements
@@ -5814,8 +5999,11 @@ async def cb_process(callback: CallbackQuery):
         text_overlay=text_overlay,
         priority=priority,
         template=template,
-        enable_watermark_trap=enable_watermark_trap
+        enable_watermark_trap=enable_watermark_trap,
+        on_progress=make_progress_reporter(callback.message, user_id),
+        plan=plan
     )
+    task.metrics.add("download", download_seconds)
     
     logger.info(f"[PROCESS] Adding task to queue for user {user_id}")
     queued, position = await add_to_queue(task)
@@ -5831,7 +6019,9 @@ async def cb_process(callback: CallbackQuery):
             [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_processing")]
         ])
         await callback.message.edit_text(
-            f"{get_text(user_id, 'queue_position', position=position)}\n{get_text(user_id, 'processing')}",
+            f"{get_text(user_id, 'queue_position', position=position)}\n"
+            f"{get_text(user_id, 'eta_remaining', time=estimate_queue_time(position))}\n"
+            f"{get_text(user_id, 'processing')}",
             reply_markup=cancel_kb
         )
 
@@ -5857,10 +6047,20 @@ URL_PATTERN = re.compile(
     r')[^\s]+'
 )
 
-# Кэш скачанных видео: url_hash -> file_path
-video_cache: dict = {}
-CACHE_MAX_SIZE = 50
-CACHE_TTL_SECONDS = 3600  # 1 час
+async def download_url_cached(url: str, output_path: str) -> bool:
+    """ v3.4.0: Скачивание через кэш результатов (повторный URL не качаем заново) """
+    from result_cache import get_result_cache
+    from config import RESULT_CACHE_URL_TTL_SECONDS
+    cache = get_result_cache()
+    key = cache.key_for_url(url)
+    if cache.get(key, output_path):
+        logger.info(f"[CACHE] Hit for {url[:50]}...")
+        return True
+    success = await download_video_from_url(url, output_path)
+    if success and os.path.exists(output_path):
+        cache.put(key, output_path, ttl=RESULT_CACHE_URL_TTL_SECONDS)
+    return success
+
 
 async def download_youtube_video(url: str, output_path: str) -> bool:
     """Скачать YouTube видео через Invidious API или публичные прокси"""
@@ -6415,45 +6615,29 @@ async def cb_url_download(callback: CallbackQuery):
     
     rate_limiter.set_processing(user_id, True)
     
-    # Проверяем кэш
-    import hashlib
-    url_hash = hashlib.md5(url.encode()).hexdigest()
-    cached_path = video_cache.get(url_hash)
+    # v3.4.0: Кэш результатов (копия файла — можно удалять после отправки)
+    output_path = str(get_temp_dir() / generate_unique_filename())
+    success = await download_url_cached(url, output_path)
     
-    if cached_path and os.path.exists(cached_path.get("path", "")):
-        output_path = cached_path["path"]
-        logger.info(f"[CACHE] Hit for {url[:50]}...")
-    else:
-        output_path = str(get_temp_dir() / generate_unique_filename())
-        success = await download_video_from_url(url, output_path)
-        
-        if not success or not os.path.exists(output_path):
-            rate_limiter.set_processing(user_id, False)
-            await callback.message.edit_text(get_text(user_id, "error_download"))
-            return
-        
-        # Сохраняем в кэш
-        if len(video_cache) >= CACHE_MAX_SIZE:
-            # Удаляем старые записи
-            oldest = sorted(video_cache.items(), key=lambda x: x[1].get("time", 0))[:10]
-            for k, v in oldest:
-                cleanup_file(v.get("path", ""))
-                video_cache.pop(k, None)
-        
-        video_cache[url_hash] = {"path": output_path, "time": time_module.time()}
+    if not success or not os.path.exists(output_path):
+        rate_limiter.set_processing(user_id, False)
+        await callback.message.edit_text(get_text(user_id, "error_download"))
+        return
     
     rate_limiter.set_processing(user_id, False)
     
     # Проверяем размер
     file_size_mb = os.path.getsize(output_path) / (1024 * 1024)
     if file_size_mb > MAX_FILE_SIZE_MB:
+        cleanup_file(output_path)
         await callback.message.edit_text(get_text(user_id, "file_too_large"))
         return
     
     try:
         # Увеличиваем счётчик скачиваний
-        rate_limiter.increment_download_count(user_id)
-        rate_limiter.increment_video_count(user_id)
+        with rate_limiter.transaction(user_id):
+            rate_limiter.increment_download_count(user_id)
+            rate_limiter.increment_video_count(user_id)
         
         video_file = FSInputFile(output_path)
         await bot.send_video(
@@ -6465,6 +6649,8 @@ async def cb_url_download(callback: CallbackQuery):
     except Exception as e:
         logger.error(f"Send error: {e}")
         await callback.message.edit_text(get_text(user_id, "error"))
+    finally:
+        cleanup_file(output_path)
     
     # Удаляем из pending
     pending_urls.pop(short_id, None)
@@ -6525,8 +6711,10 @@ async def cb_url_process(callback: CallbackQuery):
     
     output_path = str(get_temp_dir() / generate_unique_filename())
     
-    # Скачиваем видео
-    success = await download_video_from_url(url, output_path)
+    # Скачиваем видео (v3.4.0: повторный URL — из кэша результатов)
+    download_started = time_module.perf_counter()
+    success = await download_url_cached(url, output_path)
+    download_seconds = time_module.perf_counter() - download_started
     
     if not success or not os.path.exists(output_path):
         rate_limiter.set_processing(user_id, False)
@@ -6551,7 +6739,7 @@ async def cb_url_process(callback: CallbackQuery):
     
     # Определяем приоритет на основе плана
     plan = rate_limiter.get_plan(user_id)
-    priority = {"free": 0, "vip": 1, "premium": 2}.get(plan, 0)
+    priority = rate_limiter.get_limits(user_id).priority  # v3.4.0: из PlanLimits
     
     # Кнопка отмены
     cancel_kb = InlineKeyboardMarkup(inline_keyboard=[
@@ -6578,13 +6766,15 @@ async def cb_url_process(callback: CallbackQuery):
         
         if success and result_path:
             try:
-                rate_limiter.increment_video_count(user_id)
-                rate_limiter.add_to_history(user_id, "unique", url_source)
-                
-                # v2.9.0: Gamification
-                new_level, level_up = rate_limiter.add_points(user_id, 10, "video_processed")
-                achievements = rate_limiter.check_achievements(user_id)
-                rate_limiter.update_weekly_stats(user_id)
+                # v3.4.0: Весь учёт по видео — одной записью в журнал
+                with rate_limiter.transaction(user_id):
+                    rate_limiter.increment_video_count(user_id)
+                    rate_limiter.add_to_history(user_id, "unique", url_source)
+                    
+                    # v2.9.0: Gamification
+                    new_level, level_up = rate_limiter.add_points(user_id, 10, "video_processed")
+                    achievements = rate_limiter.check_achievements(user_id)
+                    rate_limiter.update_weekly_stats(user_id)
                 
                 video_file = FSInputFile(result_path)
                 new_short_id = generate_short_id()
@@ -6636,8 +6826,11 @@ async def cb_url_process(callback: CallbackQuery):
         text_overlay=text_overlay,
         priority=priority,
         template=template,
-        enable_watermark_trap=enable_watermark_trap
+        enable_watermark_trap=enable_watermark_trap,
+        on_progress=make_progress_reporter(status_message, user_id),
+        plan=plan
     )
+    task.metrics.add("download", download_seconds)
     
     queued, position = await add_to_queue(task)
     if not queued:
@@ -6651,7 +6844,9 @@ async def cb_url_process(callback: CallbackQuery):
             [InlineKeyboardButton(text="❌ Отменить", callback_data="cancel_processing")]
         ])
         await callback.message.edit_text(
-            f"{get_text(user_id, 'queue_position', position=position)}\n{get_text(user_id, 'processing')}",
+            f"{get_text(user_id, 'queue_position', position=position)}\n"
+            f"{get_text(user_id, 'eta_remaining', time=estimate_queue_time(position))}\n"
+            f"{get_text(user_id, 'processing')}",
             reply_markup=cancel_kb
         )
 
@@ -6663,21 +6858,64 @@ async def handle_other(message: Message):
 # MAIN
 # ══════════════════════════════════════════════════════════════════════════════
 
-async def on_startup():
-    # Диагностика FFmpeg
+def log_ffmpeg_diagnostics():
+    """ Диагностика FFmpeg """
     import shutil
     logger.info(f"[FFMPEG] FFMPEG_PATH = {FFMPEG_PATH}")
     logger.info(f"[FFMPEG] FFPROBE_PATH = {FFPROBE_PATH}")
     logger.info(f"[FFMPEG] which ffmpeg = {shutil.which('ffmpeg')}")
     logger.info(f"[FFMPEG] which ffprobe = {shutil.which('ffprobe')}")
     logger.info(f"[FFMPEG] OS = {os.name}, Platform = {sys.platform}")
-    
+
+
+def build_startup() -> StartupOrchestrator:
+    """
+    v3.4.0: Фазы запуска.
+    Критические (polling ждёт): пользователи, воркеры, IPC планировщика.
+    Фоновые: базы Shield и сигнатуры Watermark-Trap, кэши, очистка, yt-dlp.
+    """
+    from queue_estimator import get_queue_estimator
+    from metrics import start_metrics_server
+    from config import METRICS_HTTP_PORT
+    
+    startup = StartupOrchestrator()
+    startup.record("imports", time_module.perf_counter() - IMPORT_STARTED)
+    startup.phase("user_store", rate_limiter.ensure_loaded, thread=True)
+    startup.phase("workers", start_workers)
+    # IPC планировщика — API сервер берёт слоты из того же бюджета
+    startup.phase("scheduler_ipc", start_scheduler_server)
+    
+    startup.phase("ffmpeg_diag", log_ffmpeg_diagnostics, thread=True, critical=False)
+    startup.phase("short_ids", cleanup_short_id_map, critical=False)
+    startup.phase("cleanup_files", cleanup_old_files, thread=True, critical=False)
+    startup.phase("result_cache", get_result_cache, thread=True, critical=False)
+    startup.phase("queue_estimator", get_queue_estimator, thread=True, critical=False)
+    if VIREX_SHIELD_AVAILABLE:
+        startup.phase("shield_db", get_virex_shield, thread=True, critical=False)
+    if WATERMARK_TRAP_DETECTION_AVAILABLE:
+        startup.phase("trap_signatures", get_trap_detector, thread=True, critical=False)
+    # Напоминания и /schedule: куча сроков из хранилища, дальше — по подпискам
+    timed = get_timed_scheduler(rate_limiter, send_timed_reminder, run_timed_task)
+    startup.phase("timed_tasks", timed.start, critical=False, after=("user_store", "workers"))
+    # Prometheus /metrics процесса бота (VIREX_METRICS_PORT)
+    if METRICS_HTTP_PORT:
+        startup.phase("metrics_http", start_metrics_server, critical=False)
     # Автоматическое обновление yt-dlp при старте (в фоне)
-    asyncio.create_task(auto_update_ytdlp())
-    await start_workers()
-    cleanup_old_files()
-    cleanup_short_id_map()
+    startup.phase("ytdlp_update", auto_update_ytdlp, critical=False)
+    return startup
+
+
+async def on_startup():
+    startup = build_startup()
+    await startup.run()
     logger.info("Virex started")
+    logger.info(startup.report())
+    
+    async def report_background():
+        await startup.wait_background()
+        logger.info(startup.report())
+    
+    asyncio.create_task(report_background())
 
 
 async def auto_update_ytdlp():
@@ -6775,7 +7013,10 @@ async def periodic_autosave():
 async def on_shutdown():
     """ Graceful shutdown """
     logger.info("Shutting down...")
-    rate_limiter.save_data()
+    rate_limiter.compact_data()
+    # v3.4.0: Оценщик очереди пишет модель на диск с интервалом — дописываем остаток
+    from queue_estimator import get_queue_estimator
+    get_queue_estimator().flush()
     cleanup_old_files()
     logger.info("Data saved, shutdown complete")
 
@@ -86,7 +86,80 @@ MAX_VIDEO_DURATION_SECONDS = 120
 ALLOWED_EXTENSIONS = (".mp4", ".mov")
 FFMPEG_TIMEOUT_SECONDS = 600
 MAX_QUEUE_SIZE = 10
-MAX_CONCURRENT_TASKS = 2
+MAX_CONCURRENT_TASKS = 2  # v3.4.0: число воркеров, только при CPU_POLICY_ENABLED = False
+
+# v3.4.0: CPU-политика воркеров (cpu_policy.py).
+# Бюджет потоков = min(доступные ядра, квота cgroup); каждая задача берёт из
+# бюджета потоки по разрешению кадра, число воркеров — по самому лёгкому уровню
+CPU_POLICY_ENABLED = True
+CPU_THREADS_OVERRIDE = int(os.getenv("VIREX_CPU_THREADS", 0))  # 0 = определить автоматически
+CPU_THREAD_TIERS = (  # (пикселей кадра не больше, потоков FFmpeg на задачу)
+    (1280 * 720, 2),       # до 720p
+    (1920 * 1080, 4),      # 1080p
+    (2560 * 1440, 6),      # 1440p
+    (3840 * 2160, 8),      # 4K
+)
+CPU_THREADS_ABOVE_TIERS = 16  # 8K и всё, что больше 4K
+CPU_MAX_WORKERS = 8
+
+# v3.4.0: Сегментное кодирование process_video: вход режется по ключевым кадрам,
+# сегменты кодируются параллельно (потоки задачи делятся между ними), склейка -c copy
+SEGMENT_ENCODE_ENABLED = True
+SEGMENT_ENCODE_MIN_MEGAPIXELS = 2500  # ширина × высота × fps × длительность / 1e6 (≈10 с 4K30)
+SEGMENT_ENCODE_MAX_SEGMENTS = 4
+SEGMENT_ENCODE_MIN_SECONDS = 4.0  # Сегменты короче не режем
+
+# v3.4.0: Общий планировщик слотов FFmpeg (бот + API, IPC между процессами)
+SCHEDULER_SOCKET_PATH = os.getenv("VIREX_SCHEDULER_SOCKET", "")  # "" = <tmp>/virex_scheduler.sock
+SCHEDULER_TCP_PORT = int(os.getenv("VIREX_SCHEDULER_PORT", 8765))  # Для систем без unix socket
+SCHEDULER_AGING_SECONDS = 60  # +1 к приоритету за каждую минуту ожидания
+
+# v3.4.0: Живой прогресс FFmpeg (-progress pipe:1)
+PROGRESS_UPDATE_INTERVAL = 5  # Секунд между edit статус-сообщения (лимиты Telegram)
+FFMPEG_STDERR_TAIL_LINES = 30  # Сколько последних строк stderr хранить для логов ошибок
+
+# v3.4.0: Общий запуск FFmpeg (потоковый stderr, kill группы процессов, замеры)
+FFMPEG_STDERR_MAX_LINE = 4096  # Длиннее — строка обрезается (stderr не копится в памяти)
+FFMPEG_SAMPLE_INTERVAL = 0.5  # Секунд между замерами CPU / RSS через psutil
+
+# v3.4.0: Rate control под лимит доставки (без повторного сжатия после кодирования)
+TELEGRAM_DELIVERY_MAX_MB = 49  # Лимит Bot API — 50 MB, 1 MB запаса
+RATE_CONTROL_CONTAINER_OVERHEAD = 0.02  # Доля mp4-контейнера в размере файла
+RATE_CONTROL_MIN_VIDEO_KBPS = 300  # Ниже — не режем (файл уйдёт в запасное сжатие)
+RATE_CONTROL_FALLBACK_AUDIO = "96k"  # Аудио для длинных видео, если видео не влезает
+RATE_CONTROL_ALPHA = 0.2  # Вес нового замера в EWMA факт/цель
+
+# v3.4.0: Оценка времени очереди по измеренным задачам
+QUEUE_ESTIMATOR_FILE = "queue_estimator.json"
+QUEUE_ESTIMATOR_ALPHA = 0.2  # Вес нового наблюдения в EWMA
+QUEUE_ESTIMATOR_SAVE_INTERVAL_SECONDS = 60  # Запись модели на диск не чаще (flush при shutdown)
+QUEUE_DEFAULT_JOB_SECONDS = 30  # Пока нет измерений
+QUEUE_ADMISSION_MAX_WAIT_SECONDS = 1800  # Не брать в очередь, если ждать дольше (0 = без лимита)
+
+# v3.4.0: Метрики задач (стадии, p50/p95/p99, Prometheus /metrics)
+METRICS_WINDOW = 500  # Последних наблюдений на серию для перцентилей
+METRICS_HTTP_HOST = os.getenv("VIREX_METRICS_HOST", "127.0.0.1")
+METRICS_HTTP_PORT = int(os.getenv("VIREX_METRICS_PORT", 0))  # 0 = /metrics бота выключен
+
+# v3.4.0: Кэш результатов по содержимому (get_temp_dir()/result_cache)
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", 2048))
+RESULT_CACHE_MAX_ENTRIES = 500
+RESULT_CACHE_URL_TTL_SECONDS = 3600  # Скачанные по URL видео могут измениться на источнике
+
+# v3.4.0: Параллельные загрузки файлов из Telegram (склейка, обработка)
+DOWNLOAD_GLOBAL_CONCURRENCY = 8   # Одновременных загрузок на весь бот
+DOWNLOAD_PER_USER_CONCURRENCY = 3  # Одновременных загрузок на пользователя
+DOWNLOAD_RETRIES = 3  # Таймаут одной попытки — DOWNLOAD_TIMEOUT_SECONDS (v2.8.0)
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
+DOWNLOAD_PARTIAL_TTL_SECONDS = 6 * 3600  # Брошенные .part в result_cache/partial старше — удаляются
+
+# v3.4.0: Планировщик склейки (copy → перекодировать несовпадающие → один filtergraph)
+MERGE_NORMALIZE_MAX_SHARE = 0.6  # Если перекодировать больше этой доли работы — один filtergraph
+
+# v3.4.0: Исполнение напоминаний (/reminder) и отложенных задач (/schedule)
+TIMED_SEND_RATE = 25  # Сообщений в секунду от планировщика (лимит Telegram ~30/с)
+TIMED_MAX_SLEEP_SECONDS = 60  # Просыпаться не реже (перевод часов, сон системы)
+SCHEDULE_ACTIONS = ("process",)  # Действия /schedule: обработка видео в очереди
 
 # v2.8.0: Auto-retry & Timeout protection
 MAX_RETRY_ATTEMPTS = 3
@@ -103,6 +176,14 @@ MAX_BATCH_SIZE = 5  # Максимум видео за раз
 # v3.0.0: Merge videos limit
 MAX_MERGE_VIDEOS = 5  # Максимум видео для склейки
 
+# v3.4.0: Инкрементальное хранилище пользователей (журнал + снапшот)
+USERS_JOURNAL_FILE = "users_data.journal"
+USERS_JOURNAL_COMPACT_RECORDS = 5000  # Компактировать журнал после N записей
+
+# v3.4.0: Кэш ffprobe (ключ: путь + размер + mtime)
+PROBE_CACHE_SIZE = 256
+PROBE_TIMEOUT_SECONDS = 30
+
 # ══════════════════════════════════════════════════════════════════════════════
 # v3.2.0: ANTI-REUPLOAD LEVELS (защита от повторного контента)
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1115,6 +1196,8 @@ PLAN_LIMITS: Dict[str, PlanLimits] = {
 # Хранится в user.bonus_videos
 
 RATE_LIMIT_WINDOW_SECONDS = 2592000   # 30 дней
+# v3.4.0: Корзин в кольце скользящего окна (30 → по дню)
+RATE_LIMIT_WINDOW_BUCKETS = 30
 ABUSE_THRESHOLD_HITS = 10
 SOFT_BLOCK_DURATION_SECONDS = 1800
 BUTTON_COOLDOWN_SECONDS = 2
@@ -1371,6 +1454,7 @@ TEXTS = {
     "banlist_title": "🚫 <b>Заблокированные:</b>\n\n{ban_list}",
     # Очередь
     "queue_position": "📥 Позиция в очереди: #{position}",
+    "processing_progress": "⏳ Обрабатываем видео... {percent}%\n⏱ Осталось ~{eta}",
     "queue_started": "🎬 Обработка началась...",
     # Быстрые настройки качества
     "quick_quality": "🎚 Выбери качество для этого видео:",
@@ -1587,12 +1671,13 @@ TEXTS = {
     "volume_normalized": "⚖️ Звук нормализован!",
     
     # v3.0.0: Scheduler
-    "schedule_help": "📅 <b>Планировщик</b>\n\n📝 Использование:\n<code>/schedule HH:MM действие</code>\n\nПример: <code>/schedule 15:00 compress telegram</code>\n\n📋 Запланировано: {count}",
+    "schedule_help": "📅 <b>Планировщик</b>\n\n📝 Использование:\n<code>/schedule HH:MM действие</code>\n\nПример (ответом на видео): <code>/schedule 15:00 process</code>\n\n📋 Запланировано: {count}",
     "schedule_added": "✅ Задача запланирована на {time}",
     "schedule_list": "📅 <b>Запланированные задачи:</b>\n\n{tasks}",
     "schedule_empty": "📅 Нет запланированных задач",
     "schedule_removed": "🗑 Задача удалена",
     "schedule_executed": "✅ Запланированная задача выполнена!",
+    "schedule_need_video": "📎 Отправьте команду ответом на видео: <code>/schedule HH:MM process</code>",
     
     # v3.0.0: Auto-process
     "autoprocess_menu": "⚙️ <b>Авто-обработка</b>\n\nТекущий шаблон: {current}\n\nВыбери шаблон:",
@@ -1791,6 +1876,7 @@ TEXTS_EN = {
     "banlist_title": "🚫 <b>Banned users:</b>\n\n{ban_list}",
     # Queue
     "queue_position": "📥 Queue position: #{position}",
+    "processing_progress": "⏳ Processing video... {percent}%\n⏱ About {eta} left",
     "queue_started": "🎬 Processing started...",
     # Quick quality settings
     "quick_quality": "🎚 Choose quality for this video:",
@@ -2007,12 +2093,13 @@ TEXTS_EN = {
     "volume_normalized": "⚖️ Audio normalized!",
     
     # v3.0.0: Scheduler
-    "schedule_help": "📅 <b>Scheduler</b>\n\n📝 Usage:\n<code>/schedule HH:MM action</code>\n\nExample: <code>/schedule 15:00 compress telegram</code>\n\n📋 Scheduled: {count}",
+    "schedule_help": "📅 <b>Scheduler</b>\n\n📝 Usage:\n<code>/schedule HH:MM action</code>\n\nExample (reply to a video): <code>/schedule 15:00 process</code>\n\n📋 Scheduled: {count}",
     "schedule_added": "✅ Task scheduled for {time}",
     "schedule_list": "📅 <b>Scheduled Tasks:</b>\n\n{tasks}",
     "schedule_empty": "📅 No scheduled tasks",
     "schedule_removed": "🗑 Task removed",
     "schedule_executed": "✅ Scheduled task executed!",
+    "schedule_need_video": "📎 Send the command as a reply to a video: <code>/schedule HH:MM process</code>",
     
     # v3.0.0: Auto-process
     "autoprocess_menu": "⚙️ <b>Auto-Process</b>\n\nCurrent template: {current}\n\nChoose template:",
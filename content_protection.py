@@ -31,11 +31,15 @@
 
 import os
 import json
+import atexit
 import time
 import hashlib
 import asyncio
 import struct
 import random
+import re
+import math
+import threading
 from pathlib import Path
 from typing import Optional, Dict, Any, List, Tuple
 from dataclasses import dataclass, field, asdict
@@ -55,6 +59,14 @@ ANALYTICS_FILE = "analytics_data.json"
 # Порог схожести для совпадения (0.0 - 1.0)
 SIMILARITY_THRESHOLD = 0.75  # 75%+
 
+# v3.4.0: Радиус поиска по перцептуальному хешу (бит из 64).
+# 16 бит = 75% схожести = SIMILARITY_THRESHOLD
+PERCEPTUAL_HASH_BITS = 64
+PERCEPTUAL_SEARCH_RADIUS = int(PERCEPTUAL_HASH_BITS * (1 - SIMILARITY_THRESHOLD))
+
+# v3.4.0: Запись баз откладывается и склеивается: не чаще раза в N секунд на файл
+SHIELD_FLUSH_DELAY_SECONDS = 2.0
+
 # Риски
 class RiskLevel(Enum):
     SAFE = "safe"           # 🟢 Безопасно
@@ -64,6 +76,122 @@ class RiskLevel(Enum):
     CRITICAL = "critical"   # 🔴 Критический
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# PERSISTENCE — Отложенная запись баз (v3.4.0)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class JsonPersistence:
+    """
+    v3.4.0: Общий слой записи JSON-баз Shield
+    
+    - register(path, snapshot) — файл и функция, собирающая его содержимое
+    - mark_dirty(path) — пометить изменённым; запись через
+      SHIELD_FLUSH_DELAY_SECONDS, все изменения за это время — одной записью
+    - snapshot() вызывается в event loop (консистентный срез), json.dump,
+      fsync и атомарный os.replace — в потоке
+    - Без запущенного event loop (скрипты, тесты) пишет сразу
+    - При выходе процесса недописанное сбрасывается (atexit)
+    """
+    
+    def __init__(self, delay: float = SHIELD_FLUSH_DELAY_SECONDS):
+        self.delay = delay
+        self._snapshots: Dict[str, Any] = {}
+        self._dirty: set = set()
+        self._timer: Optional[asyncio.TimerHandle] = None
+        # Ссылка на фоновую запись — иначе event loop может собрать задачу GC
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flushing = False
+        self._write_lock = threading.Lock()
+        self.stats = {
+            "marks": 0, "flushes": 0, "files_written": 0, "bytes_written": 0,
+            "errors": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "total_flush_ms": 0.0,
+        }
+        atexit.register(self.flush_sync)
+    
+    def register(self, path: str, snapshot):
+        self._snapshots[path] = snapshot
+    
+    def mark_dirty(self, path: str):
+        self.stats["marks"] += 1
+        self._dirty.add(path)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush_sync()
+            return
+        if self._timer is None and not self._flushing:
+            self._timer = loop.call_later(self.delay, self._start_flush)
+    
+    def _start_flush(self):
+        self._timer = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+    
+    def _collect(self) -> List[Tuple[str, Any]]:
+        dirty, self._dirty = self._dirty, set()
+        return [(path, self._snapshots[path]()) for path in dirty]
+    
+    def _write(self, path: str, data) -> int:
+        tmp_file = path + ".tmp"
+        encoded = json.dumps(data, indent=2).encode()
+        with self._write_lock:
+            with open(tmp_file, 'wb') as f:
+                f.write(encoded)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, path)
+        return len(encoded)
+    
+    def _write_all(self, items: List[Tuple[str, Any]]) -> List[str]:
+        failed = []
+        for path, data in items:
+            try:
+                self.stats["bytes_written"] += self._write(path, data)
+                self.stats["files_written"] += 1
+            except (OSError, TypeError, ValueError, RuntimeError) as e:
+                self.stats["errors"] += 1
+                failed.append(path)
+                print(f"[SHIELD DB] Failed to save {path}: {e}")
+        return failed
+    
+    def _record_flush(self, started: float):
+        elapsed = (time.perf_counter() - started) * 1000
+        self.stats["flushes"] += 1
+        self.stats["last_flush_ms"] = round(elapsed, 2)
+        self.stats["max_flush_ms"] = round(max(self.stats["max_flush_ms"], elapsed), 2)
+        self.stats["total_flush_ms"] = round(self.stats["total_flush_ms"] + elapsed, 2)
+    
+    async def flush(self):
+        """ Записать всё изменённое (запись — вне event loop) """
+        if self._flushing or not self._dirty:
+            return
+        self._flushing = True
+        started = time.perf_counter()
+        try:
+            failed = await asyncio.to_thread(self._write_all, self._collect())
+            self._dirty.update(failed)
+        finally:
+            self._flushing = False
+            self._record_flush(started)
+        # Изменения, пришедшие во время записи, — следующим тиком
+        if self._dirty and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self._start_flush)
+    
+    def flush_sync(self):
+        """ Записать всё изменённое сразу (без event loop, при выходе) """
+        if not self._dirty:
+            return
+        started = time.perf_counter()
+        self._write_all(self._collect())
+        self._record_flush(started)
+    
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["pending_files"] = len(self._dirty)
+        flushes = stats["flushes"]
+        stats["avg_flush_ms"] = round(stats["total_flush_ms"] / flushes, 2) if flushes else 0.0
+        return stats
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # 1. DIGITAL PASSPORT — Цифровой паспорт видео
 # ══════════════════════════════════════════════════════════════════════════════
@@ -190,6 +318,18 @@ class DigitalPassport:
 # 2. VIDEO FINGERPRINTING — Перцептуальные хеши
 # ══════════════════════════════════════════════════════════════════════════════
 
+@dataclass
+class FrameFingerprints:
+    """Результат одного прохода декодера"""
+    perceptual_hash: str
+    temporal_signature: str
+    brightness_profile: List[float] = field(default_factory=list)
+
+
+# showinfo: "... pts_time:1.234 ..."
+_PTS_TIME_RE = re.compile(r"pts_time:\s*(-?[0-9.]+)")
+
+
 class VideoFingerprinter:
     """
     Создание "отпечатков" видео для сравнения
@@ -214,6 +354,139 @@ class VideoFingerprinter:
             print(f"[FP] File hash error: {e}")
             return hashlib.sha256(os.urandom(32)).hexdigest()
     
+    # Параметры сэмплирования (менять нельзя — иначе старые хеши станут невалидны)
+    PERCEPTUAL_SAMPLES = 64     # Кадров для перцептуального хеша (8x8 gray)
+    TEMPORAL_FRAMES = 32        # Кадров для временной сигнатуры (fps=1, 4x4 gray)
+    
+    @staticmethod
+    async def calculate_frame_fingerprints(filepath: str) -> "FrameFingerprints":
+        """
+        v3.4.0: Один проход декодера вместо 64 ffmpeg + отдельного прогона.
+        
+        Граф: split на две ветки.
+        1. select — первый кадр с t >= i*duration/64 (то же, что давал -ss t -vframes 1),
+           scale=8:8,format=gray → rawvideo в stdout, showinfo даёт pts_time кадров
+        2. fps=1,scale=4:4,format=gray, 32 кадра → временный файл (как раньше)
+        
+        Хеши бит-в-бит совпадают со старым алгоритмом.
+        """
+        from config import FFMPEG_PATH
+        from ffmpeg_utils import probe, get_temp_dir, run_ffmpeg
+        
+        num_samples = VideoFingerprinter.PERCEPTUAL_SAMPLES
+        
+        # Получаем длительность (v3.4.0: из общего кэша ffprobe)
+        media = await probe(filepath)
+        duration = media.format_duration if media and media.format_duration else 10.0
+        interval = duration / num_samples
+        
+        temporal_file = str(get_temp_dir() / f"fp_ts_{os.getpid()}_{random.randint(0, 1 << 30):x}.raw")
+        
+        filter_graph = (
+            f"[0:v]split=2[ph][ts];"
+            f"[ph]select='isnan(prev_t)+gt(floor(t/{interval:.9f}),floor(prev_t/{interval:.9f}))',"
+            f"scale=8:8,format=gray,showinfo[p];"
+            f"[ts]fps=1,scale=4:4,format=gray[t]"
+        )
+        cmd = [
+            FFMPEG_PATH, "-hide_banner", "-nostdin", "-y",
+            "-i", filepath,
+            "-filter_complex", filter_graph,
+            # passthrough: rawvideo по умолчанию CFR и продублирует выбранные кадры
+            "-map", "[p]", "-fps_mode", "passthrough", "-f", "rawvideo", "pipe:1",
+            "-map", "[t]", "-vframes", str(VideoFingerprinter.TEMPORAL_FRAMES),
+            "-f", "rawvideo", temporal_file,
+        ]
+        
+        # pts_time из showinfo собираются по строкам stderr (весь stderr не хранится)
+        pts_times: List[float] = []
+        
+        def on_stderr_line(line: str):
+            match = _PTS_TIME_RE.search(line)
+            if match:
+                pts_times.append(float(match.group(1)))
+        
+        try:
+            result = await run_ffmpeg(cmd, label="fingerprint", capture_stdout=True,
+                                      on_stderr_line=on_stderr_line)
+            stdout = result.stdout
+            
+            temporal_raw = b""
+            if os.path.exists(temporal_file):
+                with open(temporal_file, 'rb') as f:
+                    temporal_raw = f.read()
+        finally:
+            try:
+                if os.path.exists(temporal_file):
+                    os.remove(temporal_file)
+            except OSError:
+                pass
+        
+        # Раскладываем выбранные кадры по точкам сэмплирования.
+        # Кадр покрывает все точки i*interval <= t, не покрытые предыдущим
+        # (при коротком видео один кадр может ответить за несколько точек).
+        frame_size = 64
+        brightness_values = [128.0] * num_samples
+        next_sample = 0
+        for k, pts_time in enumerate(pts_times):
+            frame = stdout[k * frame_size:(k + 1) * frame_size]
+            if len(frame) < frame_size:
+                break
+            avg = sum(frame) / len(frame)
+            last_sample = min(math.floor(pts_time / interval), num_samples - 1) if interval > 0 else num_samples - 1
+            while next_sample <= last_sample:
+                brightness_values[next_sample] = avg
+                next_sample += 1
+            if next_sample >= num_samples:
+                break
+        
+        return FrameFingerprints(
+            perceptual_hash=VideoFingerprinter._perceptual_from_profile(brightness_values),
+            temporal_signature=VideoFingerprinter._temporal_from_raw(temporal_raw),
+            brightness_profile=brightness_values,
+        )
+    
+    @staticmethod
+    def _perceptual_from_profile(brightness_values: List[float]) -> str:
+        """Битовая строка выше/ниже средней яркости → hex"""
+        if len(brightness_values) < 64:
+            brightness_values = brightness_values + [128] * (64 - len(brightness_values))
+        
+        overall_avg = sum(brightness_values) / len(brightness_values)
+        bits = "".join("1" if b > overall_avg else "0" for b in brightness_values[:64])
+        
+        # Конвертируем в hex
+        hash_int = int(bits, 2)
+        return format(hash_int, '016x')
+    
+    @staticmethod
+    def _temporal_from_raw(raw: bytes) -> str:
+        """Паттерн дельт яркости (U/D/S) между кадрами 4x4 → md5[:8]"""
+        if not raw or len(raw) < 32:
+            return "0" * 8
+        
+        # Группируем по кадрам (4x4 = 16 пикселей)
+        frame_size = 16
+        frames = [raw[i:i+frame_size] for i in range(0, len(raw), frame_size)]
+        
+        # Считаем средние яркости
+        avgs = [sum(f) / len(f) if f else 128 for f in frames[:32]]
+        
+        # Создаём паттерн дельт
+        deltas = []
+        for i in range(1, len(avgs)):
+            delta = avgs[i] - avgs[i-1]
+            if delta > 10:
+                deltas.append("U")  # Up
+            elif delta < -10:
+                deltas.append("D")  # Down
+            else:
+                deltas.append("S")  # Stable
+        
+        # Хешируем паттерн
+        pattern = "".join(deltas)
+        return hashlib.md5(pattern.encode()).hexdigest()[:8]
+    
     @staticmethod
     async def calculate_perceptual_hash(filepath: str) -> str:
         """
@@ -226,75 +499,8 @@ class VideoFingerprinter:
         4. Конвертируем в hex
         """
         try:
-            from config import FFPROBE_PATH, FFMPEG_PATH
-            
-            # Получаем длительность
-            cmd = [
-                FFPROBE_PATH,
-                "-v", "error",
-                "-show_entries", "format=duration",
-                "-of", "csv=p=0",
-                filepath
-            ]
-            
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
-            
-            try:
-                duration = float(stdout.decode().strip())
-            except:
-                duration = 10.0
-            
-            # Берём 64 точки для хеша
-            num_samples = 64
-            interval = duration / num_samples
-            
-            # Получаем яркость в каждой точке через ffprobe
-            brightness_values = []
-            
-            for i in range(num_samples):
-                timestamp = i * interval
-                
-                # Извлекаем один кадр и считаем среднюю яркость
-                cmd = [
-                    FFMPEG_PATH,
-                    "-ss", str(timestamp),
-                    "-i", filepath,
-                    "-vframes", "1",
-                    "-vf", "scale=8:8,format=gray",
-                    "-f", "rawvideo",
-                    "-"
-                ]
-                
-                proc = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE
-                )
-                stdout, _ = await proc.communicate()
-                
-                if stdout:
-                    # Средняя яркость пикселей
-                    avg = sum(stdout) / len(stdout) if stdout else 128
-                    brightness_values.append(avg)
-                else:
-                    brightness_values.append(128)
-            
-            # Создаём битовую строку
-            if len(brightness_values) < 64:
-                brightness_values.extend([128] * (64 - len(brightness_values)))
-            
-            overall_avg = sum(brightness_values) / len(brightness_values)
-            bits = "".join("1" if b > overall_avg else "0" for b in brightness_values[:64])
-            
-            # Конвертируем в hex
-            hash_int = int(bits, 2)
-            return format(hash_int, '016x')
-            
+            fingerprints = await VideoFingerprinter.calculate_frame_fingerprints(filepath)
+            return fingerprints.perceptual_hash
         except Exception as e:
             print(f"[FP] Perceptual hash error: {e}")
             # Fallback: используем часть file hash
@@ -307,50 +513,8 @@ class VideoFingerprinter:
         Временная сигнатура — паттерн изменения яркости между кадрами
         """
         try:
-            from config import FFMPEG_PATH
-            
-            # Извлекаем 32 кадра и считаем дельты яркости
-            cmd = [
-                FFMPEG_PATH,
-                "-i", filepath,
-                "-vf", "fps=1,scale=4:4,format=gray",
-                "-vframes", "32",
-                "-f", "rawvideo",
-                "-"
-            ]
-            
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
-            
-            if not stdout or len(stdout) < 32:
-                return "0" * 8
-            
-            # Группируем по кадрам (4x4 = 16 пикселей)
-            frame_size = 16
-            frames = [stdout[i:i+frame_size] for i in range(0, len(stdout), frame_size)]
-            
-            # Считаем средние яркости
-            avgs = [sum(f) / len(f) if f else 128 for f in frames[:32]]
-            
-            # Создаём паттерн дельт
-            deltas = []
-            for i in range(1, len(avgs)):
-                delta = avgs[i] - avgs[i-1]
-                if delta > 10:
-                    deltas.append("U")  # Up
-                elif delta < -10:
-                    deltas.append("D")  # Down
-                else:
-                    deltas.append("S")  # Stable
-            
-            # Хешируем паттерн
-            pattern = "".join(deltas)
-            return hashlib.md5(pattern.encode()).hexdigest()[:8]
-            
+            fingerprints = await VideoFingerprinter.calculate_frame_fingerprints(filepath)
+            return fingerprints.temporal_signature
         except Exception as e:
             print(f"[FP] Temporal signature error: {e}")
             return "0" * 8
@@ -395,6 +559,165 @@ class VideoFingerprinter:
 # 3. SIMILARITY DETECTION — Поиск совпадений
 # ══════════════════════════════════════════════════════════════════════════════
 
+class FingerprintIndex:
+    """
+    v3.4.0: Индекс отпечатков вместо линейного прохода по fingerprints_db
+    
+    - file_hash → passport_id: точное совпадение за O(1)
+    - perceptual_hash: multi-index hashing — 64 бита режем на 8 чанков по 8 бит.
+      Если Hamming(a, b) <= r, то хотя бы один чанк отличается не более чем на r // 8 бит
+      (принцип Дирихле). Кандидатов проверяем через XOR + popcount.
+    - user_id → passport_id: фильтр по владельцу
+    """
+    
+    CHUNKS = 8
+    CHUNK_BITS = PERCEPTUAL_HASH_BITS // CHUNKS
+    
+    def __init__(self):
+        self._by_file_hash: Dict[str, List[str]] = {}
+        self._by_owner: Dict[int, set] = {}
+        self._hashes: Dict[str, int] = {}           # passport_id → int(perceptual_hash)
+        self._owners: Dict[str, int] = {}           # passport_id → user_id
+        self._file_hashes: Dict[str, str] = {}      # passport_id → file_hash
+        self._order: Dict[str, int] = {}            # порядок вставки (для стабильного выбора)
+        self._seq = 0
+        self._tables: List[Dict[int, set]] = [{} for _ in range(self.CHUNKS)]
+        # Маски с <= k установленными битами внутри чанка (для перебора соседей)
+        self._flip_masks: Dict[int, List[int]] = {}
+    
+    def __len__(self) -> int:
+        return len(self._order)
+    
+    @staticmethod
+    def _parse_hash(perceptual_hash: str) -> Optional[int]:
+        if not perceptual_hash or len(perceptual_hash) > PERCEPTUAL_HASH_BITS // 4:
+            return None
+        try:
+            return int(perceptual_hash, 16)
+        except ValueError:
+            return None
+    
+    def _chunks(self, value: int) -> List[int]:
+        mask = (1 << self.CHUNK_BITS) - 1
+        return [(value >> (i * self.CHUNK_BITS)) & mask for i in range(self.CHUNKS)]
+    
+    def _masks(self, radius: int) -> List[int]:
+        """Все маски чанка с не более чем radius установленными битами"""
+        if radius not in self._flip_masks:
+            self._flip_masks[radius] = [
+                m for m in range(1 << self.CHUNK_BITS) if m.bit_count() <= radius
+            ]
+        return self._flip_masks[radius]
+    
+    def add(self, passport_id: str, file_hash: str, perceptual_hash: str, user_id: int):
+        """Инкрементальная вставка (повторная вставка обновляет запись)"""
+        if passport_id in self._order:
+            self.remove(passport_id)
+        
+        self._seq += 1
+        self._order[passport_id] = self._seq
+        self._owners[passport_id] = user_id
+        self._by_owner.setdefault(user_id, set()).add(passport_id)
+        
+        if file_hash:
+            self._file_hashes[passport_id] = file_hash
+            self._by_file_hash.setdefault(file_hash, []).append(passport_id)
+        
+        value = self._parse_hash(perceptual_hash)
+        if value is not None:
+            self._hashes[passport_id] = value
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                table.setdefault(chunk, set()).add(passport_id)
+    
+    def remove(self, passport_id: str):
+        """Инкрементальное удаление"""
+        if passport_id not in self._order:
+            return
+        del self._order[passport_id]
+        
+        user_id = self._owners.pop(passport_id, None)
+        owned = self._by_owner.get(user_id)
+        if owned is not None:
+            owned.discard(passport_id)
+            if not owned:
+                del self._by_owner[user_id]
+        
+        file_hash = self._file_hashes.pop(passport_id, None)
+        if file_hash:
+            ids = self._by_file_hash.get(file_hash, [])
+            if passport_id in ids:
+                ids.remove(passport_id)
+            if not ids:
+                self._by_file_hash.pop(file_hash, None)
+        
+        value = self._hashes.pop(passport_id, None)
+        if value is not None:
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                bucket = table.get(chunk)
+                if bucket is not None:
+                    bucket.discard(passport_id)
+                    if not bucket:
+                        del table[chunk]
+    
+    def _allowed(self, passport_id: str, owner_id: Optional[int], exclude_owner: int) -> bool:
+        user_id = self._owners.get(passport_id)
+        if owner_id is not None and user_id != owner_id:
+            return False
+        if exclude_owner and user_id == exclude_owner:
+            return False
+        return True
+    
+    def find_exact(self, file_hash: str, owner_id: Optional[int] = None,
+                   exclude_owner: int = 0) -> Optional[str]:
+        """Первый (по времени добавления) паспорт с таким же file_hash"""
+        for passport_id in self._by_file_hash.get(file_hash, []):
+            if self._allowed(passport_id, owner_id, exclude_owner):
+                return passport_id
+        return None
+    
+    def find_nearest(self, perceptual_hash: str, radius: int = PERCEPTUAL_SEARCH_RADIUS,
+                     owner_id: Optional[int] = None,
+                     exclude_owner: int = 0) -> Optional[Tuple[str, int]]:
+        """
+        Ближайший по Hamming паспорт в пределах radius.
+        Возвращает (passport_id, distance) или None.
+        """
+        value = self._parse_hash(perceptual_hash)
+        if value is None:
+            return None
+        
+        # Фильтр по владельцу: у одного пользователя паспортов мало — проверяем напрямую
+        if owner_id is not None:
+            candidates = self._by_owner.get(owner_id, set())
+        elif radius >= PERCEPTUAL_HASH_BITS:
+            candidates = self._hashes.keys()
+        else:
+            candidates = set()
+            masks = self._masks(radius // self.CHUNKS)
+            for table, chunk in zip(self._tables, self._chunks(value)):
+                for m in masks:
+                    bucket = table.get(chunk ^ m)
+                    if bucket:
+                        candidates |= bucket
+        
+        best = None
+        for passport_id in candidates:
+            other = self._hashes.get(passport_id)
+            if other is None or not self._allowed(passport_id, owner_id, exclude_owner):
+                continue
+            distance = (value ^ other).bit_count()
+            if distance > radius:
+                continue
+            key = (distance, self._order[passport_id])
+            if best is None or key < best[0]:
+                best = (key, passport_id)
+        
+        if best is None:
+            return None
+        return best[1], best[0][0]
+
+
+
 @dataclass
 class MatchResult:
     """Результат поиска совпадений"""
@@ -509,7 +832,24 @@ class SimilarityDetector:
     def __init__(self):
         self.fingerprints_db: Dict[str, Dict] = {}
         self.passports_db: Dict[str, DigitalPassport] = {}
+        self.index = FingerprintIndex()
         self._load_databases()
+        self._rebuild_index()
+        persistence = get_shield_persistence()
+        persistence.register(FINGERPRINTS_DB_FILE, lambda: dict(self.fingerprints_db))
+        persistence.register(PASSPORTS_DB_FILE,
+                             lambda: {k: v.to_dict() for k, v in self.passports_db.items()})
+    
+    def _rebuild_index(self):
+        """v3.4.0: Построить индекс по загруженной базе"""
+        self.index = FingerprintIndex()
+        for fp_id, fp_data in self.fingerprints_db.items():
+            self.index.add(
+                fp_id,
+                fp_data.get("file_hash", ""),
+                fp_data.get("perceptual_hash", ""),
+                fp_data.get("user_id", 0),
+            )
     
     def _load_databases(self):
         """Загрузка баз данных"""
@@ -533,20 +873,13 @@ class SimilarityDetector:
             except:
                 self.passports_db = {}
     
-    def _save_databases(self):
-        """Сохранение баз данных"""
-        try:
-            with open(FINGERPRINTS_DB_FILE, 'w') as f:
-                json.dump(self.fingerprints_db, f, indent=2)
-        except Exception as e:
-            print(f"[DB] Failed to save fingerprints: {e}")
-        
-        try:
-            with open(PASSPORTS_DB_FILE, 'w') as f:
-                data = {k: v.to_dict() for k, v in self.passports_db.items()}
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            print(f"[DB] Failed to save passports: {e}")
+    def _save_databases(self, fingerprints: bool = True, passports: bool = True):
+        """Сохранение баз данных (v3.4.0: отложенно, через JsonPersistence)"""
+        persistence = get_shield_persistence()
+        if fingerprints:
+            persistence.mark_dirty(FINGERPRINTS_DB_FILE)
+        if passports:
+            persistence.mark_dirty(PASSPORTS_DB_FILE)
     
     async def add_video(self, filepath: str, user_id: int, 
                         username: str = "", **metadata) -> DigitalPassport:
@@ -554,8 +887,15 @@ class SimilarityDetector:
         
         # Вычисляем отпечатки
         file_hash = await VideoFingerprinter.calculate_file_hash(filepath)
-        perceptual_hash = await VideoFingerprinter.calculate_perceptual_hash(filepath)
-        temporal_sig = await VideoFingerprinter.calculate_temporal_signature(filepath)
+        try:
+            # v3.4.0: Перцептуальный хеш и временная сигнатура за один проход
+            fingerprints = await VideoFingerprinter.calculate_frame_fingerprints(filepath)
+            perceptual_hash = fingerprints.perceptual_hash
+            temporal_sig = fingerprints.temporal_signature
+        except Exception as e:
+            print(f"[FP] Frame fingerprints error: {e}")
+            perceptual_hash = file_hash[:16]
+            temporal_sig = "0" * 8
         
         # Получаем инфо о файле
         file_size = os.path.getsize(filepath) if os.path.exists(filepath) else 0
@@ -590,6 +930,8 @@ class SimilarityDetector:
             "created_at": passport.created_at,
         }
         
+        self.index.add(passport.passport_id, file_hash, perceptual_hash, user_id)
+        
         # Сохраняем паспорт
         self.passports_db[passport.passport_id] = passport
         
@@ -618,27 +960,18 @@ class SimilarityDetector:
         best_similarity = 0.0
         match_type = ""
         
-        for fp_id, fp_data in self.fingerprints_db.items():
-            # Пропускаем свои видео
-            if exclude_user_id and fp_data.get("user_id") == exclude_user_id:
-                continue
-            
-            # 1. Проверка точного совпадения
-            if fp_data.get("file_hash") == file_hash:
-                best_match = fp_id
-                best_similarity = 1.0
-                match_type = "exact"
-                break
-            
-            # 2. Визуальное сходство
-            visual_sim = VideoFingerprinter.compare_hashes(
-                perceptual_hash, 
-                fp_data.get("perceptual_hash", "")
-            )
-            
-            if visual_sim > best_similarity:
-                best_similarity = visual_sim
-                best_match = fp_id
+        # 1. Проверка точного совпадения (v3.4.0: через индекс, свои видео пропускаем)
+        exact_id = self.index.find_exact(file_hash, exclude_owner=exclude_user_id)
+        if exact_id:
+            best_match = exact_id
+            best_similarity = 1.0
+            match_type = "exact"
+        else:
+            # 2. Визуальное сходство в пределах радиуса
+            nearest = self.index.find_nearest(perceptual_hash, exclude_owner=exclude_user_id)
+            if nearest:
+                best_match, distance = nearest
+                best_similarity = 1.0 - distance / PERCEPTUAL_HASH_BITS
                 match_type = "visual"
         
         # Определяем уровень риска
@@ -660,7 +993,7 @@ class SimilarityDetector:
             # Увеличиваем счётчик совпадений
             if original_passport:
                 original_passport.matches_found += 1
-                self._save_databases()
+                self._save_databases(fingerprints=False)
             
             return MatchResult(
                 found=True,
@@ -679,6 +1012,16 @@ class SimilarityDetector:
             details={}
         )
     
+    def remove_video(self, passport_id: str) -> bool:
+        """v3.4.0: Удалить видео из базы и индекса"""
+        if passport_id not in self.passports_db and passport_id not in self.fingerprints_db:
+            return False
+        self.passports_db.pop(passport_id, None)
+        self.fingerprints_db.pop(passport_id, None)
+        self.index.remove(passport_id)
+        self._save_databases()
+        return True
+    
     def get_passport(self, passport_id: str) -> Optional[DigitalPassport]:
         """Получить паспорт по ID"""
         return self.passports_db.get(passport_id)
@@ -693,7 +1036,7 @@ class SimilarityDetector:
         if passport:
             passport.verification_count += 1
             passport.last_verified_at = time.time()
-            self._save_databases()
+            self._save_databases(fingerprints=False)
             return True
         return False
 
@@ -1010,6 +1353,9 @@ class AnalyticsManager:
     def __init__(self):
         self.data: Dict[int, UserAnalytics] = {}
         self._load()
+        get_shield_persistence().register(
+            ANALYTICS_FILE, lambda: {str(k): asdict(v) for k, v in self.data.items()}
+        )
     
     def _load(self):
         """Загрузка данных"""
@@ -1027,13 +1373,8 @@ class AnalyticsManager:
                 print(f"[ANALYTICS] Load error: {e}")
     
     def _save(self):
-        """Сохранение данных"""
-        try:
-            data = {str(k): asdict(v) for k, v in self.data.items()}
-            with open(ANALYTICS_FILE, 'w') as f:
-                json.dump(data, f, indent=2)
-        except Exception as e:
-            print(f"[ANALYTICS] Save error: {e}")
+        """Сохранение данных (v3.4.0: отложенно, через JsonPersistence)"""
+        get_shield_persistence().mark_dirty(ANALYTICS_FILE)
     
     def get_or_create(self, user_id: int) -> UserAnalytics:
         """Получить или создать аналитику пользователя"""
@@ -1392,6 +1733,9 @@ class AntiStealSystem:
         self.detector = detector
         self.theft_history: Dict[str, List[Dict]] = {}
         self._load_history()
+        get_shield_persistence().register(
+            self.THEFT_HISTORY_FILE, lambda: {k: list(v) for k, v in self.theft_history.items()}
+        )
     
     def _load_history(self):
         """Загрузка истории краж"""
@@ -1403,12 +1747,8 @@ class AntiStealSystem:
                 self.theft_history = {}
     
     def _save_history(self):
-        """Сохранение истории"""
-        try:
-            with open(self.THEFT_HISTORY_FILE, 'w') as f:
-                json.dump(self.theft_history, f, indent=2)
-        except Exception as e:
-            print(f"[ANTI-STEAL] Save error: {e}")
+        """Сохранение истории (v3.4.0: отложенно, через JsonPersistence)"""
+        get_shield_persistence().mark_dirty(self.THEFT_HISTORY_FILE)
     
     async def register_video(self, filepath: str, user_id: int, 
                             username: str = "", **metadata) -> DigitalPassport:
@@ -1447,30 +1787,18 @@ class AntiStealSystem:
         best_similarity = 0.0
         detection_method = ""
         
-        # Проходим только по видео указанного пользователя
-        for passport_id, passport in self.detector.passports_db.items():
-            if passport.owner_user_id != owner_user_id:
-                continue
-            
-            # Проверяем fingerprint
-            fp_data = self.detector.fingerprints_db.get(passport_id, {})
-            
-            # Точное совпадение хеша файла
-            if fp_data.get("file_hash") == file_hash:
-                best_match_passport = passport
-                best_similarity = 1.0
-                detection_method = "exact_hash"
-                break
-            
-            # Визуальное сходство
-            visual_sim = VideoFingerprinter.compare_hashes(
-                perceptual_hash,
-                fp_data.get("perceptual_hash", "")
-            )
-            
-            if visual_sim > best_similarity:
-                best_similarity = visual_sim
-                best_match_passport = passport
+        # v3.4.0: Ищем только среди видео указанного пользователя через индекс
+        index = self.detector.index
+        exact_id = index.find_exact(file_hash, owner_id=owner_user_id)
+        if exact_id and exact_id in self.detector.passports_db:
+            best_match_passport = self.detector.passports_db[exact_id]
+            best_similarity = 1.0
+            detection_method = "exact_hash"
+        else:
+            nearest = index.find_nearest(perceptual_hash, owner_id=owner_user_id)
+            if nearest and nearest[0] in self.detector.passports_db:
+                best_match_passport = self.detector.passports_db[nearest[0]]
+                best_similarity = 1.0 - nearest[1] / PERCEPTUAL_HASH_BITS
                 detection_method = "perceptual_hash"
         
         # Если нашли совпадение
@@ -1878,6 +2206,10 @@ class VirexShield:
     # Info
     # ────────────────────────────────────────────────────────────────────────
     
+    def get_persistence_stats(self) -> dict:
+        """v3.4.0: Счётчики записи баз (flush, байты, задержка)"""
+        return get_shield_persistence().get_stats()
+    
     def get_shield_info(self, lang: str = "ru") -> str:
         """Информация о системе"""
         total_passports = len(self.detector.passports_db)
@@ -1929,6 +2261,17 @@ _similarity_detector: Optional[SimilarityDetector] = None
 _safe_checker: Optional[SafeChecker] = None
 _analytics_manager: Optional[AnalyticsManager] = None
 _virex_shield: Optional[VirexShield] = None
+# v3.4.0: Shield грузится фоновой фазой запуска — защищаем от двойной инициализации
+_shield_lock = threading.Lock()
+_persistence: Optional[JsonPersistence] = None
+
+
+def get_shield_persistence() -> JsonPersistence:
+    """v3.4.0: Общий слой отложенной записи баз"""
+    global _persistence
+    if _persistence is None:
+        _persistence = JsonPersistence()
+    return _persistence
 
 
 def get_similarity_detector() -> SimilarityDetector:
@@ -1956,7 +2299,9 @@ def get_virex_shield() -> VirexShield:
     """Получить главный экземпляр Virex Shield"""
     global _virex_shield
     if _virex_shield is None:
-        _virex_shield = VirexShield()
+        with _shield_lock:
+            if _virex_shield is None:
+                _virex_shield = VirexShield()
     return _virex_shield
 
 
@@ -1970,6 +2315,7 @@ __all__ = [
     
     # Dataclasses
     "DigitalPassport",
+    "FrameFingerprints",
     "MatchResult",
     "SafeCheckResult",
     "UserAnalytics",
@@ -1978,7 +2324,9 @@ __all__ = [
     "ScanResult",
     
     # Classes
+    "JsonPersistence",
     "VideoFingerprinter",
+    "FingerprintIndex",
     "SimilarityDetector",
     "SafeChecker",
     "AnalyticsManager",
@@ -1997,4 +2345,5 @@ __all__ = [
     "get_safe_checker",
     "get_analytics_manager",
     "get_virex_shield",
+    "get_shield_persistence",
 ]
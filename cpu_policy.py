@@ -0,0 +1,168 @@
+"""
+Virex — CPU Policy v3.4.0
+
+Сколько CPU реально доступно процессу и как его делить между задачами:
+- Ядра: sched_getaffinity (учитывает taskset / cpuset), иначе os.cpu_count()
+- Квота cgroup: v2 cpu.max, v1 cpu.cfs_quota_us / cpu.cfs_period_us
+  (по пути процесса из /proc/self/cgroup и его родителям, берётся минимум)
+- Бюджет потоков = min(ядра, квота), VIREX_CPU_THREADS переопределяет
+- Потоки задачи — по разрешению кадра (CPU_THREAD_TIERS), не больше бюджета;
+  FFmpeg получает -threads / -filter_threads, планировщик списывает их из бюджета
+- Воркеров столько, чтобы бюджет заполнялся самыми лёгкими задачами;
+  лишние воркеры ждут в планировщике, а не конкурируют за ядра
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from config import (
+    MAX_CONCURRENT_TASKS,
+    CPU_POLICY_ENABLED,
+    CPU_THREADS_OVERRIDE,
+    CPU_THREAD_TIERS,
+    CPU_THREADS_ABOVE_TIERS,
+    CPU_MAX_WORKERS,
+)
+
+CGROUP_ROOT = "/sys/fs/cgroup"
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def detect_cpu_count() -> int:
+    """Ядра, на которых процессу разрешено выполняться"""
+    if hasattr(os, "sched_getaffinity"):
+        try:
+            return max(1, len(os.sched_getaffinity(0)))
+        except OSError:
+            pass
+    return os.cpu_count() or 1
+
+
+def _cgroup_dirs(base: str, rel_path: str):
+    """Каталог группы процесса и все родители (квота родителя тоже ограничивает)"""
+    rel_path = rel_path.strip("/")
+    while True:
+        yield os.path.join(base, rel_path) if rel_path else base
+        if not rel_path:
+            return
+        rel_path = os.path.dirname(rel_path)
+
+
+def _quota_v2(rel_path: str) -> Optional[float]:
+    quotas = []
+    for directory in _cgroup_dirs(CGROUP_ROOT, rel_path):
+        value = _read(os.path.join(directory, "cpu.max"))
+        if not value:
+            continue
+        quota, _, period = value.partition(" ")
+        if quota != "max" and period:
+            quotas.append(int(quota) / int(period))
+    return min(quotas) if quotas else None
+
+
+def _quota_v1(rel_path: str, controllers: str) -> Optional[float]:
+    quotas = []
+    for mount in (controllers, "cpu", "cpu,cpuacct"):
+        base = os.path.join(CGROUP_ROOT, mount)
+        if not os.path.isdir(base):
+            continue
+        # В контейнере путь из /proc/self/cgroup часто не смонтирован — тогда корень
+        for directory in _cgroup_dirs(base, rel_path):
+            quota = _read(os.path.join(directory, "cpu.cfs_quota_us"))
+            period = _read(os.path.join(directory, "cpu.cfs_period_us"))
+            if quota and period and int(quota) > 0:
+                quotas.append(int(quota) / int(period))
+        break
+    return min(quotas) if quotas else None
+
+
+def detect_cgroup_quota() -> Optional[float]:
+    """Квота CPU в ядрах (1.5 = полтора ядра) или None, если не ограничена"""
+    content = _read("/proc/self/cgroup")
+    if content is None:
+        return None
+    try:
+        for line in content.splitlines():
+            _, controllers, rel_path = line.split(":", 2)
+            if controllers == "" and os.path.exists(os.path.join(CGROUP_ROOT, "cgroup.controllers")):
+                quota = _quota_v2(rel_path)
+                if quota:
+                    return quota
+            elif "cpu" in controllers.split(","):
+                quota = _quota_v1(rel_path, controllers)
+                if quota:
+                    return quota
+    except ValueError:
+        pass
+    return None
+
+
+@dataclass
+class CpuPolicy:
+    """Бюджет потоков FFmpeg и его раздача задачам"""
+    cores: int
+    quota: Optional[float]
+    threads: int                        # Бюджет потоков (ёмкость планировщика)
+    workers: int
+    enabled: bool = True
+
+    def threads_for(self, width: int, height: int) -> int:
+        """Потоков на задачу по разрешению (0 — политика выключена, решает FFmpeg)"""
+        if not self.enabled:
+            return 0
+        pixels = (width or 0) * (height or 0)
+        wanted = CPU_THREADS_ABOVE_TIERS
+        for max_pixels, tier_threads in CPU_THREAD_TIERS:
+            if pixels <= max_pixels:
+                wanted = tier_threads
+                break
+        return max(1, min(wanted, self.threads))
+
+    def weight_for(self, width: int, height: int) -> int:
+        """Сколько единиц ёмкости планировщика занимает задача"""
+        return self.threads_for(width, height) or 1
+
+    def describe(self) -> str:
+        if not self.enabled:
+            return f"fixed: {self.workers} workers"
+        quota = f"{self.quota:.2f}" if self.quota else "none"
+        return f"cores={self.cores} quota={quota} → {self.threads} threads, {self.workers} workers"
+
+
+def build_cpu_policy(cores: int = None, quota: Optional[float] = -1.0,
+                     override: int = CPU_THREADS_OVERRIDE,
+                     enabled: bool = CPU_POLICY_ENABLED) -> CpuPolicy:
+    """Политика по обнаруженным (или переданным — для тестов/бенчмарка) ресурсам"""
+    cores = cores or detect_cpu_count()
+    quota = detect_cgroup_quota() if quota == -1.0 else quota
+    if not enabled:
+        return CpuPolicy(cores, quota, MAX_CONCURRENT_TASKS, MAX_CONCURRENT_TASKS, enabled=False)
+
+    threads = cores
+    if quota:
+        threads = min(threads, max(1, int(quota + 0.5)))
+    if override > 0:
+        threads = override
+    lightest = min(tier_threads for _, tier_threads in CPU_THREAD_TIERS)
+    # С округлением вверх: остаток бюджета тоже может взять задача
+    workers = max(1, min(CPU_MAX_WORKERS, -(-threads // lightest)))
+    return CpuPolicy(cores, quota, threads, workers)
+
+
+# Singleton
+_policy: Optional[CpuPolicy] = None
+
+
+def get_cpu_policy() -> CpuPolicy:
+    global _policy
+    if _policy is None:
+        _policy = build_cpu_policy()
+        print(f"[CPU] Policy: {_policy.describe()}")
+    return _policy
@@ -0,0 +1,184 @@
+"""
+Virex — Telegram Download Manager v3.4.0
+
+Загрузка файлов из Telegram для склейки и обработки:
+- Параллельно, под глобальным и пользовательским лимитом соединений
+- Повторы с backoff; недокачанный .part докачивается через Range
+- Кэш по file_unique_id (в ResultCache): повторная склейка / обработка
+  того же клипа обходится без скачивания
+- Одновременные запросы одного file_unique_id качаются один раз
+"""
+import os
+import asyncio
+from typing import Callable, Dict, List, Optional
+
+import aiohttp
+import aiofiles
+
+from config import (
+    DOWNLOAD_GLOBAL_CONCURRENCY,
+    DOWNLOAD_PER_USER_CONCURRENCY,
+    DOWNLOAD_RETRIES,
+    DOWNLOAD_TIMEOUT_SECONDS,
+    DOWNLOAD_CHUNK_SIZE,
+)
+from result_cache import get_result_cache
+
+_RETRY_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, OSError)
+
+
+class DownloadManager:
+    """ Параллельные загрузки из Telegram с лимитами, докачкой и кэшем """
+
+    def __init__(self, bot,
+                 global_limit: int = DOWNLOAD_GLOBAL_CONCURRENCY,
+                 per_user_limit: int = DOWNLOAD_PER_USER_CONCURRENCY,
+                 retries: int = DOWNLOAD_RETRIES):
+        self.bot = bot
+        self.per_user_limit = per_user_limit
+        self.retries = retries
+        self._global = asyncio.Semaphore(global_limit)
+        self._per_user: Dict[int, asyncio.Semaphore] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {"downloads": 0, "cache_hits": 0, "resumed": 0, "retries": 0, "bytes": 0}
+
+    def _user_semaphore(self, user_id: int) -> asyncio.Semaphore:
+        sem = self._per_user.get(user_id)
+        if sem is None:
+            sem = self._per_user[user_id] = asyncio.Semaphore(self.per_user_limit)
+        return sem
+
+    @staticmethod
+    def _cache_key(file_unique_id: str) -> str:
+        return get_result_cache().make_key("tg_file", file_unique_id)
+
+    @staticmethod
+    def _part_path(file_unique_id: str) -> str:
+        cache = get_result_cache()
+        part_dir = cache.cache_dir / "partial"
+        part_dir.mkdir(exist_ok=True)
+        return str(part_dir / f"{file_unique_id}.part")
+
+    # ═════════════════════════════════════════════════════════════
+    # PUBLIC
+    # ═════════════════════════════════════════════════════════════
+
+    async def fetch(self, file_id: str, output_path: str, user_id: int = 0) -> str:
+        """Скачать файл в output_path (или взять из кэша). Возвращает output_path"""
+        tg_file = await self.bot.get_file(file_id)
+        unique_id = tg_file.file_unique_id
+        cache = get_result_cache()
+        key = self._cache_key(unique_id)
+        if cache.get(key, output_path):
+            self.stats["cache_hits"] += 1
+            return output_path
+
+        # Тот же клип уже качается — ждём ту загрузку и берём результат из кэша
+        pending = self._inflight.get(unique_id)
+        if pending is not None:
+            await asyncio.shield(pending)
+            if cache.get(key, output_path):
+                self.stats["cache_hits"] += 1
+                return output_path
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[unique_id] = future
+        try:
+            async with self._user_semaphore(user_id), self._global:
+                part_path = await self._download_with_retry(tg_file, self._part_path(unique_id))
+            os.replace(part_path, output_path)
+            cache.put(key, output_path)
+            future.set_result(True)
+            return output_path
+        except BaseException:
+            future.set_result(False)
+            raise
+        finally:
+            self._inflight.pop(unique_id, None)
+
+    async def fetch_many(self, file_ids: List[str], user_id: int,
+                         make_path: Callable[[int], str]) -> List[str]:
+        """
+        Скачать несколько файлов параллельно (порядок результата = порядок file_ids).
+        При ошибке — уже скачанные удаляются, исключение пробрасывается.
+        """
+        paths = [make_path(i) for i in range(len(file_ids))]
+        results = await asyncio.gather(
+            *(self.fetch(file_id, path, user_id) for file_id, path in zip(file_ids, paths)),
+            return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+            raise errors[0]
+        return paths
+
+    def get_stats(self) -> dict:
+        return dict(self.stats)
+
+    # ═════════════════════════════════════════════════════════════
+    # DOWNLOAD
+    # ═════════════════════════════════════════════════════════════
+
+    async def _download_with_retry(self, tg_file, part_path: str) -> str:
+        for attempt in range(self.retries):
+            try:
+                await self._download(tg_file, part_path)
+                size = os.path.getsize(part_path)
+                if tg_file.file_size and size != tg_file.file_size:
+                    raise OSError(f"size mismatch: {size} != {tg_file.file_size}")
+                self.stats["downloads"] += 1
+                self.stats["bytes"] += size
+                return part_path
+            except _RETRY_ERRORS as e:
+                if attempt == self.retries - 1:
+                    # Докачивать больше некому — .part не оставляем
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+                    raise
+                self.stats["retries"] += 1
+                print(f"[DOWNLOAD] {tg_file.file_unique_id} attempt {attempt + 1} failed: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _download(self, tg_file, part_path: str):
+        api = self.bot.session.api
+        if api.is_local:
+            # Локальный Bot API сервер — файл уже на диске
+            await self.bot.download_file(tg_file.file_path, part_path)
+            return
+
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if tg_file.file_size and offset > tg_file.file_size:
+            os.remove(part_path)
+            offset = 0
+        if tg_file.file_size and offset == tg_file.file_size:
+            return
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        session = await self.bot.session.create_session()
+        url = api.file_url(self.bot.token, tg_file.file_path)
+        timeout = aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT_SECONDS)
+        async with session.get(url, headers=headers, timeout=timeout) as resp:
+            resp.raise_for_status()
+            # 206 — сервер докачивает, 200 — отдаёт файл целиком
+            resumed = offset and resp.status == 206
+            if resumed:
+                self.stats["resumed"] += 1
+            async with aiofiles.open(part_path, 'ab' if resumed else 'wb') as f:
+                async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                    await f.write(chunk)
+
+
+# Singleton
+_download_manager: Optional[DownloadManager] = None
+
+
+def get_download_manager(bot=None) -> DownloadManager:
+    global _download_manager
+    if _download_manager is None:
+        if bot is None:
+            raise RuntimeError("DownloadManager is not initialized")
+        _download_manager = DownloadManager(bot)
+    return _download_manager
@@ -2,12 +2,19 @@
 Virex — FFmpeg Video Processing (Anti-TikTok 2026)
 """
 import os
+import re
 import random
 import asyncio
+import signal
 import subprocess
 import tempfile
 import uuid
 import time
+import json
+import struct
+from collections import OrderedDict, deque
+from contextvars import ContextVar
+from dataclasses import dataclass, field
 from pathlib import Path
 from typing import Optional, Tuple, List
 from config import (
@@ -15,7 +22,6 @@ from config import (
     TIKTOK_VIDEO, TIKTOK_AUDIO,
     YOUTUBE_VIDEO, YOUTUBE_AUDIO,
     FFMPEG_TIMEOUT_SECONDS,
-    MAX_CONCURRENT_TASKS,
     MAX_QUEUE_SIZE,
     FFMPEG_PATH,
     FFPROBE_PATH,
@@ -27,7 +33,27 @@ from config import (
     MEMORY_CLEANUP_INTERVAL_MINUTES,
     # v3.2.0
     WATERMARK_TRAP_ENABLED,
+    # v3.4.0
+    PROBE_CACHE_SIZE,
+    PROBE_TIMEOUT_SECONDS,
+    PROGRESS_UPDATE_INTERVAL,
+    FFMPEG_STDERR_TAIL_LINES,
+    FFMPEG_STDERR_MAX_LINE,
+    FFMPEG_SAMPLE_INTERVAL,
+    QUEUE_ADMISSION_MAX_WAIT_SECONDS,
+    MERGE_NORMALIZE_MAX_SHARE,
+    TELEGRAM_DELIVERY_MAX_MB,
+    RATE_CONTROL_CONTAINER_OVERHEAD,
+    RATE_CONTROL_MIN_VIDEO_KBPS,
+    RATE_CONTROL_FALLBACK_AUDIO,
+    RATE_CONTROL_ALPHA,
+    SEGMENT_ENCODE_ENABLED,
+    SEGMENT_ENCODE_MIN_MEGAPIXELS,
+    SEGMENT_ENCODE_MAX_SEGMENTS,
+    SEGMENT_ENCODE_MIN_SECONDS,
 )
+from metrics import JobMetrics, PLAN_BY_PRIORITY, get_metrics_registry
+from cpu_policy import get_cpu_policy
 
 processing_queue: asyncio.Queue = None
 active_processes: list = []
@@ -48,6 +74,13 @@ except ImportError:
     WATERMARK_TRAP_AVAILABLE = False
     print("[WARN] watermark_trap module not available")
 
+# v3.4.0: CPU / пиковая память процессов FFmpeg
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
 # ══════════════════════════════════════════════════════════════════════════════
 # ANTI-TIKTOK 2026: CREATIVE TEXTS
 # ══════════════════════════════════════════════════════════════════════════════
@@ -211,12 +244,26 @@ class ProgressTracker:
         self.current_time = 0
         self.stage = "downloading"  # downloading, processing, uploading
         self.start_time = time.time()
+        # v3.4.0: Данные из -progress pipe:1
+        self.speed = 0.0            # Скорость кодирования (x реального времени)
+        self.last_report = 0.0      # Когда последний раз показали прогресс
     
-    def update(self, current_time: float):
+    def update(self, current_time: float, speed: float = None):
         self.current_time = current_time
+        if speed is not None:
+            self.speed = speed
     
     def set_stage(self, stage: str):
         self.stage = stage
+        self.start_time = time.time()
+    
+    def should_report(self, interval: float = PROGRESS_UPDATE_INTERVAL) -> bool:
+        """Троттлинг обновлений статуса (Telegram ограничивает частоту edit)"""
+        now = time.time()
+        if now - self.last_report < interval:
+            return False
+        self.last_report = now
+        return True
     
     def get_percent(self) -> int:
         if self.total_duration <= 0:
@@ -229,8 +276,12 @@ class ProgressTracker:
         if percent <= 0:
             return "?"
         
-        total_time = elapsed / (percent / 100)
-        remaining = total_time - elapsed
+        if self.speed > 0:
+            # v3.4.0: По реальной скорости кодирования
+            remaining = max(0, self.total_duration - self.current_time) / self.speed
+        else:
+            total_time = elapsed / (percent / 100)
+            remaining = total_time - elapsed
         
         if remaining < 60:
             return f"{int(remaining)}с"
@@ -240,11 +291,27 @@ class ProgressTracker:
             return f"{int(remaining // 3600)}ч"
 
 # v2.8.0: Estimate queue wait time
+def estimate_queue_seconds(position: int) -> float:
+    """
+    v3.4.0: Ожидание в секундах по измеренным длительностям задач.
+    Суммируем прогноз для `position` задач в очереди (по приоритету).
+    """
+    from queue_estimator import get_queue_estimator
+    estimator = get_queue_estimator()
+    
+    queued = sorted(
+        (t for t in active_tasks.values() if not t.cancelled and not t.started_at),
+        key=lambda t: (-t.priority, t.created_at)
+    )[:position]
+    total = sum(estimator.predict(t.features) for t in queued)
+    # Задачи без записи в active_tasks — по средней длительности
+    total += max(0, position - len(queued)) * estimator.job_seconds
+    return total / get_cpu_policy().workers
+
+
 def estimate_queue_time(position: int) -> str:
     """ Примерное время ожидания в очереди """
-    # Среднее время обработки ~30 сек
-    avg_process_time = 30
-    wait_seconds = (position / MAX_CONCURRENT_TASKS) * avg_process_time
+    wait_seconds = estimate_queue_seconds(position)
     
     if wait_seconds < 60:
         return f"{int(wait_seconds)}с"
@@ -842,76 +909,796 @@ def _build_youtube_filter(width: int, height: int) -> Tuple[str, str, dict]:
     return _build_youtube_filter_v2(width, height, 30.0, 30.0)
 
 # ══════════════════════════════════════════════════════════════════════════════
-# VIDEO INFO & PROCESSING
+# v3.4.0: FFMPEG RUNNER (единый запуск FFmpeg / ffprobe)
 # ══════════════════════════════════════════════════════════════════════════════
+#
+# Все вызовы FFmpeg идут через run_ffmpeg():
+# - stderr читается по мере вывода, в памяти — только последние tail_lines строк
+#   (раньше communicate() держал весь вывод многоминутного кодирования)
+# - строки режутся и по \r (статистика FFmpeg), длинные обрезаются
+# - процесс — лидер своей группы: таймаут, отмена задачи и kill_all_ffmpeg
+#   убивают всю группу
+# - регистрация в active_processes — только здесь
+# - замеры: wall, CPU и пиковый RSS (psutil, раз в FFMPEG_SAMPLE_INTERVAL)
+
+_LINE_SPLIT = re.compile(rb"[\r\n]")
+
+# label → {"runs", "failures", "timeouts", "wall", "cpu", "peak_rss"}
+runner_stats: dict = {}
+
+# Учёт ресурсов задачи: объект с add_usage(cpu, peak_rss), обычно JobMetrics.
+# Контекст копируется в дочерние asyncio-задачи, поэтому все FFmpeg одной
+# ProcessingTask попадают в её метрики без передачи через аргументы.
+usage_sink: ContextVar = ContextVar("ffmpeg_usage_sink", default=None)
+
+
+@dataclass
+class FFmpegResult:
+    """Итог одного запуска FFmpeg / ffprobe"""
+    returncode: Optional[int]
+    stderr_tail: str = ""
+    stdout: bytes = b""                 # Только при capture_stdout=True
+    timed_out: bool = False
+    wall: float = 0.0                   # Секунды
+    cpu: float = 0.0                    # user + system, секунды
+    peak_rss: int = 0                   # Байты (0 — psutil недоступен)
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0 and not self.timed_out
+
+    def error(self, limit: int = 200) -> str:
+        """Текст ошибки для пользователя/лога: конец stderr, а не баннер"""
+        if self.timed_out:
+            return "Timeout"
+        return self.stderr_tail[-limit:]
+
+
+def _kill_process_group(proc):
+    """SIGKILL всей группе процесса (FFmpeg мог запустить дочерние)"""
+    if proc.returncode is not None:
+        return
+    try:
+        if os.name == "posix":
+            os.killpg(proc.pid, signal.SIGKILL)
+        else:
+            proc.kill()
+    except ProcessLookupError:
+        pass
+    except Exception:
+        try:
+            proc.kill()
+        except Exception:
+            pass
 
-async def get_video_info(input_path: str) -> Optional[Tuple[int, int, float, float]]:
-    """Получает width, height, duration, fps из видео"""
-    # Проверяем что файл существует
-    if not os.path.exists(input_path):
+
+async def _read_lines(stream, on_line):
+    """Построчное чтение потока (\\n и \\r), строка не длиннее FFMPEG_STDERR_MAX_LINE"""
+    pending = b""
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        parts = _LINE_SPLIT.split(pending + chunk)
+        pending = parts.pop()[-FFMPEG_STDERR_MAX_LINE:]
+        for part in parts:
+            if part:
+                result = on_line(part[:FFMPEG_STDERR_MAX_LINE].decode(errors="ignore"))
+                if asyncio.iscoroutine(result):
+                    await result
+    if pending:
+        result = on_line(pending.decode(errors="ignore"))
+        if asyncio.iscoroutine(result):
+            await result
+
+
+async def _sample_usage(pid: int, usage: dict):
+    """Периодические замеры CPU и RSS процесса (последний замер — итог по CPU)"""
+    try:
+        process = psutil.Process(pid)
+        while True:
+            with process.oneshot():
+                times = process.cpu_times()
+                usage["cpu"] = times.user + times.system
+                usage["peak_rss"] = max(usage["peak_rss"], process.memory_info().rss)
+            await asyncio.sleep(FFMPEG_SAMPLE_INTERVAL)
+    except (psutil.Error, OSError):
+        pass  # Процесс уже завершился
+
+
+def _record_run(label: str, result: FFmpegResult):
+    stats = runner_stats.setdefault(label, {
+        "runs": 0, "failures": 0, "timeouts": 0, "wall": 0.0, "cpu": 0.0, "peak_rss": 0,
+    })
+    stats["runs"] += 1
+    stats["failures"] += not result.ok
+    stats["timeouts"] += result.timed_out
+    stats["wall"] += result.wall
+    stats["cpu"] += result.cpu
+    stats["peak_rss"] = max(stats["peak_rss"], result.peak_rss)
+
+
+def get_runner_stats() -> dict:
+    """Сводка запусков FFmpeg по меткам: число, ошибки, среднее wall/CPU, пик RSS"""
+    summary = {}
+    for label, stats in runner_stats.items():
+        runs = stats["runs"] or 1
+        summary[label] = {
+            "runs": stats["runs"],
+            "failures": stats["failures"],
+            "timeouts": stats["timeouts"],
+            "avg_wall": round(stats["wall"] / runs, 2),
+            "avg_cpu": round(stats["cpu"] / runs, 2),
+            "peak_rss_mb": round(stats["peak_rss"] / 1024 / 1024, 1),
+        }
+    return summary
+
+
+async def run_ffmpeg(
+    cmd: List[str],
+    label: str = "ffmpeg",
+    timeout: float = FFMPEG_TIMEOUT_SECONDS,
+    capture_stdout: bool = False,
+    on_stdout_line=None,
+    on_stderr_line=None,
+    tail_lines: int = FFMPEG_STDERR_TAIL_LINES,
+    preexec_fn=None,
+) -> FFmpegResult:
+    """
+    Запуск FFmpeg / ffprobe.
+    capture_stdout — вернуть stdout целиком (JSON ffprobe, rawvideo в pipe:1);
+    on_stdout_line / on_stderr_line — разбор вывода по строкам (можно async).
+    Таймаут не бросает исключение: result.timed_out = True.
+    При отмене задачи процесс убивается, CancelledError пробрасывается.
+    """
+    stderr_tail = deque(maxlen=tail_lines)
+    stdout_chunks: List[bytes] = []
+    usage = {"cpu": 0.0, "peak_rss": 0}
+    kwargs = {"preexec_fn": preexec_fn} if preexec_fn else {}
+    if os.name == "posix":
+        kwargs["start_new_session"] = True  # Своя группа процессов
+
+    def on_stderr(line: str):
+        stderr_tail.append(line.rstrip())
+        if on_stderr_line is not None:
+            return on_stderr_line(line)
+
+    async def read_stdout():
+        if on_stdout_line is not None:
+            await _read_lines(proc.stdout, on_stdout_line)
+            return
+        while True:
+            chunk = await proc.stdout.read(65536)
+            if not chunk:
+                break
+            if capture_stdout:
+                stdout_chunks.append(chunk)
+
+    started = time.perf_counter()
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        **kwargs
+    )
+    active_processes.append(proc)
+    sampler = asyncio.create_task(_sample_usage(proc.pid, usage)) if PSUTIL_AVAILABLE else None
+
+    # Чтение не отменяется по таймауту: после kill каналы закроются сами
+    io = asyncio.gather(read_stdout(), _read_lines(proc.stderr, on_stderr), proc.wait())
+    timed_out = False
+    try:
+        done, _ = await asyncio.wait({io}, timeout=timeout)
+        timed_out = not done
+    finally:
+        if proc.returncode is None:
+            _kill_process_group(proc)
+        try:
+            await io
+        finally:
+            if proc in active_processes:
+                active_processes.remove(proc)
+            if sampler is not None:
+                sampler.cancel()
+
+    result = FFmpegResult(
+        returncode=proc.returncode,
+        stderr_tail="\n".join(stderr_tail),
+        stdout=b"".join(stdout_chunks),
+        timed_out=timed_out,
+        wall=time.perf_counter() - started,
+        cpu=usage["cpu"],
+        peak_rss=usage["peak_rss"],
+    )
+    _record_run(label, result)
+    sink = usage_sink.get()
+    if sink is not None:
+        sink.add_usage(result.cpu, result.peak_rss)
+    status = "timeout" if timed_out else f"rc={result.returncode}"
+    print(f"[FFMPEG] {label}: {status} wall={result.wall:.2f}s cpu={result.cpu:.2f}s "
+          f"rss={result.peak_rss / 1024 / 1024:.0f}MB")
+    return result
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: MEDIA PROBE (один ffprobe на файл + LRU кэш)
+# ══════════════════════════════════════════════════════════════════════════════
+
+@dataclass
+class MediaInfo:
+    """Результат одного ffprobe -show_streams -show_format"""
+    path: str
+    width: int = 0
+    height: int = 0
+    fps: float = 30.0
+    duration: float = 0.0          # Длительность видеопотока (или контейнера)
+    format_duration: float = 0.0   # Длительность контейнера
+    has_video: bool = False
+    has_audio: bool = False
+    video_codec: str = ""
+    audio_codec: str = ""
+    bit_rate: int = 0
+    size: int = 0
+    format_name: str = ""
+    tags: dict = field(default_factory=dict)
+    streams: list = field(default_factory=list)
+    format: dict = field(default_factory=dict)
+
+
+_probe_cache: "OrderedDict[tuple, MediaInfo]" = OrderedDict()
+probe_stats = {"hits": 0, "misses": 0}
+
+
+def _parse_fps(fps_str: str, default: float = 30.0) -> float:
+    """Парсинг r_frame_rate ("30/1", "60000/1001")"""
+    try:
+        if "/" in fps_str:
+            num, den = fps_str.split("/")
+            if float(den) > 0:
+                return float(num) / float(den)
+            return default
+        return float(fps_str) if fps_str else default
+    except (ValueError, TypeError):
+        return default
+
+
+def _parse_media_info(path: str, data: dict) -> MediaInfo:
+    """Собирает MediaInfo из JSON ffprobe"""
+    streams = data.get("streams", [])
+    fmt = data.get("format", {})
+    info = MediaInfo(path=path, streams=streams, format=fmt)
+    
+    video = next((st for st in streams if st.get("codec_type") == "video"), None)
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), None)
+    
+    try:
+        info.format_duration = float(fmt.get("duration", 0) or 0)
+    except ValueError:
+        info.format_duration = 0.0
+    try:
+        info.bit_rate = int(fmt.get("bit_rate", 0) or 0)
+    except ValueError:
+        info.bit_rate = 0
+    info.format_name = fmt.get("format_name", "")
+    info.tags = fmt.get("tags", {}) or {}
+    
+    if video:
+        info.has_video = True
+        info.width = int(video.get("width", 0) or 0)
+        info.height = int(video.get("height", 0) or 0)
+        info.fps = _parse_fps(video.get("r_frame_rate", ""))
+        info.video_codec = video.get("codec_name", "")
+        try:
+            info.duration = float(video.get("duration", 0) or 0)
+        except ValueError:
+            info.duration = 0.0
+    if not info.duration:
+        info.duration = info.format_duration
+    
+    if audio:
+        info.has_audio = True
+        info.audio_codec = audio.get("codec_name", "")
+    
+    return info
+
+
+async def probe(input_path: str) -> Optional[MediaInfo]:
+    """
+    Единственный ffprobe на файл: -show_streams -show_format в JSON.
+    Результат кэшируется по (path, size, mtime); при изменении файла ключ меняется.
+    """
+    try:
+        st = os.stat(input_path)
+    except OSError:
         print(f"[FFPROBE] File not found: {input_path}")
         return None
     
+    key = (os.path.abspath(input_path), st.st_size, st.st_mtime_ns)
+    cached = _probe_cache.get(key)
+    if cached is not None:
+        _probe_cache.move_to_end(key)
+        probe_stats["hits"] += 1
+        return cached
+    probe_stats["misses"] += 1
+    
     cmd = [
         FFPROBE_PATH,
         "-v", "error",
-        "-select_streams", "v:0",
-        "-show_entries", "stream=width,height,r_frame_rate,duration",
-        "-of", "csv=p=0",
+        "-print_format", "json",
+        "-show_streams",
+        "-show_format",
         input_path
     ]
     
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=30)
+        result = await run_ffmpeg(cmd, label="probe", timeout=PROBE_TIMEOUT_SECONDS,
+                                  capture_stdout=True)
+        if result.timed_out:
+            print(f"[FFPROBE] Timeout for file: {input_path}")
+            return None
         
         # Логируем ошибки ffprobe
-        if stderr:
-            stderr_text = stderr.decode().strip()
-            if stderr_text:
-                print(f"[FFPROBE] stderr: {stderr_text[:200]}")
+        if result.stderr_tail.strip():
+            print(f"[FFPROBE] stderr: {result.error()}")
         
-        # Формат вывода: width,height,r_frame_rate,duration
-        output = stdout.decode().strip()
+        output = result.stdout.decode(errors="ignore").strip()
         if not output:
             print(f"[FFPROBE] Empty output for file: {input_path}")
             return None
-            
-        parts = output.split(",")
-        if len(parts) >= 2:
-            width = int(parts[0])
-            height = int(parts[1])
-            
-            # Parse FPS (format: "30/1" or "60000/1001") - parts[2]
-            fps = 30.0
-            if len(parts) > 2 and parts[2]:
-                fps_str = parts[2]
-                if "/" in fps_str:
-                    fps_parts = fps_str.split("/")
-                    if len(fps_parts) == 2 and float(fps_parts[1]) > 0:
-                        fps = float(fps_parts[0]) / float(fps_parts[1])
-                else:
-                    fps = float(fps_str)
-            
-            # Duration - parts[3]
-            duration = 60.0
-            if len(parts) > 3 and parts[3]:
-                try:
-                    duration = float(parts[3])
-                except ValueError:
-                    duration = 60.0
-            
-            return width, height, duration, fps
+        
+        info = _parse_media_info(input_path, json.loads(output))
     except Exception as e:
         print(f"[FFPROBE] Error: {e}")
+        return None
+    
+    _probe_cache[key] = info
+    while len(_probe_cache) > PROBE_CACHE_SIZE:
+        _probe_cache.popitem(last=False)
+    return info
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: FILTER GRAPH COMPOSITION (одно кодирование вместо цепочки)
+# ══════════════════════════════════════════════════════════════════════════════
+
+@dataclass
+class FilterFragment:
+    """Вклад одной операции в общий граф: фильтры + выходные опции"""
+    video: List[str] = field(default_factory=list)
+    audio: List[str] = field(default_factory=list)
+    output_args: List[str] = field(default_factory=list)   # -map_metadata и т.п.
+    speed: float = 1.0                                      # Множитель скорости (длительность / speed)
+
+    @property
+    def video_filter(self) -> str:
+        return ",".join(self.video)
+
+    @property
+    def audio_filter(self) -> str:
+        return ",".join(self.audio)
+
+
+# Кодер по умолчанию (как у одиночных операций: libx264 fast + aac)
+DEFAULT_ENCODER_ARGS = ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-c:a", "aac"]
+
+
+class FilterPipeline:
+    """
+    Склейка фрагментов в один вызов FFmpeg.
+    Фильтры идут в порядке добавления, кодирование — одно, в конце.
+    """
+
+    def __init__(self, fragments: List[FilterFragment] = None):
+        self.fragments: List[FilterFragment] = list(fragments or [])
+
+    def add(self, fragment: FilterFragment) -> "FilterPipeline":
+        self.fragments.append(fragment)
+        return self
+
+    @property
+    def video_filter(self) -> str:
+        return ",".join(f.video_filter for f in self.fragments if f.video)
+
+    @property
+    def audio_filter(self) -> str:
+        return ",".join(f.audio_filter for f in self.fragments if f.audio)
+
+    @property
+    def speed(self) -> float:
+        total = 1.0
+        for f in self.fragments:
+            total *= f.speed
+        return total
+
+    def output_duration(self, input_duration: float) -> float:
+        """Длительность результата (нужна для расчёта битрейта сжатия)"""
+        return input_duration / self.speed
+
+    def build_command(self, input_path: str, output_path: str,
+                      encoder_args: List[str] = None, has_audio: bool = True) -> List[str]:
+        cmd = [FFMPEG_PATH, "-y", "-i", input_path]
+        if self.video_filter:
+            cmd.extend(["-vf", self.video_filter])
+        if has_audio and self.audio_filter:
+            cmd.extend(["-af", self.audio_filter])
+        cmd.extend(encoder_args if encoder_args is not None else DEFAULT_ENCODER_ARGS)
+        for f in self.fragments:
+            cmd.extend(f.output_args)
+        cmd.append(output_path)
+        return cmd
+
+    async def run(self, input_path: str, output_path: str,
+                  encoder_args: List[str] = None, has_audio: bool = True) -> Tuple[bool, Optional[str]]:
+        cmd = self.build_command(input_path, output_path, encoder_args, has_audio)
+        print(f"[FFMPEG] Pipeline: {len(self.fragments)} fragments, VF length: {len(self.video_filter)}")
+        try:
+            result = await run_ffmpeg(cmd, label="pipeline")
+            if not result.ok:
+                return False, result.error()
+            return True, None
+        except Exception as e:
+            return False, str(e)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: FFMPEG PROGRESS (-progress pipe:1)
+# ══════════════════════════════════════════════════════════════════════════════
+
+# Скорость кодирования по пресету и разрешению: "fast@1080p" → {"count", "avg_speed"}
+encode_stats: dict = {}
+
+
+def _resolution_bucket(width: int, height: int) -> str:
+    short_side = min(width, height)
+    for bucket in (480, 720, 1080, 1440, 2160):
+        if short_side <= bucket:
+            return f"{bucket}p"
+    return "4320p"
+
+
+def _record_encode_speed(preset: str, width: int, height: int, speed: float):
+    if speed <= 0:
+        return
+    key = f"{preset}@{_resolution_bucket(width, height)}"
+    entry = encode_stats.setdefault(key, {"count": 0, "avg_speed": 0.0})
+    entry["count"] += 1
+    entry["avg_speed"] += (speed - entry["avg_speed"]) / entry["count"]
+
+
+def get_encode_stats() -> dict:
+    """Средняя скорость кодирования (x realtime) по пресету и разрешению"""
+    return {key: {"count": v["count"], "avg_speed": round(v["avg_speed"], 2)}
+            for key, v in encode_stats.items()}
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: RATE CONTROL — размер под лимит доставки до первого кодирования
+# ══════════════════════════════════════════════════════════════════════════════
+
+DELIVERY_MAX_BYTES = TELEGRAM_DELIVERY_MAX_MB * 1024 * 1024
+# bufsize = 2 × maxrate (_process_encoder_args): VBV может выдать до 2 с сверх среднего
+VBV_BUFFER_SECONDS = 2
+
+# Факт/цель по пресету и разрешению: "fast@1080p" → {"count", "mean", "dev", "max", "over"}
+rate_control_stats: dict = {}
+rate_control_counters = {"planned": 0, "capped": 0, "fallbacks": 0}
+
+
+@dataclass
+class RateControlPlan:
+    key: str               # пресет@разрешение
+    duration: float        # длительность результата, с
+    video_kbps: int        # -maxrate
+    audio_kbps: int
+    capped: bool           # потолок ниже исходного maxrate — размер ограничен планом
     
+    @property
+    def target_bytes(self) -> int:
+        """Ожидаемый максимум размера при выбранных битрейтах (с буфером VBV)"""
+        kbits = self.video_kbps * (self.duration + VBV_BUFFER_SECONDS) + self.audio_kbps * self.duration
+        return int(kbits * 1000 / 8 * (1 + RATE_CONTROL_CONTAINER_OVERHEAD))
+
+
+def _kbps(bitrate: str) -> int:
+    return int(str(bitrate).lower().rstrip("k"))
+
+
+def _rate_control_correction(key: str) -> float:
+    """Насколько файлы этого пресета вылезают за цель (≥ 1: запас, а не добавка)"""
+    entry = rate_control_stats.get(key)
+    if not entry or entry["count"] < 3:
+        return 1.0
+    return max(1.0, entry["mean"] + 2 * entry["dev"])
+
+
+def plan_rate_control(params: dict, duration: float, width: int, height: int,
+                      has_audio: bool = True,
+                      max_bytes: int = None) -> Tuple[dict, RateControlPlan]:
+    """
+    Capped CRF под лимит размера: CRF остаётся, -maxrate опускается так,
+    чтобы видео (с буфером VBV) + аудио уложились в max_bytes с поправкой
+    на то, насколько этот пресет раньше промахивался.
+    Возвращает: (params с новым bitrate/audio_bitrate, план)
+    """
+    max_bytes = max_bytes or DELIVERY_MAX_BYTES
+    key = f"{params['preset']}@{_resolution_bucket(width, height)}"
+    duration = max(duration, 1.0)
+    budget_kbits = (max_bytes * 8 / 1000
+                    / (1 + RATE_CONTROL_CONTAINER_OVERHEAD) / _rate_control_correction(key))
+    
+    def video_cap(audio_kbps: int) -> int:
+        return int((budget_kbits - audio_kbps * duration) / (duration + VBV_BUFFER_SECONDS))
+    
+    audio_bitrate = params["audio_bitrate"]
+    audio_kbps = _kbps(audio_bitrate) if has_audio else 0
+    video_kbps = _kbps(params["bitrate"])
+    cap = video_cap(audio_kbps)
+    
+    fallback_audio = _kbps(RATE_CONTROL_FALLBACK_AUDIO)
+    if cap < RATE_CONTROL_MIN_VIDEO_KBPS and has_audio and audio_kbps > fallback_audio:
+        # Длинное видео: сначала ужимаем звук
+        audio_bitrate, audio_kbps = RATE_CONTROL_FALLBACK_AUDIO, fallback_audio
+        cap = video_cap(audio_kbps)
+    
+    rate_control_counters["planned"] += 1
+    planned = dict(params)
+    capped = cap < video_kbps
+    if capped:
+        rate_control_counters["capped"] += 1
+        video_kbps = max(cap, RATE_CONTROL_MIN_VIDEO_KBPS)
+        planned["bitrate"] = f"{video_kbps}k"
+        planned["audio_bitrate"] = audio_bitrate
+    return planned, RateControlPlan(key, duration, video_kbps, audio_kbps, capped)
+
+
+def record_rate_control(plan: RateControlPlan, actual_bytes: int, max_bytes: int = None):
+    """Запомнить, куда попал фактический размер относительно цели плана"""
+    if actual_bytes <= 0 or not plan.capped:
+        return
+    max_bytes = max_bytes or DELIVERY_MAX_BYTES
+    ratio = actual_bytes / plan.target_bytes
+    entry = rate_control_stats.setdefault(
+        plan.key, {"count": 0, "mean": ratio, "dev": 0.0, "max": 0.0, "over": 0}
+    )
+    entry["count"] += 1
+    entry["dev"] += RATE_CONTROL_ALPHA * (abs(ratio - entry["mean"]) - entry["dev"])
+    entry["mean"] += RATE_CONTROL_ALPHA * (ratio - entry["mean"])
+    entry["max"] = max(entry["max"], ratio)
+    if actual_bytes > max_bytes:
+        entry["over"] += 1
+
+
+def get_rate_control_stats() -> dict:
+    """Счётчики планировщика битрейта и точность попадания по пресетам"""
+    return {
+        **rate_control_counters,
+        "presets": {key: {"count": v["count"], "mean": round(v["mean"], 3),
+                          "dev": round(v["dev"], 3), "max": round(v["max"], 3),
+                          "over": v["over"], "correction": round(_rate_control_correction(key), 3)}
+                    for key, v in rate_control_stats.items()},
+    }
+
+
+def _parse_progress_line(line: str, tracker: "ProgressTracker") -> Optional[str]:
+    """
+    Разбор одной строки key=value из -progress.
+    Возвращает значение progress (continue/end) на конце блока, иначе None.
+    """
+    key, _, value = line.strip().partition("=")
+    if key in ("out_time_us", "out_time_ms"):
+        # out_time_ms исторически тоже в микросекундах
+        try:
+            tracker.update(int(value) / 1_000_000)
+        except ValueError:
+            pass
+    elif key == "speed":
+        try:
+            tracker.speed = float(value.rstrip("x"))
+        except ValueError:
+            pass
+    elif key == "progress":
+        return value
     return None
 
 
+async def run_ffmpeg_with_progress(
+    cmd: List[str],
+    tracker: "ProgressTracker" = None,
+    on_progress=None,
+    timeout: float = FFMPEG_TIMEOUT_SECONDS,
+    label: str = "process",
+) -> Tuple[int, str]:
+    """
+    Запуск FFmpeg с `-progress pipe:1 -nostats` (через run_ffmpeg).
+    stdout разбирается построчно, от stderr хранится только хвост.
+    on_progress(tracker) вызывается не чаще PROGRESS_UPDATE_INTERVAL.
+    Возвращает: (returncode, stderr_tail). Бросает asyncio.TimeoutError.
+    """
+    tracker = tracker or ProgressTracker(0)
+    cmd = [cmd[0], "-progress", "pipe:1", "-nostats"] + list(cmd[1:])
+    
+    async def on_line(line: str):
+        state = _parse_progress_line(line, tracker)
+        if state is None or on_progress is None:
+            return
+        if state == "end" or tracker.should_report():
+            try:
+                await on_progress(tracker)
+            except Exception as e:
+                print(f"[FFMPEG] Progress callback error: {e}")
+    
+    result = await run_ffmpeg(cmd, label=label, timeout=timeout, on_stdout_line=on_line)
+    if result.timed_out:
+        raise asyncio.TimeoutError()
+    return result.returncode, result.stderr_tail
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: SEGMENT-PARALLEL ENCODING (тяжёлые входы — несколько процессов libx264)
+# ══════════════════════════════════════════════════════════════════════════════
+#
+# Каждый сегмент — отдельный FFmpeg по исходному файлу: -ss до ключевого кадра
+# перед началом (-noaccurate_seek), -copyts -start_at_zero сохраняет время
+# источника, trim режет кадры по границам на сетке кадров. Поэтому граф видит
+# то же t, что и один процесс (выражения shake, pulse, границы
+# _build_segment_variation, enable= продолжаются через стык без скачка), и каждый
+# кадр попадает ровно в один сегмент. Нарезка -c copy для этого не годится:
+# segment muxer отдаёт начало сегмента со сдвигом на задержку B-кадров, а mkv
+# округляет время до миллисекунд. Случайные параметры графа выбраны один раз
+# (_build_process_graph). Звук кодируется одним процессом целиком
+# (у AAC на стыках были бы щелчки), видео склеивается concat -c copy.
+# Буфер VBV делится на число сегментов: каждый стартует с полным буфером, и без
+# деления выброс над -maxrate был бы в N раз больше заложенного в план размера.
+
+segment_counters = {"segmented": 0, "fallbacks": 0}
+
+
+def plan_segment_count(media: "MediaInfo", threads: int = 0) -> int:
+    """Сколько сегментов кодировать параллельно (1 — одним процессом)"""
+    if not SEGMENT_ENCODE_ENABLED or not media or media.duration <= 0:
+        return 1
+    megapixels = media.width * media.height * (media.fps or 30) * media.duration / 1e6
+    if megapixels < SEGMENT_ENCODE_MIN_MEGAPIXELS:
+        return 1
+    count = SEGMENT_ENCODE_MAX_SEGMENTS
+    if threads > 0:
+        count = min(count, threads)  # Каждому сегменту — хотя бы поток из бюджета задачи
+    count = min(count, int(media.duration // SEGMENT_ENCODE_MIN_SECONDS))
+    return max(1, count)
+
+
+def _segment_bounds(duration: float, fps: float, count: int) -> List[Tuple[float, Optional[float]]]:
+    """[(начало, конец)] сегментов на сетке кадров; у последнего конец None — до конца потока"""
+    frames = int(round(duration * fps))
+    cuts = sorted(set(int(round(frames * i / count)) for i in range(count)))
+    starts = [cut / fps for cut in cuts]
+    return list(zip(starts, starts[1:] + [None]))
+
+
+async def encode_segmented(input_path: str, output_path: str, video_filter: str,
+                           audio_filter: str, params: dict, width: int, height: int,
+                           has_audio: bool, duration: float, fps: float, count: int,
+                           threads: int = 0, tracker: ProgressTracker = None,
+                           on_progress=None) -> Optional[bool]:
+    """
+    Кодирование process_video по сегментам (video_filter — готовый граф с format=).
+    fps — выходная частота графа, threads — бюджет задачи (делится между сегментами).
+    Возвращает None, если вход слишком короткий для двух сегментов —
+    тогда вызывающий кодирует одним процессом.
+    """
+    import shutil
+    
+    work_dir = get_temp_dir() / f"segments_{uuid.uuid4().hex[:8]}"
+    work_dir.mkdir()
+    try:
+        pieces = _segment_bounds(duration, fps, count)
+        if len(pieces) < 2:
+            segment_counters["fallbacks"] += 1
+            return None
+        
+        piece_threads = max(1, threads // len(pieces)) if threads > 0 else 0
+        encoder_args = (_process_encoder_args(params, width, height, len(pieces))
+                        + _thread_args(piece_threads))
+        print(f"[SEGMENT] {len(pieces)} segments × {piece_threads or 'auto'} threads: {input_path}")
+        
+        # Прогресс задачи — сумма по сегментам (время каждого считается от его начала)
+        tracker = tracker or ProgressTracker(0)
+        trackers = [ProgressTracker(0) for _ in pieces]
+        outputs = [str(work_dir / f"enc_{i:03d}.mp4") for i in range(len(pieces))]
+        
+        async def report(_):
+            tracker.update(sum(t.current_time for t in trackers), sum(t.speed for t in trackers))
+            if on_progress and tracker.should_report():
+                await on_progress(tracker)
+        
+        async def encode_piece(index: int, start: float, end: Optional[float]) -> Optional[str]:
+            cmd = [FFMPEG_PATH, "-y"]
+            if start > 0:
+                # Декодирование с ключевого кадра перед началом, лишнее отрежет trim
+                cmd += ["-ss", f"{start:.6f}", "-noaccurate_seek"]
+            trim = f"trim=start={start:.6f}" + (f":end={end:.6f}" if end is not None else "")
+            cmd += [
+                "-copyts", "-start_at_zero",
+                "-i", input_path,
+                "-map", "0:v:0",
+                # Время графа — время источника; на выходе снова от нуля.
+                # setpts сбрасывает частоту кадров потока — fps возвращает её кодеру
+                "-vf", f"{trim},{video_filter},setpts=PTS-STARTPTS,fps={fps}",
+                "-an",
+            ] + encoder_args + [outputs[index]]
+            try:
+                returncode, stderr_tail = await run_ffmpeg_with_progress(
+                    cmd, trackers[index], report, label="segment"
+                )
+            except asyncio.TimeoutError:
+                return "Timeout"
+            return None if returncode == 0 else stderr_tail[-500:]
+        
+        audio_path = str(work_dir / "audio.m4a")
+        
+        async def encode_audio() -> Optional[str]:
+            cmd = [
+                FFMPEG_PATH, "-y",
+                "-i", input_path,
+                "-vn", "-af", audio_filter,
+                "-c:a", "aac", "-b:a", params["audio_bitrate"], "-ar", "48000",
+                audio_path,
+            ]
+            result = await run_ffmpeg(cmd, label="segment_audio")
+            return None if result.ok else result.error(500)
+        
+        jobs = [encode_piece(i, start, end) for i, (start, end) in enumerate(pieces)]
+        if has_audio:
+            jobs.append(encode_audio())
+        errors = [error for error in await asyncio.gather(*jobs) if error]
+        if errors:
+            print(f"[SEGMENT] Encode failed: {errors[0]}")
+            return False
+        
+        list_file = work_dir / "concat.txt"
+        with open(list_file, 'w', encoding='utf-8') as f:
+            for path in outputs:
+                escaped_path = path.replace("'", "'\\''")
+                f.write(f"file '{escaped_path}'\n")
+        cmd = [FFMPEG_PATH, "-y", "-f", "concat", "-safe", "0", "-i", str(list_file)]
+        if has_audio:
+            cmd += ["-i", audio_path, "-map", "0:v:0", "-map", "1:a:0"]
+        cmd += [
+            "-c", "copy",
+            "-map_metadata", "-1",
+            "-metadata", f"creation_time={_generate_random_timestamp()}",
+            "-fflags", "+bitexact",
+            "-movflags", "+faststart",
+            output_path,
+        ]
+        result = await run_ffmpeg(cmd, label="segment_concat")
+        if not result.ok:
+            print(f"[SEGMENT] Concat failed: {result.error(500)}")
+            return False
+        segment_counters["segmented"] += 1
+        return True
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def get_segment_stats() -> dict:
+    """Сколько задач закодировано по сегментам / не разрезалось"""
+    return dict(segment_counters)
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# VIDEO INFO & PROCESSING
+# ══════════════════════════════════════════════════════════════════════════════
+
+async def get_video_info(input_path: str) -> Optional[Tuple[int, int, float, float]]:
+    """Получает width, height, duration, fps из видео"""
+    info = await probe(input_path)
+    if not info or not info.has_video:
+        return None
+    return info.width, info.height, info.duration or 60.0, info.fps
+
+
 async def get_video_duration(input_path: str) -> float:
     """Получает длительность видео в секундах"""
     info = await get_video_info(input_path)
@@ -922,25 +1709,10 @@ async def get_video_duration(input_path: str) -> float:
 
 async def _check_has_audio(input_path: str) -> bool:
     """Проверяет наличие аудио потока в видео"""
-    cmd = [
-        FFPROBE_PATH,
-        "-v", "error",
-        "-select_streams", "a:0",
-        "-show_entries", "stream=codec_type",
-        "-of", "csv=p=0",
-        input_path
-    ]
-    
-    try:
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=10)
-        return bool(stdout.decode().strip())
-    except Exception:
+    info = await probe(input_path)
+    if not info:
         return True  # Assume has audio on error
+    return info.has_audio
 
 
 def _generate_random_timestamp() -> str:
@@ -954,38 +1726,14 @@ def _generate_random_timestamp() -> str:
     dt = datetime.datetime.now() - datetime.timedelta(days=days_ago, hours=hours, minutes=minutes, seconds=seconds)
     return dt.strftime("%Y-%m-%dT%H:%M:%S.000000Z")
 
-async def process_video(input_path: str, output_path: str, mode: str, 
-                        quality: str = DEFAULT_QUALITY, text_overlay: bool = True,
-                        template: str = "none", user_id: int = 0,
-                        enable_watermark_trap: bool = False) -> bool:
+
+def _build_process_graph(width: int, height: int, duration: float, source_fps: float,
+                         mode: str, quality: str = DEFAULT_QUALITY, text_overlay: bool = True,
+                         template: str = "none") -> Tuple[str, str, dict]:
     """
-    ANTI-TIKTOK 2026 Video Processing - поддержка до 8K 120FPS
-    + пресеты качества, опциональный текст, шаблоны и Watermark-Trap
-    
-    Args:
-        user_id: ID пользователя для Watermark-Trap
-        enable_watermark_trap: Включить невидимый цифровой отпечаток
+    Цепочки фильтров process_video (режим + шаблон).
+    Возвращает: (video_filter, audio_filter, encoder_params)
     """
-    # Проверяем что входной файл существует и не пустой
-    if not os.path.exists(input_path):
-        print(f"[FFMPEG] Input file not found: {input_path}")
-        return False
-    
-    file_size = os.path.getsize(input_path)
-    if file_size < 1000:
-        print(f"[FFMPEG] Input file too small ({file_size} bytes): {input_path}")
-        return False
-    
-    print(f"[FFMPEG] Processing file: {input_path} ({file_size} bytes)")
-    
-    info = await get_video_info(input_path)
-    if not info:
-        print(f"[FFMPEG] Failed to get video info for: {input_path}")
-        return False
-    
-    width, height, duration, source_fps = info
-    has_audio = await _check_has_audio(input_path)
-    
     # Сохраняем оригинальный FPS (до 120)
     target_fps = min(source_fps, 120)
     
@@ -1013,27 +1761,21 @@ async def process_video(input_path: str, output_path: str, mode: str,
             # Модифицируем аудио темп
             audio_filter = f"atempo={template_speed}," + audio_filter
     
-    # v3.2.0: Watermark-Trap - невидимый цифровой отпечаток
-    trap_signature = None
-    watermark_extra_params = []
-    
-    if enable_watermark_trap and WATERMARK_TRAP_AVAILABLE and WATERMARK_TRAP_ENABLED and user_id > 0:
-        try:
-            video_filter, audio_filter, watermark_extra_params, trap_signature = apply_watermark_trap(
-                user_id=user_id,
-                input_path=input_path,
-                existing_video_filter=video_filter,
-                existing_audio_filter=audio_filter,
-                width=width,
-                height=height,
-                has_audio=has_audio
-            )
-            print(f"[TRAP] Watermark-Trap applied for user {user_id}, sig: {trap_signature.full_signature[:16]}...")
-        except Exception as e:
-            print(f"[TRAP] Failed to apply Watermark-Trap: {e}")
-    
-    # Рандомный encoder profile для anti-source pattern
-    profile = params.get("profile", "main")
+    return video_filter, audio_filter, params
+
+
+def _thread_args(threads: int) -> List[str]:
+    """v3.4.0: Потоки кодера и фильтров из бюджета cpu_policy (0 — решает FFmpeg)"""
+    if threads <= 0:
+        return []
+    return ["-threads", str(threads), "-filter_threads", str(threads)]
+
+
+def _process_encoder_args(params: dict, width: int, height: int, segments: int = 1) -> List[str]:
+    """
+    Параметры кодера process_video (без -i / -vf / -af и выходного файла).
+    segments — на сколько параллельных сегментов делится буфер VBV.
+    """
     # Уровень зависит от разрешения
     if width > 3840 or height > 2160:
         level = "6.2"  # 8K
@@ -1043,15 +1785,7 @@ async def process_video(input_path: str, output_path: str, mode: str,
         level = params.get("level", "4.2")
     crf = params.get("crf", 18)
     
-    # Добавляем pix_fmt конвертацию в конец video_filter для совместимости
-    video_filter_final = video_filter + ",format=yuv420p"
-    
-    cmd = [
-        FFMPEG_PATH,
-        "-y",
-        "-i", input_path,
-        "-vf", video_filter_final,
-        "-af", audio_filter,
+    return [
         "-c:v", "libx264",
         "-profile:v", "high",
         "-level:v", level,
@@ -1059,7 +1793,9 @@ async def process_video(input_path: str, output_path: str, mode: str,
         # CRF для качества + maxrate для контроля размера
         "-crf", str(crf),
         "-maxrate", params["bitrate"],
-        "-bufsize", f"{int(params['bitrate'].replace('k', '')) * 2}k",
+        # v3.4.0: У каждого сегмента свой VBV, стартующий с полным буфером —
+        # делим буфер, чтобы суммарный выброс остался VBV_BUFFER_SECONDS (план размера)
+        "-bufsize", f"{_kbps(params['bitrate']) * VBV_BUFFER_SECONDS // max(1, segments)}k",
         "-g", str(params["gop"]),
         "-keyint_min", str(params["gop"] // 2),
         "-sc_threshold", "0",
@@ -1074,59 +1810,150 @@ async def process_video(input_path: str, output_path: str, mode: str,
         "-flags:a", "+bitexact",
         "-movflags", "+faststart",
     ]
+
+
+async def process_video(input_path: str, output_path: str, mode: str, 
+                        quality: str = DEFAULT_QUALITY, text_overlay: bool = True,
+                        template: str = "none", user_id: int = 0,
+                        enable_watermark_trap: bool = False,
+                        progress: ProgressTracker = None, on_progress=None,
+                        threads: int = 0, segments: int = None) -> bool:
+    """
+    ANTI-TIKTOK 2026 Video Processing - поддержка до 8K 120FPS
+    + пресеты качества, опциональный текст, шаблоны и Watermark-Trap
     
-    # v3.2.0: Добавляем Watermark-Trap параметры (metadata, encoding)
-    if watermark_extra_params:
-        # Вставляем перед output_path
-        cmd.extend(watermark_extra_params)
-    
-    cmd.append(output_path)
-    
-    # DEBUG: выводим команду
-    print(f"[FFMPEG] CMD: {' '.join(cmd[:6])} ... {output_path}")
-    print(f"[FFMPEG] VF length: {len(video_filter)}")
+    Args:
+        user_id: ID пользователя для Watermark-Trap
+        enable_watermark_trap: Включить невидимый цифровой отпечаток
+        progress: ProgressTracker задачи (заполняется из -progress pipe:1)
+        on_progress: async callback(tracker), вызывается с троттлингом
+        threads: потоков FFmpeg по cpu_policy (0 — без ограничения)
+        segments: сегментов для параллельного кодирования (None — по
+            plan_segment_count, 1 — одним процессом)
+    """
+    # Проверяем что входной файл существует и не пустой
+    if not os.path.exists(input_path):
+        print(f"[FFMPEG] Input file not found: {input_path}")
+        return False
+    
+    file_size = os.path.getsize(input_path)
+    if file_size < 1000:
+        print(f"[FFMPEG] Input file too small ({file_size} bytes): {input_path}")
+        return False
+    
+    print(f"[FFMPEG] Processing file: {input_path} ({file_size} bytes)")
+    
+    # v3.4.0: Один ffprobe на размеры, fps и наличие аудио
+    media = await probe(input_path)
+    if not media or not media.has_video:
+        print(f"[FFMPEG] Failed to get video info for: {input_path}")
+        return False
+    
+    width, height, source_fps = media.width, media.height, media.fps
+    duration = media.duration or 60.0
+    has_audio = media.has_audio
+    
+    # v3.4.0: Граф фильтров и параметры кодера вынесены в хелперы (общие со smart_auto_process)
+    video_filter, audio_filter, params = _build_process_graph(
+        width, height, duration, source_fps, mode, quality, text_overlay, template
+    )
+    
+    # v3.4.0: Длительность результата (с учётом скорости шаблона) → потолок битрейта
+    output_duration = duration / _get_template_speed(template) if template and template != "none" else duration
+    params, rate_plan = plan_rate_control(params, output_duration, width, height, has_audio)
+    
+    # v3.2.0: Watermark-Trap - невидимый цифровой отпечаток
+    trap_signature = None
+    watermark_extra_params = []
+    
+    if enable_watermark_trap and WATERMARK_TRAP_AVAILABLE and WATERMARK_TRAP_ENABLED and user_id > 0:
+        try:
+            video_filter, audio_filter, watermark_extra_params, trap_signature = apply_watermark_trap(
+                user_id=user_id,
+                input_path=input_path,
+                existing_video_filter=video_filter,
+                existing_audio_filter=audio_filter,
+                width=width,
+                height=height,
+                has_audio=has_audio
+            )
+            print(f"[TRAP] Watermark-Trap applied for user {user_id}, sig: {trap_signature.full_signature[:16]}...")
+        except Exception as e:
+            print(f"[TRAP] Failed to apply Watermark-Trap: {e}")
+    
+    # Добавляем pix_fmt конвертацию в конец video_filter для совместимости
+    video_filter_final = video_filter + ",format=yuv420p"
+    
+    cmd = [
+        FFMPEG_PATH,
+        "-y",
+        "-i", input_path,
+        "-vf", video_filter_final,
+        "-af", audio_filter,
+    ] + _process_encoder_args(params, width, height) + _thread_args(threads)
+    
+    # v3.2.0: Добавляем Watermark-Trap параметры (metadata, encoding)
+    if watermark_extra_params:
+        # Вставляем перед output_path
+        cmd.extend(watermark_extra_params)
+    
+    cmd.append(output_path)
+    
+    # DEBUG: выводим команду
+    print(f"[FFMPEG] CMD: {' '.join(cmd[:6])} ... {output_path}")
+    print(f"[FFMPEG] VF length: {len(video_filter)}")
     if trap_signature:
         print(f"[FFMPEG] Watermark-Trap: enabled")
     
+    # v3.4.0: Прогресс по выходной длительности (с учётом скорости шаблона)
+    tracker = progress or ProgressTracker(0)
+    tracker.total_duration = output_duration
+    tracker.set_stage("processing")
+    
+    # v3.4.0: Тяжёлые входы — параллельно по сегментам. Не с Watermark-Trap:
+    # его временной слой считает кадры (n), а n в каждом сегменте начинается с 0
+    if segments is None:
+        segments = plan_segment_count(media, threads)
+    segmented = None
+    
     try:
-        proc = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        active_processes.append(proc)
-        
-        try:
-            _, stderr = await asyncio.wait_for(
-                proc.communicate(),
-                timeout=FFMPEG_TIMEOUT_SECONDS
+        if segments > 1 and trap_signature is None:
+            segmented = await encode_segmented(
+                input_path, output_path, video_filter_final, audio_filter, params,
+                width, height, has_audio, duration, min(source_fps, 120), segments,
+                threads, tracker, on_progress
             )
-            
-            if proc.returncode != 0:
-                print(f"[FFMPEG] Error: {stderr.decode()[-500:]}")
+            if segmented is False:
+                return False
+        
+        if segmented is None:
+            try:
+                returncode, stderr_tail = await run_ffmpeg_with_progress(cmd, tracker, on_progress)
+            except asyncio.TimeoutError:
+                print(f"[FFMPEG] Timeout after {FFMPEG_TIMEOUT_SECONDS}s")
                 return False
             
-            return os.path.exists(output_path) and os.path.getsize(output_path) > 0
+            if returncode != 0:
+                print(f"[FFMPEG] Error: {stderr_tail[-500:]}")
+                return False
             
-        except asyncio.TimeoutError:
-            print(f"[FFMPEG] Timeout after {FFMPEG_TIMEOUT_SECONDS}s")
-            proc.kill()
-            await proc.wait()
+            # Скорость одного процесса (у сегментов она суммарная — в статистику не пишем)
+            _record_encode_speed(params["preset"], width, height, tracker.speed)
+        print(f"[FFMPEG] Done at {tracker.speed:.2f}x ({params['preset']}, {width}x{height})")
+        if not os.path.exists(output_path):
             return False
-        finally:
-            if proc in active_processes:
-                active_processes.remove(proc)
+        output_size = os.path.getsize(output_path)
+        record_rate_control(rate_plan, output_size)
+        return output_size > 0
                 
     except Exception as e:
         print(f"[FFMPEG] Exception: {e}")
         return False
 
 def kill_all_ffmpeg():
+    # v3.4.0: Процессы регистрирует run_ffmpeg, убиваем группы целиком
     for proc in active_processes[:]:
-        try:
-            proc.kill()
-        except Exception:
-            pass
+        _kill_process_group(proc)
     active_processes.clear()
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -1137,7 +1964,8 @@ class ProcessingTask:
     def __init__(self, user_id: int, input_path: str, mode: str, callback, 
                  quality: str = DEFAULT_QUALITY, text_overlay: bool = True,
                  priority: int = 0, template: str = "none",
-                 enable_watermark_trap: bool = False):
+                 enable_watermark_trap: bool = False, on_progress=None,
+                 plan: str = None):
         self.user_id = user_id
         self.input_path = input_path
         self.mode = mode
@@ -1150,6 +1978,19 @@ class ProcessingTask:
         self.priority = priority  # 0=free, 1=vip, 2=premium
         self.cancelled = False
         self.task_id = f"{user_id}_{int(time.time()*1000)}"
+        # v3.4.0: Живой прогресс FFmpeg → статус-сообщение бота
+        self.progress = ProgressTracker(0)
+        self.on_progress = on_progress
+        # v3.4.0: Признаки для оценки времени (заполняются в add_to_queue)
+        self.features: Optional[dict] = None
+        self.created_at = time.time()
+        self.started_at = 0.0
+        # v3.4.0: Стадии и ресурсы задачи → MetricsRegistry (download пишет бот)
+        self.metrics = JobMetrics(
+            template=template, quality=quality,
+            plan=plan or PLAN_BY_PRIORITY.get(priority, "free"),
+        )
+        self.queued_at = 0.0
     
     def __lt__(self, other):
         # Для PriorityQueue — больший приоритет = раньше в очереди
@@ -1166,65 +2007,107 @@ async def worker():
         task: ProcessingTask
         
         print(f"[WORKER] Got task for user {task.user_id}, template={task.template}, input={task.input_path}")
+        if task.queued_at:
+            task.metrics.add("queue_wait", time.time() - task.queued_at)
         
         # Проверяем отмену
         if task.cancelled:
+            task.metrics.status = "cancelled"
+            get_metrics_registry().record_job(task.metrics)
             cleanup_file(task.input_path)
             processing_queue.task_done()
             active_tasks.pop(task.task_id, None)
             continue
         
+        # v3.4.0: CPU / RSS всех FFmpeg этой задачи → task.metrics
+        sink_token = usage_sink.set(task.metrics)
+        success = False
         try:
-            print(f"[WORKER] Starting FFmpeg processing...")
-            success = await process_video(
-                task.input_path, task.output_path, task.mode,
-                task.quality, task.text_overlay, task.template,
-                user_id=task.user_id,
-                enable_watermark_trap=task.enable_watermark_trap
-            )
+            # process_video рандомизирует параметры (уникальность) — результат
+            # не кэшируем; кэш только у детерминированных convert/thumbnail/download
+            # v3.4.0: Слот из общего бюджета (бот + API); задача занимает
+            # столько единиц, сколько потоков FFmpeg ей выделено
+            from scheduler import get_scheduler
+            features = task.features or {}
+            threads = get_cpu_policy().threads_for(features.get("width", 0), features.get("height", 0))
+            slot_requested = time.time()
+            async with get_scheduler().slot("bot", task.priority, task.user_id, weight=max(1, threads)):
+                print(f"[WORKER] Starting FFmpeg processing...")
+                task.started_at = time.time()
+                task.metrics.add("queue_wait", task.started_at - slot_requested)
+                with task.metrics.stage("encode"):
+                    success = await process_video(
+                        task.input_path, task.output_path, task.mode,
+                        task.quality, task.text_overlay, task.template,
+                        user_id=task.user_id,
+                        enable_watermark_trap=task.enable_watermark_trap,
+                        progress=task.progress,
+                        on_progress=task.on_progress,
+                        threads=threads
+                    )
+        
+                print(f"[WORKER] Process result: success={success}, output_exists={os.path.exists(task.output_path)}")
+        
+                # v3.1.1: Автоматическое сжатие если файл > 49MB (Telegram limit = 50MB)
+                # v3.4.0: process_video уже целится в лимит — это запасной путь
+                if success and os.path.exists(task.output_path):
+                    file_size = os.path.getsize(task.output_path)
+                    if file_size > DELIVERY_MAX_BYTES:
+                        rate_control_counters["fallbacks"] += 1
+                        print(f"[WORKER] File too large ({file_size // 1024 // 1024}MB), compressing for Telegram...")
+                        compressed_path = task.output_path.replace(".mp4", "_compressed.mp4")
+                        with task.metrics.stage("recompress"):
+                            compress_success, compress_error, _ = await compress_video(
+                                task.output_path, compressed_path, "telegram", threads=threads
+                            )
+                        if compress_success:
+                            # Заменяем выходной файл сжатым
+                            cleanup_file(task.output_path)
+                            os.rename(compressed_path, task.output_path)
+                            new_size = os.path.getsize(task.output_path)
+                            print(f"[WORKER] Compressed: {file_size // 1024 // 1024}MB -> {new_size // 1024 // 1024}MB")
+                        else:
+                            print(f"[WORKER] Compression failed: {compress_error}")
+                            cleanup_file(compressed_path)
             
-            print(f"[WORKER] Process result: success={success}, output_exists={os.path.exists(task.output_path)}")
+                # v3.4.0: Обучаем оценщик очереди на реальной длительности
+                if success and task.features:
+                    from queue_estimator import get_queue_estimator
+                    get_queue_estimator().record(task.features, time.time() - task.started_at)
             
-            # v3.1.1: Автоматическое сжатие если файл > 49MB (Telegram limit = 50MB)
-            TELEGRAM_MAX_SIZE = 49 * 1024 * 1024  # 49MB с запасом
             if success and os.path.exists(task.output_path):
-                file_size = os.path.getsize(task.output_path)
-                if file_size > TELEGRAM_MAX_SIZE:
-                    print(f"[WORKER] File too large ({file_size // 1024 // 1024}MB), compressing for Telegram...")
-                    compressed_path = task.output_path.replace(".mp4", "_compressed.mp4")
-                    compress_success, compress_error, _ = await compress_video(
-                        task.output_path, compressed_path, "telegram"
-                    )
-                    if compress_success:
-                        # Заменяем выходной файл сжатым
-                        cleanup_file(task.output_path)
-                        os.rename(compressed_path, task.output_path)
-                        new_size = os.path.getsize(task.output_path)
-                        print(f"[WORKER] Compressed: {file_size // 1024 // 1024}MB -> {new_size // 1024 // 1024}MB")
-                    else:
-                        print(f"[WORKER] Compression failed: {compress_error}")
-                        cleanup_file(compressed_path)
+                task.metrics.output_size = os.path.getsize(task.output_path)
             
             # Ещё раз проверяем отмену после обработки
             if not task.cancelled:
+                # Отправка результата пользователю — стадия upload
+                upload_started = time.perf_counter()
                 await task.callback(success, task.output_path if success else None)
+                if success:
+                    task.metrics.add("upload", time.perf_counter() - upload_started)
             else:
                 cleanup_file(task.output_path)
         except Exception as e:
+            success = False
             print(f"[WORKER] Error: {e}")
             import traceback
             traceback.print_exc()
             if not task.cancelled:
                 await task.callback(False, None)
         finally:
+            usage_sink.reset(sink_token)
+            task.metrics.status = "cancelled" if task.cancelled else ("ok" if success else "error")
+            get_metrics_registry().record_job(task.metrics)
             cleanup_file(task.input_path)
             processing_queue.task_done()
             active_tasks.pop(task.task_id, None)
 
 async def start_workers():
-    print(f"[INIT] Starting {MAX_CONCURRENT_TASKS} workers...")
+    # v3.4.0: Число воркеров — из cpu_policy (ядра / квота cgroup)
+    workers = get_cpu_policy().workers
+    print(f"[INIT] Starting {workers} workers...")
     init_queue()
-    for i in range(MAX_CONCURRENT_TASKS):
+    for i in range(workers):
         asyncio.create_task(worker())
         print(f"[INIT] Worker {i+1} started")
     # v2.8.0: Запуск периодической очистки
@@ -1242,10 +2125,28 @@ async def add_to_queue(task: ProcessingTask) -> Tuple[bool, int]:
         print(f"[QUEUE] Queue is full! Cannot add task.")
         return False, 0
     
+    # v3.4.0: Признаки задачи (probe кэшируется — worker не платит повторно)
+    from queue_estimator import build_features
+    with task.metrics.stage("probe"):
+        media = await probe(task.input_path)
+    if media and media.has_video:
+        task.features = build_features(
+            media.width, media.height, media.duration or 60.0, media.fps,
+            task.quality, task.template, task.enable_watermark_trap
+        )
+    
+    # v3.4.0: Admission — не берём задачу, если ждать пришлось бы слишком долго
+    if QUEUE_ADMISSION_MAX_WAIT_SECONDS > 0:
+        wait_seconds = estimate_queue_seconds(processing_queue.qsize())
+        if wait_seconds > QUEUE_ADMISSION_MAX_WAIT_SECONDS:
+            print(f"[QUEUE] Estimated wait {wait_seconds:.0f}s > limit, rejecting task")
+            return False, 0
+    
     # Сохраняем задачу для возможности отмены
     active_tasks[task.task_id] = task
     
     # Добавляем с приоритетом (отрицательный для правильной сортировки)
+    task.queued_at = time.time()
     await processing_queue.put((-task.priority, task))
     
     # Позиция в очереди
@@ -1305,22 +2206,12 @@ async def trim_video(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="trim_video")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
-    except asyncio.TimeoutError:
-        return False, "Timeout"
     except Exception as e:
         return False, str(e)
 
@@ -1371,22 +2262,12 @@ async def add_music_overlay(
                 output_path
             ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="add_music_overlay")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
-    except asyncio.TimeoutError:
-        return False, "Timeout"
     except Exception as e:
         return False, str(e)
 
@@ -1402,6 +2283,13 @@ async def convert_to_gif(
 ) -> Tuple[bool, Optional[str]]:
     """Конвертировать видео в GIF"""
     try:
+        # v3.4.0: Детерминированная конвертация — берём из кэша результатов
+        from result_cache import get_result_cache
+        cache = get_result_cache()
+        cache_key = await cache.key_for_file(input_path, "gif", fps=fps, scale=scale)
+        if cache.get(cache_key, output_path):
+            return True, None
+        
         # Сначала генерируем палитру для лучшего качества
         palette_path = output_path + ".palette.png"
         
@@ -1413,12 +2301,10 @@ async def convert_to_gif(
             palette_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd1,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        await asyncio.wait_for(process.communicate(), timeout=FFMPEG_TIMEOUT_SECONDS // 2)
+        result = await run_ffmpeg(cmd1, label="gif_palette", timeout=FFMPEG_TIMEOUT_SECONDS // 2)
+        if not result.ok:
+            cleanup_file(palette_path)
+            return False, result.error()
         
         # Создание GIF с палитрой
         cmd2 = [
@@ -1429,23 +2315,16 @@ async def convert_to_gif(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd2,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd2, label="convert_to_gif")
         
         # Очистка палитры
         if os.path.exists(palette_path):
             os.remove(palette_path)
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
+        cache.put(cache_key, output_path)
         return True, None
     except Exception as e:
         return False, str(e)
@@ -1457,6 +2336,12 @@ async def convert_to_mp3(
 ) -> Tuple[bool, Optional[str]]:
     """Извлечь аудио из видео в MP3"""
     try:
+        from result_cache import get_result_cache
+        cache = get_result_cache()
+        cache_key = await cache.key_for_file(input_path, "mp3", bitrate=bitrate)
+        if cache.get(cache_key, output_path):
+            return True, None
+        
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
@@ -1466,19 +2351,12 @@ async def convert_to_mp3(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="convert_to_mp3")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
+        cache.put(cache_key, output_path)
         return True, None
     except Exception as e:
         return False, str(e)
@@ -1489,6 +2367,12 @@ async def convert_to_webm(
 ) -> Tuple[bool, Optional[str]]:
     """Конвертировать в WebM"""
     try:
+        from result_cache import get_result_cache
+        cache = get_result_cache()
+        cache_key = await cache.key_for_file(input_path, "webm")
+        if cache.get(cache_key, output_path):
+            return True, None
+        
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
@@ -1499,19 +2383,12 @@ async def convert_to_webm(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="convert_to_webm")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
+        cache.put(cache_key, output_path)
         return True, None
     except Exception as e:
         return False, str(e)
@@ -1553,18 +2430,10 @@ async def apply_custom_watermark(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="apply_custom_watermark")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1606,18 +2475,10 @@ async def change_resolution(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="change_resolution")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1654,18 +2515,10 @@ async def apply_effect_template(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="apply_effect_template")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1675,6 +2528,280 @@ async def apply_effect_template(
 # ══════════════════════════════════════════════════════════════════════════════
 # v3.0.0: MERGE VIDEOS
 # ══════════════════════════════════════════════════════════════════════════════
+# v3.4.0: Планировщик склейки. Все входы пробуются параллельно, затем:
+#   copy      — параметры совпадают: concat demuxer + -c copy
+#   normalize — перекодировать только несовпадающие клипы к общему формату, затем copy
+#   filter    — один concat filtergraph (когда перекодировать почти всё)
+# concat -c copy берёт SPS/PPS (avcC) первого файла, поэтому перед copy и normalize
+# avcC клипов сверяется; при расхождении — filter.
+
+_MERGE_CHANNEL_LAYOUTS = {1: "mono", 2: "stereo", 6: "5.1"}
+# ffprobe profile → -profile:v libx264 (10-бит и 4:2:2 не нормализуем)
+_X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline",
+                  "Main": "main", "High": "high"}
+
+
+@dataclass(frozen=True)
+class VideoFormat:
+    """Параметры видеопотока, которые должны совпадать для concat -c copy"""
+    codec: str
+    width: int
+    height: int
+    fps: float
+    pix_fmt: str
+    time_base: str
+    profile: str = ""
+    level: int = 0
+
+
+@dataclass(frozen=True)
+class AudioFormat:
+    codec: str
+    sample_rate: int
+    channels: int
+
+    @property
+    def layout(self) -> str:
+        return _MERGE_CHANNEL_LAYOUTS.get(self.channels, "stereo")
+
+
+@dataclass
+class MergePlan:
+    strategy: str                       # copy / normalize / filter
+    infos: List[MediaInfo]
+    video: VideoFormat                  # Целевой формат
+    audio: Optional[AudioFormat]        # None — ни у одного клипа нет звука
+    reencode_video: List[int] = field(default_factory=list)
+    reencode_audio: List[int] = field(default_factory=list)
+    normalize_cost: float = 0.0         # Единицы работы (queue_estimator.work_units)
+    filter_cost: float = 0.0
+
+
+def _stream(info: MediaInfo, codec_type: str) -> dict:
+    return next((st for st in info.streams if st.get("codec_type") == codec_type), {})
+
+
+def _video_format(info: MediaInfo) -> VideoFormat:
+    video = _stream(info, "video")
+    return VideoFormat(info.video_codec, info.width, info.height, round(info.fps, 2),
+                       video.get("pix_fmt", ""), video.get("time_base", ""),
+                       video.get("profile", ""), max(int(video.get("level", 0) or 0), 0))
+
+
+def _audio_format(info: MediaInfo) -> Optional[AudioFormat]:
+    if not info.has_audio:
+        return None
+    audio = _stream(info, "audio")
+    return AudioFormat(info.audio_codec, int(audio.get("sample_rate", 0) or 0),
+                       int(audio.get("channels", 0) or 0))
+
+
+def _majority(formats, infos):
+    """Формат с наибольшей суммарной длительностью (его клипы копируются)"""
+    weight = {}
+    for fmt, info in zip(formats, infos):
+        if fmt is not None:
+            weight[fmt] = weight.get(fmt, 0.0) + max(info.duration, 0.1)
+    return max(weight, key=weight.get) if weight else None
+
+
+def plan_merge(infos: List[MediaInfo]) -> MergePlan:
+    """Выбрать стратегию склейки по результатам probe"""
+    from queue_estimator import build_features, work_units
+
+    videos = [_video_format(i) for i in infos]
+    audios = [_audio_format(i) for i in infos]
+    target_video = _majority(videos, infos)
+    target_audio = _majority(audios, infos)
+
+    plan = MergePlan("copy", infos, target_video, target_audio)
+    plan.reencode_video = [i for i, v in enumerate(videos) if v != target_video]
+    plan.reencode_audio = [i for i, a in enumerate(audios) if a != target_audio]
+
+    def units(i: int) -> float:
+        return work_units(build_features(target_video.width, target_video.height,
+                                         infos[i].duration, target_video.fps))
+
+    plan.filter_cost = sum(units(i) for i in range(len(infos)))
+    plan.normalize_cost = sum(units(i) for i in plan.reencode_video)
+
+    if not plan.reencode_video and not plan.reencode_audio:
+        return plan
+    # Несовпадающие клипы перекодируем в h264/aac — целевой формат должен быть таким же
+    encodable = (target_video.codec == "h264" and target_video.pix_fmt in ("yuv420p", "")
+                 and (not target_video.profile or target_video.profile in _X264_PROFILES)
+                 and (target_audio is None or target_audio.codec == "aac"))
+    if encodable and plan.normalize_cost <= MERGE_NORMALIZE_MAX_SHARE * plan.filter_cost:
+        plan.strategy = "normalize"
+    else:
+        plan.strategy = "filter"
+    return plan
+
+
+async def _run_merge_ffmpeg(cmd: List[str], timeout: float,
+                            label: str = "merge") -> Tuple[bool, Optional[str]]:
+    result = await run_ffmpeg(cmd, label=label, timeout=timeout)
+    if result.timed_out:
+        return False, "Merge timeout"
+    if not result.ok:
+        return False, result.error()
+    return True, None
+
+
+def _normalize_clip_command(plan: MergePlan, index: int, output_path: str) -> List[str]:
+    """Привести один клип к целевому формату (что совпадает — копируется)"""
+    info = plan.infos[index]
+    video, audio = plan.video, plan.audio
+    cmd = [FFMPEG_PATH, "-y", "-i", info.path]
+    if audio is not None and not info.has_audio:
+        cmd += ["-f", "lavfi", "-i", f"anullsrc=r={audio.sample_rate}:cl={audio.layout}"]
+    cmd += ["-map", "0:v:0"]
+
+    if index in plan.reencode_video:
+        cmd += [
+            "-vf", (f"scale={video.width}:{video.height}:force_original_aspect_ratio=decrease,"
+                    f"pad={video.width}:{video.height}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+                    f"fps={video.fps},format=yuv420p"),
+            "-c:v", "libx264", "-preset", "fast", "-crf", "23",
+        ]
+        # Профиль и уровень цели — SPS должен совпасть с копируемыми клипами
+        if video.profile in _X264_PROFILES:
+            cmd += ["-profile:v", _X264_PROFILES[video.profile]]
+        if video.level >= 10:
+            cmd += ["-level:v", f"{video.level // 10}.{video.level % 10}"]
+    else:
+        cmd += ["-c:v", "copy"]
+    if video.time_base.startswith("1/"):
+        # Одинаковый timescale дорожки — иначе concat -c copy ломает тайминги
+        cmd += ["-video_track_timescale", video.time_base[2:]]
+
+    if audio is not None:
+        cmd += ["-map", "0:a:0" if info.has_audio else "1:a:0"]
+        if index in plan.reencode_audio:
+            # apad + -shortest: звук ровно по длине видео, без рассинхрона на стыках.
+            # -t — страховка: при -c:v copy -shortest не всегда завершает бесконечный apad
+            cmd += ["-af", "apad", "-shortest",
+                    "-c:a", "aac", "-ar", str(audio.sample_rate), "-ac", str(audio.channels)]
+            if info.duration > 0:
+                cmd += ["-t", f"{info.duration:.3f}"]
+        else:
+            cmd += ["-c:a", "copy"]
+    cmd += ["-avoid_negative_ts", "make_zero", output_path]
+    return cmd
+
+
+def _read_avcc(path: str) -> Optional[bytes]:
+    """avcC (SPS/PPS) видеодорожки MP4/MOV; None — не MP4 или не H.264"""
+    try:
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            pos = 0
+            while pos + 8 <= size:
+                f.seek(pos)
+                box_size, box_type = struct.unpack('>I4s', f.read(8))
+                if box_size == 1:
+                    box_size = struct.unpack('>Q', f.read(8))[0]
+                elif box_size == 0:
+                    box_size = size - pos
+                if box_size < 8:
+                    return None
+                if box_type == b'moov':
+                    f.seek(pos)
+                    moov = f.read(box_size)
+                    at = moov.find(b'avcC')
+                    if at < 4:
+                        return None
+                    length = struct.unpack('>I', moov[at - 4:at])[0]
+                    return moov[at + 4:at - 4 + length]
+                pos += box_size
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+async def _extradata_differs(paths: List[str]) -> bool:
+    """У клипов разный avcC — concat -c copy даст битый поток"""
+    extradata = await asyncio.gather(*(asyncio.to_thread(_read_avcc, path) for path in paths))
+    known = set(e for e in extradata if e is not None)
+    # Не-H.264 (нет avcC ни у кого) — сверять нечего
+    return len(known) > 1 or (bool(known) and None in extradata)
+
+
+async def _normalize_matches(plan: MergePlan) -> bool:
+    """
+    До перекодирования: один кадр первого несовпадающего клипа с теми же
+    аргументами — avcC должен совпасть с копируемыми клипами. У x264 SPS/PPS
+    определяются параметрами, а не содержимым, поэтому кадра достаточно.
+    """
+    copied = [info.path for i, info in enumerate(plan.infos) if i not in plan.reencode_video]
+    if not plan.reencode_video:
+        return not await _extradata_differs(copied)
+    probe_path = str(get_temp_dir() / f"merge_probe_{uuid.uuid4().hex[:8]}.mp4")
+    try:
+        cmd = _normalize_clip_command(plan, plan.reencode_video[0], probe_path)
+        cmd[-1:-1] = ["-frames:v", "1"]
+        success, _ = await _run_merge_ffmpeg(cmd, FFMPEG_TIMEOUT_SECONDS, "merge_probe")
+        return success and not await _extradata_differs(copied + [probe_path])
+    finally:
+        cleanup_file(probe_path)
+
+
+async def _concat_copy(paths: List[str], output_path: str) -> Tuple[bool, Optional[str]]:
+    list_file = get_temp_dir() / f"merge_list_{uuid.uuid4().hex[:8]}.txt"
+    with open(list_file, 'w', encoding='utf-8') as f:
+        for path in paths:
+            # Экранируем путь
+            escaped_path = path.replace("'", "'\\''")
+            f.write(f"file '{escaped_path}'\n")
+    cmd = [
+        FFMPEG_PATH, "-y",
+        "-fflags", "+genpts",
+        "-f", "concat",
+        "-safe", "0",
+        "-i", str(list_file),
+        "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
+        "-movflags", "+faststart",
+        output_path
+    ]
+    try:
+        return await _run_merge_ffmpeg(cmd, FFMPEG_TIMEOUT_SECONDS * 2, "merge_copy")
+    finally:
+        cleanup_file(str(list_file))
+
+
+def _concat_filter_command(plan: MergePlan, output_path: str) -> List[str]:
+    """Один проход: каждый клип приводится к цели внутри filtergraph и склеивается"""
+    video, audio = plan.video, plan.audio
+    cmd = [FFMPEG_PATH, "-y"]
+    for info in plan.infos:
+        cmd += ["-i", info.path]
+
+    parts, labels = [], []
+    for i, info in enumerate(plan.infos):
+        parts.append(
+            f"[{i}:v:0]scale={video.width}:{video.height}:force_original_aspect_ratio=decrease,"
+            f"pad={video.width}:{video.height}:(ow-iw)/2:(oh-ih)/2,setsar=1,"
+            f"fps={video.fps},format=yuv420p,setpts=PTS-STARTPTS[v{i}]"
+        )
+        labels.append(f"[v{i}]")
+        if audio is not None:
+            # Звук каждого клипа — ровно по длине его видео
+            source = (f"[{i}:a:0]aresample={audio.sample_rate},"
+                      f"aformat=sample_fmts=fltp:channel_layouts={audio.layout},apad"
+                      if info.has_audio else
+                      f"anullsrc=r={audio.sample_rate}:cl={audio.layout}")
+            parts.append(f"{source},atrim=0:{info.duration:.3f},asetpts=PTS-STARTPTS[a{i}]")
+            labels.append(f"[a{i}]")
+
+    streams = "[v][a]" if audio is not None else "[v]"
+    parts.append(f"{''.join(labels)}concat=n={len(plan.infos)}:v=1:a={int(audio is not None)}{streams}")
+    cmd += ["-filter_complex", ";".join(parts), "-map", "[v]"]
+    if audio is not None:
+        cmd += ["-map", "[a]"]
+    cmd += DEFAULT_ENCODER_ARGS + ["-movflags", "+faststart", output_path]
+    return cmd
+
 
 async def merge_videos(
     input_paths: List[str],
@@ -1682,50 +2809,55 @@ async def merge_videos(
 ) -> Tuple[bool, Optional[str]]:
     """
     Склеить несколько видео в одно.
+    v3.4.0: copy, если форматы совпадают; иначе перекодируются только
+    несовпадающие клипы или всё одним filtergraph — что дешевле (plan_merge).
     """
     try:
         if len(input_paths) < 2:
             return False, "Need at least 2 videos to merge"
-        
-        # Создаём файл со списком видео
-        temp_dir = get_temp_dir()
-        list_file = temp_dir / f"merge_list_{uuid.uuid4().hex[:8]}.txt"
-        
-        with open(list_file, 'w', encoding='utf-8') as f:
-            for path in input_paths:
-                # Экранируем путь
-                escaped_path = path.replace("'", "'\\''")
-                f.write(f"file '{escaped_path}'\n")
-        
-        cmd = [
-            FFMPEG_PATH, "-y",
-            "-f", "concat",
-            "-safe", "0",
-            "-i", str(list_file),
-            "-c", "copy",
-            output_path
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS * 2  # Больше времени для склейки
-        )
-        
-        # Удаляем временный файл
+
+        infos = await asyncio.gather(*(probe(path) for path in input_paths))
+        for path, info in zip(input_paths, infos):
+            if info is None or not info.has_video:
+                return False, f"Cannot read video: {os.path.basename(path)}"
+
+        plan = plan_merge(list(infos))
+        print(f"[MERGE] {len(infos)} clips → {plan.strategy} "
+              f"(reencode video {len(plan.reencode_video)}, audio {len(plan.reencode_audio)})")
+
+        # Формат совпал, но SPS/PPS разные (другой энкодер / настройки) — только filter
+        if plan.strategy == "copy" and await _extradata_differs(input_paths):
+            print("[MERGE] avcC differs between clips → filter")
+            plan.strategy = "filter"
+        elif plan.strategy == "normalize" and not await _normalize_matches(plan):
+            print("[MERGE] Normalized avcC would not match → filter")
+            plan.strategy = "filter"
+
+        if plan.strategy == "copy":
+            return await _concat_copy(input_paths, output_path)
+
+        if plan.strategy == "filter":
+            timeout = FFMPEG_TIMEOUT_SECONDS * 2
+            return await _run_merge_ffmpeg(_concat_filter_command(plan, output_path), timeout,
+                                           "merge_filter")
+
+        # normalize: несовпадающие клипы → временные файлы, затем concat -c copy
+        parts = list(input_paths)
+        temp_files = []
         try:
-            os.remove(list_file)
-        except:
-            pass
-        
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
-        
-        return True, None
+            for i in sorted(set(plan.reencode_video) | set(plan.reencode_audio)):
+                temp_path = str(get_temp_dir() / f"merge_norm_{uuid.uuid4().hex[:8]}.mp4")
+                temp_files.append(temp_path)
+                success, error = await _run_merge_ffmpeg(
+                    _normalize_clip_command(plan, i, temp_path), FFMPEG_TIMEOUT_SECONDS, "merge_normalize"
+                )
+                if not success:
+                    return False, error
+                parts[i] = temp_path
+            return await _concat_copy(parts, output_path)
+        finally:
+            for temp_path in temp_files:
+                cleanup_file(temp_path)
     except Exception as e:
         return False, str(e)
 
@@ -1734,6 +2866,24 @@ async def merge_videos(
 # v3.0.0: SPEED CONTROL
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _speed_fragment(speed: float) -> FilterFragment:
+    """Фрагмент графа: setpts + atempo"""
+    if speed <= 0 or speed > 4:
+        raise ValueError("Speed must be between 0.1 and 4.0")
+    
+    # Фильтр для видео и аудио
+    video_filter = f"setpts={1/speed}*PTS"
+    audio_filter = f"atempo={speed}" if 0.5 <= speed <= 2.0 else f"atempo={min(2.0, speed)},atempo={speed/2.0}"
+    
+    # Для скоростей вне 0.5-2.0 нужно каскадировать atempo
+    if speed < 0.5:
+        audio_filter = f"atempo=0.5,atempo={speed/0.5}"
+    elif speed > 2.0:
+        audio_filter = f"atempo=2.0,atempo={speed/2.0}"
+    
+    return FilterFragment(video=[video_filter], audio=[audio_filter], speed=speed)
+
+
 async def change_speed(
     input_path: str,
     output_path: str,
@@ -1744,41 +2894,22 @@ async def change_speed(
     speed: 0.5 (замедление) - 2.0 (ускорение)
     """
     try:
-        if speed <= 0 or speed > 4:
-            return False, "Speed must be between 0.1 and 4.0"
-        
-        # Фильтр для видео и аудио
-        video_filter = f"setpts={1/speed}*PTS"
-        audio_filter = f"atempo={speed}" if 0.5 <= speed <= 2.0 else f"atempo={min(2.0, speed)},atempo={speed/2.0}"
-        
-        # Для скоростей вне 0.5-2.0 нужно каскадировать atempo
-        if speed < 0.5:
-            audio_filter = f"atempo=0.5,atempo={speed/0.5}"
-        elif speed > 2.0:
-            audio_filter = f"atempo=2.0,atempo={speed/2.0}"
+        fragment = _speed_fragment(speed)
         
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
-            "-filter:v", video_filter,
-            "-filter:a", audio_filter,
+            "-filter:v", fragment.video_filter,
+            "-filter:a", fragment.audio_filter,
             "-c:v", "libx264",
             "-preset", "fast",
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="change_speed")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1822,18 +2953,10 @@ async def rotate_flip_video(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="rotate_flip_video")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1844,6 +2967,33 @@ async def rotate_flip_video(
 # v3.0.0: CHANGE ASPECT RATIO
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _aspect_ratio_fragment(aspect: str) -> FilterFragment:
+    """Фрагмент графа: crop + scale под соотношение сторон"""
+    from config import ASPECT_RATIOS
+    
+    if aspect not in ASPECT_RATIOS:
+        raise ValueError(f"Unknown aspect ratio: {aspect}")
+    
+    ratio = ASPECT_RATIOS[aspect]
+    w, h = ratio["width"], ratio["height"]
+    
+    # Crop + pad для нужного соотношения
+    filter_str = f"crop=ih*{w}/{h}:ih:(iw-ih*{w}/{h})/2:0,scale=1080:-2,pad=1080:1920:(ow-iw)/2:(oh-ih)/2"
+    
+    if aspect == "16:9":
+        filter_str = "crop=iw:iw*9/16:0:(ih-iw*9/16)/2,scale=1920:1080"
+    elif aspect == "1:1":
+        filter_str = "crop=min(iw\\,ih):min(iw\\,ih),scale=1080:1080"
+    elif aspect == "4:3":
+        filter_str = "crop=ih*4/3:ih:(iw-ih*4/3)/2:0,scale=1440:1080"
+    elif aspect == "4:5":
+        filter_str = "crop=ih*4/5:ih:(iw-ih*4/5)/2:0,scale=864:1080"
+    elif aspect == "9:16":
+        filter_str = "crop=ih*9/16:ih:(iw-ih*9/16)/2:0,scale=1080:1920"
+    
+    return FilterFragment(video=[filter_str])
+
+
 async def change_aspect_ratio(
     input_path: str,
     output_path: str,
@@ -1853,51 +3003,23 @@ async def change_aspect_ratio(
     Изменить соотношение сторон.
     aspect: 9:16, 16:9, 1:1, 4:3, 4:5
     """
-    from config import ASPECT_RATIOS
-    
     try:
-        if aspect not in ASPECT_RATIOS:
-            return False, f"Unknown aspect ratio: {aspect}"
-        
-        ratio = ASPECT_RATIOS[aspect]
-        w, h = ratio["width"], ratio["height"]
-        
-        # Crop + pad для нужного соотношения
-        filter_str = f"crop=ih*{w}/{h}:ih:(iw-ih*{w}/{h})/2:0,scale=1080:-2,pad=1080:1920:(ow-iw)/2:(oh-ih)/2"
-        
-        if aspect == "16:9":
-            filter_str = "crop=iw:iw*9/16:0:(ih-iw*9/16)/2,scale=1920:1080"
-        elif aspect == "1:1":
-            filter_str = "crop=min(iw\\,ih):min(iw\\,ih),scale=1080:1080"
-        elif aspect == "4:3":
-            filter_str = "crop=ih*4/3:ih:(iw-ih*4/3)/2:0,scale=1440:1080"
-        elif aspect == "4:5":
-            filter_str = "crop=ih*4/5:ih:(iw-ih*4/5)/2:0,scale=864:1080"
-        elif aspect == "9:16":
-            filter_str = "crop=ih*9/16:ih:(iw-ih*9/16)/2:0,scale=1080:1920"
+        fragment = _aspect_ratio_fragment(aspect)
         
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
-            "-vf", filter_str,
+            "-vf", fragment.video_filter,
             "-c:v", "libx264",
             "-preset", "fast",
             "-c:a", "copy",
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="change_aspect_ratio")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -1908,6 +3030,16 @@ async def change_aspect_ratio(
 # v3.0.0: APPLY VIDEO FILTER
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _video_filter_fragment(filter_name: str) -> FilterFragment:
+    """Фрагмент графа: цветовой фильтр из VIDEO_FILTERS"""
+    from config import VIDEO_FILTERS
+    
+    if filter_name not in VIDEO_FILTERS:
+        raise ValueError(f"Unknown filter: {filter_name}")
+    
+    return FilterFragment(video=[VIDEO_FILTERS[filter_name]["filter"]])
+
+
 async def apply_video_filter(
     input_path: str,
     output_path: str,
@@ -1917,37 +3049,23 @@ async def apply_video_filter(
     Применить видео-фильтр.
     filter_name: bw, sepia, negative, blur, sharpen, vintage, warm, cold, vignette, bright
     """
-    from config import VIDEO_FILTERS
-    
     try:
-        if filter_name not in VIDEO_FILTERS:
-            return False, f"Unknown filter: {filter_name}"
-        
-        filter_data = VIDEO_FILTERS[filter_name]
-        video_filter = filter_data["filter"]
+        fragment = _video_filter_fragment(filter_name)
         
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
-            "-vf", video_filter,
+            "-vf", fragment.video_filter,
             "-c:v", "libx264",
             "-preset", "fast",
             "-c:a", "copy",
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="apply_video_filter")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -2017,18 +3135,10 @@ async def add_custom_text(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="add_custom_text")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -2043,10 +3153,12 @@ async def compress_video(
     input_path: str,
     output_path: str,
     preset: str,
+    threads: int = 0,
 ) -> Tuple[bool, Optional[str], dict]:
     """
     Сжать видео под конкретную платформу.
     preset: telegram, whatsapp, discord, email, max_quality
+    threads: потоков FFmpeg по cpu_policy (0 — без ограничения)
     Возвращает: (success, error, info_dict)
     """
     from config import COMPRESSION_PRESETS
@@ -2055,25 +3167,8 @@ async def compress_video(
         if preset not in COMPRESSION_PRESETS:
             return False, f"Unknown preset: {preset}", {}
         
-        preset_data = COMPRESSION_PRESETS[preset]
-        target_size_mb = preset_data["target_size_mb"]
-        max_bitrate = preset_data["max_bitrate"]
-        audio_bitrate = preset_data["audio_bitrate"]
-        
         # Получаем длительность видео
         duration = await get_video_duration(input_path)
-        if duration <= 0:
-            duration = 60  # fallback
-        
-        # Рассчитываем оптимальный битрейт
-        # target_size_bits = target_size_mb * 8 * 1024 * 1024
-        # video_bitrate = (target_size_bits / duration) - audio_bitrate_int
-        audio_bitrate_int = int(audio_bitrate.replace('k', '')) * 1000
-        target_size_bits = target_size_mb * 8 * 1024 * 1024
-        calculated_bitrate = int((target_size_bits / duration - audio_bitrate_int) / 1000)
-        
-        # Используем минимум из рассчитанного и максимального
-        video_bitrate = min(calculated_bitrate, max_bitrate)
         
         # Получаем размер исходного файла
         original_size = os.path.getsize(input_path)
@@ -2081,28 +3176,12 @@ async def compress_video(
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
-            "-c:v", "libx264",
-            "-b:v", f"{video_bitrate}k",
-            "-maxrate", f"{video_bitrate}k",
-            "-bufsize", f"{video_bitrate * 2}k",
-            "-preset", "fast",
-            "-c:a", "aac",
-            "-b:a", audio_bitrate,
-            output_path
-        ]
+        ] + _compression_encoder_args(preset, duration) + _thread_args(threads) + [output_path]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="compress_video")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200], {}
+        if not result.ok:
+            return False, result.error(), {}
         
         # Получаем размер выходного файла
         new_size = os.path.getsize(output_path)
@@ -2119,6 +3198,42 @@ async def compress_video(
         return False, str(e), {}
 
 
+def _compression_encoder_args(preset: str, duration: float) -> List[str]:
+    """Параметры кодера под целевой размер пресета сжатия"""
+    from config import COMPRESSION_PRESETS
+    
+    if preset not in COMPRESSION_PRESETS:
+        raise ValueError(f"Unknown preset: {preset}")
+    
+    preset_data = COMPRESSION_PRESETS[preset]
+    target_size_mb = preset_data["target_size_mb"]
+    max_bitrate = preset_data["max_bitrate"]
+    audio_bitrate = preset_data["audio_bitrate"]
+    
+    if duration <= 0:
+        duration = 60  # fallback
+    
+    # Рассчитываем оптимальный битрейт
+    # target_size_bits = target_size_mb * 8 * 1024 * 1024
+    # video_bitrate = (target_size_bits / duration) - audio_bitrate_int
+    audio_bitrate_int = int(audio_bitrate.replace('k', '')) * 1000
+    target_size_bits = target_size_mb * 8 * 1024 * 1024
+    calculated_bitrate = int((target_size_bits / duration - audio_bitrate_int) / 1000)
+    
+    # Используем минимум из рассчитанного и максимального
+    video_bitrate = min(calculated_bitrate, max_bitrate)
+    
+    return [
+        "-c:v", "libx264",
+        "-b:v", f"{video_bitrate}k",
+        "-maxrate", f"{video_bitrate}k",
+        "-bufsize", f"{video_bitrate * 2}k",
+        "-preset", "fast",
+        "-c:a", "aac",
+        "-b:a", audio_bitrate,
+    ]
+
+
 def format_file_size(size_bytes: int) -> str:
     """Форматировать размер файла"""
     if size_bytes < 1024:
@@ -2170,6 +3285,15 @@ async def extract_thumbnail(
         
         seek_time = min(seek_time, duration - 0.1)
         
+        # v3.4.0: "best" — случайный кадр, его не кэшируем
+        from result_cache import get_result_cache
+        cache = get_result_cache()
+        cache_key = None
+        if time_position != "best":
+            cache_key = await cache.key_for_file(input_path, "thumbnail", seek=round(seek_time, 3))
+            if cache.get(cache_key, output_path):
+                return True, None
+        
         cmd = [
             FFMPEG_PATH, "-y",
             "-ss", str(seek_time),
@@ -2179,19 +3303,12 @@ async def extract_thumbnail(
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=30
-        )
+        result = await run_ffmpeg(cmd, label="extract_thumbnail", timeout=30)
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
+        cache.put(cache_key, output_path)
         return True, None
     except Exception as e:
         return False, str(e)
@@ -2206,27 +3323,11 @@ async def get_detailed_video_info(input_path: str) -> dict:
     Получить подробную информацию о видео.
     """
     try:
-        cmd = [
-            FFPROBE_PATH,
-            "-v", "quiet",
-            "-print_format", "json",
-            "-show_format",
-            "-show_streams",
-            input_path
-        ]
-        
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, _ = await asyncio.wait_for(
-            process.communicate(),
-            timeout=30
-        )
-        
-        import json
-        data = json.loads(stdout.decode())
+        # v3.4.0: Берём из кэша probe()
+        media = await probe(input_path)
+        if not media:
+            raise ValueError("ffprobe failed")
+        data = {"streams": media.streams, "format": media.format}
         
         # Парсим информацию
         video_stream = None
@@ -2305,6 +3406,27 @@ async def get_detailed_video_info(input_path: str) -> dict:
 # v3.0.0: ADJUST VOLUME
 # ══════════════════════════════════════════════════════════════════════════════
 
+def _volume_fragment(volume_setting: str) -> FilterFragment:
+    """Фрагмент графа: громкость / нормализация"""
+    from config import VOLUME_OPTIONS
+    
+    if volume_setting not in VOLUME_OPTIONS:
+        raise ValueError(f"Unknown volume setting: {volume_setting}")
+    
+    value = VOLUME_OPTIONS[volume_setting]["value"]
+    
+    if value == "normalize":
+        # Нормализация громкости
+        audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
+    elif value == 0:
+        # Без звука
+        audio_filter = "volume=0"
+    else:
+        audio_filter = f"volume={value}"
+    
+    return FilterFragment(audio=[audio_filter])
+
+
 async def adjust_volume(
     input_path: str,
     output_path: str,
@@ -2314,44 +3436,22 @@ async def adjust_volume(
     Изменить громкость видео.
     volume_setting: mute, 50%, 100%, 150%, 200%, normalize
     """
-    from config import VOLUME_OPTIONS
-    
     try:
-        if volume_setting not in VOLUME_OPTIONS:
-            return False, f"Unknown volume setting: {volume_setting}"
-        
-        value = VOLUME_OPTIONS[volume_setting]["value"]
-        
-        if value == "normalize":
-            # Нормализация громкости
-            audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
-        elif value == 0:
-            # Без звука
-            audio_filter = "volume=0"
-        else:
-            audio_filter = f"volume={value}"
+        fragment = _volume_fragment(volume_setting)
         
         cmd = [
             FFMPEG_PATH, "-y",
             "-i", input_path,
             "-c:v", "copy",
-            "-af", audio_filter,
+            "-af", fragment.audio_filter,
             "-c:a", "aac",
             output_path
         ]
         
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="adjust_volume")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[:200]
+        if not result.ok:
+            return False, result.error()
         
         return True, None
     except Exception as e:
@@ -2369,6 +3469,8 @@ async def auto_process_video(
 ) -> Tuple[bool, Optional[str]]:
     """
     Автоматическая обработка видео по шаблону.
+    v3.4.0: все шаги шаблона собираются в один граф фильтров — одно
+    декодирование и одно кодирование (битрейт по пресету сжатия).
     """
     from config import AUTO_PROCESS_TEMPLATES
     
@@ -2378,87 +3480,45 @@ async def auto_process_video(
         
         template = AUTO_PROCESS_TEMPLATES[template_id]
         
-        # Временные файлы для промежуточных результатов
-        temp_dir = get_temp_dir()
-        current_input = input_path
-        step = 0
+        media = await probe(input_path)
+        if not media or not media.has_video:
+            return False, "Cannot get video info"
         
-        # Применяем настройки по очереди
+        pipeline = FilterPipeline()
         
         # 1. Aspect ratio
         if "aspect" in template:
-            step += 1
-            temp_output = str(temp_dir / f"auto_{step}_{uuid.uuid4().hex[:8]}.mp4")
-            success, error = await change_aspect_ratio(current_input, temp_output, template["aspect"])
-            if not success:
-                return False, f"Aspect ratio error: {error}"
-            if current_input != input_path:
-                try:
-                    os.remove(current_input)
-                except:
-                    pass
-            current_input = temp_output
+            pipeline.add(_aspect_ratio_fragment(template["aspect"]))
         
         # 2. Speed
         if "speed" in template and template["speed"] != "1x":
-            step += 1
-            temp_output = str(temp_dir / f"auto_{step}_{uuid.uuid4().hex[:8]}.mp4")
-            speed_val = float(template["speed"].replace("x", ""))
-            success, error = await change_speed(current_input, temp_output, speed_val)
-            if not success:
-                return False, f"Speed error: {error}"
-            if current_input != input_path:
-                try:
-                    os.remove(current_input)
-                except:
-                    pass
-            current_input = temp_output
+            pipeline.add(_speed_fragment(float(template["speed"].replace("x", ""))))
         
         # 3. Filter
         if "filter" in template:
-            step += 1
-            temp_output = str(temp_dir / f"auto_{step}_{uuid.uuid4().hex[:8]}.mp4")
-            success, error = await apply_video_filter(current_input, temp_output, template["filter"])
-            if not success:
-                return False, f"Filter error: {error}"
-            if current_input != input_path:
-                try:
-                    os.remove(current_input)
-                except:
-                    pass
-            current_input = temp_output
+            pipeline.add(_video_filter_fragment(template["filter"]))
         
         # 4. Volume
         if "volume" in template:
-            step += 1
-            temp_output = str(temp_dir / f"auto_{step}_{uuid.uuid4().hex[:8]}.mp4")
-            success, error = await adjust_volume(current_input, temp_output, template["volume"])
-            if not success:
-                return False, f"Volume error: {error}"
-            if current_input != input_path:
-                try:
-                    os.remove(current_input)
-                except:
-                    pass
-            current_input = temp_output
-        
-        # 5. Compression (последний шаг)
+            pipeline.add(_volume_fragment(template["volume"]))
+        
+        # 5. Compression (параметры финального кодирования)
         if "compression" in template:
-            success, error, _ = await compress_video(current_input, output_path, template["compression"])
-            if not success:
-                return False, f"Compression error: {error}"
-            if current_input != input_path:
-                try:
-                    os.remove(current_input)
-                except:
-                    pass
+            encoder_args = _compression_encoder_args(
+                template["compression"],
+                pipeline.output_duration(media.duration or 60.0)
+            )
+        elif pipeline.fragments:
+            encoder_args = DEFAULT_ENCODER_ARGS
         else:
-            # Просто копируем если нет сжатия
+            # Просто копируем если нечего делать
             import shutil
-            if current_input != input_path:
-                shutil.move(current_input, output_path)
-            else:
-                shutil.copy(current_input, output_path)
+            shutil.copy(input_path, output_path)
+            return True, None
+        
+        success, error = await pipeline.run(input_path, output_path, encoder_args, media.has_audio)
+        if not success:
+            return False, f"Processing error: {error}"
         
         return True, None
     except Exception as e:
@@ -2513,24 +3573,10 @@ def _get_anti_reupload_settings(level: str) -> dict:
     return ANTI_REUPLOAD_LEVELS.get(level, ANTI_REUPLOAD_LEVELS[DEFAULT_ANTI_REUPLOAD_LEVEL])
 
 
-async def apply_anti_reupload(
-    input_path: str,
-    output_path: str,
-    level: str = "medium"
-) -> Tuple[bool, Optional[str]]:
-    """
-    Применить Anti-Reupload фильтры на основе уровня.
-    Low = быстро, базовая защита
-    Medium = оптимальный баланс
-    Hardcore = максимальная защита (Premium only)
-    """
+def _anti_reupload_fragment(level: str, width: int, height: int) -> FilterFragment:
+    """Фрагмент графа Anti-Reupload для уровня level"""
     settings = _get_anti_reupload_settings(level)
     
-    info = await get_video_info(input_path)
-    if not info:
-        return False, "Cannot get video info"
-    
-    width, height, duration, fps = info
     filters = []
     audio_filters = []
     
@@ -2574,57 +3620,37 @@ async def apply_anti_reupload(
         audio_filters.append(f"asetrate=44100*{pitch:.4f},aresample=44100")
     
     # Mirror segments (Hardcore) - зеркалим случайные сегменты
-    if settings.get("mirror_segments") and duration > 5:
-        # Добавляем subtle hflip в случайные моменты через blend
-        pass  # Сложная логика, пропускаем для MVP
+    # (Сложная логика, пропускаем для MVP)
     
     filters.append("format=yuv420p")
     
-    video_filter = ",".join(filters)
-    audio_filter = ",".join(audio_filters) if audio_filters else None
-    
-    cmd = [
-        FFMPEG_PATH, "-y",
-        "-i", input_path,
-        "-vf", video_filter,
-    ]
-    
-    if audio_filter:
-        cmd.extend(["-af", audio_filter])
-    
-    cmd.extend([
-        "-c:v", "libx264",
-        "-preset", "fast",
-        "-crf", "23",
-        "-c:a", "aac",
-        "-b:a", "128k",
-    ])
-    
     # Metadata wipe (Medium+)
-    if settings.get("metadata_wipe"):
-        cmd.extend(["-map_metadata", "-1"])
+    output_args = ["-map_metadata", "-1"] if settings.get("metadata_wipe") else []
     
-    cmd.append(output_path)
+    return FilterFragment(video=filters, audio=audio_filters, output_args=output_args, speed=speed)
+
+
+# Кодер одиночного Anti-Reupload прохода
+ANTI_REUPLOAD_ENCODER_ARGS = ["-c:v", "libx264", "-preset", "fast", "-crf", "23", "-c:a", "aac", "-b:a", "128k"]
+
+
+async def apply_anti_reupload(
+    input_path: str,
+    output_path: str,
+    level: str = "medium"
+) -> Tuple[bool, Optional[str]]:
+    """
+    Применить Anti-Reupload фильтры на основе уровня.
+    Low = быстро, базовая защита
+    Medium = оптимальный баланс
+    Hardcore = максимальная защита (Premium only)
+    """
+    media = await probe(input_path)
+    if not media or not media.has_video:
+        return False, "Cannot get video info"
     
-    try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
-        
-        if process.returncode != 0:
-            return False, stderr.decode()[-200:]
-        
-        return True, None
-    except asyncio.TimeoutError:
-        return False, "Timeout"
-    except Exception as e:
-        return False, str(e)
+    pipeline = FilterPipeline([_anti_reupload_fragment(level, media.width, media.height)])
+    return await pipeline.run(input_path, output_path, ANTI_REUPLOAD_ENCODER_ARGS, media.has_audio)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -2639,6 +3665,30 @@ def _generate_watermark_hash(user_id: int) -> str:
     return hashlib.sha256(data.encode()).hexdigest()[:16]
 
 
+def _watermark_trap_fragment(user_id: int, width: int, height: int,
+                             strength: float = 0.02) -> Tuple[FilterFragment, str]:
+    """Фрагмент графа: невидимый drawtext с хешем. Возвращает (fragment, watermark_hash)"""
+    watermark_hash = _generate_watermark_hash(user_id)
+    
+    # Простой метод: добавляем невидимый текст с очень низкой opacity
+    # В будущем можно использовать LSB стеганографию
+    
+    # Невидимый watermark через drawtext с минимальной видимостью
+    # Позиция рандомная, чтобы сложнее было удалить
+    x_pos = random.randint(10, max(10, width - 100))
+    y_pos = random.randint(10, max(10, height - 50))
+    
+    # Alpha очень низкая (0.01-0.03) - практически невидимо
+    alpha = strength
+    
+    watermark_filter = (
+        f"drawtext=text='{watermark_hash}':"
+        f"fontsize=8:fontcolor=white@{alpha:.2f}:"
+        f"x={x_pos}:y={y_pos}"
+    )
+    return FilterFragment(video=[watermark_filter]), watermark_hash
+
+
 async def embed_watermark_trap(
     input_path: str,
     output_path: str,
@@ -2652,35 +3702,17 @@ async def embed_watermark_trap(
     Метод: Добавляем микро-паттерн в случайные кадры, 
     который незаметен глазу но может быть извлечён.
     """
-    watermark_hash = _generate_watermark_hash(user_id)
-    
-    # Простой метод: добавляем невидимый текст с очень низкой opacity
-    # В будущем можно использовать LSB стеганографию
-    
     info = await get_video_info(input_path)
     if not info:
         return False, "Cannot get video info", ""
     
     width, height, _, _ = info
-    
-    # Невидимый watermark через drawtext с минимальной видимостью
-    # Позиция рандомная, чтобы сложнее было удалить
-    x_pos = random.randint(10, width - 100)
-    y_pos = random.randint(10, height - 50)
-    
-    # Alpha очень низкая (0.01-0.03) - практически невидимо
-    alpha = strength
-    
-    watermark_filter = (
-        f"drawtext=text='{watermark_hash}':"
-        f"fontsize=8:fontcolor=white@{alpha:.2f}:"
-        f"x={x_pos}:y={y_pos}"
-    )
+    fragment, watermark_hash = _watermark_trap_fragment(user_id, width, height, strength)
     
     cmd = [
         FFMPEG_PATH, "-y",
         "-i", input_path,
-        "-vf", watermark_filter,
+        "-vf", fragment.video_filter,
         "-c:v", "libx264",
         "-preset", "fast",
         "-crf", "18",  # Высокое качество чтобы сохранить watermark
@@ -2689,18 +3721,10 @@ async def embed_watermark_trap(
     ]
     
     try:
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        _, stderr = await asyncio.wait_for(
-            process.communicate(),
-            timeout=FFMPEG_TIMEOUT_SECONDS
-        )
+        result = await run_ffmpeg(cmd, label="embed_watermark_trap")
         
-        if process.returncode != 0:
-            return False, stderr.decode()[-200:], ""
+        if not result.ok:
+            return False, result.error(), ""
         
         return True, None, watermark_hash
     except Exception as e:
@@ -2724,7 +3748,6 @@ async def smart_auto_process(
     
     Returns: (success, error, info_dict)
     """
-    import uuid
     result_info = {
         "template": None,
         "anti_reupload_level": anti_reupload_level,
@@ -2735,63 +3758,59 @@ async def smart_auto_process(
     start_time = time.time()
     
     # 1. Анализируем видео
-    info = await get_video_info(input_path)
-    if not info:
+    media = await probe(input_path)
+    if not media or not media.has_video:
         return False, "Cannot analyze video", result_info
     
-    width, height, duration, fps = info
+    width, height, fps = media.width, media.height, media.fps
+    duration = media.duration or 60.0
     
     # 2. Выбираем лучший шаблон
     best_template = _select_best_template_for_video(width, height, duration)
     result_info["template"] = best_template
     
-    # 3. Создаём временные файлы
-    temp_dir = get_temp_dir()
-    temp1 = str(temp_dir / f"auto1_{uuid.uuid4().hex[:8]}.mp4")
-    temp2 = str(temp_dir / f"auto2_{uuid.uuid4().hex[:8]}.mp4")
+    # 3. v3.4.0: Anti-Reupload → шаблон → Watermark Trap одним графом фильтров
+    anti_reupload = _anti_reupload_fragment(anti_reupload_level, width, height)
     
-    try:
-        # 4. Применяем Anti-Reupload
-        success, error = await apply_anti_reupload(input_path, temp1, anti_reupload_level)
-        if not success:
-            return False, f"Anti-reupload failed: {error}", result_info
-        
-        # 5. Применяем шаблон
-        success = await process_video(
-            temp1, temp2, "tiktok",
-            quality="max", text_overlay=True, template=best_template
+    video_filter, audio_filter, params = _build_process_graph(
+        width, height, duration / anti_reupload.speed, fps,
+        "tiktok", quality="max", text_overlay=True, template=best_template
+    )
+    template_fragment = FilterFragment(video=[video_filter, "format=yuv420p"], audio=[audio_filter])
+    
+    watermark_fragment = None
+    if enable_watermark_trap:
+        from config import WATERMARK_TRAP_SETTINGS
+        watermark_fragment, wm_hash = _watermark_trap_fragment(
+            user_id, width, height, WATERMARK_TRAP_SETTINGS.get("strength", 0.02)
         )
-        
-        current_output = temp2 if success else temp1
-        
-        # 6. Watermark Trap (если включен)
-        if enable_watermark_trap:
-            from config import WATERMARK_TRAP_SETTINGS
-            success, error, wm_hash = await embed_watermark_trap(
-                current_output, output_path, user_id,
-                WATERMARK_TRAP_SETTINGS.get("strength", 0.02)
-            )
+    
+    # Деградация как раньше: упал шаблон — водяной знак ставится на результат
+    # Anti-Reupload; упал водяной знак — остаётся результат предыдущего шага
+    params, _ = plan_rate_control(params, duration / anti_reupload.speed, width, height, media.has_audio)
+    template_args = _process_encoder_args(params, width, height)
+    attempts = []
+    if watermark_fragment:
+        attempts.append(([anti_reupload, template_fragment, watermark_fragment], template_args, True))
+    attempts.append(([anti_reupload, template_fragment], template_args, False))
+    if watermark_fragment:
+        attempts.append(([anti_reupload, watermark_fragment], ANTI_REUPLOAD_ENCODER_ARGS, True))
+    attempts.append(([anti_reupload], ANTI_REUPLOAD_ENCODER_ARGS, False))
+    
+    try:
+        error = None
+        for fragments, encoder_args, with_watermark in attempts:
+            pipeline = FilterPipeline(fragments)
+            success, error = await pipeline.run(input_path, output_path, encoder_args, media.has_audio)
             if success:
-                result_info["watermark_hash"] = wm_hash
-            else:
-                # Если watermark не удался, просто копируем
-                import shutil
-                shutil.copy(current_output, output_path)
-        else:
-            import shutil
-            shutil.copy(current_output, output_path)
+                if with_watermark:
+                    result_info["watermark_hash"] = wm_hash
+                result_info["processing_time"] = round(time.time() - start_time, 2)
+                return True, None, result_info
+            print(f"[SMART] Pipeline with {len(fragments)} fragments failed: {error}")
         
-        result_info["processing_time"] = round(time.time() - start_time, 2)
-        
-        return True, None, result_info
+        return False, f"Anti-reupload failed: {error}", result_info
         
     except Exception as e:
         return False, str(e), result_info
-    finally:
-        # Cleanup
-        for f in [temp1, temp2]:
-            try:
-                if os.path.exists(f):
-                    os.remove(f)
-            except:
-                pass
+
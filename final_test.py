@@ -79,7 +79,7 @@ expected_fields = [
     'operation_logs', 'username', 'processing', 'abuse_hits', 'admin_notified',
     'current_file_id', 'daily_date', 'last_button_time', 'last_file_hash',
     'last_file_time', 'last_process_time', 'last_request_time', 'monthly_downloads',
-    'period_start', 'request_timestamps', 'soft_block_until', 'today_date',
+    'period_start', 'request_window', 'soft_block_until', 'today_date',
     'today_videos', 'week_start'
 ]
 
@@ -0,0 +1,287 @@
+"""
+Virex — Job Metrics v3.4.0
+
+Учёт ресурсов по задачам обработки:
+- Каждая ProcessingTask ведёт JobMetrics: время стадий (download, queue_wait,
+  probe, encode, recompress, upload), размер результата, CPU-секунды и
+  пиковый RSS FFmpeg (run_ffmpeg добавляет их в текущую задачу сам)
+- MetricsRegistry: гистограммы с фиксированными корзинами (для Prometheus)
+  и скользящее окно последних METRICS_WINDOW значений на серию (p50/p95/p99)
+- Серия = метрика + template + quality + plan (+ stage); срезы по одному
+  измерению собираются из окон подходящих серий
+- /metrics в текстовом формате Prometheus: отдельный сервер бота
+  (METRICS_HTTP_PORT) и маршрут на API сервере
+"""
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from config import METRICS_WINDOW, METRICS_HTTP_HOST, METRICS_HTTP_PORT
+
+STAGES = ("download", "queue_wait", "probe", "encode", "recompress", "upload")
+DIMENSIONS = ("template", "quality", "plan")
+PERCENTILES = (50, 95, 99)
+
+SECONDS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+BYTES_BUCKETS = tuple(mb * 1024 * 1024 for mb in (1, 5, 10, 20, 35, 49, 100))
+
+# Метрика → (корзины, описание)
+METRICS = {
+    "virex_job_stage_seconds": (SECONDS_BUCKETS, "Время стадии задачи обработки"),
+    "virex_job_total_seconds": (SECONDS_BUCKETS, "Время задачи от скачивания до отправки"),
+    "virex_job_cpu_seconds": (SECONDS_BUCKETS, "CPU-секунды FFmpeg на задачу"),
+    "virex_job_output_bytes": (BYTES_BUCKETS, "Размер результата"),
+}
+
+# PlanLimits.priority → план (когда план не передан явно)
+PLAN_BY_PRIORITY = {0: "free", 1: "vip", 2: "premium"}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+@dataclass
+class JobMetrics:
+    """Стадии и ресурсы одной задачи"""
+    template: str = "none"
+    quality: str = ""
+    plan: str = "free"
+    stages: Dict[str, float] = field(default_factory=dict)
+    output_size: int = 0
+    cpu_seconds: float = 0.0
+    peak_rss: int = 0
+    status: str = "ok"                  # ok / error / cancelled
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + max(seconds, 0.0)
+
+    @contextmanager
+    def stage(self, stage: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def add_usage(self, cpu: float, peak_rss: int):
+        """Вызывается run_ffmpeg после каждого процесса задачи"""
+        self.cpu_seconds += cpu
+        self.peak_rss = max(self.peak_rss, peak_rss)
+
+    @property
+    def total(self) -> float:
+        return sum(self.stages.values())
+
+    @property
+    def labels(self) -> Dict[str, str]:
+        return {"template": self.template or "none", "quality": self.quality or "",
+                "plan": self.plan or "free"}
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    """Перцентиль по ближайшему рангу (значения уже отсортированы)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, -(-len(sorted_values) * p // 100))  # ceil
+    return sorted_values[int(rank) - 1]
+
+
+class Histogram:
+    """Кумулятивные корзины + окно последних значений"""
+
+    def __init__(self, buckets: Tuple[float, ...], window: int = METRICS_WINDOW):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.window = deque(maxlen=window)
+
+    def observe(self, value: float):
+        self.count += 1
+        self.sum += value
+        self.window.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self) -> List[int]:
+        total, result = 0, []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+class MetricsRegistry:
+    """ Гистограммы задач по сериям (метрика + метки) """
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.window = window
+        self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+        self.jobs: Dict[Tuple[str, str], int] = {}  # (source, status) → число задач
+
+    def observe(self, name: str, value: float, labels: Dict[str, str]):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(METRICS[name][0], self.window)
+        histogram.observe(value)
+
+    def record_job(self, job: JobMetrics, source: str = "bot"):
+        """Записать завершённую задачу"""
+        status_key = (source, job.status)
+        self.jobs[status_key] = self.jobs.get(status_key, 0) + 1
+        if job.status != "ok":
+            return
+        labels = job.labels
+        for stage, seconds in job.stages.items():
+            self.observe("virex_job_stage_seconds", seconds, dict(labels, stage=stage))
+        self.observe("virex_job_total_seconds", job.total, labels)
+        self.observe("virex_job_cpu_seconds", job.cpu_seconds, labels)
+        if job.output_size:
+            self.observe("virex_job_output_bytes", job.output_size, labels)
+
+    # ═════════════════════════════════════════════════════════════
+    # QUERIES
+    # ═════════════════════════════════════════════════════════════
+
+    def _window(self, name: str, **match) -> List[float]:
+        values = []
+        for (metric, labels), histogram in self.histograms.items():
+            if metric != name:
+                continue
+            label_map = dict(labels)
+            if all(label_map.get(k) == v for k, v in match.items()):
+                values.extend(histogram.window)
+        return sorted(values)
+
+    def _values(self, name: str, dimension: str) -> List[str]:
+        return sorted({dict(labels).get(dimension, "") for (metric, labels) in self.histograms
+                       if metric == name})
+
+    def summarize(self, name: str, **match) -> dict:
+        """count + p50/p95/p99 по окнам всех подходящих серий"""
+        values = self._window(name, **match)
+        summary = {"count": len(values)}
+        for p in PERCENTILES:
+            summary[f"p{p}"] = round(percentile(values, p), 2)
+        return summary
+
+    def stage_summary(self, **match) -> Dict[str, dict]:
+        """Перцентили каждой стадии (опционально — в срезе template/quality/plan)"""
+        return {stage: self.summarize("virex_job_stage_seconds", stage=stage, **match)
+                for stage in STAGES}
+
+    def breakdown(self, dimension: str, name: str = "virex_job_total_seconds") -> Dict[str, dict]:
+        """Перцентили метрики по значениям одного измерения"""
+        return {value: self.summarize(name, **{dimension: value})
+                for value in self._values(name, dimension)}
+
+    def get_stats(self) -> dict:
+        jobs = {}
+        for (source, status), count in self.jobs.items():
+            jobs.setdefault(source, {})[status] = count
+        return {"jobs": jobs, "series": len(self.histograms)}
+
+    # ═════════════════════════════════════════════════════════════
+    # PROMETHEUS
+    # ═════════════════════════════════════════════════════════════
+
+    @staticmethod
+    def _format_labels(labels) -> str:
+        if not labels:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+    def render_prometheus(self) -> str:
+        """Текстовый формат экспозиции Prometheus 0.0.4"""
+        lines = ["# HELP virex_jobs_total Завершённые задачи обработки",
+                 "# TYPE virex_jobs_total counter"]
+        for (source, status), count in sorted(self.jobs.items()):
+            lines.append(f"virex_jobs_total{self._format_labels((('source', source), ('status', status)))} {count}")
+
+        for name, (_, help_text) in METRICS.items():
+            series = sorted((labels, h) for (metric, labels), h in self.histograms.items()
+                            if metric == name)
+            if not series:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                for bound, count in zip(histogram.buckets, histogram.cumulative()):
+                    bucket_labels = labels + (("le", f"{bound:g}"),)
+                    lines.append(f"{name}_bucket{self._format_labels(bucket_labels)} {count}")
+                lines.append(f"{name}_bucket{self._format_labels(labels + (('le', '+Inf'),))} {histogram.count}")
+                lines.append(f"{name}_sum{self._format_labels(labels)} {_number(histogram.sum)}")
+                lines.append(f"{name}_count{self._format_labels(labels)} {histogram.count}")
+
+        lines.extend(_runner_lines())
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _number(value) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.6f}".rstrip("0").rstrip(".")
+
+
+def _runner_lines() -> List[str]:
+    """Счётчики run_ffmpeg по меткам (процессы FFmpeg этого процесса)"""
+    try:
+        from ffmpeg_utils import runner_stats
+    except ImportError:
+        return []
+    lines = []
+    for metric, key, kind, help_text in (
+        ("virex_ffmpeg_runs_total", "runs", "counter", "Запуски FFmpeg/ffprobe"),
+        ("virex_ffmpeg_failures_total", "failures", "counter", "Неуспешные запуски"),
+        ("virex_ffmpeg_wall_seconds_total", "wall", "counter", "Суммарное время запусков"),
+        ("virex_ffmpeg_cpu_seconds_total", "cpu", "counter", "Суммарное CPU-время запусков"),
+        ("virex_ffmpeg_peak_rss_bytes", "peak_rss", "gauge", "Пиковый RSS процесса FFmpeg"),
+    ):
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for label, stats in sorted(runner_stats.items()):
+            lines.append(f'{metric}{{label="{_escape(label)}"}} {_number(stats[key])}')
+    return lines
+
+
+# ═════════════════════════════════════════════════════════════
+# HTTP
+# ═════════════════════════════════════════════════════════════
+
+async def metrics_handler(request):
+    """aiohttp: GET /metrics"""
+    from aiohttp import web
+    return web.Response(text=get_metrics_registry().render_prometheus(),
+                        content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+
+async def start_metrics_server(host: str = METRICS_HTTP_HOST, port: int = METRICS_HTTP_PORT):
+    """Отдельный /metrics для процесса бота (port 0 — выключено)"""
+    if not port:
+        return None
+    from aiohttp import web
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"[METRICS] Serving http://{host}:{port}/metrics")
+    return runner
+
+
+# Singleton
+_registry: Optional[MetricsRegistry] = None
+
+
+def get_metrics_registry() -> MetricsRegistry:
+    global _registry
+    if _registry is None:
+        _registry = MetricsRegistry()
+    return _registry
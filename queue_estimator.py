@@ -0,0 +1,167 @@
+"""
+Virex — Queue Time Estimator v3.4.0
+
+Оценка времени обработки по реально измеренным задачам:
+- Каждая завершённая ProcessingTask записывается вместе с признаками
+  (пиксели × секунды × fps, качество, шаблон, Watermark-Trap)
+- Модель: EWMA "секунд на единицу работы" по корзинам
+  (качество + шаблон + trap → качество → общая), единица работы = 1 Мпикс·с при 30 fps
+- Модель сохраняется в queue_estimator.json и переживает рестарт
+  (record не пишет на диск после каждой задачи — не чаще раза в
+  QUEUE_ESTIMATOR_SAVE_INTERVAL_SECONDS, остаток — flush() при shutdown)
+"""
+import os
+import json
+import time
+from typing import Dict, Optional
+
+from config import (
+    QUEUE_ESTIMATOR_FILE,
+    QUEUE_ESTIMATOR_ALPHA,
+    QUEUE_ESTIMATOR_SAVE_INTERVAL_SECONDS,
+    QUEUE_DEFAULT_JOB_SECONDS,
+)
+
+GLOBAL_BUCKET = "*"
+
+
+def build_features(width: int, height: int, duration: float, fps: float,
+                   quality: str = "", template: str = "none",
+                   watermark_trap: bool = False) -> dict:
+    """Признаки задачи для оценки времени"""
+    return {
+        "width": width,
+        "height": height,
+        "duration": duration,
+        "fps": fps,
+        "quality": quality or "",
+        "template": template or "none",
+        "trap": bool(watermark_trap),
+    }
+
+
+def work_units(features: dict) -> float:
+    """Объём работы: мегапиксели × секунды × (fps / 30)"""
+    fps = min(features.get("fps") or 30.0, 120.0)
+    pixels = features.get("width", 0) * features.get("height", 0)
+    units = pixels * features.get("duration", 0) * fps / (1_000_000 * 30)
+    return max(units, 0.01)
+
+
+def _bucket_keys(features: dict):
+    """Корзины от точной к общей"""
+    quality = features.get("quality", "")
+    trap = "trap" if features.get("trap") else "plain"
+    return (
+        f"{quality}|{features.get('template', 'none')}|{trap}",
+        f"{quality}|{trap}",
+        GLOBAL_BUCKET,
+    )
+
+
+class QueueTimeEstimator:
+    """ EWMA-оценщик длительности задач с сохранением на диск """
+
+    # Сколько наблюдений нужно корзине, прежде чем ей доверять
+    MIN_SAMPLES = 3
+
+    def __init__(self, data_file: str = QUEUE_ESTIMATOR_FILE,
+                 alpha: float = QUEUE_ESTIMATOR_ALPHA,
+                 default_job_seconds: float = QUEUE_DEFAULT_JOB_SECONDS,
+                 save_interval: float = QUEUE_ESTIMATOR_SAVE_INTERVAL_SECONDS):
+        self.data_file = data_file
+        self.alpha = alpha
+        self.default_job_seconds = default_job_seconds
+        self.save_interval = save_interval
+        self._dirty = False
+        self._last_save = time.monotonic()
+        # key → {"rate": сек/единицу работы, "count": n}
+        self.buckets: Dict[str, dict] = {}
+        # EWMA длительности задачи целиком (когда признаков нет)
+        self.job_seconds = default_job_seconds
+        self.load()
+
+    # ═════════════════════════════════════════════════════════════
+    # MODEL
+    # ═════════════════════════════════════════════════════════════
+
+    def _ewma(self, old: float, value: float, count: int) -> float:
+        # Первые наблюдения — простое среднее, дальше EWMA
+        weight = max(self.alpha, 1.0 / count)
+        return old + (value - old) * weight
+
+    def record(self, features: dict, seconds: float):
+        """Записать длительность завершённой задачи"""
+        if seconds <= 0:
+            return
+        rate = seconds / work_units(features)
+        for key in _bucket_keys(features):
+            bucket = self.buckets.setdefault(key, {"rate": rate, "count": 0})
+            bucket["count"] += 1
+            bucket["rate"] = self._ewma(bucket["rate"], rate, bucket["count"])
+        total = self.buckets[GLOBAL_BUCKET]["count"]
+        self.job_seconds = self._ewma(self.job_seconds, seconds, total)
+        # Вызывается из воркера в event loop — диск не чаще save_interval
+        self._dirty = True
+        if time.monotonic() - self._last_save >= self.save_interval:
+            self.save()
+
+    def predict(self, features: Optional[dict]) -> float:
+        """Ожидаемая длительность задачи в секундах"""
+        if not features:
+            return self.job_seconds
+        for key in _bucket_keys(features):
+            bucket = self.buckets.get(key)
+            if bucket and (bucket["count"] >= self.MIN_SAMPLES or key == GLOBAL_BUCKET):
+                return bucket["rate"] * work_units(features)
+        return self.job_seconds
+
+    # ═════════════════════════════════════════════════════════════
+    # PERSISTENCE
+    # ═════════════════════════════════════════════════════════════
+
+    def load(self):
+        if not os.path.exists(self.data_file):
+            return
+        try:
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.buckets = data.get("buckets", {})
+            self.job_seconds = data.get("job_seconds", self.default_job_seconds)
+            print(f"[ESTIMATOR] Loaded {len(self.buckets)} buckets")
+        except (OSError, ValueError) as e:
+            print(f"[ESTIMATOR] Load error: {e}")
+
+    def save(self):
+        tmp_file = self.data_file + ".tmp"
+        self._last_save = time.monotonic()
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump({"buckets": self.buckets, "job_seconds": self.job_seconds}, f, indent=2)
+            os.replace(tmp_file, self.data_file)
+            self._dirty = False
+        except OSError as e:
+            print(f"[ESTIMATOR] Save error: {e}")
+
+    def flush(self):
+        """Записать несохранённые наблюдения (shutdown)"""
+        if self._dirty:
+            self.save()
+
+    def get_stats(self) -> dict:
+        return {
+            "job_seconds": round(self.job_seconds, 1),
+            "samples": self.buckets.get(GLOBAL_BUCKET, {}).get("count", 0),
+            "buckets": len(self.buckets),
+        }
+
+
+# Singleton
+_estimator: Optional[QueueTimeEstimator] = None
+
+
+def get_queue_estimator() -> QueueTimeEstimator:
+    global _estimator
+    if _estimator is None:
+        _estimator = QueueTimeEstimator()
+    return _estimator
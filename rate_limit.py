@@ -1,10 +1,19 @@
 """
 Virex — Rate Limiting & Anti-Abuse
 """
+import sys
+import json
 import time
+import asyncio
 import hashlib
-from typing import Dict, Optional, Tuple
+import functools
+import threading
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Set, Tuple
 from dataclasses import dataclass, field
+from user_store import UserStore
+from user_index import UserIndex
+from sliding_window import SlidingWindowCounter
 from config import (
     PLAN_LIMITS,
     RATE_LIMIT_WINDOW_SECONDS,
@@ -15,12 +24,63 @@ from config import (
     Quality, DEFAULT_QUALITY,
 )
 
-@dataclass
+# ═══════════════════════════════════════════════════════════════
+# v3.4.0: COMPACT USER STATE
+# ═══════════════════════════════════════════════════════════════
+# Холодные коллекции: у большинства пользователей пустые и читаются редко.
+# Лежат в одном слоте _cold: None (всё по умолчанию), str (JSON как пришёл
+# из хранилища) или dict (развёрнут при первом обращении к любому полю).
+COLD_FIELDS = {
+    "history": list,
+    "favorites": list,
+    "operation_logs": list,
+    "achievements": list,
+    "reminders": list,
+    "weekly_stats": dict,
+    "batch_videos": list,
+    "merge_videos": list,
+    "scheduled_tasks": list,
+    "project_history": list,
+}
+
+# Перечислимые строки и даты — при загрузке интернируются (одна копия на всех)
+INTERNED_FIELDS = frozenset({
+    "plan", "mode", "quality", "language", "today_date", "daily_date",
+    "week_start", "period_start", "first_seen", "plan_expires", "expiry_notified",
+    "streak_last_date", "watermark_position", "resolution", "current_template",
+    "speed_setting", "rotation_setting", "aspect_setting", "filter_setting",
+    "caption_style", "compression_preset", "volume_setting",
+    "auto_process_template", "video_template", "anti_reupload_level",
+})
+
+
+class _ColdField:
+    """ Поле холодной коллекции: разворачивает _cold при обращении """
+    
+    def __set_name__(self, owner, name):
+        self.name = name
+        self.factory = COLD_FIELDS[name]
+    
+    def __get__(self, user, owner=None):
+        if user is None:
+            return self
+        cold = user._materialize_cold()
+        value = cold.get(self.name)
+        if value is None:
+            value = cold[self.name] = self.factory()
+        return value
+    
+    def __set__(self, user, value):
+        user._materialize_cold()[self.name] = value
+
+
+@dataclass(slots=True)
 class UserState:
     user_id: int
     plan: str = "free"
     mode: str = "tiktok"
-    request_timestamps: list = field(default_factory=list)
+    # v3.4.0: Скользящее окно запросов (кольцо корзин, создаётся при первом запросе)
+    request_window: Optional[SlidingWindowCounter] = None
     last_request_time: float = 0
     last_button_time: float = 0
     last_file_hash: str = ""
@@ -70,20 +130,20 @@ class UserState:
     # Ночной режим
     night_mode: bool = False
     # История загрузок (последние 20)
-    history: list = field(default_factory=list)
+    history = _ColdField()
     # v2.8.0: Trial VIP
     trial_used: bool = False
     # v2.8.0: Streak bonus
     streak_count: int = 0
     streak_last_date: str = ""
     # v2.8.0: Favorites
-    favorites: list = field(default_factory=list)
+    favorites = _ColdField()
     # v2.8.0: Operation logs
-    operation_logs: list = field(default_factory=list)
+    operation_logs = _ColdField()
     # v2.9.0: Gamification
     points: int = 0
     level: int = 1
-    achievements: list = field(default_factory=list)
+    achievements = _ColdField()
     # v2.9.0: Trim settings
     trim_start: str = ""
     trim_end: str = ""
@@ -95,15 +155,15 @@ class UserState:
     # v2.9.0: Current template
     current_template: str = ""
     # v2.9.0: Reminders
-    reminders: list = field(default_factory=list)
+    reminders = _ColdField()
     # v2.9.0: Weekly stats for analytics
-    weekly_stats: dict = field(default_factory=dict)
+    weekly_stats = _ColdField()
     # v2.9.0: Pending audio for music overlay
     pending_audio_file_id: str = ""
     # v2.9.0: Batch processing state
-    batch_videos: list = field(default_factory=list)
+    batch_videos = _ColdField()
     # v3.0.0: Merge videos queue
-    merge_videos: list = field(default_factory=list)
+    merge_videos = _ColdField()
     # v3.0.0: Speed setting (0.5x - 2x)
     speed_setting: str = "1x"
     # v3.0.0: Rotation setting
@@ -121,7 +181,7 @@ class UserState:
     # v3.0.0: Volume setting
     volume_setting: str = "100%"
     # v3.0.0: Scheduled tasks
-    scheduled_tasks: list = field(default_factory=list)
+    scheduled_tasks = _ColdField()
     # v3.0.0: Auto-process template
     auto_process_template: str = ""
     # v3.0.0: Pending video for processing
@@ -137,7 +197,7 @@ class UserState:
     # v3.2.0: Watermark trap enabled
     watermark_trap: bool = True
     # v3.2.0: Project history (последние N обработок)
-    project_history: list = field(default_factory=list)
+    project_history = _ColdField()
     # v3.2.0: Pay-as-you-go bonus videos
     bonus_videos: int = 0
     # v3.2.0: First purchase flag (для скидки -50%)
@@ -150,100 +210,271 @@ class UserState:
     suspicious_hits: int = 0
     # v3.2.0: Premium badge
     show_premium_badge: bool = True
+    # Временные состояния диалогов (не сохраняются)
+    pending_convert_format: str = ""
+    pending_thumbnail_time: Optional[str] = None
+    pending_video_info: bool = False
+    # v3.4.0: Холодные коллекции (см. COLD_FIELDS)
+    _cold: object = field(default=None, init=False, repr=False, compare=False)
+    
+    def _materialize_cold(self) -> dict:
+        cold = self._cold
+        if cold is None:
+            cold = self._cold = {}
+        elif isinstance(cold, str):
+            cold = self._cold = json.loads(cold)
+        return cold
+    
+    def load_cold(self, data: dict):
+        """ Холодные поля из хранилища: пустые отбрасываются, остальные — компактный JSON """
+        data = {k: v for k, v in data.items() if v}
+        self._cold = json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else None
+    
+    def cold_data(self) -> dict:
+        """ Холодные поля только для чтения (без разворачивания в памяти) """
+        cold = self._cold
+        if cold is None:
+            return {}
+        if isinstance(cold, str):
+            return json.loads(cold)
+        return cold
+    
+    @property
+    def cold_loaded(self) -> bool:
+        return isinstance(self._cold, dict)
+
+def _marks_dirty(method):
+    """
+    v3.4.0: Сеттер пользователя — user_id попадает в набор на запись,
+    вторичные индексы обновляются сразу (не дожидаясь save_data).
+    """
+    @functools.wraps(method)
+    def wrapper(self, user_id, *args, **kwargs):
+        self._dirty.add(user_id)
+        result = method(self, user_id, *args, **kwargs)
+        user = self.users.get(user_id)
+        if user is not None:
+            self._index.update(user)
+        return result
+    return wrapper
+
 
 class RateLimiter:
-    def __init__(self):
-        self.users: Dict[int, UserState] = {}
+    def __init__(self, lazy: bool = False):
+        """
+        lazy=True — users_data.json читается не в конструкторе, а при первом
+        обращении к self.users или явном ensure_loaded() (можно из потока).
+        """
         self.data_file = "users_data.json"
-        self._load_data()
+        # v3.4.0: Снапшот + append-only журнал вместо полной перезаписи
+        self._store = UserStore(self.data_file)
+        # v3.4.0: Изменённые пользователи — пишутся в журнал при save_data
+        self._dirty: Set[int] = set()
+        # v3.4.0: Unit-of-work — внутри transaction() save_data только копит id
+        self._tx_depth = 0
+        # v3.4.0: Вторичные индексы (ip, fingerprint, username, plan, expiry, рейтинги)
+        self._index = UserIndex()
+        # v3.4.0: Подписчики на изменения напоминаний/задач (TimedTaskScheduler)
+        self._schedule_listeners: List[Callable[[int], None]] = []
+        self._load_lock = threading.Lock()
+        if not lazy:
+            self.ensure_loaded()
+    
+    def __getattr__(self, name):
+        # Вызывается только пока self.users ещё нет (ленивая загрузка)
+        if name == "users":
+            self.ensure_loaded()
+            return self.__dict__["users"]
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+    
+    @property
+    def loaded(self) -> bool:
+        return "users" in self.__dict__
+    
+    def ensure_loaded(self):
+        """ v3.4.0: Загрузить пользователей, если ещё не загружены (потокобезопасно) """
+        if self.loaded:
+            return
+        with self._load_lock:
+            if not self.loaded:
+                self.users = self._load_data()
     
-    def _load_data(self):
-        """ Загрузить данные из файла """
-        import json
-        import os
+    def _load_data(self) -> Dict[int, UserState]:
+        """ Загрузить данные из файла (снапшот + журнал) """
+        users: Dict[int, UserState] = {}
         try:
-            if os.path.exists(self.data_file):
-                with open(self.data_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for uid, udata in data.items():
-                        user = UserState(user_id=int(uid))
-                        for key, value in udata.items():
-                            if hasattr(user, key):
-                                setattr(user, key, value)
-                        self.users[int(uid)] = user
-                print(f"[DATA] Loaded {len(self.users)} users")
+            data = self._store.load()
+            for uid, udata in data.items():
+                user = UserState(user_id=int(uid))
+                cold = {}
+                for key, value in udata.items():
+                    if key in COLD_FIELDS:
+                        cold[key] = value
+                    elif hasattr(user, key):
+                        if key in INTERNED_FIELDS and isinstance(value, str):
+                            value = sys.intern(value)
+                        setattr(user, key, value)
+                # v3.4.0: Холодные коллекции разворачиваются при первом обращении
+                user.load_cold(cold)
+                users[int(uid)] = user
+            self._index.rebuild(users.values())
+            print(f"[DATA] Loaded {len(users)} users")
         except Exception as e:
             print(f"[DATA] Error loading: {e}")
+        return users
     
-    def save_data(self):
-        """ Сохранить данные в файл """
-        import json
+    def save_data(self, *user_ids: int):
+        """
+        Сохранить данные.
+        v3.4.0: пишутся только пользователи из набора изменённых — его
+        пополняют user_ids, сеттеры (_marks_dirty) и новые пользователи.
+        Без аргументов (автосохранение) остальных пользователей не трогаем.
+        Внутри transaction() запись откладывается до выхода из неё.
+        """
+        self._dirty.update(user_ids)
+        if self._tx_depth:
+            # Запись — при выходе из transaction, индексы — сразу
+            if self._dirty:
+                self.reindex(*self._dirty)
+            return
+        self._write_dirty()
+    
+    def _write_dirty(self):
+        # v3.4.0: Пользователи, чей фоновый append упал, пишутся повторно
+        self._dirty.update(int(uid) for uid in self._store.pop_failed())
+        if not self._dirty:
+            return
+        # v3.4.0: Прямые изменения полей (без сеттера) попадают в индексы здесь
+        self.reindex(*self._dirty)
+        dirty, self._dirty = self._dirty, set()
         try:
-            data = {}
-            for uid, user in self.users.items():
-                data[str(uid)] = {
-                    "plan": user.plan,
-                    "mode": user.mode,
-                    "total_videos": user.total_videos,
-                    "monthly_videos": user.monthly_videos,
-                    "period_start": user.period_start,
-                    "daily_videos": user.daily_videos,
-                    "daily_date": user.daily_date,
-                    "weekly_videos": user.weekly_videos,
-                    "week_start": user.week_start,
-                    "username": user.username,
-                    "total_downloads": user.total_downloads,
-                    "monthly_downloads": user.monthly_downloads,
-                    "first_seen": user.first_seen,
-                    "quality": user.quality,
-                    "text_overlay": user.text_overlay,
-                    "banned": user.banned,
-                    "ban_reason": user.ban_reason,
-                    "language": user.language,
-                    "referrer_id": user.referrer_id,
-                    "referral_count": user.referral_count,
-                    "referral_bonus": user.referral_bonus,
-                    "plan_expires": user.plan_expires,
-                    "night_mode": user.night_mode,
-                    "history": getattr(user, 'history', [])[:20],
-                    # v2.8.0
-                    "trial_used": getattr(user, 'trial_used', False),
-                    "streak_count": getattr(user, 'streak_count', 0),
-                    "streak_last_date": getattr(user, 'streak_last_date', ''),
-                    "favorites": getattr(user, 'favorites', [])[:5],
-                    # v2.9.0
-                    "points": getattr(user, 'points', 0),
-                    "level": getattr(user, 'level', 1),
-                    "achievements": getattr(user, 'achievements', []),
-                    "watermark_file_id": getattr(user, 'watermark_file_id', ''),
-                    "watermark_position": getattr(user, 'watermark_position', 'br'),
-                    "resolution": getattr(user, 'resolution', 'original'),
-                    "current_template": getattr(user, 'current_template', ''),
-                    "reminders": getattr(user, 'reminders', []),
-                    "weekly_stats": getattr(user, 'weekly_stats', {}),
-                    # v3.0.0
-                    "merge_videos": getattr(user, 'merge_videos', []),
-                    "speed_setting": getattr(user, 'speed_setting', '1x'),
-                    "rotation_setting": getattr(user, 'rotation_setting', ''),
-                    "aspect_setting": getattr(user, 'aspect_setting', ''),
-                    "filter_setting": getattr(user, 'filter_setting', ''),
-                    "custom_text": getattr(user, 'custom_text', ''),
-                    "caption_style": getattr(user, 'caption_style', 'default'),
-                    "compression_preset": getattr(user, 'compression_preset', ''),
-                    "volume_setting": getattr(user, 'volume_setting', '100%'),
-                    "scheduled_tasks": getattr(user, 'scheduled_tasks', []),
-                    "auto_process_template": getattr(user, 'auto_process_template', ''),
-                    "is_admin": getattr(user, 'is_admin', False),
-                    "video_template": getattr(user, 'video_template', 'none'),
-                }
-            with open(self.data_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            uids = [uid for uid in dirty if uid in self.users]
+            self._store.write(
+                ((str(uid), self._serialize_user(self.users[uid])) for uid in uids),
+                background=self._in_event_loop()
+            )
         except Exception as e:
+            # Не записались — останутся в наборе до следующего save_data
+            self._dirty |= dirty
             print(f"[DATA] Error saving: {e}")
     
+    @staticmethod
+    def _in_event_loop() -> bool:
+        # В боте — фоновая запись, в синхронных скриптах — сразу
+        try:
+            asyncio.get_running_loop()
+            return True
+        except RuntimeError:
+            return False
+    
+    def reindex(self, *user_ids: int):
+        """ v3.4.0: Обновить вторичные индексы (без аргументов — всех) """
+        if user_ids:
+            for uid in user_ids:
+                user = self.users.get(uid)
+                if user is not None:
+                    self._index.update(user)
+        else:
+            for user in self.users.values():
+                self._index.update(user)
+    
+    @contextmanager
+    def transaction(self, *user_ids: int):
+        """
+        v3.4.0: Пакет изменений с одной записью в конце.
+        
+            with rate_limiter.transaction(user_id):
+                rate_limiter.increment_video_count(user_id)
+                rate_limiter.add_points(user_id, 10, "video_processed")
+        
+        Вложенные транзакции сливаются во внешнюю.
+        """
+        self._tx_depth += 1
+        self._dirty.update(user_ids)
+        try:
+            yield self
+        finally:
+            self._tx_depth -= 1
+            if self._tx_depth == 0:
+                self._write_dirty()
+    
+    def flush(self):
+        """ v3.4.0: Дождаться фоновой записи журнала """
+        self._store.drain()
+    
+    def compact_data(self):
+        """ v3.4.0: Свернуть журнал в users_data.json (shutdown / бэкап) """
+        try:
+            self.save_data()
+            self._store.compact()
+        except Exception as e:
+            print(f"[DATA] Error compacting: {e}")
+    
+    def _serialize_user(self, user: UserState) -> dict:
+        """ Запись пользователя в формате users_data.json """
+        # v3.4.0: Не разворачиваем холодные поля у спящих пользователей
+        cold = user.cold_data()
+        return {
+            "plan": user.plan,
+            "mode": user.mode,
+            "total_videos": user.total_videos,
+            "monthly_videos": user.monthly_videos,
+            "period_start": user.period_start,
+            "daily_videos": user.daily_videos,
+            "daily_date": user.daily_date,
+            "weekly_videos": user.weekly_videos,
+            "week_start": user.week_start,
+            "username": user.username,
+            "total_downloads": user.total_downloads,
+            "monthly_downloads": user.monthly_downloads,
+            "first_seen": user.first_seen,
+            "quality": user.quality,
+            "text_overlay": user.text_overlay,
+            "banned": user.banned,
+            "ban_reason": user.ban_reason,
+            "language": user.language,
+            "referrer_id": user.referrer_id,
+            "referral_count": user.referral_count,
+            "referral_bonus": user.referral_bonus,
+            "plan_expires": user.plan_expires,
+            "night_mode": user.night_mode,
+            "history": cold.get('history', [])[:20],
+            # v2.8.0
+            "trial_used": getattr(user, 'trial_used', False),
+            "streak_count": getattr(user, 'streak_count', 0),
+            "streak_last_date": getattr(user, 'streak_last_date', ''),
+            "favorites": cold.get('favorites', [])[:5],
+            # v2.9.0
+            "points": getattr(user, 'points', 0),
+            "level": getattr(user, 'level', 1),
+            "achievements": cold.get('achievements', []),
+            "watermark_file_id": getattr(user, 'watermark_file_id', ''),
+            "watermark_position": getattr(user, 'watermark_position', 'br'),
+            "resolution": getattr(user, 'resolution', 'original'),
+            "current_template": getattr(user, 'current_template', ''),
+            "reminders": cold.get('reminders', []),
+            "weekly_stats": cold.get('weekly_stats', {}),
+            # v3.0.0
+            "merge_videos": cold.get('merge_videos', []),
+            "speed_setting": getattr(user, 'speed_setting', '1x'),
+            "rotation_setting": getattr(user, 'rotation_setting', ''),
+            "aspect_setting": getattr(user, 'aspect_setting', ''),
+            "filter_setting": getattr(user, 'filter_setting', ''),
+            "custom_text": getattr(user, 'custom_text', ''),
+            "caption_style": getattr(user, 'caption_style', 'default'),
+            "compression_preset": getattr(user, 'compression_preset', ''),
+            "volume_setting": getattr(user, 'volume_setting', '100%'),
+            "scheduled_tasks": cold.get('scheduled_tasks', []),
+            "auto_process_template": getattr(user, 'auto_process_template', ''),
+            "is_admin": getattr(user, 'is_admin', False),
+            "video_template": getattr(user, 'video_template', 'none'),
+        }
+    
     def get_user(self, user_id: int) -> UserState:
         if user_id not in self.users:
             self.users[user_id] = UserState(user_id=user_id)
+            self._index.update(self.users[user_id])
+            self._dirty.add(user_id)
         return self.users[user_id]
     
     def get_limits(self, user_id: int):
@@ -296,6 +527,7 @@ class RateLimiter:
         
         return True, None
     
+    @_marks_dirty
     def _reset_daily_if_needed(self, user_id: int):
         """ Сброс дневного счётчика """
         import datetime
@@ -306,6 +538,7 @@ class RateLimiter:
             user.daily_date = today
             user.daily_videos = 0
     
+    @_marks_dirty
     def _reset_weekly_if_needed(self, user_id: int):
         """ Сброс недельного счётчика (каждые 7 дней) """
         import datetime
@@ -328,6 +561,7 @@ class RateLimiter:
             user.week_start = today.isoformat()
             user.weekly_videos = 0
     
+    @_marks_dirty
     def _reset_monthly_if_needed(self, user_id: int):
         """ Сброс счётчика если прошло 30 дней """
         import datetime
@@ -430,6 +664,7 @@ class RateLimiter:
         
         return False
     
+    @_marks_dirty
     def check_button_spam(self, user_id: int) -> bool:
         user = self.get_user(user_id)
         now = time.time()
@@ -440,15 +675,19 @@ class RateLimiter:
         user.last_button_time = now
         return False
     
+    @_marks_dirty
     def register_request(self, user_id: int, file_unique_id: str):
         user = self.get_user(user_id)
         now = time.time()
         
-        user.request_timestamps.append(now)
+        if user.request_window is None:
+            user.request_window = SlidingWindowCounter()
+        user.request_window.add(now)
         user.last_request_time = now
         user.last_file_hash = hashlib.md5(file_unique_id.encode()).hexdigest()
         user.last_file_time = now
     
+    @_marks_dirty
     def _check_abuse(self, user_id: int):
         user = self.get_user(user_id)
         
@@ -457,18 +696,20 @@ class RateLimiter:
             user.abuse_hits = 0
             print(f"[ABUSE] User {user_id} soft-blocked for {SOFT_BLOCK_DURATION_SECONDS}s")
     
-    def get_remaining_videos(self, user_id: int) -> int:
+    def get_window_requests(self, user_id: int) -> int:
+        """ v3.4.0: Запросов за RATE_LIMIT_WINDOW_SECONDS, O(1) """
         user = self.get_user(user_id)
+        if user.request_window is None:
+            return 0
+        return user.request_window.count(time.time())
+    
+    def get_remaining_videos(self, user_id: int) -> int:
+        """ Осталось видео в скользящем окне (дневной лимит × дней в окне) """
         limits = self.get_limits(user_id)
-        now = time.time()
-        
-        user.request_timestamps = [
-            ts for ts in user.request_timestamps
-            if now - ts < RATE_LIMIT_WINDOW_SECONDS
-        ]
-        
-        return max(0, limits.videos_per_hour - len(user.request_timestamps))
+        window_limit = limits.videos_per_day * RATE_LIMIT_WINDOW_SECONDS // 86400
+        return max(0, window_limit - self.get_window_requests(user_id))
     
+    @_marks_dirty
     def set_mode(self, user_id: int, mode: str):
         user = self.get_user(user_id)
         user.mode = mode
@@ -476,22 +717,22 @@ class RateLimiter:
     def get_mode(self, user_id: int) -> str:
         return self.get_user(user_id).mode
     
+    @_marks_dirty
     def set_username(self, user_id: int, username: str):
         """ Сохранить username пользователя """
         user = self.get_user(user_id)
         user.username = username or ""
+        self._index.update(user)
     
     def get_username(self, user_id: int) -> str:
         return self.get_user(user_id).username
     
     def find_user_by_username(self, username: str) -> Optional[int]:
         """ Найти user_id по username """
-        username = username.lstrip("@").lower()
-        for user_id, user in self.users.items():
-            if user.username.lower() == username:
-                return user_id
-        return None
+        # v3.4.0: По индексу вместо перебора
+        return self._index.find_username(username.lstrip("@"))
     
+    @_marks_dirty
     def set_processing(self, user_id: int, processing: bool, file_id: str = None):
         user = self.get_user(user_id)
         user.processing = processing
@@ -506,7 +747,7 @@ class RateLimiter:
             user.plan = plan
             if plan == "free":
                 user.plan_expires = ""  # Сбрасываем дату истечения
-            self.save_data()
+            self.save_data(user_id)
     
     def get_plan(self, user_id: int) -> str:
         return self.get_user(user_id).plan
@@ -515,6 +756,7 @@ class RateLimiter:
     # STATISTICS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def increment_video_count(self, user_id: int, use_bonus: bool = False):
         """ Увеличить счётчик обработанных видео 
         
@@ -551,6 +793,7 @@ class RateLimiter:
         self._reset_monthly_if_needed(user_id)
         user.monthly_videos += 1
     
+    @_marks_dirty
     def get_stats(self, user_id: int) -> dict:
         """ Получить статистику пользователя """
         import datetime
@@ -590,6 +833,7 @@ class RateLimiter:
             "first_seen": user.first_seen,
         }
     
+    @_marks_dirty
     def increment_download_count(self, user_id: int):
         """ Увеличить счётчик скачиваний (только скачать) """
         import datetime
@@ -601,6 +845,7 @@ class RateLimiter:
         user.total_downloads += 1
         user.monthly_downloads += 1
     
+    @_marks_dirty
     def is_new_user(self, user_id: int) -> bool:
         """ Проверка, новый ли пользователь (ещё не уведомляли админа) """
         import datetime
@@ -624,9 +869,11 @@ class RateLimiter:
         total_users = len(self.users)
         total_videos = sum(u.total_videos for u in self.users.values())
         total_downloads = sum(u.total_downloads for u in self.users.values())
-        vip_users = sum(1 for u in self.users.values() if u.plan == "vip")
-        premium_users = sum(1 for u in self.users.values() if u.plan == "premium")
-        free_users = sum(1 for u in self.users.values() if u.plan == "free")
+        # v3.4.0: Тарифы — из индекса by_plan
+        plans = self._index.plan_counts()
+        vip_users = plans.get("vip", 0)
+        premium_users = plans.get("premium", 0)
+        free_users = plans.get("free", 0)
         
         # Активные сегодня
         today = datetime.date.today().isoformat()
@@ -681,12 +928,13 @@ class RateLimiter:
             user.today_videos = 0
             if hasattr(user, 'today_downloads'):
                 user.today_downloads = 0
-        self.save_data()
+        self.save_data(*self.users)
     
     # ═════════════════════════════════════════════════════════════
     # QUALITY SETTINGS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_quality(self, user_id: int, quality: str):
         user = self.get_user(user_id)
         if quality in [Quality.LOW, Quality.MEDIUM, Quality.MAX]:
@@ -705,7 +953,7 @@ class RateLimiter:
         if template in VIDEO_TEMPLATES:
             user = self.get_user(user_id)
             user.video_template = template
-            self.save_data()
+            self.save_data(user_id)
     
     def get_template(self, user_id: int) -> str:
         """Получить текущий шаблон"""
@@ -734,7 +982,7 @@ class RateLimiter:
                 return False
             user = self.get_user(user_id)
             user.anti_reupload_level = level
-            self.save_data()
+            self.save_data(user_id)
             return True
         return False
     
@@ -750,7 +998,7 @@ class RateLimiter:
         """Переключить режим автоуникализации"""
         user = self.get_user(user_id)
         user.auto_unique_mode = not getattr(user, 'auto_unique_mode', False)
-        self.save_data()
+        self.save_data(user_id)
         return user.auto_unique_mode
     
     def get_auto_unique(self, user_id: int) -> bool:
@@ -765,7 +1013,7 @@ class RateLimiter:
         """Переключить цифровой отпечаток"""
         user = self.get_user(user_id)
         user.watermark_trap = not getattr(user, 'watermark_trap', True)
-        self.save_data()
+        self.save_data(user_id)
         return user.watermark_trap
     
     def get_watermark_trap(self, user_id: int) -> bool:
@@ -794,7 +1042,7 @@ class RateLimiter:
         if len(user.project_history) > MAX_PROJECT_HISTORY:
             user.project_history = user.project_history[:MAX_PROJECT_HISTORY]
         
-        self.save_data()
+        self.save_data(user_id)
     
     def get_project_history(self, user_id: int) -> list:
         """Получить историю проектов"""
@@ -812,12 +1060,13 @@ class RateLimiter:
         """Очистить историю проектов"""
         user = self.get_user(user_id)
         user.project_history = []
-        self.save_data()
+        self.save_data(user_id)
     
     # ═════════════════════════════════════════════════════════════
     # TEXT OVERLAY SETTINGS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def toggle_text_overlay(self, user_id: int) -> bool:
         """ Переключить текст на видео, вернуть новое значение """
         user = self.get_user(user_id)
@@ -909,7 +1158,7 @@ class RateLimiter:
         """Добавить бонусные видео (после покупки)"""
         user = self.get_user(user_id)
         user.bonus_videos = getattr(user, 'bonus_videos', 0) + count
-        self.save_data()
+        self.save_data(user_id)
     
     def use_bonus_video(self, user_id: int) -> bool:
         """Использовать одно бонусное видео. Возвращает True если успешно."""
@@ -917,7 +1166,7 @@ class RateLimiter:
         bonus = getattr(user, 'bonus_videos', 0)
         if bonus > 0:
             user.bonus_videos = bonus - 1
-            self.save_data()
+            self.save_data(user_id)
             return True
         return False
     
@@ -937,7 +1186,7 @@ class RateLimiter:
         """Отметить что первая покупка использована"""
         user = self.get_user(user_id)
         user.first_purchase = False
-        self.save_data()
+        self.save_data(user_id)
     
     # ═════════════════════════════════════════════════════════════
     # v3.2.0: ANTI-ABUSE SYSTEM
@@ -953,16 +1202,12 @@ class RateLimiter:
             # Храним только последние 10 IP
             if len(user.ip_history) > 10:
                 user.ip_history = user.ip_history[-10:]
-            self.save_data()
+            self.save_data(user_id)
     
     def get_ip_count(self, ip: str) -> int:
         """Сколько Free аккаунтов с этого IP"""
-        count = 0
-        for uid, user in self.users.items():
-            if user.plan == "free":
-                if hasattr(user, 'ip_history') and ip in user.ip_history:
-                    count += 1
-        return count
+        # v3.4.0: По индексу ip → пользователи
+        return sum(1 for uid in self._index.users_by_ip(ip) if self.users[uid].plan == "free")
     
     def is_ip_abused(self, ip: str) -> bool:
         """Превышен ли лимит аккаунтов с одного IP"""
@@ -974,7 +1219,7 @@ class RateLimiter:
         """Записать подозрительную активность"""
         user = self.get_user(user_id)
         user.suspicious_hits = getattr(user, 'suspicious_hits', 0) + 1
-        self.save_data()
+        self.save_data(user_id)
     
     def is_suspicious(self, user_id: int) -> bool:
         """Подозрительный ли пользователь"""
@@ -985,15 +1230,11 @@ class RateLimiter:
         """Установить device fingerprint"""
         user = self.get_user(user_id)
         user.device_fingerprint = fingerprint
-        self.save_data()
+        self.save_data(user_id)
     
     def check_fingerprint_abuse(self, fingerprint: str) -> int:
         """Сколько аккаунтов с этим fingerprint"""
-        count = 0
-        for uid, user in self.users.items():
-            if getattr(user, 'device_fingerprint', '') == fingerprint:
-                count += 1
-        return count
+        return len(self._index.users_by_fingerprint(fingerprint))
     
     # ═════════════════════════════════════════════════════════════
     # v3.2.0: PREMIUM BADGE
@@ -1010,7 +1251,7 @@ class RateLimiter:
         """Переключить отображение значка Premium"""
         user = self.get_user(user_id)
         user.show_premium_badge = not getattr(user, 'show_premium_badge', True)
-        self.save_data()
+        self.save_data(user_id)
         return user.show_premium_badge
     
     # ═════════════════════════════════════════════════════════════
@@ -1021,13 +1262,13 @@ class RateLimiter:
         user = self.get_user(user_id)
         user.banned = True
         user.ban_reason = reason
-        self.save_data()
+        self.save_data(user_id)
     
     def unban_user(self, user_id: int):
         user = self.get_user(user_id)
         user.banned = False
         user.ban_reason = ""
-        self.save_data()
+        self.save_data(user_id)
     
     def is_banned(self, user_id: int) -> bool:
         return self.get_user(user_id).banned
@@ -1043,7 +1284,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         user.language = lang
         user.language_set = True
-        self.save_data()
+        self.save_data(user_id)
     
     def is_language_set(self, user_id: int) -> bool:
         """ Проверка, был ли выбран язык пользователем """
@@ -1069,7 +1310,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         if user.referral_bonus > 0:
             user.referral_bonus -= 1
-            self.save_data()
+            self.save_data(user_id)
             return True
         return False
     
@@ -1090,7 +1331,7 @@ class RateLimiter:
         # Сброс месячного счётчика
         user.monthly_videos = 0
         user.period_start = datetime.date.today().isoformat()
-        self.save_data()
+        self.save_data(user_id)
     
     def check_plan_expiry(self, user_id: int) -> bool:
         """ Проверить, не истёк ли план. Возвращает True если истёк """
@@ -1104,7 +1345,7 @@ class RateLimiter:
             if datetime.date.today() > expiry:
                 user.plan = "free"
                 user.plan_expires = ""
-                self.save_data()
+                self.save_data(user_id)
                 return True
         except:
             pass
@@ -1129,21 +1370,21 @@ class RateLimiter:
         import datetime
         result = []
         today = datetime.date.today()
+        last_day = today + datetime.timedelta(days=days_before)
         
-        for uid, user in self.users.items():
-            if user.plan != "free" and user.plan_expires:
-                try:
-                    expiry = datetime.date.fromisoformat(user.plan_expires)
-                    days_left = (expiry - today).days
-                    if 0 < days_left <= days_before:
-                        result.append({
-                            "user_id": uid,
-                            "username": user.username,
-                            "plan": user.plan,
-                            "days_left": days_left,
-                        })
-                except:
-                    pass
+        # v3.4.0: Диапазон по отсортированному индексу дат
+        for expires, uid in self._index.expiring_between(today.isoformat(), last_day.isoformat()):
+            user = self.users[uid]
+            try:
+                expiry = datetime.date.fromisoformat(expires)
+            except ValueError:
+                continue
+            result.append({
+                "user_id": uid,
+                "username": user.username,
+                "plan": user.plan,
+                "days_left": (expiry - today).days,
+            })
         return result
     
     def should_notify_expiry(self, user_id: int) -> bool:
@@ -1162,7 +1403,7 @@ class RateLimiter:
         import datetime
         user = self.get_user(user_id)
         user.expiry_notified = datetime.date.today().isoformat()
-        self.save_data()
+        self.save_data(user_id)
     
     # ═════════════════════════════════════════════════════════════
     # NIGHT MODE
@@ -1172,7 +1413,7 @@ class RateLimiter:
         """ Переключить ночной режим, вернуть новое значение """
         user = self.get_user(user_id)
         user.night_mode = not user.night_mode
-        self.save_data()
+        self.save_data(user_id)
         return user.night_mode
     
     def is_night_mode(self, user_id: int) -> bool:
@@ -1184,11 +1425,8 @@ class RateLimiter:
     
     def get_top_users(self, limit: int = 10) -> list:
         """ Получить топ пользователей по количеству обработок """
-        sorted_users = sorted(
-            self.users.values(),
-            key=lambda u: u.total_videos,
-            reverse=True
-        )[:limit]
+        # v3.4.0: Из рейтинга total_videos
+        sorted_users = [self.users[uid] for uid, _ in self._index.videos.top(limit)]
         
         result = []
         for i, user in enumerate(sorted_users, 1):
@@ -1208,7 +1446,8 @@ class RateLimiter:
     def get_banned_users(self) -> list:
         """ Получить список забаненных пользователей """
         result = []
-        for user in self.users.values():
+        for uid in sorted(self._index.banned):
+            user = self.users[uid]
             if user.banned:
                 result.append({
                     "user_id": user.user_id,
@@ -1235,7 +1474,7 @@ class RateLimiter:
             referrer = self.get_user(referrer_id)
             referrer.referral_count += 1
             referrer.referral_bonus += 3  # +3 бонусных видео
-            self.save_data()
+            self.save_data(user_id, referrer_id)
             print(f"[REFERRAL] SUCCESS! referrer {referrer_id} now has {referrer.referral_bonus} bonus videos")
             return True
         print(f"[REFERRAL] REJECTED: user already has referrer_id={user.referrer_id}")
@@ -1347,7 +1586,7 @@ class RateLimiter:
         promo["used_count"] += 1
         promo["used_by"].append(user_id)
         self._save_promo_codes()
-        self.save_data()
+        self.save_data(user_id)
         
         return True, result_msg
     
@@ -1380,6 +1619,7 @@ class RateLimiter:
     # PROCESSING HISTORY
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def add_to_history(self, user_id: int, video_type: str, source: str = "file"):
         """ Добавить запись в историю обработок """
         user = self.get_user(user_id)
@@ -1417,13 +1657,14 @@ class RateLimiter:
         active_today = 0
         total_videos = 0
         total_downloads = 0
+        # v3.4.0: Тарифы — из индекса by_plan
         plans = {"free": 0, "vip": 0, "premium": 0}
+        plans.update(self._index.plan_counts())
         languages = {"ru": 0, "en": 0}
         
         for user in self.users.values():
             total_videos += user.total_videos
             total_downloads += user.total_downloads
-            plans[user.plan] = plans.get(user.plan, 0) + 1
             languages[user.language] = languages.get(user.language, 0) + 1
             
             if user.today_date == today and user.today_videos > 0:
@@ -1494,11 +1735,13 @@ class RateLimiter:
                 return False, "Invalid backup format"
             
             users_imported = 0
+            imported_ids = []
             for uid, udata in backup["users"].items():
                 user = self.get_user(int(uid))
                 for key, value in udata.items():
                     if hasattr(user, key):
                         setattr(user, key, value)
+                imported_ids.append(user.user_id)
                 users_imported += 1
             
             # Импортируем промо-коды если есть
@@ -1506,7 +1749,7 @@ class RateLimiter:
                 self._promo_codes.update(backup["promo_codes"])
                 self._save_promo_codes()
             
-            self.save_data()
+            self.save_data(*imported_ids)
             return True, f"Imported {users_imported} users"
         except json.JSONDecodeError:
             return False, "Invalid JSON"
@@ -1543,6 +1786,7 @@ class RateLimiter:
     # NEW USER CHECK
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def is_new_user(self, user_id: int) -> bool:
         """ Проверить, новый ли это пользователь """
         user = self.get_user(user_id)
@@ -1578,7 +1822,7 @@ class RateLimiter:
         
         user.trial_used = True
         self.set_plan_with_expiry(user_id, "vip", 1)  # 1 день
-        self.save_data()
+        self.save_data(user_id)
         return True
     
     def is_trial_used(self, user_id: int) -> bool:
@@ -1628,7 +1872,7 @@ class RateLimiter:
         # Бонус за 7-дневный streak: +1 к дневному лимиту
         bonus_earned = streak_count >= 7 and streak_count % 7 == 0
         
-        self.save_data()
+        self.save_data(user_id)
         return streak_count, bonus_earned
     
     def get_streak(self, user_id: int) -> dict:
@@ -1684,7 +1928,7 @@ class RateLimiter:
         }
         favorites.append(favorite)
         user.favorites = favorites
-        self.save_data()
+        self.save_data(user_id)
         return True
     
     def load_favorite(self, user_id: int, name: str) -> bool:
@@ -1697,7 +1941,7 @@ class RateLimiter:
                 user.quality = fav.get("quality", user.quality)
                 user.text_overlay = fav.get("text_overlay", user.text_overlay)
                 user.mode = fav.get("mode", user.mode)
-                self.save_data()
+                self.save_data(user_id)
                 return True
         return False
     
@@ -1710,7 +1954,7 @@ class RateLimiter:
             if fav.get("name") == name:
                 favorites.pop(i)
                 user.favorites = favorites
-                self.save_data()
+                self.save_data(user_id)
                 return True
         return False
     
@@ -1723,6 +1967,7 @@ class RateLimiter:
     # v2.8.0: OPERATION LOGS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def add_log(self, user_id: int, operation: str, details: str = ""):
         """ Добавить запись в лог операций """
         import datetime
@@ -1799,7 +2044,7 @@ class RateLimiter:
         user.level = new_level
         level_up = new_level > old_level
         
-        self.save_data()
+        self.save_data(user_id)
         return new_level, level_up
     
     def get_user_level(self, user_id: int) -> dict:
@@ -1843,13 +2088,15 @@ class RateLimiter:
             return None  # Не существует
         
         achievement = ACHIEVEMENTS[achievement_id]
-        achievements.append(achievement_id)
-        user.achievements = achievements
         
-        # Добавляем очки
-        self.add_points(user_id, achievement["points"], achievement_id)
+        # v3.4.0: Достижение + очки — одна запись
+        with self.transaction(user_id):
+            achievements.append(achievement_id)
+            user.achievements = achievements
+            
+            # Добавляем очки
+            self.add_points(user_id, achievement["points"], achievement_id)
         
-        self.save_data()
         return achievement
     
     def check_achievements(self, user_id: int) -> list:
@@ -1878,11 +2125,12 @@ class RateLimiter:
             ("early_bird", hour >= 5 and hour < 7),
         ]
         
-        for ach_id, condition in checks:
-            if condition:
-                result = self.unlock_achievement(user_id, ach_id)
-                if result:
-                    unlocked.append(result)
+        with self.transaction(user_id):
+            for ach_id, condition in checks:
+                if condition:
+                    result = self.unlock_achievement(user_id, ach_id)
+                    if result:
+                        unlocked.append(result)
         
         return unlocked
     
@@ -1902,27 +2150,22 @@ class RateLimiter:
     
     def get_leaderboard(self, limit: int = 10) -> list:
         """Получить таблицу лидеров по очкам"""
-        users_with_points = []
-        
-        for uid, user in self.users.items():
-            points = getattr(user, 'points', 0)
-            level = getattr(user, 'level', 1)
-            if points > 0:
-                users_with_points.append({
-                    "user_id": uid,
-                    "username": user.username,
-                    "points": points,
-                    "level": level,
-                })
-        
-        # Сортируем по очкам
-        users_with_points.sort(key=lambda x: x["points"], reverse=True)
-        return users_with_points[:limit]
+        # v3.4.0: Из рейтинга points (уже отсортирован)
+        return [
+            {
+                "user_id": uid,
+                "username": self.users[uid].username,
+                "points": points,
+                "level": getattr(self.users[uid], 'level', 1),
+            }
+            for uid, points in self._index.points.top(limit, min_score=1)
+        ]
     
     # ═════════════════════════════════════════════════════════════
     # v2.9.0: TRIM SETTINGS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_trim(self, user_id: int, start: str, end: str):
         """Установить параметры обрезки"""
         user = self.get_user(user_id)
@@ -1934,6 +2177,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'trim_start', ''), getattr(user, 'trim_end', '')
     
+    @_marks_dirty
     def clear_trim(self, user_id: int):
         """Очистить параметры обрезки"""
         user = self.get_user(user_id)
@@ -1949,7 +2193,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         user.watermark_file_id = file_id
         user.watermark_position = position
-        self.save_data()
+        self.save_data(user_id)
     
     def get_watermark(self, user_id: int) -> Tuple[str, str]:
         """Получить водяной знак"""
@@ -1960,7 +2204,7 @@ class RateLimiter:
         """Удалить водяной знак"""
         user = self.get_user(user_id)
         user.watermark_file_id = ""
-        self.save_data()
+        self.save_data(user_id)
     
     # ═════════════════════════════════════════════════════════════
     # v2.9.0: RESOLUTION SETTINGS
@@ -1970,7 +2214,7 @@ class RateLimiter:
         """Установить разрешение"""
         user = self.get_user(user_id)
         user.resolution = resolution
-        self.save_data()
+        self.save_data(user_id)
     
     def get_resolution(self, user_id: int) -> str:
         """Получить разрешение"""
@@ -1985,7 +2229,7 @@ class RateLimiter:
         """Установить шаблон эффектов"""
         user = self.get_user(user_id)
         user.current_template = template_id
-        self.save_data()
+        self.save_data(user_id)
     
     def get_template(self, user_id: int) -> str:
         """Получить текущий шаблон"""
@@ -2008,7 +2252,8 @@ class RateLimiter:
         })
         
         user.reminders = reminders
-        self.save_data()
+        self.save_data(user_id)
+        self._schedule_changed(user_id)
     
     def get_reminders(self, user_id: int) -> list:
         """Получить напоминания"""
@@ -2019,6 +2264,7 @@ class RateLimiter:
     # v2.9.0: WEEKLY ANALYTICS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def update_weekly_stats(self, user_id: int):
         """Обновить недельную статистику"""
         import datetime
@@ -2070,6 +2316,7 @@ class RateLimiter:
     # v2.9.0: MUSIC OVERLAY
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_pending_audio(self, user_id: int, file_id: str):
         """Установить ожидающее аудио"""
         user = self.get_user(user_id)
@@ -2080,6 +2327,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'pending_audio_file_id', '')
     
+    @_marks_dirty
     def clear_pending_audio(self, user_id: int):
         """Очистить ожидающее аудио"""
         user = self.get_user(user_id)
@@ -2089,6 +2337,7 @@ class RateLimiter:
     # v2.9.0: BATCH PROCESSING
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def add_to_batch(self, user_id: int, file_id: str) -> int:
         """Добавить видео в пакет"""
         from config import MAX_BATCH_SIZE
@@ -2110,6 +2359,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'batch_videos', [])
     
+    @_marks_dirty
     def clear_batch(self, user_id: int):
         """Очистить пакет"""
         user = self.get_user(user_id)
@@ -2119,6 +2369,7 @@ class RateLimiter:
     # v3.0.0: MERGE VIDEOS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def add_to_merge(self, user_id: int, file_id: str) -> int:
         """Добавить видео в очередь склейки"""
         from config import MAX_MERGE_VIDEOS
@@ -2140,6 +2391,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'merge_videos', [])
     
+    @_marks_dirty
     def clear_merge_queue(self, user_id: int):
         """Очистить очередь склейки"""
         user = self.get_user(user_id)
@@ -2149,6 +2401,7 @@ class RateLimiter:
     # v3.0.0: SPEED CONTROL
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_speed(self, user_id: int, speed: str):
         """Установить скорость видео"""
         user = self.get_user(user_id)
@@ -2159,6 +2412,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'speed_setting', '1x')
     
+    @_marks_dirty
     def clear_speed(self, user_id: int):
         """Сбросить скорость"""
         user = self.get_user(user_id)
@@ -2168,6 +2422,7 @@ class RateLimiter:
     # v3.0.0: ROTATION/FLIP
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_rotation(self, user_id: int, rotation: str):
         """Установить поворот/отражение"""
         user = self.get_user(user_id)
@@ -2178,6 +2433,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'rotation_setting', '')
     
+    @_marks_dirty
     def clear_rotation(self, user_id: int):
         """Сбросить поворот"""
         user = self.get_user(user_id)
@@ -2187,6 +2443,7 @@ class RateLimiter:
     # v3.0.0: ASPECT RATIO
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_aspect(self, user_id: int, aspect: str):
         """Установить соотношение сторон"""
         user = self.get_user(user_id)
@@ -2197,6 +2454,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'aspect_setting', '')
     
+    @_marks_dirty
     def clear_aspect(self, user_id: int):
         """Сбросить соотношение"""
         user = self.get_user(user_id)
@@ -2206,6 +2464,7 @@ class RateLimiter:
     # v3.0.0: VIDEO FILTERS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_filter(self, user_id: int, filter_name: str):
         """Установить фильтр"""
         user = self.get_user(user_id)
@@ -2216,6 +2475,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'filter_setting', '')
     
+    @_marks_dirty
     def clear_filter(self, user_id: int):
         """Удалить фильтр"""
         user = self.get_user(user_id)
@@ -2225,6 +2485,7 @@ class RateLimiter:
     # v3.0.0: CUSTOM TEXT OVERLAY
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_custom_text(self, user_id: int, text: str):
         """Установить свой текст"""
         user = self.get_user(user_id)
@@ -2235,6 +2496,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'custom_text', '')
     
+    @_marks_dirty
     def clear_custom_text(self, user_id: int):
         """Удалить свой текст"""
         user = self.get_user(user_id)
@@ -2244,6 +2506,7 @@ class RateLimiter:
     # v3.0.0: CAPTION STYLES
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_caption_style(self, user_id: int, style: str):
         """Установить стиль текста"""
         user = self.get_user(user_id)
@@ -2258,6 +2521,7 @@ class RateLimiter:
     # v3.0.0: COMPRESSION
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_compression(self, user_id: int, preset: str):
         """Установить пресет сжатия"""
         user = self.get_user(user_id)
@@ -2268,6 +2532,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'compression_preset', '')
     
+    @_marks_dirty
     def clear_compression(self, user_id: int):
         """Сбросить сжатие"""
         user = self.get_user(user_id)
@@ -2277,6 +2542,7 @@ class RateLimiter:
     # v3.0.0: VOLUME CONTROL
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_volume(self, user_id: int, volume: str):
         """Установить громкость"""
         user = self.get_user(user_id)
@@ -2287,6 +2553,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'volume_setting', '100%')
     
+    @_marks_dirty
     def clear_volume(self, user_id: int):
         """Сбросить громкость"""
         user = self.get_user(user_id)
@@ -2305,8 +2572,10 @@ class RateLimiter:
         if not isinstance(tasks, list):
             tasks = []
         
+        # v3.4.0: id не переиспользуется после удаления задачи
+        task_id = max((t.get('id', 0) for t in tasks), default=0) + 1
         tasks.append({
-            "id": len(tasks) + 1,
+            "id": task_id,
             "time": time_str,
             "action": action,
             "params": params or {},
@@ -2315,8 +2584,9 @@ class RateLimiter:
         })
         
         user.scheduled_tasks = tasks
-        self.save_data()
-        return len(tasks)
+        self.save_data(user_id)
+        self._schedule_changed(user_id)
+        return task_id
     
     def get_scheduled_tasks(self, user_id: int) -> list:
         """Получить запланированные задачи"""
@@ -2336,7 +2606,8 @@ class RateLimiter:
                 break
         
         user.scheduled_tasks = tasks
-        self.save_data()
+        self.save_data(user_id)
+        self._schedule_changed(user_id)
     
     def remove_scheduled_task(self, user_id: int, task_id: int):
         """Удалить задачу"""
@@ -2345,18 +2616,52 @@ class RateLimiter:
         
         tasks = [t for t in tasks if t.get('id') != task_id]
         user.scheduled_tasks = tasks
-        self.save_data()
+        self.save_data(user_id)
+        self._schedule_changed(user_id)
     
     def clear_scheduled_tasks(self, user_id: int):
         """Очистить все задачи"""
         user = self.get_user(user_id)
         user.scheduled_tasks = []
-        self.save_data()
+        self.save_data(user_id)
+        self._schedule_changed(user_id)
+    
+    # v3.4.0: Уведомления планировщику и проход для построения кучи при старте
+    
+    def add_schedule_listener(self, listener: Callable[[int], None]):
+        """Подписаться на изменения напоминаний и задач пользователя"""
+        if listener not in self._schedule_listeners:
+            self._schedule_listeners.append(listener)
+    
+    def _schedule_changed(self, user_id: int):
+        for listener in self._schedule_listeners:
+            try:
+                listener(user_id)
+            except Exception as e:
+                print(f"[SCHEDULE] Listener error for {user_id}: {e}")
+    
+    def iter_timed_entries(self):
+        """
+        (user_id, reminders, невыполненные задачи) — только у кого они есть.
+        Холодные поля читаются без разворачивания; JSON без этих ключей не парсится.
+        """
+        for user_id, user in list(self.users.items()):
+            cold = user._cold
+            if cold is None:
+                continue
+            if isinstance(cold, str) and '"reminders"' not in cold and '"scheduled_tasks"' not in cold:
+                continue
+            data = user.cold_data()
+            reminders = data.get('reminders') or []
+            tasks = [t for t in data.get('scheduled_tasks') or [] if not t.get('executed', False)]
+            if reminders or tasks:
+                yield user_id, reminders, tasks
     
     # ═════════════════════════════════════════════════════════════
     # v3.0.0: AUTO-PROCESS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_auto_process(self, user_id: int, template: str):
         """Установить шаблон автообработки"""
         user = self.get_user(user_id)
@@ -2367,6 +2672,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'auto_process_template', '')
     
+    @_marks_dirty
     def clear_auto_process(self, user_id: int):
         """Выключить автообработку"""
         user = self.get_user(user_id)
@@ -2376,6 +2682,7 @@ class RateLimiter:
     # v3.0.0: PENDING VIDEO
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def set_pending_video(self, user_id: int, file_id: str):
         """Установить ожидающее видео"""
         user = self.get_user(user_id)
@@ -2386,6 +2693,7 @@ class RateLimiter:
         user = self.get_user(user_id)
         return getattr(user, 'pending_video_file_id', '')
     
+    @_marks_dirty
     def clear_pending_video(self, user_id: int):
         """Очистить ожидающее видео"""
         user = self.get_user(user_id)
@@ -2395,6 +2703,7 @@ class RateLimiter:
     # v3.0.0: CLEAR ALL V3 SETTINGS
     # ═════════════════════════════════════════════════════════════
     
+    @_marks_dirty
     def clear_v3_settings(self, user_id: int):
         """Сбросить все настройки v3.0.0"""
         user = self.get_user(user_id)
@@ -2455,4 +2764,5 @@ class RateLimiter:
         
         return "\n".join(settings) if settings else "Нет активных настроек"
 
-rate_limiter = RateLimiter()
+# v3.4.0: Ленивая загрузка — бот грузит пользователей фазой запуска (startup.py)
+rate_limiter = RateLimiter(lazy=True)
@@ -0,0 +1,239 @@
+"""
+Virex — Content-Addressed Result Cache v3.4.0
+
+Дисковый кэш результатов обработки в get_temp_dir()/result_cache:
+- Ключ = sha256(операция + хеш содержимого входа + нормализованные параметры)
+- LRU-вытеснение по суммарному размеру и количеству записей
+- Результат отдаётся копией (hardlink), вызывающий код может её удалять
+- Индекс хранится в index.json и переживает рестарт
+
+Операции, которые обязаны быть уникальными на каждый запуск
+(Watermark-Trap, рандомный Anti-Reupload), кэш не используют.
+"""
+import os
+import json
+import time
+import shutil
+import asyncio
+import hashlib
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from config import RESULT_CACHE_MAX_MB, RESULT_CACHE_MAX_ENTRIES, DOWNLOAD_PARTIAL_TTL_SECONDS
+
+_HASH_CHUNK = 1024 * 1024
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _link_or_copy(src: str, dst: str):
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ResultCache:
+    """ LRU кэш файлов-результатов по содержимому входа """
+
+    def __init__(self, cache_dir: str = None,
+                 max_bytes: int = RESULT_CACHE_MAX_MB * 1024 * 1024,
+                 max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        if cache_dir is None:
+            from ffmpeg_utils import get_temp_dir
+            cache_dir = str(get_temp_dir() / "result_cache")
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.index_file = self.cache_dir / "index.json"
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        # key → {"file", "size", "time", "expires"}; порядок = LRU
+        self.entries: "OrderedDict[str, dict]" = OrderedDict()
+        # (abspath, size, mtime_ns) → sha256, чтобы не хешировать файл повторно
+        self._hash_memo: "OrderedDict[tuple, str]" = OrderedDict()
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(e["size"] for e in self.entries.values())
+
+    # ═════════════════════════════════════════════════════════════
+    # KEYS
+    # ═════════════════════════════════════════════════════════════
+
+    @staticmethod
+    def make_key(operation: str, source: str, **params) -> str:
+        """Ключ из операции, идентификатора входа и параметров (порядок не важен)"""
+        payload = json.dumps({"op": operation, "src": source, "params": params},
+                             sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    async def content_hash(self, path: str) -> Optional[str]:
+        """sha256 содержимого (в отдельном потоке, с мемоизацией по mtime)"""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+        cached = self._hash_memo.get(memo_key)
+        if cached:
+            return cached
+        digest = await asyncio.to_thread(_file_sha256, path)
+        self._hash_memo[memo_key] = digest
+        while len(self._hash_memo) > 1024:
+            self._hash_memo.popitem(last=False)
+        return digest
+
+    async def key_for_file(self, input_path: str, operation: str, **params) -> Optional[str]:
+        digest = await self.content_hash(input_path)
+        if digest is None:
+            return None
+        return self.make_key(operation, digest, **params)
+
+    def key_for_url(self, url: str) -> str:
+        return self.make_key("download", url.strip())
+
+    # ═════════════════════════════════════════════════════════════
+    # GET / PUT
+    # ═════════════════════════════════════════════════════════════
+
+    def get(self, key: Optional[str], output_path: str) -> bool:
+        """Если результат есть — положить его в output_path и вернуть True"""
+        entry = self.entries.get(key) if key else None
+        if entry is None:
+            self.stats["misses"] += 1
+            return False
+        cached_file = self.cache_dir / entry["file"]
+        if (entry.get("expires") and entry["expires"] < time.time()) or not cached_file.exists():
+            self._remove(key)
+            self.stats["misses"] += 1
+            return False
+        try:
+            _link_or_copy(str(cached_file), output_path)
+        except OSError as e:
+            print(f"[CACHE] Read error: {e}")
+            return False
+        self.entries.move_to_end(key)
+        entry["time"] = time.time()
+        self.stats["hits"] += 1
+        return True
+
+    def put(self, key: Optional[str], result_path: str, ttl: float = 0):
+        """Сохранить копию результата под ключом"""
+        if not key or not os.path.exists(result_path):
+            return
+        size = os.path.getsize(result_path)
+        if size > self.max_bytes:
+            return
+        file_name = key + Path(result_path).suffix
+        try:
+            _link_or_copy(result_path, str(self.cache_dir / file_name))
+        except OSError as e:
+            print(f"[CACHE] Write error: {e}")
+            return
+        self.entries[key] = {
+            "file": file_name,
+            "size": size,
+            "time": time.time(),
+            "expires": time.time() + ttl if ttl else 0,
+        }
+        self.entries.move_to_end(key)
+        self._evict()
+        self._save()
+
+    async def cached_file_op(self, key: Optional[str], output_path: str, run, ttl: float = 0):
+        """
+        Обёртка для операций вида run() → (success, error):
+        hit — результат из кэша без запуска, miss — run() и сохранение результата.
+        """
+        if self.get(key, output_path):
+            return True, None
+        success, error = await run()
+        if success:
+            self.put(key, output_path, ttl)
+        return success, error
+
+    # ═════════════════════════════════════════════════════════════
+    # EVICTION / PERSISTENCE
+    # ═════════════════════════════════════════════════════════════
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry:
+            try:
+                (self.cache_dir / entry["file"]).unlink()
+            except OSError:
+                pass
+
+    def _prune_partial(self):
+        """Недокачанные файлы DownloadManager (partial/*.part), брошенные после сбоя"""
+        cutoff = time.time() - DOWNLOAD_PARTIAL_TTL_SECONDS
+        for part in (self.cache_dir / "partial").glob("*.part"):
+            try:
+                if part.stat().st_mtime < cutoff:
+                    part.unlink()
+            except OSError:
+                pass
+
+    def _evict(self):
+        self._prune_partial()
+        total = self.total_bytes
+        while self.entries and (total > self.max_bytes or len(self.entries) > self.max_entries):
+            key, entry = next(iter(self.entries.items()))
+            total -= entry["size"]
+            self._remove(key)
+            self.stats["evictions"] += 1
+
+    def _load(self):
+        if not self.index_file.exists():
+            return
+        try:
+            with open(self.index_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"[CACHE] Index load error: {e}")
+            return
+        for key, entry in sorted(data.items(), key=lambda kv: kv[1].get("time", 0)):
+            if (self.cache_dir / entry.get("file", "")).exists():
+                self.entries[key] = entry
+        self._evict()
+
+    def _save(self):
+        tmp_file = str(self.index_file) + ".tmp"
+        try:
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_file, self.index_file)
+        except OSError as e:
+            print(f"[CACHE] Index save error: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            "entries": len(self.entries),
+            "size_mb": round(self.total_bytes / (1024 * 1024), 1),
+            **self.stats,
+        }
+
+
+# Singleton
+_result_cache: Optional[ResultCache] = None
+
+
+def get_result_cache() -> ResultCache:
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
@@ -0,0 +1,286 @@
+"""
+Virex — Shared Processing Scheduler v3.4.0
+
+Единый бюджет FFmpeg-слотов для Telegram бота и API сервера:
+- v3.4.0: ёмкость — бюджет потоков CPU (cpu_policy), задача занимает
+  weight единиц (свои потоки FFmpeg); при выключенной политике — по 1 на
+  задачу из MAX_CONCURRENT_TASKS
+- Задача, которая не помещается, ждёт и держит очередь (тяжёлые 4K/8K не
+  голодают за потоком лёгких)
+- Приоритет по PlanLimits.priority (0=free, 1=vip, 2=premium) + старение ожидания
+- Справедливое деление между источниками (bot / api): при равном приоритете
+  слот получает источник, у которого меньше запущенных (затем — выданных) задач
+- Локальный IPC (unix socket / 127.0.0.1) — API в отдельном процессе
+  берёт слоты у планировщика процесса бота
+
+Протокол IPC (JSON lines, одно соединение = одна аренда слота):
+    → {"op": "acquire", "source": "api", "priority": 2, "user_id": 123, "weight": 4}
+    ← {"ok": true, "lease": 17}
+    → {"op": "release"}          (или просто закрыть соединение)
+"""
+import os
+import json
+import time
+import asyncio
+import tempfile
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+
+from config import (
+    SCHEDULER_SOCKET_PATH,
+    SCHEDULER_TCP_PORT,
+    SCHEDULER_AGING_SECONDS,
+)
+from cpu_policy import get_cpu_policy
+
+
+@dataclass
+class _Waiter:
+    source: str
+    priority: int
+    user_id: int
+    seq: int
+    future: asyncio.Future
+    weight: int = 1
+    enqueued_at: float = field(default_factory=time.time)
+
+
+class ProcessingScheduler:
+    """Глобальные слоты обработки с приоритетами и fair-share"""
+
+    def __init__(self, slots: int = None,
+                 aging_seconds: float = SCHEDULER_AGING_SECONDS):
+        self.slots = slots or get_cpu_policy().threads
+        self.aging_seconds = aging_seconds
+        self.running: Dict[str, int] = {}
+        self.leases: Dict[int, Tuple[str, int]] = {}  # lease_id → (source, weight)
+        self._busy = 0
+        self.served: Dict[str, int] = {}       # Выдано слотов по источникам (fair-share)
+        self._waiters: List[_Waiter] = []
+        self._seq = 0
+        self.stats = {"granted": 0, "max_wait": 0.0}
+
+    @property
+    def busy(self) -> int:
+        """Занятая ёмкость (сумма weight выданных аренд)"""
+        return self._busy
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _effective_priority(self, waiter: _Waiter, now: float) -> float:
+        # Старение: каждые aging_seconds ожидания = +1 к приоритету (free не голодает)
+        if self.aging_seconds > 0:
+            return waiter.priority + int((now - waiter.enqueued_at) // self.aging_seconds)
+        return waiter.priority
+
+    def _dispatch(self):
+        now = time.time()
+        self._waiters = [w for w in self._waiters if not w.future.done()]
+        while self._waiters:
+            best = min(
+                self._waiters,
+                key=lambda w: (
+                    -self._effective_priority(w, now),
+                    self.running.get(w.source, 0),
+                    self.served.get(w.source, 0),
+                    w.seq,
+                )
+            )
+            if self._busy + best.weight > self.slots:
+                break  # Лучший не помещается — ждёт освобождения, очередь не обгоняют
+            self._waiters.remove(best)
+            self._seq += 1
+            lease_id = self._seq
+            self.leases[lease_id] = (best.source, best.weight)
+            self._busy += best.weight
+            self.running[best.source] = self.running.get(best.source, 0) + 1
+            self.served[best.source] = self.served.get(best.source, 0) + 1
+            self.stats["granted"] += 1
+            self.stats["max_wait"] = max(self.stats["max_wait"], now - best.enqueued_at)
+            best.future.set_result(lease_id)
+
+    async def acquire(self, source: str, priority: int = 0, user_id: int = 0,
+                      weight: int = 1) -> int:
+        """Дождаться weight свободных единиц ёмкости. Возвращает lease_id"""
+        self._seq += 1
+        waiter = _Waiter(source, priority, user_id, self._seq,
+                         asyncio.get_running_loop().create_future(),
+                         weight=max(1, min(int(weight), self.slots)))
+        self._waiters.append(waiter)
+        self._dispatch()
+        try:
+            return await waiter.future
+        except asyncio.CancelledError:
+            # Если слот уже выдан — вернуть его
+            if waiter.future.done() and not waiter.future.cancelled():
+                self.release(waiter.future.result())
+            else:
+                # v3.4.0: Ушёл из головы очереди — следующие не ждут следующего release
+                self._dispatch()
+            raise
+
+    def release(self, lease_id: int):
+        lease = self.leases.pop(lease_id, None)
+        if lease is None:
+            return
+        source, weight = lease
+        self._busy -= weight
+        self.running[source] = max(0, self.running.get(source, 0) - 1)
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, source: str, priority: int = 0, user_id: int = 0, weight: int = 1):
+        lease_id = await self.acquire(source, priority, user_id, weight)
+        try:
+            yield lease_id
+        finally:
+            self.release(lease_id)
+
+    def get_stats(self) -> dict:
+        return {
+            "slots": self.slots,
+            "busy": self.busy,
+            "jobs": len(self.leases),
+            "waiting": self.waiting,
+            "running": dict(self.running),
+            "served": dict(self.served),
+            **self.stats,
+        }
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# IPC SERVER (процесс бота)
+# ══════════════════════════════════════════════════════════════════════════════
+
+def _use_unix_socket() -> bool:
+    return hasattr(asyncio, "start_unix_server") and os.name == "posix"
+
+
+def get_socket_path() -> str:
+    return SCHEDULER_SOCKET_PATH or os.path.join(tempfile.gettempdir(), "virex_scheduler.sock")
+
+
+async def _handle_client(scheduler: ProcessingScheduler, reader, writer):
+    lease_id = None
+    acquire = hangup = None
+    try:
+        line = await reader.readline()
+        if not line:
+            return
+        request = json.loads(line.decode())
+        if request.get("op") != "acquire":
+            return
+        acquire = asyncio.ensure_future(scheduler.acquire(
+            request.get("source", "ipc"),
+            int(request.get("priority", 0)),
+            int(request.get("user_id", 0)),
+            int(request.get("weight", 1)),
+        ))
+        # v3.4.0: Release или разрыв соединения — и в очереди, и после выдачи
+        hangup = asyncio.ensure_future(reader.readline())
+        await asyncio.wait((acquire, hangup), return_when=asyncio.FIRST_COMPLETED)
+        if not acquire.done():
+            # Клиент ушёл, не дождавшись слота — место в очереди не держим
+            return
+        lease_id = acquire.result()
+        writer.write((json.dumps({"ok": True, "lease": lease_id}) + "\n").encode())
+        await writer.drain()
+        # Держим слот до release или разрыва соединения
+        await hangup
+    except (ConnectionError, json.JSONDecodeError, ValueError):
+        pass
+    finally:
+        for task in (acquire, hangup):
+            if task is not None and not task.done():
+                # acquire сам вернёт слот, если он выдан в момент отмены
+                task.cancel()
+        if hangup is not None and hangup.done() and not hangup.cancelled():
+            hangup.exception()  # Разрыв соединения уже обработан
+        if lease_id is not None:
+            scheduler.release(lease_id)
+        writer.close()
+
+
+async def start_scheduler_server(scheduler: ProcessingScheduler = None):
+    """Поднять IPC сервер планировщика (вызывается ботом при старте)"""
+    scheduler = scheduler or get_scheduler()
+
+    async def handler(reader, writer):
+        await _handle_client(scheduler, reader, writer)
+
+    try:
+        if _use_unix_socket():
+            path = get_socket_path()
+            if os.path.exists(path):
+                os.remove(path)
+            server = await asyncio.start_unix_server(handler, path=path)
+            print(f"[SCHED] IPC listening on {path}")
+        else:
+            server = await asyncio.start_server(handler, "127.0.0.1", SCHEDULER_TCP_PORT)
+            print(f"[SCHED] IPC listening on 127.0.0.1:{SCHEDULER_TCP_PORT}")
+        return server
+    except OSError as e:
+        print(f"[SCHED] IPC server failed: {e}")
+        return None
+
+
+# ══════════════════════════════════════════════════════════════════════════════
+# IPC CLIENT (API сервер в отдельном процессе)
+# ══════════════════════════════════════════════════════════════════════════════
+
+class SchedulerClient:
+    """
+    Слоты у планировщика бота по IPC.
+    Если бот недоступен — локальный планировщик (API работает автономно).
+    """
+
+    def __init__(self, source: str = "api", fallback_slots: int = None):
+        self.source = source
+        self.fallback = ProcessingScheduler(fallback_slots)
+
+    async def _connect(self):
+        if _use_unix_socket():
+            return await asyncio.open_unix_connection(get_socket_path())
+        return await asyncio.open_connection("127.0.0.1", SCHEDULER_TCP_PORT)
+
+    @asynccontextmanager
+    async def slot(self, source: str = None, priority: int = 0, user_id: int = 0, weight: int = 1):
+        source = source or self.source
+        try:
+            reader, writer = await self._connect()
+        except (OSError, ConnectionError):
+            async with self.fallback.slot(source, priority, user_id, weight) as lease_id:
+                yield lease_id
+            return
+
+        try:
+            writer.write((json.dumps({
+                "op": "acquire", "source": source,
+                "priority": priority, "user_id": user_id, "weight": weight,
+            }) + "\n").encode())
+            await writer.drain()
+            reply = json.loads((await reader.readline()).decode() or "{}")
+            if not reply.get("ok"):
+                raise ConnectionError("scheduler refused")
+            yield reply.get("lease")
+        finally:
+            try:
+                writer.write(b'{"op": "release"}\n')
+                await writer.drain()
+            except (ConnectionError, OSError):
+                pass
+            writer.close()
+
+
+# Singleton
+_scheduler: Optional[ProcessingScheduler] = None
+
+
+def get_scheduler() -> ProcessingScheduler:
+    global _scheduler
+    if _scheduler is None:
+        _scheduler = ProcessingScheduler()
+    return _scheduler
@@ -0,0 +1,52 @@
+"""
+Virex — Sliding Window Counter v3.4.0
+
+Счётчик запросов за скользящее окно с постоянной памятью:
+- Окно делится на N корзин (по умолчанию 30 корзин по дню на 30-дневное окно)
+- Корзины лежат кольцом, running total — count() за O(1)
+- add()/count() сдвигают голову кольца и обнуляют устаревшие корзины
+  (не больше N шагов — не зависит от числа запросов)
+
+Точность — одна корзина: событие забывается через окно − ширина корзины … окно.
+"""
+from typing import List
+
+from config import RATE_LIMIT_WINDOW_SECONDS, RATE_LIMIT_WINDOW_BUCKETS
+
+
+class SlidingWindowCounter:
+    """ Кольцо из N корзин + running total """
+
+    __slots__ = ("buckets", "head", "total", "width")
+
+    def __init__(self, window_seconds: float = RATE_LIMIT_WINDOW_SECONDS,
+                 buckets: int = RATE_LIMIT_WINDOW_BUCKETS):
+        self.buckets: List[int] = [0] * buckets
+        self.width = window_seconds / buckets
+        self.head = 0      # Номер (абсолютный) текущей корзины
+        self.total = 0
+
+    def _advance(self, now: float):
+        slot = int(now // self.width)
+        steps = slot - self.head
+        if steps <= 0:
+            return
+        size = len(self.buckets)
+        if steps >= size:
+            self.buckets[:] = [0] * size
+            self.total = 0
+        else:
+            for i in range(1, steps + 1):
+                idx = (self.head + i) % size
+                self.total -= self.buckets[idx]
+                self.buckets[idx] = 0
+        self.head = slot
+
+    def add(self, now: float, count: int = 1):
+        self._advance(now)
+        self.buckets[self.head % len(self.buckets)] += count
+        self.total += count
+
+    def count(self, now: float) -> int:
+        self._advance(now)
+        return self.total
@@ -0,0 +1,151 @@
+"""
+Virex — Startup Orchestrator v3.4.0
+
+Параллельный запуск подсистем бота с замером времени по фазам:
+- Фаза = корутина или синхронная функция (thread=True → в отдельном потоке)
+- critical=True — polling ждёт эти фазы (хранилище пользователей, воркеры, IPC)
+- critical=False — фоновые фазы (базы Shield, сигнатуры, очистка, yt-dlp)
+- after=(...) — зависимости между фазами
+- Ошибка фоновой фазы логируется и не мешает старту, критической — пробрасывается
+
+    startup = StartupOrchestrator()
+    startup.phase("user_store", rate_limiter.ensure_loaded, thread=True)
+    startup.phase("shield_db", get_virex_shield, thread=True, critical=False)
+    await startup.run()          # вернётся, когда готовы критические фазы
+    print(startup.report())
+"""
+import time
+import asyncio
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Момент импорта модуля — бот импортирует его первым, это точка отсчёта
+IMPORT_STARTED = time.perf_counter()
+
+
+@dataclass
+class StartupPhase:
+    name: str
+    func: Callable
+    critical: bool = True
+    thread: bool = False
+    after: Tuple[str, ...] = ()
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    error: Optional[str] = None
+    task: Optional[asyncio.Task] = field(default=None, repr=False)
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+
+class StartupOrchestrator:
+    """ Граф фаз запуска: критические ждём, фоновые доезжают сами """
+
+    def __init__(self):
+        self.phases: Dict[str, StartupPhase] = {}
+        self.started_at: Optional[float] = None
+        self.ready_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        # Фазы, замеренные вне оркестратора (например, импорт модулей)
+        self.recorded: List[Tuple[str, float]] = []
+
+    def record(self, name: str, seconds: float):
+        self.recorded.append((name, seconds))
+
+    def phase(self, name: str, func: Callable, *, critical: bool = True,
+              thread: bool = False, after: Tuple[str, ...] = ()):
+        if name in self.phases:
+            raise ValueError(f"Duplicate startup phase: {name}")
+        self.phases[name] = StartupPhase(name, func, critical, thread, tuple(after))
+        return self
+
+    # ═════════════════════════════════════════════════════════════
+    # RUN
+    # ═════════════════════════════════════════════════════════════
+
+    async def _run_phase(self, phase: StartupPhase):
+        for dep in phase.after:
+            dependency = self.phases[dep].task
+            if dependency is not None:
+                try:
+                    await dependency
+                except Exception:
+                    pass  # Ошибку зависимости уже залогировала её фаза
+        phase.started = time.perf_counter()
+        try:
+            if phase.thread:
+                result = await asyncio.to_thread(phase.func)
+            else:
+                result = phase.func()
+            if asyncio.iscoroutine(result):
+                await result
+        except Exception as e:
+            phase.error = str(e) or type(e).__name__
+            print(f"[STARTUP] Phase {phase.name} failed: {phase.error}")
+            if phase.critical:
+                raise
+        finally:
+            phase.finished = time.perf_counter()
+            self._maybe_finish()
+
+    def _maybe_finish(self):
+        if all(p.finished is not None for p in self.phases.values()):
+            self.finished_at = time.perf_counter()
+
+    async def run(self):
+        """ Запустить все фазы; вернуться, когда готовы критические """
+        for phase in self.phases.values():
+            for dep in phase.after:
+                if dep not in self.phases:
+                    raise ValueError(f"Unknown startup dependency: {phase.name} → {dep}")
+        self.started_at = time.perf_counter()
+        for phase in self.phases.values():
+            phase.task = asyncio.create_task(self._run_phase(phase))
+        critical = [p.task for p in self.phases.values() if p.critical]
+        if critical:
+            await asyncio.gather(*critical)
+        self.ready_at = time.perf_counter()
+
+    async def wait_background(self):
+        """ Дождаться фоновых фаз (ошибки уже залогированы) """
+        background = [p.task for p in self.phases.values() if not p.critical and p.task]
+        if background:
+            await asyncio.gather(*background, return_exceptions=True)
+
+    # ═════════════════════════════════════════════════════════════
+    # REPORT
+    # ═════════════════════════════════════════════════════════════
+
+    def get_timings(self) -> dict:
+        timings = {name: round(seconds, 3) for name, seconds in self.recorded}
+        for phase in self.phases.values():
+            if phase.duration is not None:
+                timings[phase.name] = round(phase.duration, 3)
+        if self.started_at is not None and self.ready_at is not None:
+            timings["ready"] = round(self.ready_at - self.started_at, 3)
+        if self.started_at is not None and self.finished_at is not None:
+            timings["total"] = round(self.finished_at - self.started_at, 3)
+        return timings
+
+    def report(self) -> str:
+        lines = ["[STARTUP] Phase timings:"]
+        for name, seconds in self.recorded:
+            lines.append(f"  {name:<20} {seconds * 1000:>8.0f} ms")
+        for phase in sorted(self.phases.values(), key=lambda p: p.started or 0):
+            if phase.duration is None:
+                status = "running"
+                value = f"{'-':>8}   "
+            else:
+                status = "FAILED" if phase.error else ("critical" if phase.critical else "background")
+                value = f"{phase.duration * 1000:>8.0f} ms"
+            lines.append(f"  {phase.name:<20} {value}  {status}")
+        timings = self.get_timings()
+        if "ready" in timings:
+            lines.append(f"  {'→ polling after':<20} {timings['ready'] * 1000:>8.0f} ms")
+        if "total" in timings:
+            lines.append(f"  {'→ all phases':<20} {timings['total'] * 1000:>8.0f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,885 @@
+"""
+Проверка поведения VIREX v3.4.0: хранилища и индексы, планировщики,
+кэш и загрузки, оценка очереди, склейка, битрейт, сегментное кодирование
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+
+# Счётчики
+passed = 0
+failed = 0
+errors = []
+
+def test(name, condition, details=""):
+    global passed, failed, errors
+    if condition:
+        print(f"  ✅ {name}")
+        passed += 1
+    else:
+        print(f"  ❌ {name} {details}")
+        failed += 1
+        errors.append(f"{name}: {details}")
+
+
+async def ffmpeg_run(*args) -> str:
+    """Запустить FFmpeg, вернуть stderr"""
+    from config import FFMPEG_PATH
+    proc = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", *args,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await proc.communicate()
+    return stderr.decode(errors="replace")
+
+
+@contextmanager
+def temp_workdir():
+    """RateLimiter пишет users_data.json / журнал в текущую директорию"""
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            yield tmp
+        finally:
+            os.chdir(cwd)
+
+
+def journal_lines(path: str = "users_data.journal") -> int:
+    if not os.path.exists(path):
+        return 0
+    with open(path, encoding="utf-8") as f:
+        return sum(1 for line in f if line.strip())
+
+
+async def frame_luma(path: str) -> list:
+    """Средняя яркость (YAVG) каждого кадра"""
+    stderr = await ffmpeg_run(
+        "-i", path, "-vf", "signalstats,metadata=print:key=lavfi.signalstats.YAVG", "-f", "null", "-"
+    )
+    return [float(v) for v in re.findall(r"lavfi\.signalstats\.YAVG=([\d.]+)", stderr)]
+
+
+async def run_tests():
+    global passed, failed
+
+    print("=" * 60)
+    print("🧪 VIREX v3.4.0 — ПРОВЕРКА ПОВЕДЕНИЯ")
+    print("=" * 60)
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 1. USER_STORE.PY — журнал и компактация")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from user_store import UserStore
+
+        with temp_workdir() as tmp:
+            store = UserStore("data.json", "data.journal", compact_records=1000)
+            test("Пустой стор", store.load() == {})
+            written = store.write([("1", {"plan": "free"}), ("2", {"plan": "vip"})])
+            test("Запись двух пользователей", written == 2, f"got {written}")
+            test("Без изменений — в журнал ничего", store.write([("1", {"plan": "free"})]) == 0)
+            store.write([("1", {"plan": "premium"})])
+            test("В журнале только изменения", journal_lines("data.journal") == 3,
+                 f"got {journal_lines('data.journal')}")
+
+            reloaded = UserStore("data.json", "data.journal").load()
+            test("Round-trip: снапшот + журнал",
+                 reloaded == {"1": {"plan": "premium"}, "2": {"plan": "vip"}}, str(reloaded))
+
+            # Компактация в фоне по порогу записей
+            store = UserStore("snap.json", "snap.journal", compact_records=3)
+            store.load()
+            for uid in range(5):
+                store.write([(str(uid), {"n": uid})], background=True)
+            store.drain()
+            with open("snap.json", encoding="utf-8") as f:
+                snapshot = json.load(f)
+            test("Компактация свернула журнал в снапшот", len(snapshot) == 3, f"got {len(snapshot)}")
+            test("После компактации в журнале только хвост", journal_lines("snap.journal") == 2,
+                 f"got {journal_lines('snap.journal')}")
+            store.compact()
+            test("compact() — журнал пуст", journal_lines("snap.journal") == 0)
+            reloaded = UserStore("snap.json", "snap.journal").load()
+            test("Данные после компактации", reloaded == {str(i): {"n": i} for i in range(5)}, str(reloaded))
+
+            # Упавший append: запись не считается сохранённой
+            store = UserStore("fail.json", "fail.journal")
+            store.load()
+            os.mkdir("fail.journal")  # open(..., 'a') → IsADirectoryError
+            store.write([("7", {"plan": "vip"})], background=True)
+            store.drain()
+            test("Фоновая ошибка → pop_failed()", store.pop_failed() == {"7"})
+            test("last_error заполнен", bool(store.last_error))
+            try:
+                store.write([("7", {"plan": "vip"})])
+                test("Синхронная ошибка → OSError", False, "no exception")
+            except OSError:
+                test("Синхронная ошибка → OSError", True)
+            os.rmdir("fail.journal")
+            test("После ошибки запись повторяется", store.write([("7", {"plan": "vip"})]) == 1)
+            test("Повтор записан", UserStore("fail.json", "fail.journal").load() == {"7": {"plan": "vip"}})
+    except Exception as e:
+        test("user_store", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 2. RATE_LIMIT.PY — набор изменённых пользователей")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from rate_limit import RateLimiter
+
+        with temp_workdir():
+            rl = RateLimiter()
+            rl.set_username(101, "alice")
+            rl.set_quality(102, "high")
+            test("Сеттеры помечают пользователей", {101, 102} <= rl._dirty, str(rl._dirty))
+            rl.save_data()
+            rl.flush()
+            test("save_data() пишет изменённых", journal_lines() == 2, f"got {journal_lines()}")
+            test("Набор очищен", not rl._dirty)
+            rl.save_data()
+            rl.flush()
+            test("Повторный save_data() ничего не пишет", journal_lines() == 2, f"got {journal_lines()}")
+
+            with rl.transaction(103):
+                rl.set_mode(103, "youtube")
+                rl.save_data(103)
+                test("Внутри transaction запись отложена", journal_lines() == 2)
+            rl.flush()
+            test("Выход из transaction — одна запись", journal_lines() == 3, f"got {journal_lines()}")
+
+            # Фоновый append упал — пользователь снова в наборе и пишется позже
+            async def failed_append():
+                os.rename("users_data.journal", "users_data.journal.bak")
+                os.mkdir("users_data.journal")
+                rl.set_username(104, "bob")
+                rl.save_data()
+                rl.flush()
+                os.rmdir("users_data.journal")
+                os.rename("users_data.journal.bak", "users_data.journal")
+                rl.save_data()
+                rl.flush()
+            await failed_append()
+            reloaded = RateLimiter()
+            test("Упавшая запись восстановлена",
+                 104 in reloaded.users and reloaded.users[104].username == "bob")
+            test("Round-trip RateLimiter", reloaded.users[101].username == "alice"
+                 and reloaded.users[103].mode == "youtube")
+    except Exception as e:
+        test("rate_limit dirty set", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 3. USER_INDEX.PY — индексы после изменений")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from rate_limit import RateLimiter
+
+        with temp_workdir():
+            rl = RateLimiter()
+            rl.set_username(201, "Carol")
+            rl.save_data()
+            test("username → индекс", rl.find_user_by_username("@carol") == 201)
+            rl.set_username(201, "dave")
+            rl.save_data()
+            test("Старый username удалён", rl.find_user_by_username("carol") is None)
+            test("Новый username найден", rl.find_user_by_username("Dave") == 201)
+
+            rl.set_plan(201, "vip")
+            rl.set_plan(202, "premium")
+            rl.get_user(203)
+            rl.save_data()
+            plans = rl.get_global_stats()["plans"]
+            test("Тарифы из by_plan", plans.get("vip") == 1 and plans.get("premium") == 1
+                 and plans.get("free") == 1, str(plans))
+            rl.set_plan(201, "free")
+            plans = rl.get_global_stats()["plans"]
+            test("Смена тарифа обновляет by_plan", plans.get("vip", 0) == 0 and plans.get("free") == 2,
+                 str(plans))
+            test("by_plan = перебор users", rl._index.plan_counts() == {
+                plan: sum(1 for u in rl.users.values() if u.plan == plan)
+                for plan in {u.plan for u in rl.users.values()}
+            })
+
+            rl.ban_user(202, "spam")
+            test("Бан → индекс banned", 202 in rl._index.banned)
+            rl.unban_user(202)
+            test("Разбан → удалён из banned", 202 not in rl._index.banned)
+
+            rl.record_ip(201, "10.0.0.1")
+            rl.record_ip(203, "10.0.0.1")
+            test("IP → индекс", rl._index.users_by_ip("10.0.0.1") == {201, 203})
+
+            rl.add_points(202, 50)
+            rl.add_points(203, 80)
+            rl.save_data()
+            leaders = [entry["user_id"] for entry in rl.get_leaderboard(10)]
+            test("Рейтинг очков отсортирован", leaders == [203, 202], str(leaders))
+
+            # Сеттеры без save_data внутри transaction — индексы не отстают
+            for _ in range(3):
+                with rl.transaction(301):
+                    rl.increment_video_count(301)
+                    rl.add_points(301, 10)
+            for _ in range(5):
+                with rl.transaction(302):
+                    rl.increment_download_count(302)
+                    rl.increment_video_count(302)
+            rl.save_data()
+            top = [(user["user_id"], user["total_videos"]) for user in rl.get_top_users(2)]
+            test("Топ по видео после transaction", top == [(302, 5), (301, 3)], str(top))
+            leaders = [(entry["user_id"], entry["points"]) for entry in rl.get_leaderboard(10)]
+            expected = sorted(((uid, u.points) for uid, u in rl.users.items() if u.points > 0),
+                              key=lambda item: (-item[1], item[0]))
+            test("Рейтинг после transaction = перебор users", leaders == expected,
+                 f"{leaders} != {expected}")
+
+            # Прямое изменение поля + save_data(uid) — тоже в индексе
+            with rl.transaction(303):
+                rl.get_user(303).total_videos = 9
+            top = [user["user_id"] for user in rl.get_top_users(1)]
+            test("Прямое изменение попадает в индекс", top == [303], str(top))
+    except Exception as e:
+        test("user_index", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 4. SCHEDULER.PY — приоритет и fair-share")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from scheduler import ProcessingScheduler
+
+        async def grant_order(scheduler, requests):
+            """Занять все слоты, поставить requests в очередь, вернуть порядок выдачи"""
+            holder = await scheduler.acquire("bot", weight=scheduler.slots)
+            order = []
+
+            async def worker(name, source, priority, weight):
+                async with scheduler.slot(source, priority, weight=weight):
+                    order.append(name)
+                    await asyncio.sleep(0)
+
+            tasks = []
+            for request in requests:
+                tasks.append(asyncio.create_task(worker(*request)))
+                await asyncio.sleep(0)  # Порядок постановки в очередь
+            scheduler.release(holder)
+            await asyncio.gather(*tasks)
+            return order
+
+        order = await grant_order(ProcessingScheduler(slots=1, aging_seconds=0), [
+            ("free", "bot", 0, 1), ("premium", "bot", 2, 1), ("vip", "bot", 1, 1),
+        ])
+        test("Приоритет: premium → vip → free", order == ["premium", "vip", "free"], str(order))
+
+        scheduler = ProcessingScheduler(slots=1, aging_seconds=0)
+        order = await grant_order(scheduler, [
+            ("bot-1", "bot", 0, 1), ("bot-2", "bot", 0, 1), ("api-1", "api", 0, 1),
+        ])
+        test("Fair-share: api не ждёт всю очередь бота", order == ["api-1", "bot-1", "bot-2"], str(order))
+        test("Учёт выданных слотов", scheduler.served == {"bot": 3, "api": 1}, str(scheduler.served))
+
+        order = await grant_order(ProcessingScheduler(slots=2, aging_seconds=0), [
+            ("heavy", "bot", 1, 2), ("light", "bot", 0, 1),
+        ])
+        test("Тяжёлая задача не голодает за лёгкими", order == ["heavy", "light"], str(order))
+
+        scheduler = ProcessingScheduler(slots=2, aging_seconds=0)
+        lease = await scheduler.acquire("bot", weight=1)
+        heavy = asyncio.create_task(scheduler.acquire("api", priority=2, weight=2))
+        await asyncio.sleep(0)
+        light = asyncio.create_task(scheduler.acquire("bot", priority=0, weight=1))
+        await asyncio.sleep(0)
+        test("Лёгкая не обгоняет ждущую тяжёлую", not light.done() and not heavy.done())
+        scheduler.release(lease)
+        scheduler.release(await heavy)
+        scheduler.release(await light)
+        test("Ёмкость освобождена", scheduler.busy == 0 and not scheduler.leases)
+
+        # IPC: клиент отключился, стоя в очереди — его место освобождается
+        from scheduler import _handle_client
+
+        scheduler = ProcessingScheduler(slots=2, aging_seconds=0)
+        server = await asyncio.start_server(
+            lambda r, w: _handle_client(scheduler, r, w), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        lease = await scheduler.acquire("bot", weight=1)
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b'{"op": "acquire", "source": "api", "priority": 2, "weight": 2}\n')
+        await writer.drain()
+        for _ in range(50):
+            if scheduler.waiting:
+                break
+            await asyncio.sleep(0.01)
+        test("IPC-клиент в очереди", scheduler.waiting == 1)
+        writer.close()
+        light = asyncio.create_task(scheduler.acquire("bot", weight=1))
+        try:
+            scheduler.release(await asyncio.wait_for(light, 2))
+            test("Отключившийся клиент не держит очередь", True)
+        except asyncio.TimeoutError:
+            test("Отключившийся клиент не держит очередь", False, f"waiting={scheduler.waiting}")
+        scheduler.release(lease)
+        server.close()
+        await server.wait_closed()
+        test("IPC: ёмкость освобождена", scheduler.busy == 0 and scheduler.waiting == 0,
+             f"busy={scheduler.busy} waiting={scheduler.waiting}")
+    except Exception as e:
+        test("scheduler", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 5. RESULT_CACHE.PY — брошенные .part")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from result_cache import ResultCache
+        from config import DOWNLOAD_PARTIAL_TTL_SECONDS
+
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(tmp)
+            partial = os.path.join(tmp, "partial")
+            os.mkdir(partial)
+            for name in ("stale.part", "fresh.part"):
+                with open(os.path.join(partial, name), "wb") as f:
+                    f.write(b"x" * 1024)
+            old = time.time() - DOWNLOAD_PARTIAL_TTL_SECONDS - 60
+            os.utime(os.path.join(partial, "stale.part"), (old, old))
+            src = os.path.join(tmp, "result.mp4")
+            with open(src, "wb") as f:
+                f.write(b"video")
+            cache.put(cache.make_key("op", "src"), src)
+            left = sorted(os.listdir(partial))
+            test("Старый .part удалён, свежий оставлен", left == ["fresh.part"], str(left))
+
+        from types import SimpleNamespace
+        from download_manager import DownloadManager
+
+        class BrokenDownload(DownloadManager):
+            async def _download(self, tg_file, part_path):
+                with open(part_path, "ab") as f:
+                    f.write(b"partial")
+                raise OSError("connection reset")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            part_path = os.path.join(tmp, "clip.part")
+            manager = BrokenDownload(bot=None, retries=1)
+            tg_file = SimpleNamespace(file_unique_id="clip", file_size=100)
+            try:
+                await manager._download_with_retry(tg_file, part_path)
+                test("Последняя попытка пробрасывает ошибку", False, "no exception")
+            except OSError:
+                test("Последняя попытка пробрасывает ошибку", True)
+            test("После последней попытки .part удалён", not os.path.exists(part_path))
+    except Exception as e:
+        test("result_cache partial", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 6. WATERMARK_TRAP.PY — SignatureStore")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from watermark_trap import SignatureStore, TrapSignature, WatermarkTrapDetector, TRAP_CONFIG
+
+        def make_signature(i: int) -> TrapSignature:
+            return TrapSignature(user_id=i % 3, video_hash=f"hash{i}", timestamp=1700000000.0 + i,
+                                 random_salt=f"salt{i}", master_key=TRAP_CONFIG.master_secret)
+
+        with temp_workdir():
+            store = SignatureStore("sigs.json", "sigs.journal", compact_records=1000)
+            for i in range(5):
+                store.add(make_signature(i))
+            store.add(make_signature(0))  # Дубликат — не пишется
+            store.drain()
+            test("Журнал: по строке на сигнатуру", journal_lines("sigs.journal") == 5,
+                 f"got {journal_lines('sigs.journal')}")
+
+            with open("sigs.journal", "a", encoding="utf-8") as f:
+                f.write('{"user_id": 9, "video_ha')  # Оборванная запись после падения
+            replay = SignatureStore("sigs.json", "sigs.journal")
+            replay.load()
+            test("Replay журнала без снапшота", len(replay) == 5, f"got {len(replay)}")
+            sig = make_signature(4)
+            test("Индексы после replay",
+                 replay.find_by_hash("hash4").full_signature == sig.full_signature
+                 and replay.find_by_prefix(sig.full_signature[:16]) is not None
+                 and len(replay.get_user_signatures(1)) == 2)
+
+            replay.compact()
+            test("Компактация: журнал пуст", journal_lines("sigs.journal") == 0)
+            with open("sigs.json", encoding="utf-8") as f:
+                test("Компактация: снапшот полный", len(json.load(f)) == 5)
+            reloaded = SignatureStore("sigs.json", "sigs.journal")
+            reloaded.load()
+            test("Снапшот → те же сигнатуры", set(reloaded.signatures) == set(store.signatures))
+
+            auto = SignatureStore("auto.json", "auto.journal", compact_records=3)
+            for i in range(4):
+                auto.add(make_signature(i))
+            auto.drain()
+            with open("auto.json", encoding="utf-8") as f:
+                test("Компактация по порогу записей", len(json.load(f)) == 3
+                     and journal_lines("auto.journal") == 1)
+
+            # Детектор: путь учитывается и для снапшота, и для журнала
+            detector = WatermarkTrapDetector(store=SignatureStore("sigs.json", "sigs.journal"))
+            detector.load_signatures_from_file()
+            detector.save_signatures_to_file("export.json")
+            test("Экспорт не трогает свой журнал/снапшот", journal_lines("sigs.journal") == 0
+                 and os.path.exists("export.json"))
+            other = WatermarkTrapDetector(store=SignatureStore("sigs.json", "sigs.journal"))
+            other.load_signatures_from_file("auto.json")
+            test("Чужой снапшот + его журнал", len(other.signatures_db) == 4, f"got {len(other.signatures_db)}")
+    except Exception as e:
+        test("watermark_trap store", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 7. CONTENT_PROTECTION.PY — FingerprintIndex")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from content_protection import FingerprintIndex, VideoFingerprinter, PERCEPTUAL_SEARCH_RADIUS
+
+        rng = random.Random(2026)
+        index = FingerprintIndex()
+        entries = []  # (passport_id, perceptual_hash, user_id) в порядке вставки
+        bases = [rng.getrandbits(64) for _ in range(50)]
+        for i in range(1500):
+            # Кластеры около базовых хешей — соседи на разных расстояниях
+            value = rng.choice(bases)
+            for _ in range(rng.randint(0, 24)):
+                value ^= 1 << rng.randrange(64)
+            entry = (f"p{i}", f"{value:016x}", i % 7)
+            entries.append(entry)
+            index.add(entry[0], f"file{i % 300}", entry[1], entry[2])
+
+        def brute_force(query, radius, owner_id=None, exclude_owner=0):
+            best = None
+            for passport_id, phash, user_id in entries:
+                if owner_id is not None and user_id != owner_id:
+                    continue
+                if exclude_owner and user_id == exclude_owner:
+                    continue
+                distance = round((1 - VideoFingerprinter.compare_hashes(query, phash)) * 64)
+                if distance <= radius and (best is None or distance < best[1]):
+                    best = (passport_id, distance)
+            return best
+
+        queries = []
+        for _ in range(200):
+            value = rng.choice(bases)
+            for _ in range(rng.randint(0, 30)):
+                value ^= 1 << rng.randrange(64)
+            queries.append(f"{value:016x}")
+        mismatches = [q for q in queries if index.find_nearest(q) != brute_force(q, PERCEPTUAL_SEARCH_RADIUS)]
+        test("find_nearest = перебор compare_hashes", not mismatches, f"{len(mismatches)} of {len(queries)}")
+        found = sum(1 for q in queries if index.find_nearest(q) is not None)
+        test("Запросы попадают и мимо, и в радиус", 0 < found < len(queries), f"found {found}")
+
+        # Граница радиуса: ровно radius — находится, radius + 1 — нет
+        edge = FingerprintIndex()
+        edge.add("base", "", "0" * 16, 1)
+        at_radius = f"{(1 << PERCEPTUAL_SEARCH_RADIUS) - 1:016x}"
+        past_radius = f"{(1 << (PERCEPTUAL_SEARCH_RADIUS + 1)) - 1:016x}"
+        test("Расстояние = radius — совпадение", edge.find_nearest(at_radius) == ("base", PERCEPTUAL_SEARCH_RADIUS))
+        test("Расстояние = radius + 1 — мимо", edge.find_nearest(past_radius) is None)
+
+        owner_mismatches = [q for q in queries[:50]
+                            if index.find_nearest(q, owner_id=3) != brute_force(q, PERCEPTUAL_SEARCH_RADIUS, owner_id=3)
+                            or index.find_nearest(q, exclude_owner=3) != brute_force(q, PERCEPTUAL_SEARCH_RADIUS, exclude_owner=3)]
+        test("Фильтр владельца = перебор", not owner_mismatches, f"{len(owner_mismatches)} of 50")
+        test("find_exact — первый по вставке", index.find_exact("file5") == "p5"
+             and index.find_exact("file5", exclude_owner=5) == "p305")
+
+        query = entries[10][1]
+        test("Точный хеш — расстояние 0", index.find_nearest(query)[1] == 0)
+        for passport_id, _, _ in entries[:750]:
+            index.remove(passport_id)
+        entries = entries[750:]
+        mismatches = [q for q in queries if index.find_nearest(q) != brute_force(q, PERCEPTUAL_SEARCH_RADIUS)]
+        test("После remove — снова = перебор", not mismatches and len(index) == 750,
+             f"{len(mismatches)} mismatches, {len(index)} left")
+        test("remove чистит file_hash", index.find_exact("file5") == "p905")
+    except Exception as e:
+        test("fingerprint index", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 8. TIMED_TASKS.PY — куча сроков")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        import datetime
+        from rate_limit import RateLimiter
+        from timed_tasks import TimedTaskScheduler, next_daily, task_due, REMINDER, TASK
+
+        with temp_workdir():
+            rl = RateLimiter()
+            sent, run = [], []
+
+            async def on_reminder(user_id, reminder):
+                sent.append((user_id, reminder["time"]))
+
+            async def on_task(user_id, task):
+                run.append((user_id, task["id"]))
+
+            timed = TimedTaskScheduler(rl, on_reminder, on_task, send_rate=1000)
+            rl.add_schedule_listener(timed.sync_user)
+
+            rl.add_reminder(1, "tiktok", "09:00")
+            key = (REMINDER, 1, ("tiktok", "09:00"))
+            due = timed._live.get(key)
+            test("Напоминание в куче", due == next_daily("09:00", datetime.datetime.now()))
+
+            # Изменение: старый элемент остаётся в куче, но пропускается
+            rl.get_reminders(1)[0]["time"] = "10:00"
+            rl._schedule_changed(1)
+            test("Lazy deletion: старый элемент не ищется", len(timed._heap) == 2 and len(timed._live) == 1)
+            popped = timed._pop_due(due + 2 * 86400)
+            test("Извлекается только актуальный срок", [item[3] for item in popped] == [("tiktok", "10:00")]
+                 and timed.stats["stale_skipped"] == 1, str(popped))
+
+            task_id = rl.add_scheduled_task(2, "11:30", "process")
+            rl.remove_scheduled_task(2, task_id)
+            test("Удалённая задача — не в _live", (TASK, 2, task_id) not in timed._live)
+            test("Удалённая задача не выполняется", timed._pop_due(time.time() + 2 * 86400) == [])
+
+            # Много изменений — куча не растёт без предела
+            for i in range(200):
+                rl.get_reminders(1)[0]["time"] = f"{i % 24:02d}:{i % 60:02d}"
+                rl._schedule_changed(1)
+            test("Куча компактируется", len(timed._heap) <= max(64, 2 * len(timed._live)) + 1,
+                 f"heap {len(timed._heap)}, live {len(timed._live)}")
+
+            # Ежедневное напоминание встаёт на завтра, задача — однократная
+            timed = TimedTaskScheduler(rl, on_reminder, on_task, send_rate=1000)
+            rl._schedule_listeners.clear()
+            rl.add_schedule_listener(timed.sync_user)
+            rl.get_reminders(1)[0]["time"] = "07:15"
+            rl._schedule_changed(1)
+            key = (REMINDER, 1, ("tiktok", "07:15"))
+            due = timed._live[key]
+            timed._dispatch_due(due)
+            await asyncio.gather(*timed._inflight)
+            test("Напоминание отправлено", sent == [(1, "07:15")], str(sent))
+            test("Напоминание встало на следующий день",
+                 timed._live.get(key) == next_daily("07:15", datetime.datetime.fromtimestamp(due)))
+
+            rl.add_scheduled_task(3, "12:45", "process")
+            task = rl.get_scheduled_tasks(3)[-1]
+            due = task_due(task)
+            timed._dispatch_due(due)
+            await asyncio.gather(*timed._inflight)
+            test("Задача выполнена и отмечена", run == [(3, task["id"])] and not rl.get_scheduled_tasks(3))
+            timed._dispatch_due(due + 2 * 86400)
+            await asyncio.gather(*timed._inflight)
+            test("Задача не повторяется", run == [(3, task["id"])], str(run))
+            rl.flush()
+    except Exception as e:
+        test("timed tasks", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 9. CONTENT_PROTECTION.PY — JsonPersistence")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from content_protection import JsonPersistence
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "db.json")
+            data = {"n": 0}
+            persistence = JsonPersistence(delay=0.05)
+            persistence.register(path, lambda: dict(data))
+
+            # В event loop: изменения за delay — одной записью
+            for i in range(50):
+                data["n"] = i
+                persistence.mark_dirty(path)
+            test("До таймера на диск не пишется", not os.path.exists(path))
+            await asyncio.sleep(0.3)
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            test("50 изменений — одна запись", persistence.stats["files_written"] == 1
+                 and persistence.stats["marks"] == 50, str(persistence.stats))
+            test("Записано последнее состояние", saved == {"n": 49}, str(saved))
+            test("Ссылка на задачу записи хранится", persistence._flush_task is not None
+                 and persistence._flush_task.done())
+
+            # Без event loop (скрипты, atexit) — запись сразу
+            data["n"] = 100
+            await asyncio.to_thread(persistence.mark_dirty, path)
+            with open(path, encoding="utf-8") as f:
+                test("Без event loop — flush_sync сразу", json.load(f) == {"n": 100})
+            test("flush_sync — вторая запись", persistence.stats["files_written"] == 2)
+
+            # flush_sync до таймера: таймер потом ничего не пишет повторно
+            data["n"] = 200
+            persistence.mark_dirty(path)
+            persistence.flush_sync()
+            await asyncio.sleep(0.3)
+            with open(path, encoding="utf-8") as f:
+                test("flush_sync забирает отложенное", json.load(f) == {"n": 200}
+                     and persistence.stats["files_written"] == 3, str(persistence.stats))
+            test("Временный файл не остаётся", not os.path.exists(path + ".tmp"))
+    except Exception as e:
+        test("json persistence", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 10. QUEUE_ESTIMATOR.PY — корзины и сохранение")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from queue_estimator import QueueTimeEstimator, build_features, work_units
+
+        with tempfile.TemporaryDirectory() as tmp:
+            data_file = os.path.join(tmp, "estimator.json")
+            estimator = QueueTimeEstimator(data_file, alpha=0.2, default_job_seconds=30.0,
+                                           save_interval=3600)
+            hd_fast = build_features(1280, 720, 10.0, 30.0, "high", "none", False)
+            hd_trap = build_features(1280, 720, 10.0, 30.0, "high", "none", True)
+            uhd_max = build_features(3840, 2160, 10.0, 30.0, "max", "neon", True)
+            units = work_units(hd_fast)
+
+            test("Без наблюдений — значение по умолчанию", estimator.predict(hd_fast) == 30.0)
+            estimator.record(hd_fast, units * 2.0)
+            test("Одно наблюдение — общая корзина",
+                 abs(estimator.predict(uhd_max) - 2.0 * work_units(uhd_max)) < 1e-6)
+            estimator.record(hd_fast, units * 2.0)
+            estimator.record(hd_fast, units * 2.0)
+            for _ in range(2):
+                estimator.record(hd_trap, units * 5.0)
+            # high|none|trap: 2 наблюдения < MIN_SAMPLES → high|trap тоже 2 → общая
+            general = estimator.buckets["*"]["rate"]
+            test("Мало наблюдений в точной корзине — общая",
+                 abs(estimator.predict(hd_trap) - general * units) < 1e-6)
+            estimator.record(hd_trap, units * 5.0)
+            test("Точная корзина после MIN_SAMPLES",
+                 abs(estimator.predict(hd_trap) - 5.0 * units) < 1e-6)
+            test("Соседняя корзина не смешивается",
+                 abs(estimator.predict(hd_fast) - 2.0 * units) < 1e-6)
+            test("predict(None) — EWMA длительности задачи",
+                 estimator.predict(None) == estimator.job_seconds)
+
+            test("record не пишет на диск чаще save_interval", not os.path.exists(data_file))
+            estimator.flush()
+            reloaded = QueueTimeEstimator(data_file)
+            test("flush + загрузка — те же оценки",
+                 abs(reloaded.predict(hd_trap) - estimator.predict(hd_trap)) < 1e-6
+                 and reloaded.buckets == estimator.buckets)
+
+            frequent = QueueTimeEstimator(data_file + ".2", save_interval=0)
+            frequent.record(hd_fast, 1.0)
+            test("save_interval=0 — запись сразу", os.path.exists(data_file + ".2"))
+    except Exception as e:
+        test("queue estimator", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 11. FFMPEG_UTILS.PY — план склейки")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        import struct
+        from ffmpeg_utils import MediaInfo, plan_merge, _read_avcc, _extradata_differs
+
+        def clip(duration, width=1080, height=1920, fps=30.0, codec="h264", pix_fmt="yuv420p",
+                 profile="High", audio="aac", sample_rate=44100, channels=2):
+            streams = [{"codec_type": "video", "pix_fmt": pix_fmt, "time_base": "1/15360",
+                        "profile": profile, "level": 40}]
+            if audio:
+                streams.append({"codec_type": "audio", "sample_rate": str(sample_rate),
+                                "channels": channels})
+            return MediaInfo(path=f"clip{duration}.mp4", width=width, height=height, fps=fps,
+                             duration=duration, has_video=True, has_audio=bool(audio),
+                             video_codec=codec, audio_codec=audio or "", streams=streams)
+
+        plan = plan_merge([clip(10), clip(8), clip(5)])
+        test("Одинаковые клипы — copy", plan.strategy == "copy"
+             and not plan.reencode_video and not plan.reencode_audio)
+
+        plan = plan_merge([clip(10), clip(10), clip(2, width=720, height=1280)])
+        test("Один короткий отличается — normalize", plan.strategy == "normalize"
+             and plan.reencode_video == [2], f"{plan.strategy} {plan.reencode_video}")
+        test("Целевой формат — формат большинства", (plan.video.width, plan.video.height) == (1080, 1920))
+
+        plan = plan_merge([clip(10), clip(10, width=720, height=1280), clip(10, fps=60.0)])
+        test("Перекодировать большую часть — filter", plan.strategy == "filter"
+             and len(plan.reencode_video) == 2, f"{plan.strategy} {plan.reencode_video}")
+
+        plan = plan_merge([clip(10), clip(10), clip(2, sample_rate=48000)])
+        test("Отличается только звук — normalize без видео", plan.strategy == "normalize"
+             and plan.reencode_audio == [2] and not plan.reencode_video and plan.normalize_cost == 0)
+        plan = plan_merge([clip(10), clip(10), clip(2, audio=None)])
+        test("Клип без звука — тишина при normalize", plan.strategy == "normalize"
+             and plan.reencode_audio == [2])
+
+        for name, kwargs in (("HEVC", {"codec": "hevc"}), ("High 10", {"profile": "High 10"}),
+                             ("yuv422p", {"pix_fmt": "yuv422p"}), ("mp3", {"audio": "mp3"})):
+            plan = plan_merge([clip(10, **kwargs), clip(10, **kwargs), clip(2, width=720, height=1280)])
+            test(f"Целевой {name} не кодируем в libx264/aac — filter", plan.strategy == "filter",
+                 plan.strategy)
+
+        plan = plan_merge([clip(10, profile="Main"), clip(10, profile="Main"), clip(2, profile="High")])
+        test("Другой profile — клип перекодируется", plan.reencode_video == [2]
+             and plan.video.profile == "Main")
+
+        # avcC: сверяется по содержимому moov
+        def mp4_with_avcc(path, payload):
+            avcc = struct.pack('>I4s', 8 + len(payload), b'avcC') + payload
+            moov = struct.pack('>I4s', 8 + len(avcc), b'moov') + avcc
+            with open(path, "wb") as f:
+                f.write(struct.pack('>I4s', 16, b'ftyp') + b'isom\0\0\0\0' + moov)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            first, second, third = (os.path.join(tmp, f"{n}.mp4") for n in "abc")
+            mp4_with_avcc(first, b"\x01\x64\x00\x28sps-pps-a")
+            mp4_with_avcc(second, b"\x01\x64\x00\x28sps-pps-a")
+            mp4_with_avcc(third, b"\x01\x4d\x00\x1fsps-pps-b")
+            test("_read_avcc читает avcC", _read_avcc(first) == b"\x01\x64\x00\x28sps-pps-a")
+            raw = os.path.join(tmp, "raw.ts")
+            with open(raw, "wb") as f:
+                f.write(b"\x47" * 188)
+            test("Не MP4 — None", _read_avcc(raw) is None)
+            test("Одинаковый avcC — copy можно", not await _extradata_differs([first, second]))
+            test("Разный avcC — нельзя", await _extradata_differs([first, third]))
+            test("avcC есть не у всех — нельзя", await _extradata_differs([first, raw]))
+    except Exception as e:
+        test("merge plan", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 12. FFMPEG_UTILS.PY — потолок битрейта под лимит размера")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from ffmpeg_utils import (plan_rate_control, record_rate_control, rate_control_stats,
+                                  _resolution_bucket)
+        from config import RATE_CONTROL_MIN_VIDEO_KBPS, RATE_CONTROL_FALLBACK_AUDIO
+
+        limit = 50 * 1024 * 1024
+        params = {"preset": "test-rc", "bitrate": "8000k", "audio_bitrate": "192k", "crf": 20}
+        key = f"test-rc@{_resolution_bucket(1080, 1920)}"
+        rate_control_stats.pop(key, None)
+
+        planned, plan = plan_rate_control(params, 15.0, 1080, 1920, True, max_bytes=limit)
+        test("Короткое видео — без потолка", not plan.capped and planned == params)
+
+        planned, plan = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        test("Длинное видео — maxrate опущен", plan.capped and planned["bitrate"] == f"{plan.video_kbps}k"
+             and plan.video_kbps < 8000, planned["bitrate"])
+        test("План укладывается в лимит", plan.target_bytes <= limit, f"{plan.target_bytes} > {limit}")
+        test("CRF и исходные params не тронуты", planned["crf"] == 20 and params["bitrate"] == "8000k")
+
+        planned, plan = plan_rate_control(params, 1200.0, 1080, 1920, True, max_bytes=limit)
+        test("Очень длинное — сначала ужат звук", planned["audio_bitrate"] == RATE_CONTROL_FALLBACK_AUDIO)
+        planned, plan = plan_rate_control(params, 3600.0, 1080, 1920, True, max_bytes=limit)
+        test("Нижняя граница видео", plan.video_kbps == RATE_CONTROL_MIN_VIDEO_KBPS)
+        _, silent = plan_rate_control(params, 120.0, 1080, 1920, False, max_bytes=limit)
+        _, loud = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        test("Без звука — больше бюджета видео", silent.video_kbps > loud.video_kbps)
+
+        # Пресет систематически промахивается — следующий план с запасом
+        _, before = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        record_rate_control(plan_rate_control(params, 15.0, 1080, 1920, True, max_bytes=limit)[1],
+                            limit, max_bytes=limit)
+        test("Без потолка — замер не учитывается", key not in rate_control_stats)
+        for _ in range(2):
+            record_rate_control(before, int(before.target_bytes * 1.2), max_bytes=limit)
+        _, still = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        test("Меньше 3 замеров — без поправки", still.video_kbps == before.video_kbps)
+        record_rate_control(before, int(before.target_bytes * 1.2), max_bytes=limit)
+        _, after = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        test("Промахи → потолок ниже", after.video_kbps < before.video_kbps,
+             f"{after.video_kbps} >= {before.video_kbps}")
+        for _ in range(3):
+            record_rate_control(after, int(after.target_bytes * 0.5), max_bytes=limit)
+        _, under = plan_rate_control(params, 120.0, 1080, 1920, True, max_bytes=limit)
+        test("Недолёт не поднимает потолок выше плана", under.video_kbps <= before.video_kbps)
+        rate_control_stats.pop(key, None)
+    except Exception as e:
+        test("rate control", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n📦 13. SEGMENT-PARALLEL ENCODING")
+    # ══════════════════════════════════════════════════════════════
+    try:
+        from config import FFMPEG_PATH
+        from ffmpeg_utils import (
+            encode_segmented, _process_encoder_args, _build_segment_variation,
+        )
+
+        params = {"preset": "ultrafast", "bitrate": "800k", "gop": 30,
+                  "audio_bitrate": "64k", "crf": 23}
+
+        # Буфер VBV делится между сегментами — суммарный выброс как у одного процесса
+        single_args = _process_encoder_args(params, 320, 240)
+        split_args = _process_encoder_args(params, 320, 240, segments=4)
+        test("bufsize одного процесса = 2 × maxrate",
+             single_args[single_args.index("-bufsize") + 1] == "1600k")
+        test("bufsize сегмента = буфер / число сегментов",
+             split_args[split_args.index("-bufsize") + 1] == "400k",
+             str(split_args[split_args.index("-bufsize") + 1]))
+
+        if shutil.which(FFMPEG_PATH) is None:
+            print("  ⏭️  FFmpeg не найден — проверка стыков пропущена")
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                src = os.path.join(tmp, "src.mp4")
+                await ffmpeg_run(
+                    "-y", "-f", "lavfi", "-i", "testsrc2=s=320x240:r=30:d=8",
+                    "-f", "lavfi", "-i", "sine=f=440:r=44100:d=8",
+                    # veryfast — с B-кадрами, как у реальных входов
+                    "-c:v", "libx264", "-preset", "veryfast", "-g", "30",
+                    "-c:a", "aac", "-pix_fmt", "yuv420p", src
+                )
+
+                # Граф, зависящий от t: яркость меняется на границах _build_segment_variation.
+                # Если время графа в сегменте начнётся с нуля — ступени яркости съедут
+                random.seed(2026)
+                variation = _build_segment_variation(8.0)
+                steps = [
+                    f"eq=brightness={0.25 if i % 2 else -0.25}:"
+                    f"enable='between(t,{seg['start']:.3f},{seg['end']:.3f})'"
+                    for i, seg in enumerate(variation)
+                ]
+                video_filter = ",".join(steps + ["format=yuv420p"])
+
+                single = os.path.join(tmp, "single.mp4")
+                await ffmpeg_run("-y", "-i", src, "-vf", video_filter, "-af", "anull",
+                                 *(single_args + [single]))
+                segmented = os.path.join(tmp, "segmented.mp4")
+                result = await encode_segmented(
+                    src, segmented, video_filter, "anull", params, 320, 240,
+                    True, 8.0, 30, 4
+                )
+                test("encode_segmented разрезал и закодировал", result is True, f"got {result}")
+
+                luma_single = await frame_luma(single)
+                luma_segmented = await frame_luma(segmented)
+                test("Число кадров совпадает", len(luma_single) == len(luma_segmented) > 0,
+                     f"{len(luma_single)} vs {len(luma_segmented)}")
+
+                # Чувствительность: ступень яркости на границе вариации заметна
+                boundary = int(variation[1]["start"] * 30)
+                jump = (abs(luma_single[boundary + 2] - luma_single[boundary - 2])
+                        if boundary + 2 < len(luma_single) else 0)
+                test("Ступень яркости на границе вариации", jump > 20, f"jump={jump:.1f}")
+
+                diffs = [abs(a - b) for a, b in zip(luma_single, luma_segmented)]
+                worst = max(range(len(diffs)), key=diffs.__getitem__) if diffs else 0
+                test("Вариации непрерывны через стыки сегментов",
+                     bool(diffs) and diffs[worst] < 3.0,
+                     f"max |ΔYAVG|={diffs[worst] if diffs else 0:.2f} at frame {worst}")
+    except Exception as e:
+        test("segment encoding", False, f"{type(e).__name__}: {e}")
+
+    # ══════════════════════════════════════════════════════════════
+    print("\n" + "=" * 60)
+    print(f"📊 ИТОГО: {passed} ✅ passed, {failed} ❌ failed")
+    print("=" * 60)
+
+    if errors:
+        print("\n❌ ОШИБКИ:")
+        for e in errors:
+            print(f"   • {e}")
+    else:
+        print("\n🎉 ВСЕ ТЕСТЫ ПРОЙДЕНЫ!")
+
+    return failed == 0
+
+if __name__ == "__main__":
+    success = asyncio.run(run_tests())
+    sys.exit(0 if success else 1)
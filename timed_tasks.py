@@ -0,0 +1,282 @@
+"""
+Virex — Timed Tasks v3.4.0
+
+Исполнение напоминаний (/reminder) и отложенных задач (/schedule):
+- Одна глобальная min-куча (due, seq, kind, user_id, key) на весь бот —
+  следующий срок за O(1), вставка/извлечение за O(log n), пользователи
+  не перебираются
+- Куча строится из хранилища при старте (rebuild), дальше RateLimiter
+  сообщает об изменениях через listener → sync_user(user_id)
+- Удалённые/изменённые записи не ищутся в куче: _live хранит актуальный
+  срок, устаревшие элементы пропускаются при извлечении (lazy deletion)
+- Напоминания — ежедневные (HH:MM), после срабатывания встают на завтра
+- Задачи — однократные: ближайшее HH:MM после создания; пропущенные,
+  пока бот был выключен, выполняются сразу после старта
+- Отправка в Telegram — через SendRateLimiter (не больше TIMED_SEND_RATE/с)
+"""
+import time
+import heapq
+import asyncio
+import datetime
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from config import TIMED_SEND_RATE, TIMED_MAX_SLEEP_SECONDS
+
+REMINDER = "reminder"
+TASK = "task"
+
+# (kind, user_id, key): key напоминания — (platform, time), задачи — id
+EntryKey = Tuple[str, int, object]
+
+
+def parse_hhmm(time_str: str) -> Optional[Tuple[int, int]]:
+    """ "HH:MM" → (час, минута) или None """
+    try:
+        hour, minute = (int(part) for part in str(time_str).split(":"))
+    except (TypeError, ValueError):
+        return None
+    if 0 <= hour < 24 and 0 <= minute < 60:
+        return hour, minute
+    return None
+
+
+def next_daily(time_str: str, after: datetime.datetime) -> Optional[float]:
+    """ Ближайшее HH:MM строго после after (локальное время), timestamp """
+    parsed = parse_hhmm(time_str)
+    if parsed is None:
+        return None
+    due = after.replace(hour=parsed[0], minute=parsed[1], second=0, microsecond=0)
+    if due <= after:
+        due += datetime.timedelta(days=1)
+    return due.timestamp()
+
+
+def task_due(task: dict) -> Optional[float]:
+    """ Срок однократной задачи: ближайшее task["time"] после task["created"] """
+    try:
+        created = datetime.datetime.fromisoformat(task.get("created", ""))
+    except (TypeError, ValueError):
+        created = datetime.datetime.now()
+    return next_daily(task.get("time", ""), created)
+
+
+class SendRateLimiter:
+    """ Равномерный темп отправки: не чаще rate сообщений в секунду """
+
+    def __init__(self, rate: float = TIMED_SEND_RATE):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+
+    async def wait(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class TimedTaskScheduler:
+    """ Min-куча сроков напоминаний и задач всех пользователей """
+
+    def __init__(self, rate_limiter,
+                 on_reminder: Callable[[int, dict], Awaitable[None]],
+                 on_task: Callable[[int, dict], Awaitable[None]],
+                 send_rate: float = TIMED_SEND_RATE):
+        self.rate_limiter = rate_limiter
+        self.on_reminder = on_reminder
+        self.on_task = on_task
+        self.sender = SendRateLimiter(send_rate)
+        self._heap: List[Tuple[float, int, str, int, object]] = []
+        self._live: Dict[EntryKey, float] = {}
+        self._by_user: Dict[int, Set[EntryKey]] = {}
+        self._seq = 0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._runner: Optional[asyncio.Task] = None
+        self._rebuilding = False
+        self._synced_during_rebuild: Set[int] = set()
+        self._inflight: Set[asyncio.Task] = set()
+        self.stats = {"reminders_sent": 0, "tasks_run": 0, "errors": 0, "stale_skipped": 0}
+
+    # ═════════════════════════════════════════════════════════════
+    # HEAP
+    # ═════════════════════════════════════════════════════════════
+
+    def _push(self, due: float, kind: str, user_id: int, key):
+        entry_key = (kind, user_id, key)
+        if self._live.get(entry_key) == due:
+            return
+        self._live[entry_key] = due
+        self._by_user.setdefault(user_id, set()).add(entry_key)
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, kind, user_id, key))
+        if self._heap[0][1] == self._seq and self._wakeup is not None:
+            self._wakeup.set()  # Новый ближайший срок — пересчитать сон
+
+    def _drop(self, entry_key: EntryKey):
+        self._live.pop(entry_key, None)
+        keys = self._by_user.get(entry_key[1])
+        if keys is not None:
+            keys.discard(entry_key)
+            if not keys:
+                del self._by_user[entry_key[1]]
+
+    def _maybe_compact(self):
+        # Устаревших элементов больше, чем живых — пересобрать кучу
+        if len(self._heap) > 64 and len(self._heap) > 2 * len(self._live):
+            self._heap = [item for item in self._heap
+                          if self._live.get((item[2], item[3], item[4])) == item[0]]
+            heapq.heapify(self._heap)
+
+    def _entries_for(self, user_id: int, reminders: Iterable[dict], tasks: Iterable[dict],
+                     now: datetime.datetime) -> Dict[EntryKey, float]:
+        wanted = {}
+        for reminder in reminders:
+            if not reminder.get("enabled", True):
+                continue
+            time_str = reminder.get("time", "")
+            due = next_daily(time_str, now)
+            if due is not None:
+                wanted[(REMINDER, user_id, (reminder.get("platform", ""), time_str))] = due
+        for task in tasks:
+            if task.get("executed"):
+                continue
+            due = task_due(task)
+            if due is not None:
+                wanted[(TASK, user_id, task.get("id"))] = due
+        return wanted
+
+    def _apply_user(self, user_id: int, reminders, tasks):
+        wanted = self._entries_for(user_id, reminders, tasks, datetime.datetime.now())
+        for entry_key in list(self._by_user.get(user_id, ())):
+            if entry_key not in wanted:
+                self._drop(entry_key)
+        for entry_key, due in wanted.items():
+            # Уже стоящее в куче напоминание не сдвигаем (его срок мог наступить)
+            if entry_key[0] == REMINDER and entry_key in self._live:
+                continue
+            self._push(due, *entry_key)
+        self._maybe_compact()
+
+    # ═════════════════════════════════════════════════════════════
+    # STORE SYNC
+    # ═════════════════════════════════════════════════════════════
+
+    def sync_user(self, user_id: int):
+        """ Listener RateLimiter: записи пользователя изменились """
+        if self._rebuilding:
+            self._synced_during_rebuild.add(user_id)
+        reminders = self.rate_limiter.get_reminders(user_id)
+        tasks = self.rate_limiter.get_scheduled_tasks(user_id)
+        self._apply_user(user_id, reminders, tasks)
+
+    async def rebuild(self):
+        """ Построить кучу из хранилища (один проход в потоке при старте) """
+        self._rebuilding = True
+        self._synced_during_rebuild.clear()
+        try:
+            entries = await asyncio.to_thread(lambda: list(self.rate_limiter.iter_timed_entries()))
+            for user_id, reminders, tasks in entries:
+                # Пользователь успел что-то поменять — его записи уже актуальны
+                if user_id not in self._synced_during_rebuild:
+                    self._apply_user(user_id, reminders, tasks)
+        finally:
+            self._rebuilding = False
+        print(f"[TIMED] Loaded {len(self._live)} entries for {len(self._by_user)} users")
+
+    # ═════════════════════════════════════════════════════════════
+    # DISPATCH
+    # ═════════════════════════════════════════════════════════════
+
+    def _pop_due(self, now: float) -> List[Tuple[float, str, int, object]]:
+        due_items = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, kind, user_id, key = heapq.heappop(self._heap)
+            entry_key = (kind, user_id, key)
+            if self._live.get(entry_key) != due:
+                self.stats["stale_skipped"] += 1
+                continue
+            self._drop(entry_key)
+            due_items.append((due, kind, user_id, key))
+        return due_items
+
+    def _dispatch_due(self, now: float):
+        for due, kind, user_id, key in self._pop_due(now):
+            if kind == REMINDER:
+                platform, time_str = key
+                # Ежедневное — сразу следующий срок
+                next_due = next_daily(time_str, datetime.datetime.fromtimestamp(max(now, due)))
+                if next_due is not None:
+                    self._push(next_due, kind, user_id, key)
+                reminder = {"platform": platform, "time": time_str, "enabled": True}
+                coro = self._fire_reminder(user_id, reminder)
+            else:
+                task = next((t for t in self.rate_limiter.get_scheduled_tasks(user_id)
+                             if t.get("id") == key), None)
+                if task is None:
+                    continue
+                # Отметить до запуска: после падения задача не повторится
+                self.rate_limiter.mark_task_executed(user_id, key)
+                coro = self._fire_task(user_id, task)
+            job = asyncio.create_task(coro)
+            self._inflight.add(job)
+            job.add_done_callback(self._inflight.discard)
+
+    async def _fire_reminder(self, user_id: int, reminder: dict):
+        try:
+            await self.sender.wait()
+            await self.on_reminder(user_id, reminder)
+            self.stats["reminders_sent"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[TIMED] Reminder for {user_id} failed: {e}")
+
+    async def _fire_task(self, user_id: int, task: dict):
+        try:
+            await self.on_task(user_id, task)
+            self.stats["tasks_run"] += 1
+        except Exception as e:
+            self.stats["errors"] += 1
+            print(f"[TIMED] Task {task.get('id')} for {user_id} failed: {e}")
+
+    async def run(self):
+        """ Цикл: спать до ближайшего срока, выполнить наступившие """
+        self._wakeup = asyncio.Event()
+        while True:
+            self._dispatch_due(time.time())
+            delay = TIMED_MAX_SLEEP_SECONDS
+            if self._heap:
+                delay = min(delay, max(0.0, self._heap[0][0] - time.time()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    async def start(self):
+        """ Подписаться на изменения, построить кучу, запустить цикл """
+        self.rate_limiter.add_schedule_listener(self.sync_user)
+        await self.rebuild()
+        if self._runner is None:
+            self._runner = asyncio.create_task(self.run())
+
+    def get_stats(self) -> dict:
+        stats = dict(self.stats)
+        stats["pending"] = len(self._live)
+        stats["heap_size"] = len(self._heap)
+        if self._heap:
+            stats["next_due_in"] = round(max(0.0, self._heap[0][0] - time.time()), 1)
+        return stats
+
+
+# Singleton
+_timed_scheduler: Optional[TimedTaskScheduler] = None
+
+
+def get_timed_scheduler(rate_limiter=None, on_reminder=None, on_task=None) -> TimedTaskScheduler:
+    global _timed_scheduler
+    if _timed_scheduler is None:
+        if rate_limiter is None:
+            raise RuntimeError("TimedTaskScheduler is not initialized")
+        _timed_scheduler = TimedTaskScheduler(rate_limiter, on_reminder, on_task)
+    return _timed_scheduler
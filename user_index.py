@@ -0,0 +1,167 @@
+"""
+Virex — Secondary User Indexes v3.4.0
+
+Вторичные индексы поверх RateLimiter.users, чтобы запросы не сканировали всех:
+- ip → {user_id}, fingerprint → {user_id}, username (lower) → {user_id}
+- plan → {user_id}, banned → {user_id}
+- plan_expires → отсортированный список (дата, user_id)
+- рейтинги по points и total_videos — отсортированные списки (топ-N без сортировки)
+
+Обновление: UserIndex.update(user) сравнивает снимок индексируемых полей
+с прошлым и правит только изменившиеся записи.
+"""
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, List, Optional, Set, Tuple
+
+
+class RankedIndex:
+    """ Отсортированный список (-score, user_id): топ-N за O(N) """
+
+    def __init__(self):
+        self._items: List[Tuple[int, int]] = []
+        self._scores: Dict[int, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def set(self, user_id: int, score: int):
+        old = self._scores.get(user_id)
+        if old == score:
+            return
+        if old is not None:
+            self._discard(old, user_id)
+        self._scores[user_id] = score
+        insort(self._items, (-score, user_id))
+
+    def remove(self, user_id: int):
+        old = self._scores.pop(user_id, None)
+        if old is not None:
+            self._discard(old, user_id)
+
+    def _discard(self, score: int, user_id: int):
+        pos = bisect_left(self._items, (-score, user_id))
+        if pos < len(self._items) and self._items[pos] == (-score, user_id):
+            del self._items[pos]
+
+    def top(self, limit: int, min_score: Optional[int] = None) -> List[Tuple[int, int]]:
+        """[(user_id, score)] по убыванию score"""
+        items = self._items[:limit]
+        if min_score is not None:
+            # Элементы с score >= min_score идут префиксом
+            items = items[:bisect_right(self._items, (-min_score, float("inf")), 0, len(items))]
+        return [(uid, -neg) for neg, uid in items]
+
+
+def _snapshot(user) -> tuple:
+    return (
+        tuple(getattr(user, 'ip_history', None) or ()),
+        getattr(user, 'device_fingerprint', '') or '',
+        (user.username or '').lower(),
+        user.plan,
+        user.plan_expires or '',
+        user.banned,
+        getattr(user, 'points', 0),
+        user.total_videos,
+    )
+
+
+class UserIndex:
+    """ Вторичные индексы пользователей """
+
+    def __init__(self):
+        self.by_ip: Dict[str, Set[int]] = {}
+        self.by_fingerprint: Dict[str, Set[int]] = {}
+        self.by_username: Dict[str, Set[int]] = {}
+        self.by_plan: Dict[str, Set[int]] = {}
+        self.banned: Set[int] = set()
+        self.expiry: List[Tuple[str, int]] = []   # (ISO дата, user_id), отсортировано
+        self.points = RankedIndex()
+        self.videos = RankedIndex()
+        self._indexed: Dict[int, tuple] = {}
+
+    # ═════════════════════════════════════════════════════════════
+    # MAINTENANCE
+    # ═════════════════════════════════════════════════════════════
+
+    @staticmethod
+    def _add(mapping: Dict[str, Set[int]], key: str, user_id: int):
+        if key:
+            mapping.setdefault(key, set()).add(user_id)
+
+    @staticmethod
+    def _discard(mapping: Dict[str, Set[int]], key: str, user_id: int):
+        bucket = mapping.get(key)
+        if bucket is not None:
+            bucket.discard(user_id)
+            if not bucket:
+                del mapping[key]
+
+    def update(self, user):
+        """Привести индексы в соответствие с текущим состоянием пользователя"""
+        uid = user.user_id
+        new = _snapshot(user)
+        old = self._indexed.get(uid)
+        if old == new:
+            return
+        self._indexed[uid] = new
+        old_ips, old_fp, old_name, old_plan, old_exp, old_banned, _, _ = old or ((), '', '', None, '', False, 0, 0)
+        ips, fp, name, plan, expires, banned, points, videos = new
+
+        if old_ips != ips:
+            for ip in set(old_ips) - set(ips):
+                self._discard(self.by_ip, ip, uid)
+            for ip in ips:
+                self._add(self.by_ip, ip, uid)
+        if old_fp != fp:
+            self._discard(self.by_fingerprint, old_fp, uid)
+            self._add(self.by_fingerprint, fp, uid)
+        if old_name != name:
+            self._discard(self.by_username, old_name, uid)
+            self._add(self.by_username, name, uid)
+        if old_plan != plan:
+            self._discard(self.by_plan, old_plan, uid)
+            self._add(self.by_plan, plan, uid)
+        if old_banned != banned:
+            (self.banned.add if banned else self.banned.discard)(uid)
+
+        old_key = (old_exp, uid) if old is not None and old_plan != "free" and old_exp else None
+        new_key = (expires, uid) if plan != "free" and expires else None
+        if old_key != new_key:
+            if old_key:
+                pos = bisect_left(self.expiry, old_key)
+                if pos < len(self.expiry) and self.expiry[pos] == old_key:
+                    del self.expiry[pos]
+            if new_key:
+                insort(self.expiry, new_key)
+
+        self.points.set(uid, points)
+        self.videos.set(uid, videos)
+
+    def rebuild(self, users):
+        self.__init__()
+        for user in users:
+            self.update(user)
+
+    # ═════════════════════════════════════════════════════════════
+    # QUERIES
+    # ═════════════════════════════════════════════════════════════
+
+    def users_by_ip(self, ip: str) -> Set[int]:
+        return self.by_ip.get(ip, set())
+
+    def users_by_fingerprint(self, fingerprint: str) -> Set[int]:
+        return self.by_fingerprint.get(fingerprint, set())
+
+    def plan_counts(self) -> Dict[str, int]:
+        """plan → количество пользователей"""
+        return {plan: len(bucket) for plan, bucket in self.by_plan.items()}
+
+    def find_username(self, username: str) -> Optional[int]:
+        bucket = self.by_username.get(username.lower())
+        return min(bucket) if bucket else None
+
+    def expiring_between(self, start_iso: str, end_iso: str) -> List[Tuple[str, int]]:
+        """Записи с start_iso < дата <= end_iso"""
+        lo = bisect_right(self.expiry, (start_iso, float("inf")))
+        hi = bisect_right(self.expiry, (end_iso, float("inf")))
+        return self.expiry[lo:hi]
@@ -0,0 +1,224 @@
+"""
+Virex — Incremental User Store v3.4.0
+
+Хранилище пользователей без полной перезаписи файла:
+- users_data.json — снапшот (тот же формат, что и раньше)
+- users_data.journal — append-only журнал (JSON lines), одна строка на изменённого пользователя
+- При загрузке: снапшот + проигрывание журнала
+- Компактация: журнал сворачивается в снапшот (атомарно через os.replace)
+- Фоновая запись: append и компактация уходят в однопоточный executor
+  (порядок сохраняется, event loop не ждёт диск)
+- Журнал общий у бота и API сервера: append и компактация — под flock
+  на users_data.journal.lock, компактация не теряет чужие строки
+- В памяти держим только 16-байтный дайджест записи, а не её JSON
+- Дайджест считается сохранённым только после успешного append; при
+  ошибке записи uid попадает в pop_failed() и пишется повторно
+"""
+import os
+import json
+import hashlib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows — один процесс, блокировка не нужна
+    fcntl = None
+
+from config import USERS_JOURNAL_FILE, USERS_JOURNAL_COMPACT_RECORDS
+
+
+def _digest(encoded: str) -> bytes:
+    return hashlib.blake2b(encoded.encode('utf-8'), digest_size=16).digest()
+
+
+class UserStore:
+    """ Снапшот + журнал. Пишет только изменившиеся записи """
+
+    def __init__(self, data_file: str = "users_data.json",
+                 journal_file: str = USERS_JOURNAL_FILE,
+                 compact_records: int = USERS_JOURNAL_COMPACT_RECORDS):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.compact_records = compact_records
+        # uid -> дайджест записи (как последний раз записана на диск)
+        self._persisted: Dict[str, bytes] = {}
+        # uid -> дайджест, отправленный в фоновый append, но ещё не записанный
+        self._queued: Dict[str, bytes] = {}
+        # uid, чей append упал — владелец стора должен записать их заново
+        self._failed: Set[str] = set()
+        self.last_error: Optional[str] = None
+        self._lock = threading.Lock()
+        self._journal_records = 0
+        self.lock_file = journal_file + ".lock"
+        # Один поток — записи и компактация строго в порядке отправки
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="user-store")
+        self._pending = None
+
+    @contextmanager
+    def _file_lock(self):
+        """ Межпроцессная блокировка журнала (бот и API сервер пишут в один файл) """
+        if fcntl is None:
+            yield
+            return
+        with open(self.lock_file, 'a') as lock:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+    # ═════════════════════════════════════════════════════════════
+    # LOAD
+    # ═════════════════════════════════════════════════════════════
+
+    def load(self) -> Dict[str, dict]:
+        """ Загрузить снапшот и проиграть журнал поверх него """
+        records, self._journal_records = self._read_disk()
+        self._persisted = {
+            uid: _digest(json.dumps(rec, ensure_ascii=False, sort_keys=True))
+            for uid, rec in records.items()
+        }
+        if self._journal_records:
+            print(f"[STORE] Replayed {self._journal_records} journal records")
+        return records
+
+    def _read_disk(self) -> Tuple[Dict[str, dict], int]:
+        records: Dict[str, dict] = {}
+
+        if os.path.exists(self.data_file):
+            with open(self.data_file, 'r', encoding='utf-8') as f:
+                records.update(json.load(f))
+
+        journal_records = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка после падения — пропускаем
+                        print("[STORE] Skipping broken journal line")
+                        continue
+                    records[str(entry["u"])] = entry["d"]
+                    journal_records += 1
+        return records, journal_records
+
+    # ═════════════════════════════════════════════════════════════
+    # WRITE
+    # ═════════════════════════════════════════════════════════════
+
+    def write(self, records: Iterable[Tuple[str, dict]], background: bool = False) -> int:
+        """
+        Дописать в журнал только те записи, что отличаются от сохранённых.
+        background=True — сам append выполняется в фоновом потоке
+        (сериализация и diff — в вызывающем, чтобы снимок был консистентным).
+        Возвращает количество отправленных на запись пользователей.
+        Синхронная запись при ошибке диска бросает OSError; ошибки фоновой
+        записи — в pop_failed() / last_error.
+        """
+        lines = []
+        changed = {}
+        with self._lock:
+            for uid, rec in records:
+                uid = str(uid)
+                encoded = json.dumps(rec, ensure_ascii=False, sort_keys=True)
+                digest = _digest(encoded)
+                if self._queued.get(uid, self._persisted.get(uid)) == digest:
+                    continue
+                changed[uid] = digest
+                lines.append('{"u": "%s", "d": %s}\n' % (uid, encoded))
+            if not lines:
+                return 0
+            self._queued.update(changed)
+
+        if background:
+            self._pending = self._executor.submit(self._append, lines, changed)
+        else:
+            self.drain()
+            if not self._append(lines, changed):
+                raise OSError(self.last_error)
+
+        self._journal_records += len(lines)
+
+        if self._journal_records >= self.compact_records:
+            if background:
+                self._submit_compact()
+            else:
+                self.compact()
+        return len(lines)
+
+    def _append(self, lines: List[str], changed: Dict[str, bytes]) -> bool:
+        error = None
+        try:
+            with self._file_lock(), open(self.journal_file, 'a', encoding='utf-8') as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            error = e
+        with self._lock:
+            for uid, digest in changed.items():
+                # Более новый дайджест того же uid уже в очереди — не трогаем
+                if self._queued.get(uid) == digest:
+                    del self._queued[uid]
+            if error is None:
+                self._persisted.update(changed)
+            else:
+                self._failed.update(changed)
+                self.last_error = str(error)
+        if error is not None:
+            print(f"[STORE] Journal write error ({len(changed)} users kept dirty): {error}")
+            return False
+        return True
+
+    def pop_failed(self) -> Set[str]:
+        """ uid, чья запись в журнал не удалась (набор очищается) """
+        with self._lock:
+            failed, self._failed = self._failed, set()
+        return failed
+
+    def drain(self):
+        """ Дождаться фоновых записей """
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+    def _compact(self):
+        # Поток стора: все ранее отправленные строки уже в журнале. Под flock —
+        # строки, дописанные другим процессом, попадают в снапшот, а не теряются
+        try:
+            with self._file_lock():
+                data, journal_records = self._read_disk()
+                tmp_file = self.data_file + ".tmp"
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_file, self.data_file)
+                # Журнал обнуляем только после успешной замены снапшота
+                open(self.journal_file, 'w').close()
+            print(f"[STORE] Compacted {journal_records} journal records, {len(data)} users")
+        except OSError as e:
+            print(f"[STORE] Compaction error: {e}")
+
+    def _submit_compact(self):
+        self._journal_records = 0
+        self._pending = self._executor.submit(self._compact)
+
+    def compact(self, wait: bool = True):
+        """ Свернуть журнал в снапшот users_data.json (wait=False — в фоне) """
+        if not self._journal_records and os.path.exists(self.data_file):
+            return
+        self._submit_compact()
+        if wait:
+            self.drain()
+
+    @property
+    def journal_size(self) -> int:
+        return self._journal_records
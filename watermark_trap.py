@@ -25,9 +25,10 @@ import json
 import time
 import struct
 import random
-import asyncio
+import threading
 import subprocess
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Dict, Any, Tuple, List
 from dataclasses import dataclass, field, asdict
 from datetime import datetime
@@ -668,6 +669,188 @@ class WatermarkTrapProcessor:
         }
 
 
+# ══════════════════════════════════════════════════════════════════════════════
+# STORAGE: Persistent signatures database
+# ══════════════════════════════════════════════════════════════════════════════
+
+SIGNATURES_FILE = "watermark_signatures.json"
+# v3.4.0: Append-only журнал новых сигнатур (JSON lines), сворачивается в SIGNATURES_FILE
+SIGNATURES_JOURNAL_FILE = "watermark_signatures.journal"
+SIGNATURES_COMPACT_RECORDS = 2000
+SIGNATURE_PREFIX_LEN = 16  # Столько символов сигнатуры пишет GhostMetadata в comment
+
+
+class SignatureStore:
+    """
+    v3.4.0: БД сигнатур с индексами и журналом
+    
+    - signatures: полная сигнатура → TrapSignature
+    - Индексы: префикс (16 символов) → сигнатура, video_hash → сигнатуры,
+      user_id → сигнатуры — поиск при детекте без перебора
+    - add(): одна строка в журнал в фоновом потоке (воркер FFmpeg не ждёт диск)
+    - Компактация (все сигнатуры → снапшот, журнал обнуляется) — там же, в фоне
+    """
+    
+    def __init__(self, data_file: str = SIGNATURES_FILE,
+                 journal_file: str = SIGNATURES_JOURNAL_FILE,
+                 compact_records: int = SIGNATURES_COMPACT_RECORDS):
+        self.data_file = data_file
+        self.journal_file = journal_file
+        self.compact_records = compact_records
+        self.signatures: Dict[str, TrapSignature] = {}
+        self.by_prefix: Dict[str, str] = {}
+        self.by_hash: Dict[str, List[str]] = {}
+        self.by_user: Dict[int, List[str]] = {}
+        self._journal_records = 0
+        self._lock = threading.Lock()
+        # Один поток — записи и компактация строго в порядке отправки
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trap-store")
+        self._pending = None
+    
+    def __len__(self) -> int:
+        return len(self.signatures)
+    
+    # ─── Индексы ───
+    
+    def _index(self, signature: TrapSignature) -> Optional[str]:
+        full_sig = signature.full_signature
+        if full_sig in self.signatures:
+            return None
+        self.signatures[full_sig] = signature
+        self.by_prefix.setdefault(full_sig[:SIGNATURE_PREFIX_LEN], full_sig)
+        self.by_hash.setdefault(signature.video_hash, []).append(full_sig)
+        self.by_user.setdefault(signature.user_id, []).append(full_sig)
+        return full_sig
+    
+    def find_by_prefix(self, fragment: str) -> Optional[TrapSignature]:
+        full_sig = self.by_prefix.get(fragment[:SIGNATURE_PREFIX_LEN])
+        if full_sig is None and len(fragment) < SIGNATURE_PREFIX_LEN:
+            # Обрезанный тег — редкий случай, линейный поиск
+            full_sig = next((s for s in self.signatures if s.startswith(fragment)), None)
+        return self.signatures.get(full_sig) if full_sig else None
+    
+    def find_by_hash(self, video_hash: str) -> Optional[TrapSignature]:
+        sigs = self.by_hash.get(video_hash)
+        return self.signatures[sigs[0]] if sigs else None
+    
+    def get_user_signatures(self, user_id: int) -> List[TrapSignature]:
+        return [self.signatures[s] for s in self.by_user.get(user_id, ())]
+    
+    # ─── Загрузка ───
+    
+    @staticmethod
+    def _from_dict(sig_data: dict) -> TrapSignature:
+        return TrapSignature(
+            user_id=sig_data["user_id"],
+            video_hash=sig_data["video_hash"],
+            timestamp=sig_data["timestamp"],
+            random_salt=sig_data["salt"],
+            master_key=TRAP_CONFIG.master_secret
+        )
+    
+    def _journal_for(self, data_file: str) -> str:
+        """ Журнал снапшота: свой — self.journal_file, чужой — рядом с ним (.journal) """
+        if data_file == self.data_file:
+            return self.journal_file
+        return os.path.splitext(data_file)[0] + ".journal"
+    
+    def _read_disk(self, data_file: str) -> Tuple[List[dict], int]:
+        records: List[dict] = []
+        if os.path.exists(data_file):
+            with open(data_file, 'r') as f:
+                records.extend(json.load(f))
+        journal_records = 0
+        journal_file = self._journal_for(data_file)
+        if os.path.exists(journal_file):
+            with open(journal_file, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # Оборванная последняя строка после падения — пропускаем
+                        print("[TRAP] Skipping broken journal line")
+                        continue
+                    journal_records += 1
+        return records, journal_records
+    
+    def load(self, data_file: str = None):
+        """ Снапшот + журнал → индексы (data_file — другая БД со своим журналом) """
+        data_file = data_file or self.data_file
+        records, journal_records = self._read_disk(data_file)
+        with self._lock:
+            for sig_data in records:
+                self._index(self._from_dict(sig_data))
+            if data_file == self.data_file:
+                self._journal_records += journal_records
+        print(f"[TRAP] Loaded {len(self.signatures)} signatures ({journal_records} from journal)")
+    
+    # ─── Запись ───
+    
+    def add(self, signature: TrapSignature):
+        """ Добавить сигнатуру: индексы сразу, строка в журнал — в фоне """
+        with self._lock:
+            if self._index(signature) is None:
+                return
+            line = json.dumps(signature.to_dict()) + "\n"
+            self._pending = self._executor.submit(self._append, line)
+            self._journal_records += 1
+            if self._journal_records >= self.compact_records:
+                self._submit_compact()
+    
+    def _append(self, line: str):
+        try:
+            with open(self.journal_file, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            print(f"[TRAP] Journal write error: {e}")
+    
+    def _compact(self, signatures: List[TrapSignature], data_file: str):
+        # Поток стора: все ранее отправленные строки журнала уже вошли в signatures
+        try:
+            tmp_file = data_file + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump([sig.to_dict() for sig in signatures], f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, data_file)
+            # Журнал обнуляем только после успешной замены снапшота;
+            # у чужого снапшота — только если журнал есть (старые строки уже в нём)
+            journal_file = self._journal_for(data_file)
+            if data_file == self.data_file or os.path.exists(journal_file):
+                open(journal_file, 'w').close()
+            print(f"[TRAP] Compacted {len(signatures)} signatures")
+        except OSError as e:
+            print(f"[TRAP] Compaction error: {e}")
+    
+    def _submit_compact(self, data_file: str = None):
+        # Под self._lock: снимок списка — O(n) указателей, to_dict — уже в фоне
+        data_file = data_file or self.data_file
+        if data_file == self.data_file:
+            self._journal_records = 0
+        self._pending = self._executor.submit(self._compact, list(self.signatures.values()), data_file)
+    
+    def compact(self, wait: bool = True, data_file: str = None):
+        """
+        Свернуть журнал в снапшот (wait=False — не ждать фоновый поток).
+        data_file — записать все сигнатуры в другой файл (экспорт), свой журнал не трогается.
+        """
+        with self._lock:
+            self._submit_compact(data_file)
+        if wait:
+            self.drain()
+    
+    def drain(self):
+        """ Дождаться фоновых записей """
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            pending.result()
+
+
 # ══════════════════════════════════════════════════════════════════════════════
 # DETECTION MODE (Режим проверки)
 # ══════════════════════════════════════════════════════════════════════════════
@@ -721,36 +904,32 @@ class WatermarkTrapDetector:
     4. Выдаёт результат
     """
     
-    def __init__(self, signatures_db: Dict[str, TrapSignature] = None):
-        self.signatures_db = signatures_db or {}
+    def __init__(self, signatures_db: Dict[str, TrapSignature] = None,
+                 store: SignatureStore = None):
+        # v3.4.0: Сигнатуры и индексы живут в SignatureStore
+        self.store = store or SignatureStore()
+        for signature in (signatures_db or {}).values():
+            self.store._index(signature)
+    
+    @property
+    def signatures_db(self) -> Dict[str, TrapSignature]:
+        return self.store.signatures
     
     def add_signature(self, signature: TrapSignature):
         """Добавить сигнатуру в БД"""
-        self.signatures_db[signature.full_signature] = signature
+        self.store.add(signature)
     
-    def load_signatures_from_file(self, filepath: str):
-        """Загрузить сигнатуры из файла"""
+    def load_signatures_from_file(self, filepath: str = None):
+        """Загрузить сигнатуры из файла (v3.4.0: снапшот + его журнал)"""
         try:
-            with open(filepath, 'r') as f:
-                data = json.load(f)
-                for sig_data in data:
-                    sig = TrapSignature(
-                        user_id=sig_data["user_id"],
-                        video_hash=sig_data["video_hash"],
-                        timestamp=sig_data["timestamp"],
-                        random_salt=sig_data["salt"],
-                        master_key=TRAP_CONFIG.master_secret
-                    )
-                    self.signatures_db[sig.full_signature] = sig
+            self.store.load(filepath)
         except Exception as e:
             print(f"[TRAP] Failed to load signatures: {e}")
     
-    def save_signatures_to_file(self, filepath: str):
-        """Сохранить сигнатуры в файл"""
+    def save_signatures_to_file(self, filepath: str = None):
+        """Сохранить сигнатуры в файл (v3.4.0: свернуть журнал в снапшот)"""
         try:
-            data = [sig.to_dict() for sig in self.signatures_db.values()]
-            with open(filepath, 'w') as f:
-                json.dump(data, f, indent=2)
+            self.store.compact(data_file=filepath)
         except Exception as e:
             print(f"[TRAP] Failed to save signatures: {e}")
     
@@ -783,28 +962,14 @@ class WatermarkTrapDetector:
     async def _check_metadata(self, video_path: str) -> DetectionResult:
         """Проверка ghost-метаданных"""
         try:
-            from config import FFPROBE_PATH
-            
-            cmd = [
-                FFPROBE_PATH,
-                "-v", "quiet",
-                "-print_format", "json",
-                "-show_format",
-                video_path
-            ]
-            
-            proc = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
-            stdout, _ = await proc.communicate()
+            from ffmpeg_utils import probe
             
-            if proc.returncode != 0:
+            # v3.4.0: Теги контейнера из общего кэша ffprobe
+            media = await probe(video_path)
+            if not media:
                 return DetectionResult(found=False, confidence=0.0)
             
-            data = json.loads(stdout.decode())
-            tags = data.get("format", {}).get("tags", {})
+            tags = media.tags
             
             # Ищем наши маркеры
             for key, value in tags.items():
@@ -812,18 +977,18 @@ class WatermarkTrapDetector:
                 if key.lower() == "comment" and value.startswith("VTrap:"):
                     sig_fragment = value[6:22]  # Первые 16 символов сигнатуры
                     
-                    # Ищем в БД
-                    for full_sig, signature in self.signatures_db.items():
-                        if full_sig.startswith(sig_fragment):
-                            return DetectionResult(
-                                found=True,
-                                confidence=0.95,
-                                user_id=signature.user_id,
-                                timestamp=signature.timestamp,
-                                signature_match=full_sig,
-                                detection_method="Ghost Metadata (comment)",
-                                details={"tag": key, "value": value}
-                            )
+                    # Ищем в БД (v3.4.0: индекс по префиксу)
+                    signature = self.store.find_by_prefix(sig_fragment)
+                    if signature is not None:
+                        return DetectionResult(
+                            found=True,
+                            confidence=0.95,
+                            user_id=signature.user_id,
+                            timestamp=signature.timestamp,
+                            signature_match=signature.full_signature,
+                            detection_method="Ghost Metadata (comment)",
+                            details={"tag": key, "value": value}
+                        )
                 
                 # Проверяем encoder с id:
                 if key.lower() == "encoder" and "id:" in value:
@@ -851,30 +1016,31 @@ class WatermarkTrapDetector:
         """Проверка по хешу файла"""
         video_hash = _calculate_file_hash(video_path)
         
-        for full_sig, signature in self.signatures_db.items():
-            if signature.video_hash == video_hash:
-                return DetectionResult(
-                    found=True,
-                    confidence=0.99,
-                    user_id=signature.user_id,
-                    timestamp=signature.timestamp,
-                    signature_match=full_sig,
-                    detection_method="Video Hash Match",
-                    details={"hash": video_hash}
-                )
+        # v3.4.0: индекс по video_hash
+        signature = self.store.find_by_hash(video_hash)
+        if signature is not None:
+            return DetectionResult(
+                found=True,
+                confidence=0.99,
+                user_id=signature.user_id,
+                timestamp=signature.timestamp,
+                signature_match=signature.full_signature,
+                detection_method="Video Hash Match",
+                details={"hash": video_hash}
+            )
         
         return DetectionResult(found=False, confidence=0.0)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
-# STORAGE: Persistent signatures database
+# SINGLETONS
 # ══════════════════════════════════════════════════════════════════════════════
 
-SIGNATURES_FILE = "watermark_signatures.json"
-
 # Глобальные инстансы
 _trap_processor: Optional[WatermarkTrapProcessor] = None
 _trap_detector: Optional[WatermarkTrapDetector] = None
+# v3.4.0: Детектор грузится фоновой фазой запуска — защищаем от двойной инициализации
+_trap_detector_lock = threading.Lock()
 
 
 def get_trap_processor() -> WatermarkTrapProcessor:
@@ -889,18 +1055,19 @@ def get_trap_detector() -> WatermarkTrapDetector:
     """Получить глобальный детектор"""
     global _trap_detector
     if _trap_detector is None:
-        _trap_detector = WatermarkTrapDetector()
-        # Загружаем сигнатуры
-        if os.path.exists(SIGNATURES_FILE):
-            _trap_detector.load_signatures_from_file(SIGNATURES_FILE)
+        with _trap_detector_lock:
+            if _trap_detector is None:
+                detector = WatermarkTrapDetector()
+                # Загружаем сигнатуры (снапшот + журнал)
+                if os.path.exists(SIGNATURES_FILE) or os.path.exists(SIGNATURES_JOURNAL_FILE):
+                    detector.load_signatures_from_file(SIGNATURES_FILE)
+                _trap_detector = detector
     return _trap_detector
 
 
 def save_signature(signature: TrapSignature):
-    """Сохранить сигнатуру в файл"""
-    detector = get_trap_detector()
-    detector.add_signature(signature)
-    detector.save_signatures_to_file(SIGNATURES_FILE)
+    """Сохранить сигнатуру (v3.4.0: индексы + строка в журнал, без перезаписи файла)"""
+    get_trap_detector().add_signature(signature)
 
 
 # ══════════════════════════════════════════════════════════════════════════════
@@ -979,6 +1146,7 @@ __all__ = [
     "WatermarkTrapProcessor",
     "WatermarkTrapDetector",
     "DetectionResult",
+    "SignatureStore",
     
     # Level classes
     "PixelDriftTrap",